@@ -211,6 +211,13 @@ class Configuration:
             config.get('server.whois.access_list'),
             config.get('server.http.access_list'),
         }
+        query_cost_limits = config.get('server.whois.max_query_cost_per_access_list', {})
+        if not hasattr(query_cost_limits, 'items') or \
+                not all(str(limit).isnumeric() for limit in query_cost_limits.values()):
+            errors.append('Setting server.whois.max_query_cost_per_access_list must be a mapping '
+                          'of access list names to numbers, if defined.')
+        else:
+            expected_access_lists.update(query_cost_limits.keys())
 
         if not self._check_is_str(config, 'email.from') or '@' not in config.get('email.from'):
             errors.append('Setting email.from is required and must be an email address.')
@@ -303,6 +310,21 @@ class Configuration:
         if unknown_default_sources:
             errors.append(f'Setting sources_default contains unknown sources: {", ".join(unknown_default_sources)}')
 
+        for setting in ['server.whois.max_connections', 'server.whois.executor_processes', 'import_parser_processes']:
+            if not str(config.get(setting, '1')).isnumeric() or not int(config.get(setting, '1')):
+                errors.append(f'Setting {setting} must be a number of at least 1, if defined.')
+        for setting in ['server.whois.query_cache_ttl', 'server.whois.executor_max_queries',
+                        'server.whois.executor_max_memory', 'server.whois.executor_timeout',
+                        'server.whois.max_connection_backlog',
+                        'server.whois.max_connections_per_client', 'server.whois.max_query_cost']:
+            if not str(config.get(setting, '0')).isnumeric():
+                errors.append(f'Setting {setting} must be a number, if defined.')
+        for setting in ['server.whois.slow_query_threshold', 'server.whois.max_query_rate_per_client']:
+            try:
+                float(config.get(setting, '0'))
+            except (TypeError, ValueError):
+                errors.append(f'Setting {setting} must be a number, if defined.')
+
         if not str(config.get('rpki.roa_import_timer', '0')).isnumeric():
             errors.append('Setting rpki.roa_import_timer must be set to a number.')
 
@@ -218,9 +218,21 @@ class TestConfiguration:
         config = {
             'irrd': {
                 'piddir': str(tmpdir + '/does-not-exist'),
+                'import_parser_processes': 0,
                 'server': {
                     'whois': {
                         'access_list': 'doesnotexist',
+                        'executor_processes': 0,
+                        'query_cache_ttl': 'foo',
+                        'executor_max_queries': -1,
+                        'executor_max_memory': 'foo',
+                        'executor_timeout': 'foo',
+                        'slow_query_threshold': 'foo',
+                        'max_connection_backlog': 'foo',
+                        'max_connections_per_client': -1,
+                        'max_query_cost': 'foo',
+                        'max_query_cost_per_access_list': {'doesnotexist': 'foo'},
+                        'max_query_rate_per_client': 'foo',
                     },
                     'http': {
                         'access_list': ['foo'],
@@ -297,6 +309,19 @@ class TestConfiguration:
         assert 'Setting authoritative for source TESTDB2 can not be enabled when either nrtm_host or import_source are set.' in str(ce.value)
         assert 'Setting authoritative for source TESTDB3 can not be enabled when either nrtm_host or import_source are set.' in str(ce.value)
         assert 'Setting nrtm_port for source TESTDB2 must be a number.' in str(ce.value)
+        assert 'Setting server.whois.executor_processes must be a number of at least 1, if defined.' in str(ce.value)
+        assert 'Setting import_parser_processes must be a number of at least 1, if defined.' in str(ce.value)
+        assert 'Setting server.whois.query_cache_ttl must be a number, if defined.' in str(ce.value)
+        assert 'Setting server.whois.executor_max_queries must be a number, if defined.' in str(ce.value)
+        assert 'Setting server.whois.executor_max_memory must be a number, if defined.' in str(ce.value)
+        assert 'Setting server.whois.executor_timeout must be a number, if defined.' in str(ce.value)
+        assert 'Setting server.whois.slow_query_threshold must be a number, if defined.' in str(ce.value)
+        assert 'Setting server.whois.max_connection_backlog must be a number, if defined.' in str(ce.value)
+        assert 'Setting server.whois.max_connections_per_client must be a number, if defined.' in str(ce.value)
+        assert 'Setting server.whois.max_query_cost must be a number, if defined.' in str(ce.value)
+        assert 'Setting server.whois.max_query_cost_per_access_list must be a mapping of access list ' \
+               'names to numbers, if defined.' in str(ce.value)
+        assert 'Setting server.whois.max_query_rate_per_client must be a number, if defined.' in str(ce.value)
         assert 'Setting rpki.roa_import_timer must be set to a number.' in str(ce.value)
         assert 'Setting rpki.notify_invalid_subject must be a string, if defined.' in str(ce.value)
         assert 'Setting rpki.notify_invalid_header must be a string, if defined.' in str(ce.value)
@@ -582,6 +582,7 @@ class TestIntegration:
                     'whois': {
                         'interface': '::1',
                         'max_connections': 10,
+                        'executor_processes': 2,
                         'port': 8043
                     },
                 },
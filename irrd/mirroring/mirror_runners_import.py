@@ -210,6 +210,8 @@ class RPSLMirrorFullImportRunner(FileImportRunnerBase):
             roa_validator = BulkRouteROAValidator(database_handler)
 
         database_handler.disable_journaling()
+        database_handler.start_rpsl_bulk_load(
+            self.source, staging_table=bool(get_setting(f'sources.{self.source}.import_staging_table')))
         for import_filename, to_delete in import_data:
             p = MirrorFileImportParser(source=self.source, filename=import_filename, serial=None,
                                        database_handler=database_handler, roa_validator=roa_validator)
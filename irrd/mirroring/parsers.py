@@ -1,6 +1,11 @@
 import logging
+import multiprocessing
 import re
-from typing import List, Set, Optional
+import time
+from collections import defaultdict, deque
+from itertools import islice
+from multiprocessing.pool import AsyncResult
+from typing import List, Set, Optional, Tuple, Iterator, Dict, Deque, TextIO, Generator
 
 from irrd.conf import get_setting
 from irrd.rpki.validators import BulkRouteROAValidator
@@ -16,6 +21,23 @@ from ..storage.queries import RPSLDatabaseQuery
 logger = logging.getLogger(__name__)
 nrtm_start_line_re = re.compile(r'^% *START *Version: *(?P<version>\d+) +(?P<source>[\w-]+) +(?P<first_serial>\d+)-(?P<last_serial>\d+)( FILTERED)?\n$', flags=re.MULTILINE)
 
+# Number of paragraphs that a parser process parses in a single task
+PARSE_CHUNK_SIZE = 500
+
+# Reasons for which a parsed object is not imported
+REJECT_PARSE_ERRORS = 'parse_errors'
+REJECT_INVALID_SOURCE = 'invalid_source'
+REJECT_IGNORED_CLASS = 'ignored_class'
+REJECT_UNKNOWN_CLASS = 'unknown_class'
+# Returned by parser processes for key-cert objects that must be parsed with
+# strict validation, as that loads the key into the GPG keyring, which is
+# only done by the importing process.
+PARSE_IN_IMPORT_PROCESS = 'parse_in_import_process'
+
+# The result of parsing a paragraph: the object if it should be imported,
+# otherwise the reason for rejecting it, and a message with details.
+ParseResult = Tuple[Optional[RPSLObject], Optional[str], str]
+
 
 class RPSLImportError(Exception):
     def __init__(self, message: str) -> None:
@@ -35,6 +57,57 @@ class MirrorParser:
         self.strict_validation_key_cert = get_setting(f'sources.{self.source}.strict_import_keycert_objects', False)
 
 
+class MirrorFileObjectParser:
+    """
+    Parser and validator for the objects in a file import of a source.
+    This has no side effects on the database or the statistics of the import,
+    and holds no database handler, so that it can be used in a parser process,
+    see MirrorFileImportParserBase._parse_paragraphs().
+
+    If in_parser_process is set, key-cert objects that require strict
+    validation are not parsed, but returned as PARSE_IN_IMPORT_PROCESS.
+    """
+    def __init__(self, source: str, object_class_filter: Optional[List[str]], strict_validation_key_cert: bool,
+                 roa_validator: Optional[BulkRouteROAValidator], scopefilter_validator: ScopeFilterValidator,
+                 in_parser_process: bool=False) -> None:
+        self.source = source
+        self.object_class_filter = object_class_filter
+        self.strict_validation_key_cert = strict_validation_key_cert
+        self.roa_validator = roa_validator
+        self.scopefilter_validator = scopefilter_validator
+        self.in_parser_process = in_parser_process
+
+    def parse_and_validate(self, rpsl_text: str) -> ParseResult:
+        """Parse and validate a single object."""
+        try:
+            # If an object turns out to be a key-cert, and strict_import_keycert_objects
+            # is set, parse it again with strict validation to load it in the GPG keychain.
+            obj = rpsl_object_from_text(rpsl_text.strip(), strict_validation=False)
+            if self.strict_validation_key_cert and obj.__class__ == RPSLKeyCert:
+                if self.in_parser_process:
+                    return None, PARSE_IN_IMPORT_PROCESS, ''
+                obj = rpsl_object_from_text(rpsl_text.strip(), strict_validation=True)
+        except UnknownRPSLObjectClassException as e:
+            return None, REJECT_UNKNOWN_CLASS, e.rpsl_object_class
+
+        if obj.messages.errors():
+            return None, REJECT_PARSE_ERRORS, str(obj.messages.errors())
+
+        if obj.source() != self.source:
+            return None, REJECT_INVALID_SOURCE, f'Invalid source {obj.source()} for object {obj.pk()}, expected {self.source}'
+
+        if self.object_class_filter and obj.rpsl_object_class.lower() not in self.object_class_filter:
+            return None, REJECT_IGNORED_CLASS, ''
+
+        if self.roa_validator and obj.rpki_relevant and obj.prefix_length and obj.asn_first:
+            obj.rpki_status = self.roa_validator.validate_route(
+                str(obj.ip_first), obj.prefix_length, obj.asn_first, obj.source()
+            )
+
+        obj.scopefilter_status, _ = self.scopefilter_validator.validate_rpsl_object(obj)
+        return obj, None, ''
+
+
 class MirrorFileImportParserBase(MirrorParser):
     """
     This parser handles imports of files for mirror databases.
@@ -64,70 +137,163 @@ class MirrorFileImportParserBase(MirrorParser):
         self.obj_ignored_class = 0  # Objects ignored due to object_class_filter setting
         self.obj_unknown = 0  # Objects with unknown classes
         self.unknown_object_classes: Set[str] = set()  # Set of encountered unknown classes
+        # Number of items and time spent in seconds per stage of the import:
+        # reading paragraphs, parsing objects and writing them to the database.
+        self.stage_items: Dict[str, int] = defaultdict(int)
+        self.stage_seconds: Dict[str, float] = defaultdict(float)
         self.scopefilter_validator = ScopeFilterValidator()
         super().__init__()
 
-    def _parse_object(self, rpsl_text: str) -> Optional[RPSLObject]:
+    def _object_parser(self, in_parser_process: bool=False) -> MirrorFileObjectParser:
+        return MirrorFileObjectParser(self.source, self.object_class_filter, self.strict_validation_key_cert,
+                                      self.roa_validator, self.scopefilter_validator, in_parser_process)
+
+    def _process_parse_result(self, rpsl_text: str, parse_result: ParseResult) -> Optional[RPSLObject]:
         """
-        Parse and validate a single object and return it.
+        Process the result of MirrorFileObjectParser.parse_and_validate() for rpsl_text, updating
+        the statistics, and return the object to import.
         If there is a parsing error, unknown object class, invalid source:
         - if direct_error_return is set, raises an RPSLImportError
         - otherwise, returns None
         """
-        try:
-            self.obj_parsed += 1
-            # If an object turns out to be a key-cert, and strict_import_keycert_objects
-            # is set, parse it again with strict validation to load it in the GPG keychain.
-            obj = rpsl_object_from_text(rpsl_text.strip(), strict_validation=False)
-            if self.strict_validation_key_cert and obj.__class__ == RPSLKeyCert:
-                obj = rpsl_object_from_text(rpsl_text.strip(), strict_validation=True)
-
-            if obj.messages.errors():
-                log_msg = f'Parsing errors: {obj.messages.errors()}, original object text follows:\n{rpsl_text}'
-                if self.direct_error_return:
-                    raise RPSLImportError(log_msg)
-                self.database_handler.record_mirror_error(self.source, log_msg)
-                logger.critical(f'Parsing errors occurred while importing from file for {self.source}. '
-                                f'This object is ignored, causing potential data inconsistencies. A new operation for '
-                                f'this update, without errors, will still be processed and cause the inconsistency to '
-                                f'be resolved. Parser error messages: {obj.messages.errors()}; '
-                                f'original object text follows:\n{rpsl_text}')
-                self.obj_errors += 1
-                return None
+        obj, reject_reason, message = parse_result
+        self.obj_parsed += 1
 
-            if obj.source() != self.source:
-                msg = f'Invalid source {obj.source()} for object {obj.pk()}, expected {self.source}'
-                if self.direct_error_return:
-                    raise RPSLImportError(msg)
-                logger.critical(msg + '. This object is ignored, causing potential data inconsistencies.')
-                self.database_handler.record_mirror_error(self.source, msg)
-                self.obj_errors += 1
-                return None
-
-            if self.object_class_filter and obj.rpsl_object_class.lower() not in self.object_class_filter:
-                self.obj_ignored_class += 1
-                return None
-
-            if self.roa_validator and obj.rpki_relevant and obj.prefix_length and obj.asn_first:
-                obj.rpki_status = self.roa_validator.validate_route(
-                    str(obj.ip_first), obj.prefix_length, obj.asn_first, obj.source()
-                )
-
-            obj.scopefilter_status, _ = self.scopefilter_validator.validate_rpsl_object(obj)
+        if reject_reason == REJECT_PARSE_ERRORS:
+            log_msg = f'Parsing errors: {message}, original object text follows:\n{rpsl_text}'
+            if self.direct_error_return:
+                raise RPSLImportError(log_msg)
+            self.database_handler.record_mirror_error(self.source, log_msg)
+            logger.critical(f'Parsing errors occurred while importing from file for {self.source}. '
+                            f'This object is ignored, causing potential data inconsistencies. A new operation for '
+                            f'this update, without errors, will still be processed and cause the inconsistency to '
+                            f'be resolved. Parser error messages: {message}; '
+                            f'original object text follows:\n{rpsl_text}')
+            self.obj_errors += 1
+
+        elif reject_reason == REJECT_INVALID_SOURCE:
+            if self.direct_error_return:
+                raise RPSLImportError(message)
+            logger.critical(message + '. This object is ignored, causing potential data inconsistencies.')
+            self.database_handler.record_mirror_error(self.source, message)
+            self.obj_errors += 1
 
-            return obj
+        elif reject_reason == REJECT_IGNORED_CLASS:
+            self.obj_ignored_class += 1
 
-        except UnknownRPSLObjectClassException as e:
+        elif reject_reason == REJECT_UNKNOWN_CLASS:
             # Ignore legacy IRRd artifacts
             # https://github.com/irrdnet/irrd4/issues/232
-            if e.rpsl_object_class.startswith('*xx'):
+            if message.startswith('*xx'):
                 self.obj_parsed -= 1  # This object does not exist to us
                 return None
             if self.direct_error_return:
-                raise RPSLImportError(f'Unknown object class: {e.rpsl_object_class}')
+                raise RPSLImportError(f'Unknown object class: {message}')
             self.obj_unknown += 1
-            self.unknown_object_classes.add(e.rpsl_object_class)
-        return None
+            self.unknown_object_classes.add(message)
+
+        return obj
+
+    def _parse_paragraphs(self, f: TextIO) -> Generator[Tuple[str, ParseResult], None, None]:
+        """
+        Split a file into paragraphs, and parse and validate each of them.
+        Yields each paragraph with its parse result, in the order of the file,
+        so that later versions of an object in the file replace earlier ones.
+
+        If import_parser_processes is larger than 1, paragraphs are parsed in
+        a pool of parser processes, in chunks of PARSE_CHUNK_SIZE paragraphs,
+        while this process reads the file and writes the results to the database.
+        The number of chunks in progress is limited, so that the file is not
+        read into memory faster than it can be parsed.
+        """
+        paragraphs = self._timed_stage('read', split_paragraphs_rpsl(f))
+        processes = int(get_setting('import_parser_processes'))
+        object_parser = self._object_parser()
+        if processes <= 1:
+            for paragraph in paragraphs:
+                start = time.perf_counter()
+                parse_result = object_parser.parse_and_validate(paragraph)
+                self.stage_seconds['parse'] += time.perf_counter() - start
+                self.stage_items['parse'] += 1
+                yield paragraph, parse_result
+            return
+
+        pending: Deque[Tuple[List[str], AsyncResult]] = deque()
+        # Parser processes are forked, and are given an object parser,
+        # including the ROA validator, without serialising it. They do not
+        # use this parser or its database handler, and leave key-certs that
+        # are loaded into the GPG keyring to this process.
+        process_object_parser = self._object_parser(in_parser_process=True)
+        context = multiprocessing.get_context('fork')
+        with context.Pool(processes, _init_parser_process, (process_object_parser, )) as pool:
+            for chunk in iter(lambda: list(islice(paragraphs, PARSE_CHUNK_SIZE)), []):
+                pending.append((chunk, pool.apply_async(_parse_chunk, (chunk, ))))
+                if len(pending) >= processes * 2:
+                    yield from self._chunk_results(object_parser, *pending.popleft())
+            while pending:
+                yield from self._chunk_results(object_parser, *pending.popleft())
+
+    def _chunk_results(self, object_parser: MirrorFileObjectParser, chunk: List[str],
+                       async_result: AsyncResult) -> Iterator[Tuple[str, ParseResult]]:
+        """
+        Generate the paragraphs of a chunk with their parse results from a parser
+        process. Paragraphs returned as PARSE_IN_IMPORT_PROCESS are parsed here.
+        """
+        parse_results, seconds = async_result.get()
+        self.stage_seconds['parse'] += seconds
+        self.stage_items['parse'] += len(chunk)
+        for paragraph, parse_result in zip(chunk, parse_results):
+            if parse_result[1] == PARSE_IN_IMPORT_PROCESS:
+                start = time.perf_counter()
+                parse_result = object_parser.parse_and_validate(paragraph)
+                self.stage_seconds['parse'] += time.perf_counter() - start
+            yield paragraph, parse_result
+
+    def _timed_stage(self, stage: str, iterator: Iterator[str]) -> Iterator[str]:
+        """Wrap an iterator to record its items and time spent in stage."""
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.stage_seconds[stage] += time.perf_counter() - start
+            self.stage_items[stage] += 1
+            yield item
+
+    def _write_object(self, rpsl_obj: RPSLObject, origin: JournalEntryOrigin) -> None:
+        start = time.perf_counter()
+        self.database_handler.upsert_rpsl_object(rpsl_obj, origin=origin)
+        self.stage_seconds['write'] += time.perf_counter() - start
+        self.stage_items['write'] += 1
+
+    def _log_stages(self) -> None:
+        stages = ', '.join([
+            f'{stage} {self.stage_items[stage]} in {self.stage_seconds[stage]:.1f}s'
+            for stage in ['read', 'parse', 'write']
+        ])
+        logger.info(f'File import stages for {self.source}: {stages}, source {self.filename}')
+
+
+# The object parser used by a parser process, inherited from the importing process
+_process_parser: Optional[MirrorFileObjectParser] = None
+
+
+def _init_parser_process(object_parser: MirrorFileObjectParser) -> None:
+    global _process_parser
+    _process_parser = object_parser
+
+
+def _parse_chunk(paragraphs: List[str]) -> Tuple[List[ParseResult], float]:
+    """
+    Parse and validate a chunk of paragraphs in a parser process.
+    Returns the parse results, and the time spent on them in seconds.
+    """
+    assert _process_parser
+    start = time.perf_counter()
+    parse_results = [_process_parser.parse_and_validate(paragraph) for paragraph in paragraphs]
+    return parse_results, time.perf_counter() - start
 
 
 class MirrorFileImportParser(MirrorFileImportParserBase):
@@ -151,19 +317,23 @@ class MirrorFileImportParser(MirrorFileImportParserBase):
         string on encountering the first error. Otherwise, returns None.
         """
         f = open(self.filename, encoding='utf-8', errors='backslashreplace')
-        for paragraph in split_paragraphs_rpsl(f):
-            try:
-                rpsl_obj = self._parse_object(paragraph)
-            except RPSLImportError as e:
-                if self.direct_error_return:
-                    return e.message
-            else:
-                if rpsl_obj:
-                    self.database_handler.upsert_rpsl_object(
-                        rpsl_obj, origin=JournalEntryOrigin.mirror)
+        parse_results = self._parse_paragraphs(f)
+        try:
+            for paragraph, parse_result in parse_results:
+                try:
+                    rpsl_obj = self._process_parse_result(paragraph, parse_result)
+                except RPSLImportError as e:
+                    if self.direct_error_return:
+                        return e.message
+                else:
+                    if rpsl_obj:
+                        self._write_object(rpsl_obj, JournalEntryOrigin.mirror)
+        finally:
+            parse_results.close()
+            f.close()
 
         self.log_report()
-        f.close()
+        self._log_stages()
         if self.serial:
             self.database_handler.record_serial_seen(self.source, self.serial)
 
@@ -210,16 +380,20 @@ class MirrorUpdateFileImportParser(MirrorFileImportParserBase):
         """
         objs_from_file = []
         f = open(self.filename, encoding='utf-8', errors='backslashreplace')
-        for paragraph in split_paragraphs_rpsl(f):
-            try:
-                rpsl_obj = self._parse_object(paragraph)
-            except RPSLImportError as e:
-                if self.direct_error_return:
-                    return e.message
-            else:
-                if rpsl_obj:
-                    objs_from_file.append(rpsl_obj)
-        f.close()
+        parse_results = self._parse_paragraphs(f)
+        try:
+            for paragraph, parse_result in parse_results:
+                try:
+                    rpsl_obj = self._process_parse_result(paragraph, parse_result)
+                except RPSLImportError as e:
+                    if self.direct_error_return:
+                        return e.message
+                else:
+                    if rpsl_obj:
+                        objs_from_file.append(rpsl_obj)
+        finally:
+            parse_results.close()
+            f.close()
 
         query = RPSLDatabaseQuery(ordered_by_sources=False, enable_ordering=False,
                                   column_names=['rpsl_pk']).sources([self.source])
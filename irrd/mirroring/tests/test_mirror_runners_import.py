@@ -159,6 +159,7 @@ class TestRPSLMirrorFullImportRunner:
         assert flatten_mock_calls(mock_dh) == [
             ['delete_all_rpsl_objects_with_journal', ('TEST',), {}],
             ['disable_journaling', (), {}],
+            ['start_rpsl_bulk_load', ('TEST',), {'staging_table': False}],
             ['record_serial_newest_mirror', ('TEST', 424242), {}],
         ]
         assert mock_bulk_validator_init.mock_calls[0][1][0] == mock_dh
@@ -181,6 +182,7 @@ class TestRPSLMirrorFullImportRunner:
                 'TEST': {
                     'import_source': ['file://' + str(tmp_import_source1), 'file://' + str(tmp_import_source2)],
                     'import_serial_source': 'file://' + str(tmp_import_serial),
+                    'import_staging_table': True,
                 }
             }
         })
@@ -195,6 +197,7 @@ class TestRPSLMirrorFullImportRunner:
         assert flatten_mock_calls(mock_dh) == [
             ['delete_all_rpsl_objects_with_journal', ('TEST',), {}],
             ['disable_journaling', (), {}],
+            ['start_rpsl_bulk_load', ('TEST',), {'staging_table': True}],
             ['record_serial_newest_mirror', ('TEST', 424242), {}],
         ]
 
@@ -226,6 +229,7 @@ class TestRPSLMirrorFullImportRunner:
         assert flatten_mock_calls(mock_dh) == [
             ['delete_all_rpsl_objects_with_journal', ('TEST',), {}],
             ['disable_journaling', (), {}],
+            ['start_rpsl_bulk_load', ('TEST',), {'staging_table': False}],
         ]
 
     def test_import_cancelled_serial_too_old(self, monkeypatch, config_override, caplog):
@@ -287,6 +291,7 @@ class TestRPSLMirrorFullImportRunner:
         assert flatten_mock_calls(mock_dh) == [
             ['delete_all_rpsl_objects_with_journal', ('TEST',), {}],
             ['disable_journaling', (), {}],
+            ['start_rpsl_bulk_load', ('TEST',), {'staging_table': False}],
             ['record_serial_newest_mirror', ('TEST', 424242), {}],
         ]
 
@@ -18,7 +18,8 @@ from .nrtm_samples import (SAMPLE_NRTM_V3, SAMPLE_NRTM_V1, SAMPLE_NRTM_V1_TOO_MA
                            SAMPLE_NRTM_INVALID_VERSION,
                            SAMPLE_NRTM_V3_SERIAL_GAP, SAMPLE_NRTM_V3_INVALID_MULTIPLE_START_LINES,
                            SAMPLE_NRTM_INVALID_NO_START_LINE, SAMPLE_NRTM_V3_SERIAL_OUT_OF_ORDER)
-from ..parsers import NRTMStreamParser, MirrorFileImportParser, MirrorUpdateFileImportParser
+from ..parsers import (NRTMStreamParser, MirrorFileImportParser, MirrorUpdateFileImportParser,
+                       MirrorFileObjectParser, PARSE_IN_IMPORT_PROCESS)
 
 
 @pytest.fixture
@@ -32,8 +33,11 @@ def mock_scopefilter(monkeypatch):
 
 class TestMirrorFileImportParser:
     # This test also covers the common parts of MirrorFileImportParserBase
-    def test_parse(self, mock_scopefilter, caplog, tmp_gpg_dir, config_override):
+    @pytest.mark.parametrize('import_parser_processes', [1, 2])
+    def test_parse(self, mock_scopefilter, caplog, tmp_gpg_dir, config_override, monkeypatch,
+                   import_parser_processes):
         config_override({
+            'import_parser_processes': import_parser_processes,
             'sources': {
                 'TEST': {
                     'object_class_filter': ['route', 'key-cert'],
@@ -41,6 +45,8 @@ class TestMirrorFileImportParser:
                 }
             }
         })
+        # Parse in multiple chunks, to ensure the order of the file is retained
+        monkeypatch.setattr('irrd.mirroring.parsers.PARSE_CHUNK_SIZE', 2)
         mock_dh = Mock()
         mock_roa_validator = Mock(spec=BulkRouteROAValidator)
         mock_roa_validator.validate_route = lambda ip, length, asn, source: RPKIStatus.invalid
@@ -85,10 +91,25 @@ class TestMirrorFileImportParser:
         assert 'File import for TEST: 6 objects read, 2 objects inserted, ignored 2 due to errors' in caplog.text
         assert 'ignored 1 due to object_class_filter' in caplog.text
         assert 'Ignored 1 objects found in file import for TEST due to unknown object classes' in caplog.text
+        assert 'File import stages for TEST: read 7 in ' in caplog.text
+        assert parser.stage_items == {'read': 7, 'parse': 7, 'write': 2}
 
         key_cert_obj = rpsl_object_from_text(SAMPLE_KEY_CERT, strict_validation=False)
         assert key_cert_obj.verify(KEY_CERT_SIGNED_MESSAGE_VALID)
 
+    def test_object_parser_in_parser_process(self, mock_scopefilter, tmp_gpg_dir):
+        # Key-certs loaded into the GPG keyring are left to the importing process
+        object_parser = MirrorFileObjectParser('TEST', None, True, None, mock_scopefilter, in_parser_process=True)
+        assert object_parser.parse_and_validate(SAMPLE_KEY_CERT) == (None, PARSE_IN_IMPORT_PROCESS, '')
+        obj, reject_reason, message = object_parser.parse_and_validate(SAMPLE_ROUTE)
+        assert obj.pk() == '192.0.2.0/24AS65537'
+        assert reject_reason is None
+
+        object_parser = MirrorFileObjectParser('TEST', None, False, None, mock_scopefilter, in_parser_process=True)
+        obj, reject_reason, message = object_parser.parse_and_validate(SAMPLE_KEY_CERT)
+        assert obj.pk() == 'PGPKEY-80F238C6'
+        assert reject_reason is None
+
     def test_direct_error_return_invalid_source(self, mock_scopefilter, caplog, tmp_gpg_dir, config_override):
         config_override({
             'sources': {
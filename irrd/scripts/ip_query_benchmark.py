@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# flake8: noqa: E402
+"""
+Benchmark for less and more specific prefix searches, comparing the
+GiST index on the IP range of RPSL objects, used by RPSLDatabaseQuery,
+with the b-tree indexes on ip_first and ip_last.
+"""
+import argparse
+import sys
+import time
+
+from pathlib import Path
+from typing import List
+
+import sqlalchemy as sa
+from IPy import IP
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+
+from irrd.conf import CONFIG_PATH_DEFAULT, config_init
+from irrd.storage.database_handler import DatabaseHandler
+from irrd.storage.models import RPSLDatabaseObject
+from irrd.storage.queries import RPSLDatabaseQuery
+
+MATCH_TYPES = ['less', 'less-one', 'more']
+
+
+class BTreeRPSLDatabaseQuery(RPSLDatabaseQuery):
+    """
+    RPSLDatabaseQuery with the filters on ip_first and ip_last used before
+    the GiST index on the IP range was added.
+    """
+    def _ip_less_specific_filter(self, first: str, last: str):
+        return sa.and_(
+            self.columns.ip_first <= self._bindparam(first),
+            self.columns.ip_last >= self._bindparam(last),
+        )
+
+    def _ip_more_specific_filter(self, first: str, last: str):
+        return sa.and_(
+            self.columns.ip_first >= self._bindparam(first),
+            self.columns.ip_first <= self._bindparam(last),
+            self.columns.ip_last <= self._bindparam(last),
+            self.columns.ip_last >= self._bindparam(first),
+        )
+
+
+def sample_prefixes(database_handler: DatabaseHandler, count: int) -> List[IP]:
+    table = RPSLDatabaseObject.__table__
+    stmt = sa.select([table.c.ip_first, table.c.prefix_length]).where(
+        table.c.object_class.in_(['route', 'route6'])
+    ).order_by(sa.func.random()).limit(count)
+    return [IP(f"{row['ip_first']}/{row['prefix_length']}") for row in database_handler.execute_statement(stmt)]
+
+
+def run_queries(database_handler: DatabaseHandler, query_class, match_type: str, prefixes: List[IP]):
+    results = 0
+    start_time = time.perf_counter()
+    for prefix in prefixes:
+        query = query_class(column_names=['pk'])
+        if match_type == 'less':
+            query = query.ip_less_specific(prefix)
+        elif match_type == 'less-one':
+            query = query.ip_less_specific_one_level(prefix)
+        else:
+            query = query.ip_more_specific(prefix)
+        results += len(list(database_handler.execute_query(query)))
+    return time.perf_counter() - start_time, results
+
+
+def main(count: int, prefixes: List[IP]):  # pragma: no cover
+    database_handler = DatabaseHandler(readonly=True)
+    if not prefixes:
+        prefixes = sample_prefixes(database_handler, count)
+    print(f'Running {len(prefixes)} queries per match type and index')
+
+    for match_type in MATCH_TYPES:
+        timings = {}
+        for name, query_class in [('b-tree', BTreeRPSLDatabaseQuery), ('GiST range', RPSLDatabaseQuery)]:
+            elapsed, results = run_queries(database_handler, query_class, match_type, prefixes)
+            timings[name] = elapsed, results
+            time_per_query = elapsed / len(prefixes) * 1000
+            print(f'{match_type:>8} {name:>10}: {elapsed:.3f}s, {time_per_query:.3f} ms per query, {results} results')
+        if timings['b-tree'][1] != timings['GiST range'][1]:
+            print(f'WARNING: {match_type} queries returned a different number of results for both indexes')
+    database_handler.close()
+
+
+if __name__ == '__main__':  # pragma: no cover
+    description = """Benchmark less and more specific prefix searches using the GiST index on
+                     the IP range of RPSL objects, and the b-tree indexes on ip_first and ip_last."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--config', dest='config_file_path', type=str,
+                        help=f'use a different IRRd config file (default: {CONFIG_PATH_DEFAULT})')
+    parser.add_argument('--count', dest='count', type=int, default=1000,
+                        help='number of route(6) prefixes to sample from the database, if no prefixes '
+                             'are given (default: 1000)')
+    parser.add_argument('prefixes', type=str, nargs='*',
+                        help='prefixes to query')
+    args = parser.parse_args()
+
+    config_init(args.config_file_path)
+    main(args.count, [IP(prefix) for prefix in args.prefixes])
@@ -33,6 +33,7 @@ def load(source, filename, serial) -> int:
     roa_validator = BulkRouteROAValidator(dh)
     dh.delete_all_rpsl_objects_with_journal(source)
     dh.disable_journaling()
+    dh.start_rpsl_bulk_load(source, staging_table=bool(get_setting(f'sources.{source}.import_staging_table')))
     parser = MirrorFileImportParser(
         source=source, filename=filename, serial=serial, database_handler=dh,
         direct_error_return=True, roa_validator=roa_validator)
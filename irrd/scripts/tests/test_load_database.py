@@ -18,6 +18,7 @@ def test_load_database_success(capsys, monkeypatch):
     assert flatten_mock_calls(mock_dh) == [
         ['delete_all_rpsl_objects_with_journal', ('TEST',), {}],
         ['disable_journaling', (), {}],
+        ['start_rpsl_bulk_load', ('TEST',), {'staging_table': False}],
         ['commit', (), {}],
         ['close', (), {}]
     ]
@@ -41,6 +42,7 @@ def test_load_database_import_error(capsys, monkeypatch, caplog):
     assert flatten_mock_calls(mock_dh) == [
         ['delete_all_rpsl_objects_with_journal', ('TEST',), {}],
         ['disable_journaling', (), {}],
+        ['start_rpsl_bulk_load', ('TEST',), {'staging_table': False}],
         ['rollback', (), {}],
         ['close', (), {}]
     ]
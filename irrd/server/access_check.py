@@ -15,18 +15,12 @@ def is_client_permitted(ip: str, access_list_setting: str, default_deny=True) ->
     IPv6-mapped IPv4 addresses are unmapped to regular IPv4 addresses before processing.
     """
     try:
-        client_ip = IP(ip)
+        client_ip = _parse_client_ip(ip)
     except (ValueError, AttributeError) as e:
         logger.error(f'Rejecting request as client IP could not be read from '
                      f'{ip}: {e}')
         return False
 
-    if client_ip.version() == 6:
-        try:
-            client_ip = client_ip.v46map()
-        except ValueError:
-            pass
-
     access_list_name = get_setting(access_list_setting)
     access_list = get_setting(f'access_lists.{access_list_name}')
 
@@ -41,3 +35,28 @@ def is_client_permitted(ip: str, access_list_setting: str, default_deny=True) ->
     if not allowed:
         logger.info(f'Rejecting request, IP not in access list {access_list_name}: {client_ip}')
     return allowed
+
+
+def is_client_in_access_list(ip: str, access_list_name: str) -> bool:
+    """
+    Determine whether a client is included in the access list access_list_name.
+    Unlike is_client_permitted(), this does not log anything, as it is used
+    to select settings for a client, rather than to permit access.
+    """
+    try:
+        client_ip = _parse_client_ip(ip)
+    except (ValueError, AttributeError):
+        return False
+    access_list = get_setting(f'access_lists.{access_list_name}')
+    return any([client_ip in IP(allowed) for allowed in access_list or []])
+
+
+def _parse_client_ip(ip: str) -> IP:
+    """Parse a client IP, unmapping IPv6-mapped IPv4 addresses."""
+    client_ip = IP(ip)
+    if client_ip.version() == 6:
+        try:
+            client_ip = client_ip.v46map()
+        except ValueError:
+            pass
+    return client_ip
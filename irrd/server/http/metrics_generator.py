@@ -0,0 +1,240 @@
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple, Union
+
+import redis
+
+from irrd.conf import get_setting
+from irrd.server.whois.admission_control import REJECT_BACKLOG_FULL, REJECT_CLIENT_LIMIT
+from irrd.server.whois.query_metrics import (REDIS_WHOIS_QUERY_METRICS_KEY, LATENCY_BUCKETS,
+                                             RESPONSE_SIZE_BUCKETS)
+from irrd.storage.preload import REDIS_PRELOAD_METRICS_KEY, REDIS_PRELOAD_STORE_SIZE_KEY
+
+"""
+Metrics on the preload store and whois queries, in the Prometheus text
+exposition format. The metrics are recorded in redis by the preload store
+manager, by each process that commits changes relevant to the preload store,
+and by the whois query executors.
+"""
+
+
+class MetricsGenerator:
+
+    def generate_metrics(self) -> str:
+        """
+        Generate the current metrics in Prometheus text format.
+        """
+        redis_conn = redis.Redis.from_url(get_setting('redis_url'))
+        metrics = {
+            key.decode('utf-8'): float(value)
+            for key, value in redis_conn.hgetall(REDIS_PRELOAD_METRICS_KEY).items()
+        }
+        store_size = {
+            key.decode('utf-8'): int(value)
+            for key, value in redis_conn.hgetall(REDIS_PRELOAD_STORE_SIZE_KEY).items()
+        }
+        query_metrics = {
+            key.decode('utf-8'): float(value)
+            for key, value in redis_conn.hgetall(REDIS_WHOIS_QUERY_METRICS_KEY).items()
+        }
+
+        self._lines: List[str] = []
+        update_types = ['full', 'incremental']
+        self._add_metric(
+            'irrd_preload_updates_total', 'counter',
+            'Number of completed updates of the preload store, by type.',
+            [({'type': t}, metrics.get(f'updates_{t}', 0)) for t in update_types],
+        )
+        self._add_metric(
+            'irrd_preload_update_duration_seconds_total', 'counter',
+            'Total time spent on completed updates of the preload store, by type.',
+            [({'type': t}, metrics.get(f'duration_total_{t}', 0)) for t in update_types],
+        )
+        self._add_metric(
+            'irrd_preload_last_update_duration_seconds', 'gauge',
+            'Duration of the most recent completed update of the preload store, by type.',
+            [({'type': t}, metrics[f'duration_last_{t}']) for t in update_types if f'duration_last_{t}' in metrics],
+        )
+        self._add_metric(
+            'irrd_preload_coalesced_reloads_total', 'counter',
+            'Number of reload requests merged into an already scheduled update.',
+            [({}, metrics.get('coalesced_reloads', 0))],
+        )
+        self._add_optional_metric(
+            'irrd_preload_generation', 'gauge',
+            'Generation of the current preload snapshot.',
+            metrics.get('generation'),
+        )
+        self._add_optional_metric(
+            'irrd_preload_snapshot_timestamp_seconds', 'gauge',
+            'Time at which the current preload snapshot was published.',
+            metrics.get('snapshot_timestamp'),
+        )
+        self._add_optional_metric(
+            'irrd_preload_last_snapshot_duration_seconds', 'gauge',
+            'Time taken to write the current preload snapshot.',
+            metrics.get('snapshot_duration_last'),
+        )
+        self._add_optional_metric(
+            'irrd_preload_snapshot_delta_entries', 'gauge',
+            'Number of entries in the current delta snapshot, or 0 if there is none.',
+            metrics.get('snapshot_delta_entries'),
+        )
+        self._add_optional_metric(
+            'irrd_preload_last_commit_delay_seconds', 'gauge',
+            'Time between the oldest commit included in the current snapshot, and its publication.',
+            metrics.get('commit_delay_last'),
+        )
+        self._add_metric(
+            'irrd_preload_staleness_seconds', 'gauge',
+            'Time since the oldest commit that is not yet included in the current snapshot, or 0.',
+            [({}, self._staleness(metrics))],
+        )
+
+        for size_type, help_text in [('origins', 'Number of origins'), ('prefixes', 'Number of prefixes')]:
+            self._add_metric(
+                f'irrd_preload_store_{size_type}', 'gauge',
+                f'{help_text} in the preload store, by source and IP version.',
+                [
+                    ({'source': source, 'ip_version': ip_version}, value)
+                    for (ip_version, source), value in self._split_store_size(store_size, size_type)
+                ],
+            )
+        self._add_optional_metric(
+            'irrd_preload_store_sets', 'gauge',
+            'Number of as-set and route-set names in the preload store.',
+            metrics.get('sets'),
+        )
+
+        command_types = sorted({
+            key.split(':', 1)[1] for key in query_metrics.keys() if key.startswith('latency_sum:')
+        })
+        self._add_histogram(
+            'irrd_whois_query_duration_seconds',
+            'Time taken to execute whois queries, by command type.',
+            query_metrics, 'latency', LATENCY_BUCKETS, command_types,
+        )
+        self._add_histogram(
+            'irrd_whois_response_size_bytes',
+            'Size of responses to whois queries, by command type.',
+            query_metrics, 'size', RESPONSE_SIZE_BUCKETS, command_types,
+        )
+        self._add_metric(
+            'irrd_whois_slow_queries_total', 'counter',
+            'Number of whois queries that exceeded the slow query threshold, by command type.',
+            [({'command': c}, query_metrics.get(f'slow_queries:{c}', 0)) for c in command_types],
+        )
+        self._add_metric(
+            'irrd_whois_statement_cache_hits_total', 'counter',
+            'Number of whois database queries executed with a cached compiled statement.',
+            [({}, query_metrics.get('statement_cache_hits', 0))],
+        )
+        self._add_metric(
+            'irrd_whois_statement_cache_misses_total', 'counter',
+            'Number of whois database queries for which a statement was built and compiled.',
+            [({}, query_metrics.get('statement_cache_misses', 0))],
+        )
+        self._add_optional_metric(
+            'irrd_whois_connections_active', 'gauge',
+            'Number of whois connections currently being served.',
+            query_metrics.get('connections_active'),
+        )
+        self._add_optional_metric(
+            'irrd_whois_connections_waiting', 'gauge',
+            'Number of whois connections waiting in the backlog for a free connection slot.',
+            query_metrics.get('connections_waiting'),
+        )
+        self._add_metric(
+            'irrd_whois_connections_rejected_total', 'counter',
+            'Number of whois connections rejected by admission control, by reason.',
+            [
+                ({'reason': reason}, query_metrics.get(f'connections_rejected:{reason}', 0))
+                for reason in [REJECT_BACKLOG_FULL, REJECT_CLIENT_LIMIT]
+            ],
+        )
+        self._add_metric(
+            'irrd_whois_rate_limited_query_batches_total', 'counter',
+            'Number of batches of whois queries delayed by the rate limit per client.',
+            [({}, query_metrics.get('rate_limited_batches', 0))],
+        )
+        self._add_metric(
+            'irrd_whois_rate_limit_delay_seconds_total', 'counter',
+            'Total time for which whois queries were delayed by the rate limit per client.',
+            [({}, query_metrics.get('rate_limit_delay', 0))],
+        )
+        self._add_optional_metric(
+            'irrd_whois_executor_tasks_pending', 'gauge',
+            'Number of batches of whois queries waiting for, or being executed by, a query executor.',
+            query_metrics.get('executor_tasks_pending'),
+        )
+        self._add_optional_metric(
+            'irrd_whois_executors_busy', 'gauge',
+            'Number of whois query executors currently executing queries.',
+            query_metrics.get('executors_busy'),
+        )
+        return '\n'.join(self._lines) + '\n'
+
+    def _staleness(self, metrics: Dict[str, float]) -> float:
+        """
+        Determine the staleness of the preload store, from the oldest commit
+        that is not yet picked up, or is included in an update in progress.
+        """
+        commit_timestamps = [
+            metrics[key] for key in ['pending_commit_timestamp', 'claimed_commit_timestamp']
+            if key in metrics
+        ]
+        if not commit_timestamps:
+            return 0
+        return max(0.0, time.time() - min(commit_timestamps))
+
+    def _split_store_size(self, store_size: Dict[str, int], size_type: str) -> List[Tuple[Tuple[str, str], int]]:
+        """
+        Extract the sizes of size_type, e.g. origins, from the store size hash,
+        sorted by IP version and source.
+        """
+        sizes: Dict[Tuple[str, str], int] = defaultdict(int)
+        for key, value in store_size.items():
+            key_type, ip_version, source = key.split(':', 2)
+            if key_type == size_type:
+                sizes[(ip_version, source)] += value
+        return sorted(sizes.items())
+
+    def _add_histogram(self, name: str, help_text: str, query_metrics: Dict[str, float], metric_prefix: str,
+                       buckets: List[Union[int, float]], command_types: List[str]) -> None:
+        """
+        Add a histogram per command type, from the bucket counts recorded in
+        query_metrics. These are recorded per bucket, and made cumulative here.
+        """
+        self._lines.append(f'# HELP {name} {help_text}')
+        self._lines.append(f'# TYPE {name} histogram')
+        for command_type in command_types:
+            count = 0.0
+            for bound in [str(bound) for bound in buckets] + ['+Inf']:
+                count += query_metrics.get(f'{metric_prefix}_bucket:{command_type}:{bound}', 0)
+                labels = self._format_labels({'command': command_type, 'le': bound})
+                self._lines.append(f'{name}_bucket{labels} {self._format_value(count)}')
+            labels = self._format_labels({'command': command_type})
+            metric_sum = query_metrics.get(f'{metric_prefix}_sum:{command_type}', 0)
+            self._lines.append(f'{name}_sum{labels} {self._format_value(metric_sum)}')
+            self._lines.append(f'{name}_count{labels} {self._format_value(count)}')
+
+    def _add_optional_metric(self, name: str, metric_type: str, help_text: str, value: Optional[float]) -> None:
+        self._add_metric(name, metric_type, help_text, [({}, value)] if value is not None else [])
+
+    def _add_metric(self, name: str, metric_type: str, help_text: str,
+                    samples: List[Tuple[Dict[str, str], float]]) -> None:
+        self._lines.append(f'# HELP {name} {help_text}')
+        self._lines.append(f'# TYPE {name} {metric_type}')
+        for labels, value in samples:
+            self._lines.append(f'{name}{self._format_labels(labels)} {self._format_value(value)}')
+
+    def _format_labels(self, labels: Dict[str, str]) -> str:
+        label_str = ','.join(f'{label}="{label_value}"' for label, label_value in labels.items())
+        if label_str:
+            label_str = '{' + label_str + '}'
+        return label_str
+
+    def _format_value(self, value: float) -> str:
+        if float(value).is_integer():
+            return str(int(value))
+        return repr(float(value))
@@ -0,0 +1,241 @@
+import gzip
+import hashlib
+import logging
+import threading
+from http import HTTPStatus
+from typing import Dict, List, Optional, Tuple, Any, Mapping
+from urllib.parse import parse_qs, unquote
+
+import ujson
+
+from irrd.server.whois.query_parser import WhoisQueryParser, WhoisQueryParserException
+from irrd.server.whois.query_response import WhoisQueryResponseType
+from irrd.storage import DATABASE_POOL_MAX_OVERFLOW
+from irrd.storage.change_serials import SourceChangeSerials
+from irrd.storage.database_handler import DatabaseHandler
+from irrd.storage.preload import Preloader
+
+logger = logging.getLogger(__name__)
+
+QUERY_API_PATH_PREFIX = '/v1/query/'
+# Responses larger than this are compressed for clients that accept gzip, in bytes
+GZIP_MIN_RESPONSE_SIZE = 1024
+
+# Maximum number of requests executed at the same time, each with its own
+# database connection. Requests are handled in a thread per connection, so this
+# keeps the connections within the database pool of the HTTP server process,
+# with the connections in the pool itself left for the status page.
+MAX_CONCURRENT_REQUESTS = DATABASE_POOL_MAX_OVERFLOW
+# Time to wait for one of those requests to finish, in seconds
+REQUEST_SLOT_TIMEOUT = 10
+
+AGGREGATION_FLAGS = {'prefixes': ',A', 'ranges': ',R'}
+ROUTE_SEARCH_OPTIONS = {'exact': '', 'less-one': ',l', 'less': ',L', 'more': ',M'}
+
+
+class HTTPResponse:
+    """A response to an HTTP request, with the headers to add to it."""
+    def __init__(self, status: HTTPStatus, content: bytes=b'',
+                 headers: Optional[Dict[str, str]]=None) -> None:
+        self.status = status
+        self.content = content
+        self.headers = headers if headers else {}
+
+
+class QueryAPIException(ValueError):
+    """
+    Raised for invalid requests to the query API, with the status
+    and message to return to the client.
+    """
+    def __init__(self, message: str, status: HTTPStatus=HTTPStatus.BAD_REQUEST) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class QueryAPI:
+    """
+    JSON API for the most common whois lookups. Every request is translated
+    into one or more IRRD-style whois queries, executed by a WhoisQueryParser,
+    so that the results are identical to those of the whois interface.
+
+    Endpoints, relative to QUERY_API_PATH_PREFIX:
+    - origin-prefixes/<origin>: prefixes originated by an AS, like !g and !6
+    - set-prefixes/<set>: prefixes originated by members of an as-set, like !a
+    - set-members/<set>: members of an as-set or route-set, like !i
+    - prefix-origins/<prefix>: origins of routes for a prefix, like !r<prefix>,o
+    - route-search/<prefix>: route(6) objects for a prefix, like !r
+    - object/<class>/<key>: an object by its class and key, like !m
+
+    The sources can be restricted with the sources parameter, e.g.
+    ?sources=RIPE,NTTCOM. Responses carry an ETag derived from the generation
+    of the preload store and the change serials of the selected sources,
+    so that a client can revalidate a response with If-None-Match
+    without the query being executed.
+
+    At most MAX_CONCURRENT_REQUESTS requests are executed at the same time.
+    Queries are subject to the same query cost limits as whois queries.
+    """
+    _request_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+
+    def __init__(self, client_ip: str, client_str: str, preloader: Preloader) -> None:
+        self.client_ip = client_ip
+        self.client_str = client_str
+        self.preloader = preloader
+
+    def handle_get(self, path: str, query_string: str, request_headers: Mapping[str, str]) -> HTTPResponse:
+        if not self._request_slots.acquire(timeout=REQUEST_SLOT_TIMEOUT):
+            logger.info(f'{self.client_str}: rejected query API request, too many concurrent requests')
+            return self._json_response(HTTPStatus.SERVICE_UNAVAILABLE,
+                                       {'error': 'Too many concurrent requests, try again later'}, request_headers)
+        try:
+            return self._handle_get(path, query_string, request_headers)
+        finally:
+            self._request_slots.release()
+
+    def _handle_get(self, path: str, query_string: str, request_headers: Mapping[str, str]) -> HTTPResponse:
+        parameters = {key: values[-1] for key, values in parse_qs(query_string).items()}
+        database_handler = DatabaseHandler(readonly=True)
+        try:
+            query_parser = WhoisQueryParser(self.client_ip, self.client_str, self.preloader, database_handler)
+            if 'sources' in parameters:
+                query_parser.handle_irrd_sources_list(parameters['sources'])
+            result_key, queries = self._whois_queries(path, parameters)
+
+            etag = self._etag(queries, query_parser)
+            if etag and self._etag_matches(etag, request_headers.get('If-None-Match')):
+                return HTTPResponse(HTTPStatus.NOT_MODIFIED, headers={'ETag': etag})
+
+            results = []
+            for query in queries:
+                results += self._execute_query(query_parser, query)
+        except (QueryAPIException, WhoisQueryParserException) as exc:
+            status = exc.status if isinstance(exc, QueryAPIException) else HTTPStatus.BAD_REQUEST
+            return self._json_response(status, {'error': str(exc)}, request_headers)
+        finally:
+            database_handler.close()
+
+        if result_key == 'objects' and not results:
+            return self._json_response(HTTPStatus.NOT_FOUND, {'error': 'Key not found'}, request_headers)
+
+        response = self._json_response(HTTPStatus.OK, {result_key: results}, request_headers)
+        if etag:
+            response.headers['ETag'] = etag
+        return response
+
+    def _whois_queries(self, path: str, parameters: Dict[str, str]) -> Tuple[str, List[str]]:
+        """
+        Translate a request into IRRD-style whois queries.
+        Returns the key for the results in the response, and the queries.
+        """
+        endpoint, _, argument = path[len(QUERY_API_PATH_PREFIX):].strip('/').partition('/')
+        argument = unquote(argument)
+        if not argument:
+            raise QueryAPIException('Not found', HTTPStatus.NOT_FOUND)
+
+        if endpoint == 'origin-prefixes':
+            aggregation = self._aggregation_flag(parameters)
+            commands = {'4': ['!g'], '6': ['!6'], None: ['!g', '!6']}[self._ip_version(parameters)]
+            return 'prefixes', [command + argument + aggregation for command in commands]
+        elif endpoint == 'set-prefixes':
+            ip_version = self._ip_version(parameters) or ''
+            return 'prefixes', ['!a' + ip_version + argument + self._aggregation_flag(parameters)]
+        elif endpoint == 'set-members':
+            recursive = ',1' if self._boolean(parameters, 'recursive') else ''
+            return 'members', ['!i' + argument + recursive]
+        elif endpoint == 'prefix-origins':
+            return 'origins', ['!r' + argument + ',o']
+        elif endpoint == 'route-search':
+            match = parameters.get('match', 'exact')
+            if match not in ROUTE_SEARCH_OPTIONS:
+                raise QueryAPIException(f'Invalid value for match: {match}')
+            return 'objects', ['!r' + argument + ROUTE_SEARCH_OPTIONS[match]]
+        elif endpoint == 'object':
+            object_class, _, rpsl_pk = argument.partition('/')
+            if not rpsl_pk:
+                raise QueryAPIException('Missing object key')
+            return 'objects', ['!m' + object_class + ',' + rpsl_pk]
+        raise QueryAPIException('Not found', HTTPStatus.NOT_FOUND)
+
+    def _execute_query(self, query_parser: WhoisQueryParser, query: str) -> List[str]:
+        """
+        Execute a whois query, and split the result into a list of
+        prefixes, members or origins, or of object texts for !r and !m.
+        """
+        response = query_parser.handle_query(query)
+        if response.response_type == WhoisQueryResponseType.ERROR:
+            raise QueryAPIException(str(response.result))
+        if response.response_type == WhoisQueryResponseType.KEY_NOT_FOUND or not response.result:
+            return []
+        result = str(response.result)
+        if query.startswith('!m') or (query.startswith('!r') and not query.endswith(',o')):
+            # RPSL objects can not contain empty lines, which separate objects
+            return [object_text + '\n' for object_text in result.split('\n\n')]
+        return result.split()
+
+    def _etag(self, queries: List[str], query_parser: WhoisQueryParser) -> Optional[str]:
+        """
+        Determine the ETag for a response to queries. This must be determined
+        before the queries are executed, so that changes committed while they are
+        executed result in a new ETag. Returns None if the preload store is not
+        loaded yet.
+        """
+        generation = self.preloader.generation()
+        if generation is None:
+            return None
+        sources = query_parser.sources
+        change_serials = SourceChangeSerials().current(sources)
+        etag_data = '\n'.join(queries + [
+            ','.join(sources),
+            str(generation),
+            ','.join(str(serial) for serial in change_serials),
+        ])
+        return '"' + hashlib.sha256(etag_data.encode('utf-8')).hexdigest()[:32] + '"'
+
+    def _etag_matches(self, etag: str, if_none_match: Optional[str]) -> bool:
+        if not if_none_match:
+            return False
+        candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+        # Weak comparison, as required for If-None-Match
+        return '*' in candidates or etag in [candidate.replace('W/', '', 1) for candidate in candidates]
+
+    def _json_response(self, status: HTTPStatus, content: Dict[str, Any],
+                       request_headers: Mapping[str, str]) -> HTTPResponse:
+        """
+        Create a response with JSON content, compressed if it is
+        larger than GZIP_MIN_RESPONSE_SIZE and the client accepts gzip.
+        """
+        content_bytes = ujson.dumps(content, escape_forward_slashes=False).encode('utf-8')
+        headers = {'Content-Type': 'application/json', 'Vary': 'Accept-Encoding'}
+        if len(content_bytes) >= GZIP_MIN_RESPONSE_SIZE and self._accepts_gzip(request_headers.get('Accept-Encoding')):
+            content_bytes = gzip.compress(content_bytes)
+            headers['Content-Encoding'] = 'gzip'
+        return HTTPResponse(status, content_bytes, headers)
+
+    def _accepts_gzip(self, accept_encoding: Optional[str]) -> bool:
+        if not accept_encoding:
+            return False
+        for coding in accept_encoding.split(','):
+            name, _, qvalue = coding.partition(';')
+            if name.strip().lower() == 'gzip':
+                return qvalue.replace(' ', '') not in ['q=0', 'q=0.0', 'q=0.00', 'q=0.000']
+        return False
+
+    def _ip_version(self, parameters: Dict[str, str]) -> Optional[str]:
+        ip_version = parameters.get('ip_version')
+        if ip_version not in [None, '4', '6']:
+            raise QueryAPIException(f'Invalid value for ip_version: {ip_version}')
+        return ip_version
+
+    def _aggregation_flag(self, parameters: Dict[str, str]) -> str:
+        aggregation = parameters.get('aggregation')
+        if aggregation is None:
+            return ''
+        if aggregation not in AGGREGATION_FLAGS:
+            raise QueryAPIException(f'Invalid value for aggregation: {aggregation}')
+        return AGGREGATION_FLAGS[aggregation]
+
+    def _boolean(self, parameters: Dict[str, str], name: str) -> bool:
+        value = parameters.get(name, 'false').lower()
+        if value not in ['true', 'false', '1', '0']:
+            raise QueryAPIException(f'Invalid value for {name}: {value}')
+        return value in ['true', '1']
@@ -1,5 +1,6 @@
 import logging
 import signal
+import threading
 
 from IPy import IP
 from setproctitle import setproctitle
@@ -11,14 +12,32 @@ from http import HTTPStatus
 # but as we only use small parts, this is not a significant concern
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from typing import Tuple
+from urllib.parse import urlsplit
 
 from irrd import __version__
 from irrd.conf import get_setting
 from irrd.server.access_check import is_client_permitted
+from irrd.server.http.metrics_generator import MetricsGenerator
+from irrd.server.http.query_api import QUERY_API_PATH_PREFIX, HTTPResponse, QueryAPI
 from irrd.server.http.status_generator import StatusGenerator
+from irrd.storage.preload import Preloader
 
 logger = logging.getLogger(__name__)
 HTTP_TIMEOUT = 30
+# Time for which a connection may be idle between requests, or before its
+# first request, so that idle keepalive connections do not hold a thread.
+HTTP_IDLE_TIMEOUT = 5
+# Maximum number of connections handled at the same time, each in its own
+# thread. Further connections are answered with a 503 and closed.
+HTTP_MAX_THREADS = 100
+HTTP_BUSY_RESPONSE = (
+    b'HTTP/1.1 503 Service Unavailable\r\n'
+    b'Content-Type: text/plain;charset=utf-8\r\n'
+    b'Content-Length: 39\r\n'
+    b'Connection: close\r\n'
+    b'\r\n'
+    b'Too many connections, try again later\r\n'
+)
 
 # The start_http_server method and IRRdHTTPRequestHandler are
 # difficult to test in a unit test, and therefore only included
@@ -40,33 +59,73 @@ def start_http_server():  # pragma: no cover
 class HTTPServerForkingIPv6(socketserver.ThreadingMixIn, HTTPServer):  # pragma: no cover
     # Default HTTP server only supports IPv4
     allow_reuse_address = True
+    daemon_threads = True
     timeout = HTTP_TIMEOUT
 
     def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True):  # noqa: N803
         self.address_family = socket.AF_INET6 if IP(server_address[0]).version() == 6 else socket.AF_INET
+        # Shared by all request threads, for queries through the query API
+        self.preloader = Preloader()
+        self.thread_slots = threading.BoundedSemaphore(HTTP_MAX_THREADS)
         super().__init__(server_address, RequestHandlerClass, bind_and_activate)
 
+    def process_request(self, request, client_address):
+        # This runs in the listener thread, which must never block,
+        # so that other clients can still connect.
+        if not self.thread_slots.acquire(blocking=False):
+            logger.info(f'Rejecting HTTP connection from {client_address}: all {HTTP_MAX_THREADS} threads busy')
+            try:
+                request.settimeout(1)
+                request.sendall(HTTP_BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self.thread_slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.thread_slots.release()
+
     def handle_error(self, request, client_address):
         logger.error(f'Error while handling request from {client_address}', exc_info=True)
 
 
 class IRRdHTTPRequestHandler(BaseHTTPRequestHandler):  # pragma: no cover
     """
-    Request handler, called for each HTTP request, in its own process.
+    Request handler, called for each HTTP connection, in its own thread.
+    Connections are kept alive for multiple requests.
 
     Kept as lightweight as possible, and offloads most work to
     IRRdHTTPRequestProcessor, as that class is unit-testable.
     """
     server_version = f'irrd/{__version__}'
+    protocol_version = 'HTTP/1.1'
 
     def handle_one_request(self) -> None:
         # Sockets for client connections don't inherit the timeout,
-        # this wrapper sets it before any data is read.
-        self.connection.settimeout(HTTP_TIMEOUT)
+        # this wrapper sets it before any data is read. Waiting for the
+        # request line uses the shorter idle timeout.
+        self.connection.settimeout(HTTP_IDLE_TIMEOUT)
         return super().handle_one_request()
 
+    def parse_request(self) -> bool:
+        # Called once the request line is read, for the rest of the request
+        self.connection.settimeout(HTTP_TIMEOUT)
+        return super().parse_request()
+
     def do_GET(self):  # noqa: N802
         processor = IRRdHTTPRequestProcessor(self.client_address[0], self.client_address[1])
+        if self.path.startswith(QUERY_API_PATH_PREFIX):
+            response = processor.handle_query_api_get(self.path, self.headers, self.server.preloader)
+            self.generate_query_api_response(response)
+            return
         status, content = processor.handle_get(self.path)
         self.generate_response(status, content)
 
@@ -81,6 +140,15 @@ class IRRdHTTPRequestHandler(BaseHTTPRequestHandler):  # pragma: no cover
         self.end_headers()
         self.wfile.write(content_bytes)
 
+    def generate_query_api_response(self, response: HTTPResponse):
+        self.send_response(response.status)
+        for header, value in response.headers.items():
+            self.send_header(header, value)
+        if response.status != HTTPStatus.NOT_MODIFIED:
+            self.send_header('Content-Length', str(len(response.content)))
+        self.end_headers()
+        self.wfile.write(response.content)
+
 
 class IRRdHTTPRequestProcessor:
     """
@@ -95,8 +163,22 @@ class IRRdHTTPRequestProcessor:
         if not is_client_permitted(self.client_ip, 'server.http.access_list'):
             return HTTPStatus.FORBIDDEN, 'Access denied'
 
-        if path.rstrip('/') != '/v1/status':
+        path = path.rstrip('/')
+        if path == '/v1/status':
+            content = StatusGenerator().generate_status()
+        elif path == '/v1/metrics':
+            content = MetricsGenerator().generate_metrics()
+        else:
             return HTTPStatus.NOT_FOUND, 'Not found'
-
-        content = StatusGenerator().generate_status()
         return HTTPStatus.OK, content
+
+    def handle_query_api_get(self, path, request_headers, preloader: Preloader) -> HTTPResponse:
+        """
+        Handle a request to the JSON query API, for a path including
+        the query string, e.g. /v1/query/origin-prefixes/AS65537?ip_version=4
+        """
+        if not is_client_permitted(self.client_ip, 'server.http.access_list'):
+            return HTTPResponse(HTTPStatus.FORBIDDEN, b'Access denied',
+                                {'Content-Type': 'text/plain;charset=utf-8'})
+        url = urlsplit(path)
+        return QueryAPI(self.client_ip, self.client_str, preloader).handle_get(url.path, url.query, request_headers)
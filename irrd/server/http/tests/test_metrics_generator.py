@@ -0,0 +1,152 @@
+import textwrap
+from unittest.mock import Mock
+
+from irrd.server.whois.query_metrics import REDIS_WHOIS_QUERY_METRICS_KEY
+from irrd.storage.preload import REDIS_PRELOAD_METRICS_KEY, REDIS_PRELOAD_STORE_SIZE_KEY
+from ..metrics_generator import MetricsGenerator
+
+
+class TestMetricsGenerator:
+
+    def test_generate_metrics(self, monkeypatch):
+        redis_data = {
+            REDIS_PRELOAD_METRICS_KEY: {
+                b'updates_full': b'2',
+                b'duration_total_full': b'10.5',
+                b'duration_last_full': b'4.5',
+                b'updates_incremental': b'3',
+                b'duration_total_incremental': b'0.75',
+                b'duration_last_incremental': b'0.25',
+                b'coalesced_reloads': b'1',
+                b'generation': b'5',
+                b'snapshot_timestamp': b'1000',
+                b'snapshot_duration_last': b'0.125',
+                b'snapshot_delta_entries': b'7',
+                b'commit_delay_last': b'0.5',
+                b'sets': b'12',
+                b'pending_commit_timestamp': b'1015.5',
+                b'claimed_commit_timestamp': b'1010',
+            },
+            REDIS_PRELOAD_STORE_SIZE_KEY: {
+                b'origins:4:TEST2': b'1',
+                b'prefixes:4:TEST2': b'2',
+                b'origins:4:TEST1': b'3',
+                b'prefixes:4:TEST1': b'4',
+                b'origins:6:TEST1': b'5',
+                b'prefixes:6:TEST1': b'6',
+            },
+            REDIS_WHOIS_QUERY_METRICS_KEY: {
+                b'latency_bucket:!g:0.001': b'2',
+                b'latency_bucket:!g:0.5': b'1',
+                b'latency_bucket:!g:+Inf': b'1',
+                b'latency_sum:!g': b'20.5015',
+                b'size_bucket:!g:100': b'4',
+                b'size_sum:!g': b'200',
+                b'slow_queries:!g': b'1',
+                b'latency_bucket:-i:0.01': b'1',
+                b'latency_sum:-i': b'0.01',
+                b'size_bucket:-i:10000000': b'1',
+                b'size_sum:-i': b'5000000',
+                b'statement_cache_hits': b'90',
+                b'statement_cache_misses': b'10',
+                b'connections_active': b'12',
+                b'connections_waiting': b'0',
+                b'connections_rejected:client_limit': b'3',
+                b'rate_limited_batches': b'7',
+                b'rate_limit_delay': b'2.5',
+                b'executor_tasks_pending': b'4',
+                b'executors_busy': b'3',
+            },
+        }
+        mock_redis_conn = Mock()
+        mock_redis_conn.hgetall = lambda key: redis_data[key]
+        mock_redis = Mock()
+        mock_redis.Redis.from_url = lambda url: mock_redis_conn
+        monkeypatch.setattr('irrd.server.http.metrics_generator.redis', mock_redis)
+        monkeypatch.setattr('irrd.server.http.metrics_generator.time.time', lambda: 1020)
+
+        metrics = MetricsGenerator().generate_metrics()
+        samples = [line for line in metrics.splitlines() if not line.startswith('#')]
+        latency_bounds = ['0.001', '0.0025', '0.005', '0.01', '0.025', '0.05', '0.1',
+                          '0.25', '0.5', '1', '2.5', '5', '10', '+Inf']
+        size_bounds = ['100', '1000', '10000', '100000', '1000000', '10000000', '+Inf']
+        assert samples == textwrap.dedent("""
+            irrd_preload_updates_total{type="full"} 2
+            irrd_preload_updates_total{type="incremental"} 3
+            irrd_preload_update_duration_seconds_total{type="full"} 10.5
+            irrd_preload_update_duration_seconds_total{type="incremental"} 0.75
+            irrd_preload_last_update_duration_seconds{type="full"} 4.5
+            irrd_preload_last_update_duration_seconds{type="incremental"} 0.25
+            irrd_preload_coalesced_reloads_total 1
+            irrd_preload_generation 5
+            irrd_preload_snapshot_timestamp_seconds 1000
+            irrd_preload_last_snapshot_duration_seconds 0.125
+            irrd_preload_snapshot_delta_entries 7
+            irrd_preload_last_commit_delay_seconds 0.5
+            irrd_preload_staleness_seconds 10
+            irrd_preload_store_origins{source="TEST1",ip_version="4"} 3
+            irrd_preload_store_origins{source="TEST2",ip_version="4"} 1
+            irrd_preload_store_origins{source="TEST1",ip_version="6"} 5
+            irrd_preload_store_prefixes{source="TEST1",ip_version="4"} 4
+            irrd_preload_store_prefixes{source="TEST2",ip_version="4"} 2
+            irrd_preload_store_prefixes{source="TEST1",ip_version="6"} 6
+            irrd_preload_store_sets 12
+        """).strip().splitlines() + [
+            *self._histogram_samples('irrd_whois_query_duration_seconds', '!g', latency_bounds,
+                                     [2, 2, 2, 2, 2, 2, 2, 2, 3, 3, 3, 3, 3, 4], '20.5015'),
+            *self._histogram_samples('irrd_whois_query_duration_seconds', '-i', latency_bounds,
+                                     [0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1], '0.01'),
+            *self._histogram_samples('irrd_whois_response_size_bytes', '!g', size_bounds,
+                                     [4, 4, 4, 4, 4, 4, 4], '200'),
+            *self._histogram_samples('irrd_whois_response_size_bytes', '-i', size_bounds,
+                                     [0, 0, 0, 0, 0, 1, 1], '5000000'),
+            'irrd_whois_slow_queries_total{command="!g"} 1',
+            'irrd_whois_slow_queries_total{command="-i"} 0',
+            'irrd_whois_statement_cache_hits_total 90',
+            'irrd_whois_statement_cache_misses_total 10',
+            'irrd_whois_connections_active 12',
+            'irrd_whois_connections_waiting 0',
+            'irrd_whois_connections_rejected_total{reason="backlog_full"} 0',
+            'irrd_whois_connections_rejected_total{reason="client_limit"} 3',
+            'irrd_whois_rate_limited_query_batches_total 7',
+            'irrd_whois_rate_limit_delay_seconds_total 2.5',
+            'irrd_whois_executor_tasks_pending 4',
+            'irrd_whois_executors_busy 3',
+        ]
+        assert '# TYPE irrd_preload_updates_total counter' in metrics
+        assert '# TYPE irrd_preload_staleness_seconds gauge' in metrics
+        assert '# TYPE irrd_whois_query_duration_seconds histogram' in metrics
+
+    def _histogram_samples(self, name, command, bounds, bucket_counts, metric_sum):
+        samples = [
+            f'{name}_bucket{{command="{command}",le="{bound}"}} {bucket_count}'
+            for bound, bucket_count in zip(bounds, bucket_counts)
+        ]
+        return samples + [
+            f'{name}_sum{{command="{command}"}} {metric_sum}',
+            f'{name}_count{{command="{command}"}} {bucket_counts[-1]}',
+        ]
+
+    def test_generate_metrics_empty(self, monkeypatch):
+        mock_redis_conn = Mock()
+        mock_redis_conn.hgetall = lambda key: {}
+        mock_redis = Mock()
+        mock_redis.Redis.from_url = lambda url: mock_redis_conn
+        monkeypatch.setattr('irrd.server.http.metrics_generator.redis', mock_redis)
+
+        metrics = MetricsGenerator().generate_metrics()
+        samples = [line for line in metrics.splitlines() if not line.startswith('#')]
+        assert samples == [
+            'irrd_preload_updates_total{type="full"} 0',
+            'irrd_preload_updates_total{type="incremental"} 0',
+            'irrd_preload_update_duration_seconds_total{type="full"} 0',
+            'irrd_preload_update_duration_seconds_total{type="incremental"} 0',
+            'irrd_preload_coalesced_reloads_total 0',
+            'irrd_preload_staleness_seconds 0',
+            'irrd_whois_statement_cache_hits_total 0',
+            'irrd_whois_statement_cache_misses_total 0',
+            'irrd_whois_connections_rejected_total{reason="backlog_full"} 0',
+            'irrd_whois_connections_rejected_total{reason="client_limit"} 0',
+            'irrd_whois_rate_limited_query_batches_total 0',
+            'irrd_whois_rate_limit_delay_seconds_total 0',
+        ]
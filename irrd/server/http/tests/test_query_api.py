@@ -0,0 +1,256 @@
+import gzip
+import threading
+from http import HTTPStatus
+from unittest.mock import Mock
+
+import pytest
+import ujson
+
+from irrd.server.whois.query_parser import WhoisQueryParserException
+from irrd.server.whois.query_response import (WhoisQueryResponse, WhoisQueryResponseType,
+                                              WhoisQueryResponseMode)
+from ..query_api import QueryAPI, GZIP_MIN_RESPONSE_SIZE
+
+OBJECT_TEXTS = 'route: 192.0.2.0/24\norigin: AS65537\n\nroute: 192.0.2.0/24\norigin: AS65538'
+
+
+@pytest.fixture()
+def prepare_query_api(monkeypatch):
+    mock_dh = Mock()
+    monkeypatch.setattr('irrd.server.http.query_api.DatabaseHandler', lambda readonly: mock_dh)
+    mock_change_serials = Mock()
+    monkeypatch.setattr('irrd.server.http.query_api.SourceChangeSerials', lambda: mock_change_serials)
+    mock_change_serials.current = lambda sources: [len(source) for source in sources]
+
+    responses = {
+        '!gAS65537': '192.0.2.0/24 198.51.100.0/24',
+        '!6AS65537': '2001:db8::/32',
+        '!gAS65537,A': '192.0.2.0/23',
+        '!a4AS-FOO': '192.0.2.0/24',
+        '!iAS-FOO,1': 'AS65537 AS65538',
+        '!r192.0.2.0/24,o': 'AS65537 AS65538',
+        '!r192.0.2.0/24,l': OBJECT_TEXTS,
+        '!mroute,192.0.2.0/24AS65537': OBJECT_TEXTS.split('\n\n')[0],
+    }
+    mock_parser = Mock()
+    mock_parser.sources = ['TEST']
+    queries = []
+
+    def handle_query(query):
+        queries.append(query)
+        if query == '!gINVALID':
+            return WhoisQueryResponse(response_type=WhoisQueryResponseType.ERROR,
+                                      mode=WhoisQueryResponseMode.IRRD, result='Invalid AS number')
+        if query in responses:
+            return WhoisQueryResponse(response_type=WhoisQueryResponseType.SUCCESS,
+                                      mode=WhoisQueryResponseMode.IRRD, result=responses[query])
+        return WhoisQueryResponse(response_type=WhoisQueryResponseType.KEY_NOT_FOUND,
+                                  mode=WhoisQueryResponseMode.IRRD, result='')
+
+    def handle_irrd_sources_list(parameter):
+        if parameter == 'INVALID':
+            raise WhoisQueryParserException('One or more selected sources are unavailable.')
+        mock_parser.sources = parameter.split(',')
+
+    mock_parser.handle_query = handle_query
+    mock_parser.handle_irrd_sources_list = handle_irrd_sources_list
+    monkeypatch.setattr('irrd.server.http.query_api.WhoisQueryParser', lambda *args: mock_parser)
+
+    mock_preloader = Mock()
+    mock_preloader.generation = lambda: 3
+    yield QueryAPI('192.0.2.1', '192.0.2.1:99999', mock_preloader), mock_preloader, queries, mock_dh
+
+
+def json_content(response):
+    assert response.headers['Content-Type'] == 'application/json'
+    return ujson.loads(response.content)
+
+
+class TestQueryAPI:
+    def test_origin_prefixes(self, prepare_query_api):
+        query_api, mock_preloader, queries, mock_dh = prepare_query_api
+
+        response = query_api.handle_get('/v1/query/origin-prefixes/AS65537', '', {})
+        assert response.status == HTTPStatus.OK
+        assert json_content(response) == {'prefixes': ['192.0.2.0/24', '198.51.100.0/24', '2001:db8::/32']}
+        assert queries == ['!gAS65537', '!6AS65537']
+        assert response.headers['ETag'].startswith('"')
+        assert mock_dh.close.call_count == 1
+
+        queries.clear()
+        response = query_api.handle_get('/v1/query/origin-prefixes/AS65537/', 'ip_version=4&aggregation=prefixes', {})
+        assert json_content(response) == {'prefixes': ['192.0.2.0/23']}
+        assert queries == ['!gAS65537,A']
+
+        response = query_api.handle_get('/v1/query/origin-prefixes/AS65537', 'ip_version=5', {})
+        assert response.status == HTTPStatus.BAD_REQUEST
+        assert json_content(response) == {'error': 'Invalid value for ip_version: 5'}
+
+        response = query_api.handle_get('/v1/query/origin-prefixes/AS65537', 'aggregation=invalid', {})
+        assert response.status == HTTPStatus.BAD_REQUEST
+
+        response = query_api.handle_get('/v1/query/origin-prefixes/INVALID', 'ip_version=4', {})
+        assert response.status == HTTPStatus.BAD_REQUEST
+        assert json_content(response) == {'error': 'Invalid AS number'}
+
+    def test_sets(self, prepare_query_api):
+        query_api, mock_preloader, queries, mock_dh = prepare_query_api
+
+        response = query_api.handle_get('/v1/query/set-prefixes/AS-FOO', 'ip_version=4', {})
+        assert json_content(response) == {'prefixes': ['192.0.2.0/24']}
+
+        response = query_api.handle_get('/v1/query/set-members/AS-FOO', 'recursive=true', {})
+        assert json_content(response) == {'members': ['AS65537', 'AS65538']}
+
+        response = query_api.handle_get('/v1/query/set-members/AS-FOO', '', {})
+        assert response.status == HTTPStatus.OK
+        assert json_content(response) == {'members': []}
+        assert queries == ['!a4AS-FOO', '!iAS-FOO,1', '!iAS-FOO']
+
+        response = query_api.handle_get('/v1/query/set-members/AS-FOO', 'recursive=maybe', {})
+        assert response.status == HTTPStatus.BAD_REQUEST
+
+    def test_route_search(self, prepare_query_api):
+        query_api, mock_preloader, queries, mock_dh = prepare_query_api
+
+        response = query_api.handle_get('/v1/query/prefix-origins/192.0.2.0/24', '', {})
+        assert json_content(response) == {'origins': ['AS65537', 'AS65538']}
+
+        response = query_api.handle_get('/v1/query/route-search/192.0.2.0/24', 'match=less-one', {})
+        assert json_content(response) == {'objects': [
+            'route: 192.0.2.0/24\norigin: AS65537\n',
+            'route: 192.0.2.0/24\norigin: AS65538\n',
+        ]}
+
+        response = query_api.handle_get('/v1/query/route-search/192.0.2.0/24', '', {})
+        assert response.status == HTTPStatus.NOT_FOUND
+        assert queries == ['!r192.0.2.0/24,o', '!r192.0.2.0/24,l', '!r192.0.2.0/24']
+
+        response = query_api.handle_get('/v1/query/route-search/192.0.2.0/24', 'match=invalid', {})
+        assert response.status == HTTPStatus.BAD_REQUEST
+
+    def test_object(self, prepare_query_api):
+        query_api, mock_preloader, queries, mock_dh = prepare_query_api
+
+        response = query_api.handle_get('/v1/query/object/route/192.0.2.0%2F24AS65537', '', {})
+        assert json_content(response) == {'objects': ['route: 192.0.2.0/24\norigin: AS65537\n']}
+
+        response = query_api.handle_get('/v1/query/object/route/192.0.2.0/24AS65537', '', {})
+        assert response.status == HTTPStatus.OK
+
+        response = query_api.handle_get('/v1/query/object/route', '', {})
+        assert response.status == HTTPStatus.BAD_REQUEST
+        assert json_content(response) == {'error': 'Missing object key'}
+        assert queries == ['!mroute,192.0.2.0/24AS65537', '!mroute,192.0.2.0/24AS65537']
+
+    def test_unknown_endpoint(self, prepare_query_api):
+        query_api, mock_preloader, queries, mock_dh = prepare_query_api
+
+        for path in ['/v1/query/unknown/AS65537', '/v1/query/origin-prefixes', '/v1/query/']:
+            response = query_api.handle_get(path, '', {})
+            assert response.status == HTTPStatus.NOT_FOUND
+            assert json_content(response) == {'error': 'Not found'}
+        assert not queries
+        assert mock_dh.close.call_count == 3
+
+    def test_etag(self, prepare_query_api):
+        query_api, mock_preloader, queries, mock_dh = prepare_query_api
+
+        etag = query_api.handle_get('/v1/query/origin-prefixes/AS65537', '', {}).headers['ETag']
+        response = query_api.handle_get('/v1/query/origin-prefixes/AS65537', '', {'If-None-Match': etag})
+        assert response.status == HTTPStatus.NOT_MODIFIED
+        assert response.headers == {'ETag': etag}
+        assert response.content == b''
+        assert queries == ['!gAS65537', '!6AS65537']
+
+        for if_none_match in [f'"other", W/{etag}', '*']:
+            response = query_api.handle_get('/v1/query/origin-prefixes/AS65537', '', {'If-None-Match': if_none_match})
+            assert response.status == HTTPStatus.NOT_MODIFIED
+
+        # Other sources or a new preload generation result in a different ETag
+        response = query_api.handle_get('/v1/query/origin-prefixes/AS65537', 'sources=TEST2', {'If-None-Match': etag})
+        assert response.status == HTTPStatus.OK
+        assert response.headers['ETag'] != etag
+        mock_preloader.generation = lambda: 4
+        response = query_api.handle_get('/v1/query/origin-prefixes/AS65537', '', {'If-None-Match': etag})
+        assert response.status == HTTPStatus.OK
+
+        # Without a preload store, no ETag can be determined
+        mock_preloader.generation = lambda: None
+        response = query_api.handle_get('/v1/query/origin-prefixes/AS65537', '', {'If-None-Match': etag})
+        assert response.status == HTTPStatus.OK
+        assert 'ETag' not in response.headers
+
+    def test_invalid_sources(self, prepare_query_api):
+        query_api, mock_preloader, queries, mock_dh = prepare_query_api
+
+        response = query_api.handle_get('/v1/query/origin-prefixes/AS65537', 'sources=INVALID', {})
+        assert response.status == HTTPStatus.BAD_REQUEST
+        assert json_content(response) == {'error': 'One or more selected sources are unavailable.'}
+        assert not queries
+
+    def test_gzip(self, prepare_query_api, monkeypatch):
+        query_api, mock_preloader, queries, mock_dh = prepare_query_api
+        prefixes = [f'10.{i // 256}.{i % 256}.0/24' for i in range(GZIP_MIN_RESPONSE_SIZE // 10)]
+        monkeypatch.setattr(query_api, '_execute_query', lambda query_parser, query: prefixes)
+
+        response = query_api.handle_get('/v1/query/origin-prefixes/AS65537', 'ip_version=4',
+                                        {'Accept-Encoding': 'deflate, gzip;q=0.8'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        assert ujson.loads(gzip.decompress(response.content)) == {'prefixes': prefixes}
+
+        for accept_encoding in [None, 'deflate', 'gzip;q=0']:
+            headers = {'Accept-Encoding': accept_encoding} if accept_encoding else {}
+            response = query_api.handle_get('/v1/query/origin-prefixes/AS65537', 'ip_version=4', headers)
+            assert 'Content-Encoding' not in response.headers
+            assert json_content(response) == {'prefixes': prefixes}
+
+        # Small responses are never compressed
+        monkeypatch.setattr(query_api, '_execute_query', lambda query_parser, query: prefixes[:1])
+        response = query_api.handle_get('/v1/query/origin-prefixes/AS65537', 'ip_version=4',
+                                        {'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers
+
+    def test_concurrent_requests(self, prepare_query_api, monkeypatch):
+        query_api, mock_preloader, queries, mock_dh = prepare_query_api
+        request_slots = threading.BoundedSemaphore(1)
+        monkeypatch.setattr(QueryAPI, '_request_slots', request_slots)
+        monkeypatch.setattr('irrd.server.http.query_api.REQUEST_SLOT_TIMEOUT', 0.01)
+
+        request_slots.acquire()
+        response = query_api.handle_get('/v1/query/origin-prefixes/AS65537', '', {})
+        assert response.status == HTTPStatus.SERVICE_UNAVAILABLE
+        assert json_content(response) == {'error': 'Too many concurrent requests, try again later'}
+        assert not queries
+
+        request_slots.release()
+        response = query_api.handle_get('/v1/query/origin-prefixes/AS65537', '', {})
+        assert response.status == HTTPStatus.OK
+        # The slot is released after the request
+        assert request_slots.acquire(blocking=False)
+
+
+class TestQueryAPIQueryCost:
+    def test_query_cost_limit(self, config_override, monkeypatch):
+        config_override({
+            'sources': {'TEST': {}},
+            'access_lists': {'limited': ['192.0.2.2']},
+            'server': {'whois': {'max_query_cost_per_access_list': {'limited': 1}}},
+        })
+        monkeypatch.setattr('irrd.server.http.query_api.DatabaseHandler', lambda readonly: Mock())
+        monkeypatch.setattr('irrd.server.whois.query_parser.WhoisQueryParser._recursive_set_resolve',
+                            lambda self, members: {'AS65537', 'AS65538'})
+        mock_preloader = Mock()
+        mock_preloader.generation = lambda: None
+        mock_preloader.set_store_available = lambda: False
+        mock_preloader.routes_for_origins = lambda origins, sources, ip_version: ['192.0.2.0/24', '198.51.100.0/24']
+
+        # The whois query cost limits apply to the query API
+        response = QueryAPI('192.0.2.1', '192.0.2.1:99999', mock_preloader).handle_get(
+            '/v1/query/set-prefixes/AS-FOO', '', {})
+        assert json_content(response) == {'prefixes': ['192.0.2.0/24', '198.51.100.0/24']}
+        response = QueryAPI('192.0.2.2', '192.0.2.2:99999', mock_preloader).handle_get(
+            '/v1/query/set-prefixes/AS-FOO', '', {})
+        assert response.status == HTTPStatus.BAD_REQUEST
+        assert 'exceeds the limit of 1 for this client' in json_content(response)['error']
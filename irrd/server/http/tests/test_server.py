@@ -1,8 +1,10 @@
+import threading
+
 import pytest
 from http import HTTPStatus
 from unittest.mock import Mock
 
-from ..server import IRRdHTTPRequestProcessor
+from ..server import HTTP_BUSY_RESPONSE, HTTPServerForkingIPv6, IRRdHTTPRequestProcessor
 
 
 @pytest.fixture()
@@ -25,6 +27,11 @@ def prepare_mocks(monkeypatch, config_override):
                         lambda: mock_database_status_generator)
     mock_database_status_generator.generate_status = lambda: 'status'
 
+    mock_metrics_generator = Mock()
+    monkeypatch.setattr('irrd.server.http.server.MetricsGenerator',
+                        lambda: mock_metrics_generator)
+    mock_metrics_generator.generate_metrics = lambda: 'metrics'
+
 
 class TestIRRdHTTPRequestProcessor:
     def test_database_status_get_permitted_client_in_access_list(self, prepare_mocks):
@@ -33,6 +40,17 @@ class TestIRRdHTTPRequestProcessor:
         assert status == HTTPStatus.OK
         assert content == 'status'
 
+    def test_metrics_get_permitted_client_in_access_list(self, prepare_mocks):
+        processor = IRRdHTTPRequestProcessor('192.0.2.1', 99999)
+        status, content = processor.handle_get('/v1/metrics')
+        assert status == HTTPStatus.OK
+        assert content == 'metrics'
+
+        processor = IRRdHTTPRequestProcessor('192.0.2.200', 99999)
+        status, content = processor.handle_get('/v1/metrics')
+        assert status == HTTPStatus.FORBIDDEN
+        assert content == 'Access denied'
+
     def test_database_status_get_denied_client_not_in_access_list(self, prepare_mocks, config_override):
         processor = IRRdHTTPRequestProcessor('192.0.2.200', 99999)
         status, content = processor.handle_get('/v1/status')
@@ -58,3 +76,31 @@ class TestIRRdHTTPRequestProcessor:
         status, content = processor.handle_get('/v1')
         assert status == HTTPStatus.NOT_FOUND
         assert content == 'Not found'
+
+    def test_query_api_get(self, prepare_mocks, monkeypatch):
+        mock_query_api = Mock()
+        monkeypatch.setattr('irrd.server.http.server.QueryAPI', lambda client_ip, client_str, preloader: mock_query_api)
+        mock_query_api.handle_get = lambda path, query_string, headers: (path, query_string, headers)
+
+        processor = IRRdHTTPRequestProcessor('192.0.2.1', 99999)
+        result = processor.handle_query_api_get('/v1/query/origin-prefixes/AS65537?ip_version=4', {'a': 'b'}, Mock())
+        assert result == ('/v1/query/origin-prefixes/AS65537', 'ip_version=4', {'a': 'b'})
+
+        processor = IRRdHTTPRequestProcessor('192.0.2.200', 99999)
+        response = processor.handle_query_api_get('/v1/query/origin-prefixes/AS65537', {}, Mock())
+        assert response.status == HTTPStatus.FORBIDDEN
+        assert response.content == b'Access denied'
+
+
+class TestHTTPServerForkingIPv6:
+    def test_process_request_all_threads_busy(self):
+        server = HTTPServerForkingIPv6.__new__(HTTPServerForkingIPv6)
+        server.thread_slots = threading.BoundedSemaphore(1)
+        server.thread_slots.acquire()
+        server.shutdown_request = Mock()
+        request = Mock()
+
+        # The listener is not blocked, the connection is rejected and closed
+        server.process_request(request, ('192.0.2.1', 99999))
+        request.sendall.assert_called_once_with(HTTP_BUSY_RESPONSE)
+        server.shutdown_request.assert_called_once_with(request)
@@ -1,4 +1,4 @@
-from .access_check import is_client_permitted
+from .access_check import is_client_permitted, is_client_in_access_list
 
 
 class TestIsClientPermitted:
@@ -40,3 +40,18 @@ class TestIsClientPermitted:
     def test_access_list_denied_invalid_ip(self):
         assert not is_client_permitted('invalid', 'test.access_list', default_deny=False)
         assert not is_client_permitted('invalid', 'test.access_list', default_deny=True)
+
+
+class TestIsClientInAccessList:
+    def test_in_access_list(self, config_override):
+        config_override({
+            'access_lists': {
+                'test-access-list': ['192.0.2.0/25', '2001:db8::/32'],
+            },
+        })
+        assert is_client_in_access_list('192.0.2.1', 'test-access-list')
+        assert is_client_in_access_list('::ffff:192.0.2.1', 'test-access-list')
+        assert is_client_in_access_list('2001:db8::1', 'test-access-list')
+        assert not is_client_in_access_list('192.0.2.200', 'test-access-list')
+        assert not is_client_in_access_list('invalid', 'test-access-list')
+        assert not is_client_in_access_list('192.0.2.1', 'unknown-access-list')
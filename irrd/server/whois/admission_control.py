@@ -0,0 +1,115 @@
+import asyncio
+import time
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+from irrd.conf import get_setting
+
+# Reasons for which connections are rejected
+REJECT_BACKLOG_FULL = 'backlog_full'
+REJECT_CLIENT_LIMIT = 'client_limit'
+
+
+class WhoisAdmissionControl:
+    """
+    Admission control for whois connections and queries.
+
+    At most server.whois.max_connections connections are served at the same
+    time. Further connections wait for a slot, in a backlog of at most
+    server.whois.max_connection_backlog connections - connections beyond
+    that are rejected immediately. Each client IP can have at most
+    server.whois.max_connections_per_client connections, including those
+    waiting in the backlog, so that a single client can not occupy most slots.
+
+    The queries of each client IP are rate limited to
+    server.whois.max_query_rate_per_client queries per second, with a token
+    bucket that allows bursts of up to one second of queries. Queries over
+    the limit are not rejected, but delayed until they fit in the rate,
+    so that heavy users are slowed down rather than cut off.
+
+    Must only be used from the event loop of the whois server.
+    """
+    def __init__(self) -> None:
+        self.max_connections = int(get_setting('server.whois.max_connections'))
+        self.active_connections = 0
+        self.waiting_connections = 0
+        self.rejected_connections: Dict[str, int] = defaultdict(int)
+        self.rate_limited_batches = 0
+        self.rate_limit_delay = 0.0
+        self._connection_slots = asyncio.Semaphore(self.max_connections)
+        self._client_connections: Dict[str, int] = defaultdict(int)
+        # Per client IP, the tokens in the bucket and the time they were last updated
+        self._query_buckets: Dict[str, Tuple[float, float]] = {}
+
+    async def admit(self, client_ip: str) -> Optional[str]:
+        """
+        Admit a connection from client_ip, waiting for a free slot if needed.
+        Returns the reason for rejecting the connection, or None if it was
+        admitted, in which case release() must be called when it is closed.
+        """
+        max_backlog = int(get_setting('server.whois.max_connection_backlog'))
+        max_client_connections = int(get_setting('server.whois.max_connections_per_client'))
+        if max_client_connections and self._client_connections.get(client_ip, 0) >= max_client_connections:
+            self.rejected_connections[REJECT_CLIENT_LIMIT] += 1
+            return REJECT_CLIENT_LIMIT
+        if self._connection_slots.locked() and self.waiting_connections >= max_backlog:
+            self.rejected_connections[REJECT_BACKLOG_FULL] += 1
+            return REJECT_BACKLOG_FULL
+
+        self._client_connections[client_ip] += 1
+        self.waiting_connections += 1
+        try:
+            await self._connection_slots.acquire()
+        except BaseException:
+            self._release_client(client_ip)
+            raise
+        finally:
+            self.waiting_connections -= 1
+        self.active_connections += 1
+        return None
+
+    def release(self, client_ip: str) -> None:
+        """Release the slot of an admitted connection from client_ip."""
+        self.active_connections -= 1
+        self._connection_slots.release()
+        self._release_client(client_ip)
+
+    def query_delay(self, client_ip: str, query_count: int) -> float:
+        """
+        Take query_count queries from the rate limit of client_ip.
+        Returns the time in seconds for which the queries must be delayed
+        to fit in the rate limit, or 0 if they can be executed immediately.
+        """
+        rate = float(get_setting('server.whois.max_query_rate_per_client'))
+        if not rate:
+            return 0
+        now = time.monotonic()
+        tokens = self._available_tokens(client_ip, rate, now) - query_count
+        self._query_buckets[client_ip] = tokens, now
+        if tokens >= 0:
+            return 0
+        delay = -tokens / rate
+        self.rate_limited_batches += 1
+        self.rate_limit_delay += delay
+        return delay
+
+    def prune(self) -> None:
+        """
+        Discard the rate limit state of clients that have not sent queries
+        for long enough to have their bucket refilled, as it is equal to
+        the state of a new client.
+        """
+        rate = float(get_setting('server.whois.max_query_rate_per_client'))
+        now = time.monotonic()
+        for client_ip in list(self._query_buckets.keys()):
+            if not rate or self._available_tokens(client_ip, rate, now) >= rate:
+                del self._query_buckets[client_ip]
+
+    def _available_tokens(self, client_ip: str, rate: float, now: float) -> float:
+        tokens, last_update = self._query_buckets.get(client_ip, (rate, now))
+        return min(rate, tokens + (now - last_update) * rate)
+
+    def _release_client(self, client_ip: str) -> None:
+        self._client_connections[client_ip] -= 1
+        if not self._client_connections[client_ip]:
+            del self._client_connections[client_ip]
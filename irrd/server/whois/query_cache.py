@@ -0,0 +1,93 @@
+import hashlib
+import logging
+import re
+from typing import List, Optional
+
+import redis
+
+from irrd.conf import get_setting
+from irrd.storage.change_serials import SourceChangeSerials
+from irrd.storage.preload import Preloader
+from .query_parser import WhoisQueryParser
+
+logger = logging.getLogger(__name__)
+
+REDIS_QUERY_CACHE_KEY_PREFIX = 'irrd-whois-query-cache-'
+# Responses larger than this are not cached, in bytes
+QUERY_CACHE_MAX_RESPONSE_SIZE = 1024 * 1024
+
+# IRRD-style commands whose response only depends on the data, and which
+# do not change the state of the session.
+CACHEABLE_IRRD_COMMANDS = set('g6aimor')
+# RIPE-style flags that do not change the state of the session.
+# Any other component is a free text search.
+CACHEABLE_RIPE_FLAGS = {'-l', '-L', '-M', '-x', '-i', '-T', '-K', '-F', '-r'}
+
+
+class WhoisQueryCache:
+    """
+    Cache for whois query responses, shared by all whois processes through redis.
+
+    Responses are cached by the normalised query and the state of the session
+    that affects the response, i.e. the selected sources and the RPKI and
+    scope filter settings, and by the query cost limit of the client, so that
+    responses to clients without a limit are not served to limited clients.
+    The cache key also includes the generation of the
+    preload store and the change serials of the selected sources, so that
+    every commit that changes the data, invalidates all affected responses.
+    Entries expire after server.whois.query_cache_ttl.
+
+    Only queries that do not change the state of the session are cached,
+    as the session state is not updated for a cached response.
+    """
+    def __init__(self, preloader: Preloader) -> None:
+        self.preloader = preloader
+        self.change_serials = SourceChangeSerials()
+        self._redis_conn = redis.Redis.from_url(get_setting('redis_url'))
+
+    def cache_key(self, query: str, query_parser: WhoisQueryParser) -> Optional[str]:
+        """
+        Determine the cache key for a query, to be executed by query_parser.
+        Returns None if the query is not cacheable. The key must be determined
+        before the query is executed, so that changes committed while the
+        query is executed result in a new key.
+        """
+        ttl = int(get_setting('server.whois.query_cache_ttl'))
+        generation = self.preloader.generation()
+        if not ttl or generation is None:
+            return None
+
+        query = re.sub(r'\s+', ' ', query.strip())
+        if query.startswith('!'):
+            if len(query) < 2 or query[1] not in CACHEABLE_IRRD_COMMANDS:
+                return None
+        else:
+            components = query.split(' ')
+            if any(c.startswith('-') and c not in CACHEABLE_RIPE_FLAGS for c in components):
+                return None
+
+        sources = query_parser.sources
+        change_serials = self.change_serials.current(sources)
+        key_data = '\n'.join([
+            query,
+            ','.join(sources),
+            str(query_parser.rpki_invalid_filter_enabled),
+            str(query_parser.out_scope_filter_enabled),
+            str(query_parser._query_cost_limit()),
+            str(generation),
+            ','.join(str(serial) for serial in change_serials),
+        ])
+        return REDIS_QUERY_CACHE_KEY_PREFIX + hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+    def get(self, cache_key: str) -> Optional[bytes]:
+        return self._redis_conn.get(cache_key)
+
+    def get_many(self, cache_keys: List[str]) -> List[Optional[bytes]]:
+        """Retrieve the cached responses for cache_keys, in the same order."""
+        if not cache_keys:
+            return []
+        return self._redis_conn.mget(cache_keys)
+
+    def set(self, cache_key: str, response: bytes) -> None:
+        ttl = int(get_setting('server.whois.query_cache_ttl'))
+        self._redis_conn.set(cache_key, response, ex=ttl)
@@ -0,0 +1,137 @@
+import logging
+import time
+from collections import defaultdict
+from typing import Dict, List, Union
+
+import redis
+
+from irrd.conf import get_setting
+from irrd.storage.database_handler import statement_cache
+
+logger = logging.getLogger(__name__)
+
+REDIS_WHOIS_QUERY_METRICS_KEY = b'irrd-whois-query-metrics'
+# Interval in which executors write their recorded metrics to redis, in seconds
+METRICS_FLUSH_INTERVAL = 5
+
+# Upper bounds of the histogram buckets for query latency, in seconds,
+# and for response size, in bytes. Larger values go in a +Inf bucket.
+LATENCY_BUCKETS: List[Union[int, float]] = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+RESPONSE_SIZE_BUCKETS: List[Union[int, float]] = [100, 1000, 10_000, 100_000, 1_000_000, 10_000_000]
+
+IRRD_COMMAND_TYPES = set('!vtg6aijJmnors')
+# RIPE-style flags that determine the type of query, rather than modify it
+RIPE_QUERY_FLAGS = {'-l', '-L', '-M', '-x', '-i', '-t', '-g'}
+# RIPE-style flags that modify a query, and take an argument
+RIPE_ARGUMENT_FLAGS = {'-s', '-T', '-V'}
+
+
+def query_command_type(query: str) -> str:
+    """
+    Determine the type of a query for metrics, e.g. !g, -i, or text
+    for a free text search. Unknown commands are reported as other,
+    so that the number of command types is limited.
+    """
+    query = query.strip()
+    if query.startswith('!'):
+        if len(query) > 1 and query[1] in IRRD_COMMAND_TYPES:
+            return query[:2]
+        return 'other'
+
+    components = query.split()
+    command_type = 'other'
+    while components:
+        component = components.pop(0)
+        if component in RIPE_QUERY_FLAGS:
+            return component
+        elif component in RIPE_ARGUMENT_FLAGS:
+            components = components[1:]
+        elif component == '-k':
+            command_type = '-k'
+        elif not component.startswith('-'):
+            return 'text'
+    return command_type
+
+
+class WhoisQueryMetrics:
+    """
+    Metrics on the latency and response size of whois queries, per command
+    type, as histograms. Each query executor records metrics locally, and
+    periodically adds them to the totals of all executors in redis, so that
+    recording metrics does not add a redis round trip to every query.
+    The hits and misses of the statement cache of the executor are
+    included on every flush.
+    The whois server process records the state of admission control and
+    the executor pool here as well, with record_server_metrics().
+    """
+    def __init__(self) -> None:
+        self._redis_conn = redis.Redis.from_url(get_setting('redis_url'))
+        self._pending: Dict[str, float] = defaultdict(float)
+        self._server_metrics: Dict[str, float] = {}
+        self._last_flush = time.monotonic()
+        self._statement_cache_hits = statement_cache.hits
+        self._statement_cache_misses = statement_cache.misses
+
+    def record(self, query: str, elapsed: float, response_size: int, slow: bool=False) -> None:
+        """
+        Record a query, which took elapsed seconds and returned
+        response_size bytes. Set slow if the query exceeded the
+        slow query threshold.
+        """
+        command_type = query_command_type(query)
+        self._pending[f'latency_bucket:{command_type}:{self._bucket(LATENCY_BUCKETS, elapsed)}'] += 1
+        self._pending[f'latency_sum:{command_type}'] += elapsed
+        self._pending[f'size_bucket:{command_type}:{self._bucket(RESPONSE_SIZE_BUCKETS, response_size)}'] += 1
+        self._pending[f'size_sum:{command_type}'] += response_size
+        if slow:
+            self._pending[f'slow_queries:{command_type}'] += 1
+
+    def record_server_metrics(self, metrics: Dict[str, float]) -> None:
+        """
+        Record metrics of the whois server process, like the number of active
+        connections. These replace the previous values, rather than being added
+        to the totals, as there is only one whois server process.
+        """
+        self._server_metrics.update(metrics)
+
+    def flush(self, force: bool=False) -> None:
+        """
+        Add the recorded metrics to the totals in redis, if METRICS_FLUSH_INTERVAL
+        has passed since the previous flush, or force is set.
+        """
+        if not (self._pending or self._server_metrics) or \
+                (not force and time.monotonic() - self._last_flush < METRICS_FLUSH_INTERVAL):
+            return
+        for field, count in [('statement_cache_hits', statement_cache.hits - self._statement_cache_hits),
+                             ('statement_cache_misses', statement_cache.misses - self._statement_cache_misses)]:
+            if count:
+                self._pending[field] += count
+        self._statement_cache_hits = statement_cache.hits
+        self._statement_cache_misses = statement_cache.misses
+        try:
+            pipeline = self._redis_conn.pipeline(transaction=False)
+            for field, value in self._pending.items():
+                if field.startswith('latency_sum:'):
+                    pipeline.hincrbyfloat(REDIS_WHOIS_QUERY_METRICS_KEY, field, value)
+                else:
+                    pipeline.hincrby(REDIS_WHOIS_QUERY_METRICS_KEY, field, int(value))
+            for field, value in self._server_metrics.items():
+                pipeline.hset(REDIS_WHOIS_QUERY_METRICS_KEY, field, value)
+            pipeline.execute()
+        except redis.ConnectionError as rce:  # pragma: no cover
+            logger.error(f'Failed to record whois query metrics due to redis connection error: {rce}')
+        self._pending.clear()
+        self._server_metrics.clear()
+        self._last_flush = time.monotonic()
+
+    def reset(self) -> None:
+        """Reset the totals of all executors, e.g. on startup of the whois server."""
+        self._pending.clear()
+        self._server_metrics.clear()
+        self._redis_conn.delete(REDIS_WHOIS_QUERY_METRICS_KEY)
+
+    def _bucket(self, buckets: List[Union[int, float]], value: float) -> str:
+        for bound in buckets:
+            if value <= bound:
+                return str(bound)
+        return '+Inf'
@@ -1,7 +1,7 @@
 import logging
 import re
 from collections import OrderedDict
-from typing import Optional, List, Set, Tuple, Any
+from typing import Optional, List, Set, Tuple, Any, Callable, Hashable, Iterable, Iterator, Union, Dict
 
 import ujson
 from IPy import IP
@@ -18,12 +18,25 @@ from irrd.scopefilter.status import ScopeFilterStatus
 from irrd.storage.database_handler import DatabaseHandler, is_serial_synchronised
 from irrd.storage.preload import Preloader
 from irrd.storage.queries import RPSLDatabaseQuery, DatabaseStatusQuery
+from irrd.storage.set_expansion_cache import origin_dependency, set_dependency
 from irrd.utils.validators import parse_as_number, ValidationError
-from .query_response import WhoisQueryResponseType, WhoisQueryResponseMode, WhoisQueryResponse
-from ..access_check import is_client_permitted
+from .query_response import (WhoisQueryResponseType, WhoisQueryResponseMode, WhoisQueryResponse,
+                             WhoisQueryResultStream)
+from ..access_check import is_client_permitted, is_client_in_access_list
 
 logger = logging.getLogger(__name__)
 
+# Optional suffixes for !g, !6 and !a queries, e.g. !gAS65537,A
+AGGREGATION_PREFIXES = 'A'
+AGGREGATION_PREFIX_RANGES = 'R'
+# Default timeout for a whois connection, in seconds, which can be changed with !t
+WHOIS_DEFAULT_TIMEOUT = 30
+# Attributes of the parser that are retained across queries in a session
+SESSION_STATE_ATTRIBUTES = [
+    'sources', 'user_agent', 'multiple_command_mode', 'rpki_invalid_filter_enabled',
+    'out_scope_filter_enabled', 'timeout',
+]
+
 
 class WhoisQueryParserException(ValueError):
     """
@@ -44,13 +57,21 @@ class WhoisQueryParser:
     Some query flags, particularly -k/!! and -s/!s retain state across queries,
     so a single instance of this object should be created per session, with
     handle_query() being called for each individual query.
+
+    If stream_results is set, queries that return object texts produce
+    a WhoisQueryResultStream rather than a string, which reads the objects
+    from the database while the response is generated.
     """
     lookup_field_names = lookup_field_names()
     database_handler: DatabaseHandler
     _current_set_root_object_class: Optional[str]
+    # Sets and origins used by the set expansion currently being resolved
+    _set_expansion_dependencies: Optional[Set[str]] = None
+    # Maximum query cost for this client, determined on first use
+    _max_query_cost: Optional[int] = None
 
     def __init__(self, client_ip: str, client_str: str, preloader: Preloader,
-                 database_handler: DatabaseHandler) -> None:
+                 database_handler: DatabaseHandler, stream_results: bool=False) -> None:
         self.all_valid_sources = list(get_setting('sources', {}).keys())
         self.sources_default = get_setting('sources_default')
         self.sources: List[str] = self.sources_default if self.sources_default else self.all_valid_sources
@@ -62,12 +83,31 @@ class WhoisQueryParser:
         self.rpki_aware = bool(get_setting('rpki.roa_source'))
         self.rpki_invalid_filter_enabled = self.rpki_aware
         self.out_scope_filter_enabled = True
-        self.timeout = 30
+        self.timeout = WHOIS_DEFAULT_TIMEOUT
         self.key_fields_only = False
         self.client_ip = client_ip
         self.client_str = client_str
         self.preloader = preloader
         self.database_handler = database_handler
+        self.stream_results = stream_results
+        self._prefetched_exact_keys: Dict[Tuple[str, str], str] = {}
+        self._prefetched_routes: Dict[Tuple[Optional[int], str], str] = {}
+
+    def session_state(self) -> Dict[str, Any]:
+        """
+        Return the state of this session that is retained across queries,
+        e.g. the selected sources, as a picklable dict.
+        """
+        return {attribute: getattr(self, attribute) for attribute in SESSION_STATE_ATTRIBUTES}
+
+    def restore_session_state(self, state: Dict[str, Any]) -> None:
+        """
+        Restore the state of a session, as returned by session_state(),
+        so that queries from one session can be handled by different
+        parser instances.
+        """
+        for attribute in SESSION_STATE_ATTRIBUTES:
+            setattr(self, attribute, state[attribute])
 
     def handle_query(self, query: str) -> WhoisQueryResponse:
         """
@@ -132,7 +172,7 @@ class WhoisQueryParser:
         command = full_command[0]
         parameter = full_command[1:]
         response_type = WhoisQueryResponseType.SUCCESS
-        result = None
+        result: Union[str, WhoisQueryResultStream, None] = None
 
         # A is not tested here because it is already handled in handle_irrd_routes_for_as_set
         queries_with_parameter = list('tg6ijmnors')
@@ -225,18 +265,49 @@ class WhoisQueryParser:
         Resolve all route(6)s prefixes for an origin, returning a space-separated list
         of all originating prefixes, not including duplicates.
         """
+        origin, aggregation = self._split_aggregation_flag(origin)
         try:
             origin_formatted, _ = parse_as_number(origin)
         except ValidationError as ve:
             raise WhoisQueryParserException(str(ve))
 
-        prefixes = self.preloader.routes_for_origins([origin_formatted], self.sources, ip_version=ip_version)
+        if not aggregation:
+            prefetched = self._prefetched_routes.pop((ip_version, origin_formatted), None)
+            if prefetched is not None:
+                return prefetched
+        prefixes = self._routes_for_origins([origin_formatted], ip_version, aggregation)
         return ' '.join(prefixes)
 
+    def prefetch_routes_for_origins(self, parameters: List[str], ip_version: int) -> None:
+        """
+        Look up the prefixes for a series of !g or !6 queries, as indicated by
+        ip_version, in a single lookup in the preload store, e.g. for pipelined
+        queries. The results are used by handle_irrd_routes_for_origin_v4/v6()
+        for each of these parameters, which must be called before any query
+        that changes the state of the session. Parameters with an aggregation
+        flag or an invalid origin are not prefetched.
+        """
+        self._prefetched_routes = {}
+        origins = set()
+        for parameter in parameters:
+            if len(parameter) > 2 and parameter[-2] == ',':
+                continue
+            try:
+                origin_formatted, _ = parse_as_number(parameter)
+            except ValidationError:
+                continue
+            origins.add(origin_formatted)
+        if not origins:
+            return
+        prefixes_per_origin = self.preloader.routes_per_origin(origins, self.sources, ip_version=ip_version)
+        for origin, prefixes in prefixes_per_origin.items():
+            self._prefetched_routes[(ip_version, origin)] = ' '.join(prefixes)
+
     def handle_irrd_routes_for_as_set(self, set_name: str) -> str:
         """
         !a query - find all originating prefixes for all members of an AS-set, e.g. !a4AS-FOO or !a6AS-FOO
         """
+        set_name, aggregation = self._split_aggregation_flag(set_name)
         ip_version: Optional[int] = None
         if set_name.startswith('4'):
             set_name = set_name[1:]
@@ -249,9 +320,16 @@ class WhoisQueryParser:
             raise WhoisQueryParserException('Missing required set name for A query')
 
         self._current_set_root_object_class = 'as-set'
-        members = self._recursive_set_resolve({set_name})
-        prefixes = self.preloader.routes_for_origins(members, self.sources, ip_version=ip_version)
-        return ' '.join(prefixes)
+
+        def resolve() -> str:
+            self._check_set_expansion_size(set_name, count_routes=True, ip_version=ip_version)
+            members = self._recursive_set_resolve({set_name})
+            prefixes = self._routes_for_origins(members, ip_version, aggregation)
+            return ' '.join(prefixes)
+
+        result = self._cached_set_expansion(('!a', set_name.upper(), ip_version, aggregation), resolve)
+        self._check_result_size(result)
+        return result
 
     def handle_irrd_set_members(self, parameter: str) -> str:
         """
@@ -264,29 +342,108 @@ class WhoisQueryParser:
             parameter = parameter[:-2]
 
         self._current_set_root_object_class = None
+        ipv4_only = get_setting('compatibility.ipv4_only_route_set_members')
+
+        def resolve() -> str:
+            if not recursive:
+                members, leaf_members = self._find_set_members({parameter})
+                members.update(leaf_members)
+            else:
+                self._check_set_expansion_size(parameter)
+                members = self._recursive_set_resolve({parameter})
+            if parameter in members:
+                members.remove(parameter)
+
+            if ipv4_only:
+                original_members = set(members)
+                for member in original_members:
+                    try:
+                        IP(member)
+                    except ValueError:
+                        continue  # This is not a prefix, ignore.
+                    try:
+                        IP(member, ipversion=4)
+                    except ValueError:
+                        # This was a valid prefix, but not a valid IPv4 prefix,
+                        # and should be removed.
+                        members.remove(member)
+
+            return ' '.join(sorted(members))
+
         if not recursive:
-            members, leaf_members = self._find_set_members({parameter})
-            members.update(leaf_members)
+            result = resolve()
         else:
-            members = self._recursive_set_resolve({parameter})
-        if parameter in members:
-            members.remove(parameter)
+            result = self._cached_set_expansion(('!i', parameter.upper(), bool(ipv4_only)), resolve)
+        self._check_result_size(result)
+        return result
 
-        if get_setting('compatibility.ipv4_only_route_set_members'):
-            original_members = set(members)
-            for member in original_members:
-                try:
-                    IP(member)
-                except ValueError:
-                    continue  # This is not a prefix, ignore.
-                try:
-                    IP(member, ipversion=4)
-                except ValueError:
-                    # This was a valid prefix, but not a valid IPv4 prefix,
-                    # and should be removed.
-                    members.remove(member)
+    def _cached_set_expansion(self, key: Tuple[Hashable, ...], resolve: Callable[[], str]) -> str:
+        """
+        Return the result of resolve(), a set expansion, from the set expansion
+        cache of the preloader if possible. Only expansions from the preload
+        store are cached. The cache key is extended with the sources, root object
+        class and filters of the current query.
+        The dependencies of the expansion are recorded while it is resolved,
+        so that the entry is invalidated when any of them change.
+        """
+        if not self.preloader.set_store_available():
+            return resolve()
+
+        cache = self.preloader.set_expansion_cache
+        key += (tuple(self.sources), self._current_set_root_object_class,
+                self.rpki_invalid_filter_enabled, self.out_scope_filter_enabled)
+        result = cache.get(key)
+        if result is not None:
+            return result
+
+        generation = cache.generation
+        self._set_expansion_dependencies = set()
+        try:
+            result = resolve()
+            cache.put(key, result, self._set_expansion_dependencies, generation)
+        finally:
+            self._set_expansion_dependencies = None
+        return result
+
+    def _routes_for_origins(self, origins: Union[List[str], Set[str]], ip_version: Optional[int]=None,
+                            aggregation: Optional[str]=None) -> Iterable[str]:
+        """
+        Find the prefixes originated by origins from the preloader,
+        recording the origins as dependencies of the current set expansion.
+        If aggregation is set, the prefixes are aggregated, optionally into ranges.
+        """
+        if self._set_expansion_dependencies is not None:
+            self._set_expansion_dependencies.update(origin_dependency(origin) for origin in origins)
+        if aggregation:
+            return self.preloader.aggregated_routes_for_origins(
+                origins, self.sources, ip_version=ip_version, ranges=aggregation == AGGREGATION_PREFIX_RANGES)
+        return self.preloader.routes_for_origins(origins, self.sources, ip_version=ip_version)
+
+    def _prefix_index_usable(self) -> bool:
+        """
+        Determine whether origins for a prefix can be retrieved from the
+        preloader, rather than the database. The preload store only
+        contains routes that are not RPKI invalid and in scope, so it can
+        only be used if the query applies the same filters.
+        """
+        if self.object_classes or not self.out_scope_filter_enabled:
+            return False
+        if self.rpki_aware and not self.rpki_invalid_filter_enabled:
+            return False
+        return self.preloader.prefix_index_available()
 
-        return ' '.join(sorted(members))
+    def _split_aggregation_flag(self, parameter: str) -> Tuple[str, Optional[str]]:
+        """
+        Split the optional aggregation flag from the parameter of a !g, !6 or !a query,
+        e.g. AS65537,A for aggregated prefixes, or AS65537,R for aggregated prefix ranges.
+        Returns the parameter without the flag, and the flag, if any.
+        """
+        if len(parameter) > 2 and parameter[-2] == ',':
+            flag = parameter[-1].upper()
+            if flag in [AGGREGATION_PREFIXES, AGGREGATION_PREFIX_RANGES]:
+                return parameter[:-2], flag
+            raise WhoisQueryParserException(f'Invalid aggregation flag: {parameter[-1]}')
+        return parameter, None
 
     def _recursive_set_resolve(self, members: Set[str], sets_seen=None) -> Set[str]:
         """
@@ -321,8 +478,7 @@ class WhoisQueryParser:
             try:
                 as_number_formatted, _ = parse_as_number(sub_member)
                 if self._current_set_root_object_class == 'route-set':
-                    set_members.update(self.preloader.routes_for_origins(
-                        [as_number_formatted], self.sources))
+                    set_members.update(self._routes_for_origins({as_number_formatted}))
                     resolved_as_members.add(sub_member)
                 else:
                     set_members.add(sub_member)
@@ -349,6 +505,11 @@ class WhoisQueryParser:
           names for which no further data could be found - for
           example references to non-existent other sets
         """
+        if self._set_expansion_dependencies is not None:
+            self._set_expansion_dependencies.update(set_dependency(set_name) for set_name in set_names)
+        if self.preloader.set_store_available():
+            return self._find_set_members_preloaded(set_names)
+
         members: Set[str] = set()
         sets_already_resolved: Set[str] = set()
 
@@ -415,6 +576,63 @@ class WhoisQueryParser:
         leaf_members = set_names - sets_already_resolved
         return members, leaf_members
 
+    def _find_set_members_preloaded(self, set_names: Set[str]) -> Tuple[Set[str], Set[str]]:
+        """
+        Find all members of a number of route-sets or as-sets, from the
+        preload store. Returns the same results as _find_set_members(),
+        including the source priority and filters of the current query.
+        """
+        members: Set[str] = set()
+        sets_already_resolved: Set[str] = set()
+        query_sources = self._query_sources()
+
+        object_classes = ['as-set', 'route-set']
+        if self._current_set_root_object_class == 'as-set':
+            object_classes = [self._current_set_root_object_class]
+
+        def source_priority(source: str) -> int:
+            if query_sources:
+                return query_sources.index(source)
+            if source in self.all_valid_sources:
+                return self.all_valid_sources.index(source)
+            return len(self.all_valid_sources)
+
+        # Find the highest priority source in which each set exists
+        found_sets = []
+        for set_name in set_names:
+            candidates = [
+                (source_priority(source), source, preloaded_set)
+                for source, preloaded_set in self.preloader.sets(set_name).items()
+                if (not query_sources or source in query_sources) and preloaded_set[0] in object_classes
+            ]
+            if candidates:
+                priority, source, preloaded_set = min(candidates, key=lambda c: (c[0], c[1]))
+                found_sets.append((priority, set_name.upper(), preloaded_set))
+
+        if not found_sets:
+            return set(), set_names
+
+        # Same as the ordering of the SQL query in _find_set_members()
+        found_sets.sort(key=lambda s: (s[0], s[1]))
+        if not self._current_set_root_object_class:
+            self._current_set_root_object_class = found_sets[0][2][0]
+
+        for _, rpsl_pk, (object_class, set_members, mbrs_by_ref_members) in found_sets:
+            sets_already_resolved.add(rpsl_pk)
+            members.update(set_members)
+
+            for source, member, rpki_acceptable, scope_acceptable in mbrs_by_ref_members:
+                if query_sources and source not in query_sources:
+                    continue
+                if self.rpki_invalid_filter_enabled and not rpki_acceptable:
+                    continue
+                if self.out_scope_filter_enabled and not scope_acceptable:
+                    continue
+                members.add(member)
+
+        leaf_members = set_names - sets_already_resolved
+        return members, leaf_members
+
     def handle_irrd_database_serial_range(self, parameter: str) -> str:
         """!j query - database serial range"""
         if parameter == '-*':
@@ -480,9 +698,43 @@ class WhoisQueryParser:
             object_class, rpsl_pk = parameter.split(',', maxsplit=1)
         except ValueError:
             raise WhoisQueryParserException(f'Invalid argument for object lookup: {parameter}')
+        prefetched = self._prefetched_exact_keys.pop((object_class, rpsl_pk.upper().strip()), None)
+        if prefetched is not None:
+            return prefetched
         query = self._prepare_query().object_classes([object_class]).rpsl_pk(rpsl_pk).first_only()
         return self._execute_query_flatten_output(query)
 
+    def prefetch_exact_keys(self, parameters: List[str]) -> None:
+        """
+        Look up the objects for a series of !m queries in a single database query,
+        e.g. for pipelined queries. The results are used by handle_irrd_exact_key()
+        for each of these parameters, which must be called before any query
+        that changes the state of the session. Keys that do not exist are
+        looked up again by handle_irrd_exact_key(), so that the response
+        is the same as without prefetching.
+        """
+        self._prefetched_exact_keys = {}
+        if self.key_fields_only:
+            return
+        keys = set()
+        for parameter in parameters:
+            try:
+                object_class, rpsl_pk = parameter.split(',', maxsplit=1)
+            except ValueError:
+                continue
+            keys.add((object_class, rpsl_pk.upper().strip()))
+        if not keys:
+            return
+
+        object_classes = list({object_class for object_class, rpsl_pk in keys})
+        rpsl_pks = list({rpsl_pk for object_class, rpsl_pk in keys})
+        query = self._prepare_query().object_classes(object_classes).rpsl_pks(rpsl_pks)
+        for obj in self.database_handler.execute_query(query):
+            key = (obj['object_class'], obj['rpsl_pk'])
+            # Results are ordered by source priority, so the first match is the one !m returns
+            if key in keys and key not in self._prefetched_exact_keys:
+                self._prefetched_exact_keys[key] = ''.join(self._flatten_query_output([obj]))
+
     def handle_irrd_route_search(self, parameter: str):
         """
         !r query - route search with various options:
@@ -498,19 +750,26 @@ class WhoisQueryParser:
         else:
             address = parameter
         try:
-            address = IP(address)
+            prefix = IP(address)
         except ValueError:
             raise WhoisQueryParserException(f'Invalid input for route search: {parameter}')
 
+        if option == 'o' and self._prefix_index_usable():
+            origins = self.preloader.origins_for_prefix(
+                prefix.version(), str(prefix.net()), prefix.prefixlen(),
+                self._query_sources() or self.all_valid_sources,
+            )
+            return ' '.join(origins)
+
         query = self._prepare_query(ordered_by_sources=False).object_classes(['route', 'route6'])
         if option is None or option == 'o':
-            query = query.ip_exact(address)
+            query = query.ip_exact(prefix)
         elif option == 'l':
-            query = query.ip_less_specific_one_level(address)
+            query = self._route_search_one_level(query, prefix)
         elif option == 'L':
-            query = query.ip_less_specific(address)
+            query = query.ip_less_specific(prefix)
         elif option == 'M':
-            query = query.ip_more_specific(address)
+            query = query.ip_more_specific(prefix)
         else:
             raise WhoisQueryParserException(f'Invalid route search option: {option}')
 
@@ -518,7 +777,7 @@ class WhoisQueryParser:
             query_result = self.database_handler.execute_query(query)
             prefixes = [r['parsed_data']['origin'] for r in query_result]
             return ' '.join(prefixes)
-        return self._execute_query_flatten_output(query)
+        return self._execute_query_flatten_output(query, estimate_cost=option == 'M')
 
     def handle_irrd_sources_list(self, parameter: str) -> Optional[str]:
         """
@@ -589,6 +848,8 @@ class WhoisQueryParser:
                 except IndexError:
                     raise WhoisQueryParserException(f'Missing argument for flag/search: {command}')
             else:  # assume query to be a free text search
+                if isinstance(result, WhoisQueryResultStream):
+                    result.close()
                 result = self.handle_ripe_text_search(component)
 
         return WhoisQueryResponse(
@@ -597,7 +858,7 @@ class WhoisQueryParser:
             result=result,
         )
 
-    def handle_ripe_route_search(self, command: str, parameter: str) -> str:
+    def handle_ripe_route_search(self, command: str, parameter: str) -> Union[str, WhoisQueryResultStream]:
         """
         -l/L/M/x query - route search for:
            -x 192.0.2.0/2 returns all exact matching objects
@@ -614,13 +875,13 @@ class WhoisQueryParser:
         if command == 'x':
             query = query.ip_exact(address)
         elif command == 'l':
-            query = query.ip_less_specific_one_level(address)
+            query = self._route_search_one_level(query, address)
         elif command == 'L':
             query = query.ip_less_specific(address)
         elif command == 'M':
             query = query.ip_more_specific(address)
 
-        return self._execute_query_flatten_output(query)
+        return self._execute_query_flatten_output(query, estimate_cost=command == 'M')
 
     def handle_ripe_sources_list(self, sources_list: Optional[str]) -> None:
         """-s/-a parameter - set sources list. Empty list enables all sources. """
@@ -647,7 +908,7 @@ class WhoisQueryParser:
         """-K paramater - only return primary key and members fields"""
         self.key_fields_only = True
 
-    def handle_ripe_text_search(self, value: str) -> str:
+    def handle_ripe_text_search(self, value: str) -> Union[str, WhoisQueryResultStream]:
         query = self._prepare_query(ordered_by_sources=False).text_search(value)
         return self._execute_query_flatten_output(query)
 
@@ -687,7 +948,7 @@ class WhoisQueryParser:
         except NRTMGeneratorException as nge:
             raise WhoisQueryParserException(str(nge))
 
-    def handle_inverse_attr_search(self, attribute: str, value: str) -> str:
+    def handle_inverse_attr_search(self, attribute: str, value: str) -> Union[str, WhoisQueryResultStream]:
         """
         -i/!o query - inverse search for attribute values
         e.g. `-i mnt-by FOO` finds all objects where (one of the) maintainer(s) is FOO,
@@ -699,17 +960,14 @@ class WhoisQueryParser:
                    f'only supported for attributes: {readable_lookup_field_names}')
             raise WhoisQueryParserException(msg)
         query = self._prepare_query(ordered_by_sources=False).lookup_attr(attribute, value)
-        return self._execute_query_flatten_output(query)
+        return self._execute_query_flatten_output(query, estimate_cost=True)
 
     def _prepare_query(self, column_names=None, ordered_by_sources=True) -> RPSLDatabaseQuery:
         """Prepare an RPSLDatabaseQuery by applying relevant sources/class filters."""
         query = RPSLDatabaseQuery(column_names, ordered_by_sources)
-        if self.sources and self.sources != self.all_valid_sources:
-            query.sources(self.sources)
-        else:
-            default = list(get_setting('sources_default', []))
-            if default:
-                query.sources(list(default))
+        query_sources = self._query_sources()
+        if query_sources:
+            query.sources(query_sources)
         if self.object_classes:
             query.object_classes(self.object_classes)
         if self.rpki_invalid_filter_enabled:
@@ -718,29 +976,187 @@ class WhoisQueryParser:
             query.scopefilter_status([ScopeFilterStatus.in_scope])
         return query
 
-    def _execute_query_flatten_output(self, query: RPSLDatabaseQuery) -> str:
+    def _route_search_one_level(self, query: RPSLDatabaseQuery, prefix: IP) -> RPSLDatabaseQuery:
+        """
+        Filter a route(6) query on the one level less specific objects of prefix.
+        The parent links in the database are kept per object class and source,
+        regardless of RPKI and scope filter status. If queries are restricted
+        to a single source, and neither filter can exclude any of its objects,
+        the parent links of route(6) objects for prefix, if any, point to the
+        one level less specific objects, which can then be found with an
+        index lookup. This is the case when a filter is disabled, not
+        configured, or the source is excluded from it.
+        """
+        query_sources = self._query_sources() or self.all_valid_sources
+        if len(query_sources) != 1:
+            return query.ip_less_specific_one_level(prefix, use_parent_links=False)
+        source = query_sources[0]
+        rpki_filter_effective = (
+            self.rpki_invalid_filter_enabled and
+            not get_setting(f'sources.{source}.rpki_excluded')
+        )
+        scope_filter_effective = (
+            self.out_scope_filter_enabled and
+            bool(get_setting('scopefilter')) and
+            not get_setting(f'sources.{source}.scopefilter_excluded')
+        )
+        use_parent_links = not rpki_filter_effective and not scope_filter_effective
+        return query.ip_less_specific_one_level(prefix, use_parent_links=use_parent_links)
+
+    def _query_sources(self) -> Optional[List[str]]:
+        """
+        Determine the sources to which queries are restricted, in order of
+        priority. Returns None if queries are not restricted to any sources.
+        """
+        if self.sources and self.sources != self.all_valid_sources:
+            return self.sources
+        default = list(get_setting('sources_default', []))
+        return default if default else None
+
+    def _execute_query_flatten_output(self, query: RPSLDatabaseQuery,
+                                      estimate_cost: bool=False) -> Union[str, WhoisQueryResultStream]:
         """
         Execute an RPSLDatabaseQuery, and flatten the output into a string with object text
-        for easy passing to a WhoisQueryResponse.
+        for easy passing to a WhoisQueryResponse. If stream_results is set, the
+        output is a WhoisQueryResultStream instead, except with key fields only,
+        which requires deduplicating the entire result.
+        If estimate_cost is set, the query is rejected before it is executed,
+        if its estimated number of results exceeds the limit for the client.
         """
-        query_response = self.database_handler.execute_query(query)
+        if estimate_cost:
+            self._check_query_cost(query)
         if self.key_fields_only:
-            result = self._filter_key_fields(query_response)
-        else:
-            result = ''
-            for obj in query_response:
-                result += obj['object_text']
-                if (
-                        self.rpki_aware and
-                        obj['source'] != RPKI_IRR_PSEUDO_SOURCE and
-                        obj['object_class'] in RPKI_RELEVANT_OBJECT_CLASSES
-                ):
-                    comment = ''
-                    if obj['rpki_status'] == RPKIStatus.not_found:
-                        comment = ' # No ROAs found, or RPKI validation not enabled for source'
-                    result += f'rpki-ov-state:  {obj["rpki_status"].name}{comment}\n'
-                result += '\n'
-        return result.strip('\n\r')
+            return self._filter_key_fields(self.database_handler.execute_query(query)).strip('\n\r')
+        if self.stream_results:
+            return WhoisQueryResultStream(self._flatten_query_output(
+                self.database_handler.execute_query_stream(query)))
+        return ''.join(self._flatten_query_output(self.database_handler.execute_query(query)))
+
+    def _check_query_cost(self, query: RPSLDatabaseQuery) -> None:
+        """
+        Reject query if the number of results estimated by the database
+        exceeds the maximum query cost for this client.
+        """
+        max_query_cost = self._query_cost_limit()
+        if not max_query_cost:
+            return
+        estimated_rows = self.database_handler.estimate_row_count(query)
+        if estimated_rows > max_query_cost:
+            self._reject_query_cost(f'estimated number of results ({estimated_rows})', max_query_cost)
+
+    def _check_result_size(self, result: str) -> None:
+        """
+        Reject a query if its result, a space-separated list like the members
+        of a set, exceeds the maximum query cost for this client.
+        """
+        max_query_cost = self._query_cost_limit()
+        if not max_query_cost or not result:
+            return
+        result_size = result.count(' ') + 1
+        if result_size > max_query_cost:
+            self._reject_query_cost(f'number of results ({result_size})', max_query_cost)
+
+    def _check_set_expansion_size(self, set_name: str, count_routes: bool=False,
+                                  ip_version: Optional[int]=None) -> None:
+        """
+        Reject a recursive set expansion before resolving it, if the number
+        of results, estimated from the preload store, exceeds the maximum
+        query cost for this client. The sets are walked through their
+        preloaded members, counting the routes originated by AS members from
+        the preloaded route counts if count_routes is set, or if the root
+        object is a route-set. The walk stops once the limit is exceeded.
+        """
+        max_query_cost = self._query_cost_limit()
+        if not max_query_cost or not self.preloader.set_store_available():
+            return
+
+        estimated_size = 0
+        sets_seen: Set[str] = set()
+        origins_seen: Set[str] = set()
+        set_names = {set_name}
+        while set_names and estimated_size <= max_query_cost:
+            sets_seen.update(set_names)
+            members, _ = self._find_set_members_preloaded(set_names)
+            set_names = set()
+            origins = set()
+            for member in members:
+                if self._current_set_root_object_class in [None, 'route-set']:
+                    try:
+                        IP(member)
+                        estimated_size += 1
+                        continue
+                    except ValueError:
+                        pass
+                try:
+                    origin, _ = parse_as_number(member)
+                except ValidationError:
+                    if member not in sets_seen:
+                        set_names.add(member)
+                    continue
+                if origin not in origins_seen:
+                    origins.add(origin)
+            origins_seen.update(origins)
+            if count_routes or self._current_set_root_object_class == 'route-set':
+                estimated_size += self.preloader.route_count_for_origins(origins, self.sources, ip_version)
+            else:
+                estimated_size += len(origins)
+
+        if estimated_size > max_query_cost:
+            self._reject_query_cost(f'estimated number of results ({estimated_size})', max_query_cost)
+
+    def _reject_query_cost(self, cost_description: str, max_query_cost: int) -> None:
+        logger.info(f'{self.client_str}: rejected query as the {cost_description} '
+                    f'exceeds the limit of {max_query_cost}')
+        raise WhoisQueryParserException(
+            f'Query rejected, as the {cost_description} exceeds the limit of {max_query_cost} '
+            f'for this client. Narrow down the query, e.g. by selecting fewer sources or object classes.'
+        )
+
+    def _query_cost_limit(self) -> int:
+        """
+        Determine the maximum query cost for this client: the limit in
+        server.whois.max_query_cost_per_access_list for the first access list
+        that includes the client, or server.whois.max_query_cost otherwise.
+        0 means no limit.
+        """
+        if self._max_query_cost is None:
+            self._max_query_cost = int(get_setting('server.whois.max_query_cost', 0))
+            access_list_limits = get_setting('server.whois.max_query_cost_per_access_list') or {}
+            for access_list_name, limit in access_list_limits.items():
+                if is_client_in_access_list(self.client_ip, access_list_name):
+                    self._max_query_cost = int(limit)
+                    break
+        return self._max_query_cost
+
+    def _flatten_query_output(self, query_response: Iterable[Dict[str, Any]]) -> Iterator[str]:
+        """
+        Generate the object texts from a query response, with one chunk for each
+        object. Leading and trailing newlines of the entire output are removed.
+        """
+        output_started = False
+        trailing_newlines = ''
+        for obj in query_response:
+            text = obj['object_text']
+            if (
+                    self.rpki_aware and
+                    obj['source'] != RPKI_IRR_PSEUDO_SOURCE and
+                    obj['object_class'] in RPKI_RELEVANT_OBJECT_CLASSES
+            ):
+                comment = ''
+                if obj['rpki_status'] == RPKIStatus.not_found:
+                    comment = ' # No ROAs found, or RPKI validation not enabled for source'
+                text += f'rpki-ov-state:  {obj["rpki_status"].name}{comment}\n'
+            text += '\n'
+
+            if not output_started:
+                text = text.lstrip('\n\r')
+            stripped_text = text.rstrip('\n\r')
+            if stripped_text:
+                yield trailing_newlines + stripped_text
+                trailing_newlines = text[len(stripped_text):]
+                output_started = True
+            else:
+                trailing_newlines += text
 
     def _filter_key_fields(self, query_response) -> str:
         results: OrderedSet[str] = OrderedSet()
@@ -1,8 +1,16 @@
 from enum import Enum
-from typing import Optional
+from tempfile import SpooledTemporaryFile
+from typing import Iterator, Optional, Union
 
 from irrd.utils.text import remove_auth_hashes
 
+# Size of the chunks in which streamed responses are read back from the spool
+# for IRRD-style responses, in characters.
+RESPONSE_SPOOL_READ_SIZE = 64 * 1024
+# Maximum size of the in-memory spool for IRRD-style streamed responses,
+# before it is written to a temporary file, in characters.
+RESPONSE_SPOOL_MAX_MEMORY = 4 * 1024 * 1024
+
 
 class WhoisQueryResponseType(Enum):
     """
@@ -22,67 +30,135 @@ class WhoisQueryResponseMode(Enum):
     RIPE = 'ripe'
 
 
+class WhoisQueryResultStream:
+    """
+    A query result that is produced in chunks, e.g. the texts of objects
+    read from a server-side database cursor, so that large results do not
+    need to be held in memory as a single string.
+
+    The first chunk is read immediately, so that empty results and errors
+    in executing the query are detected while handling the query.
+    The chunks must consist of complete lines.
+    """
+    def __init__(self, chunks: Iterator[str]) -> None:
+        self._chunks = chunks
+        self._first_chunk = next(chunks, None)
+
+    def __bool__(self) -> bool:
+        return self._first_chunk is not None
+
+    def __iter__(self) -> Iterator[str]:
+        if self._first_chunk is None:
+            return
+        yield self._first_chunk
+        yield from self._chunks
+
+    def close(self) -> None:
+        """Close the underlying iterator, if the result is not used."""
+        close = getattr(self._chunks, 'close', None)
+        if close:
+            close()
+
+
 class WhoisQueryResponse:
     """
     Container for all data for a response to a query.
 
     Based on the response_type and mode, can render a string of the complete
-    response to send back to the user.
+    response to send back to the user, or the same response in chunks,
+    to limit memory use for large results.
     """
     response_type: WhoisQueryResponseType = WhoisQueryResponseType.SUCCESS
     mode: WhoisQueryResponseMode = WhoisQueryResponseMode.RIPE
-    result: Optional[str] = None
+    result: Union[str, WhoisQueryResultStream, None] = None
 
     def __init__(
             self,
             response_type: WhoisQueryResponseType,
             mode: WhoisQueryResponseMode,
-            result: Optional[str],
+            result: Union[str, WhoisQueryResultStream, None],
     ) -> None:
         self.response_type = response_type
         self.mode = mode
         self.result = result
 
+    def generate_response_chunks(self) -> Iterator[str]:
+        """
+        Generate the response in chunks. For streamed results, RIPE-style
+        responses are generated while the result is read. IRRD-style responses
+        start with the length of the result, so the result is first spooled,
+        in memory up to RESPONSE_SPOOL_MAX_MEMORY, and to a temporary file
+        beyond that.
+        """
+        if not isinstance(self.result, WhoisQueryResultStream) or not self.result:
+            yield self.generate_response()
+            return
+
+        chunks = (remove_auth_hashes(chunk) for chunk in self.result)
+        if self.mode == WhoisQueryResponseMode.RIPE and self.response_type == WhoisQueryResponseType.SUCCESS:
+            yield from chunks
+            yield '\n\n\n'
+        elif self.mode == WhoisQueryResponseMode.IRRD and self.response_type == WhoisQueryResponseType.SUCCESS:
+            with SpooledTemporaryFile(max_size=RESPONSE_SPOOL_MAX_MEMORY, mode='w+', encoding='utf-8') as spool:
+                result_len = 1
+                for chunk in chunks:
+                    spool.write(chunk)
+                    result_len += len(chunk)
+                spool.seek(0)
+                yield f'A{result_len}\n'
+                while True:
+                    chunk = spool.read(RESPONSE_SPOOL_READ_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            yield '\nC\n'
+        else:
+            self.result = ''.join(chunks)
+            yield self.generate_response()
+
     def generate_response(self) -> str:
-        self.result = remove_auth_hashes(self.result)
+        if isinstance(self.result, WhoisQueryResultStream):
+            self.result = ''.join(self.result)
+        result: Optional[str] = remove_auth_hashes(self.result)
+        self.result = result
 
         if self.mode == WhoisQueryResponseMode.IRRD:
-            response = self._generate_response_irrd()
+            response = self._generate_response_irrd(result)
             if response is not None:
                 return response
 
         elif self.mode == WhoisQueryResponseMode.RIPE:
-            response = self._generate_response_ripe()
+            response = self._generate_response_ripe(result)
             if response is not None:
                 return response
 
         raise RuntimeError(f'Unable to formulate response for {self.response_type} / {self.mode}: {self.result}')
 
-    def _generate_response_irrd(self) -> Optional[str]:
+    def _generate_response_irrd(self, result: Optional[str]) -> Optional[str]:
         if self.response_type == WhoisQueryResponseType.SUCCESS:
-            if self.result:
-                result_len = len(self.result) + 1
-                return f'A{result_len}\n{self.result}\nC\n'
+            if result:
+                result_len = len(result) + 1
+                return f'A{result_len}\n{result}\nC\n'
             else:
                 return 'C\n'
         elif self.response_type == WhoisQueryResponseType.KEY_NOT_FOUND:
             return 'D\n'
         elif self.response_type == WhoisQueryResponseType.ERROR:
-            return f'F {self.result}\n'
+            return f'F {result}\n'
         elif self.response_type == WhoisQueryResponseType.NO_RESPONSE:
             return ''
         return None
 
-    def _generate_response_ripe(self) -> Optional[str]:
+    def _generate_response_ripe(self, result: Optional[str]) -> Optional[str]:
         # RIPE-style responses need two empty lines at the end, hence
         # the multiple newlines for each response (#335)
         # # https://www.ripe.net/manage-ips-and-asns/db/support/documentation/ripe-database-query-reference-manual#2-0-querying-the-ripe-database
         if self.response_type == WhoisQueryResponseType.SUCCESS:
-            if self.result:
-                return self.result + '\n\n\n'
+            if result:
+                return result + '\n\n\n'
             return '%  No entries found for the selected source(s).\n\n\n'
         elif self.response_type == WhoisQueryResponseType.KEY_NOT_FOUND:
             return '%  No entries found for the selected source(s).\n\n\n'
         elif self.response_type == WhoisQueryResponseType.ERROR:
-            return f'%% ERROR: {self.result}\n\n\n'
+            return f'%% ERROR: {result}\n\n\n'
         return None
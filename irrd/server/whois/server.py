@@ -1,23 +1,62 @@
+import asyncio
+import itertools
 import logging
 import multiprocessing as mp
 import os
+import queue
 import signal
 import socket
-import socketserver
 import threading
 import time
+from typing import Any, Awaitable, Callable, Dict, Generator, Iterator, List, Optional, Set, Tuple
 
 from IPy import IP
 from setproctitle import setproctitle
 
 from irrd.conf import get_setting, get_configuration
 from irrd.server.access_check import is_client_permitted
-from irrd.server.whois.query_parser import WhoisQueryParser
+from irrd.server.whois.admission_control import WhoisAdmissionControl
+from irrd.server.whois.query_cache import WhoisQueryCache, QUERY_CACHE_MAX_RESPONSE_SIZE
+from irrd.server.whois.query_metrics import WhoisQueryMetrics, METRICS_FLUSH_INTERVAL
+from irrd.server.whois.query_parser import WhoisQueryParser, WHOIS_DEFAULT_TIMEOUT
+from irrd.server.whois.query_response import WhoisQueryResponse, WhoisQueryResponseMode, WhoisQueryResponseType
 from irrd.storage.database_handler import DatabaseHandler
 from irrd.storage.preload import Preloader
+from irrd.utils.process_support import memory_usage
 
 logger = logging.getLogger(__name__)
-mp.allow_connection_pickling()
+
+# Interval in which dead query executors are detected and replaced,
+# and executors due for recycling are replaced, in seconds
+EXECUTOR_CHECK_INTERVAL = 5
+# Interval in which an executor due for recycling checks whether it can exit, in seconds
+EXECUTOR_RETIRE_CHECK_INTERVAL = 1
+# Interval in which the pool checks whether a queued task was picked up by an executor, in seconds
+EXECUTOR_PICKUP_CHECK_INTERVAL = 0.1
+
+# Minimum size of the chunks in which executors send responses, in bytes
+RESPONSE_CHUNK_SIZE = 64 * 1024
+# Maximum number of chunks of a response that an executor sends
+# before they are written to the client
+RESPONSE_CHUNKS_IN_FLIGHT = 4
+# Size of reads from client connections, and the maximum length of a query, in bytes
+CLIENT_READ_SIZE = 64 * 1024
+# Maximum number of pipelined queries executed by an executor in one task
+MAX_QUERIES_PER_BATCH = 1000
+# Commands of pipelined queries that are looked up together when consecutive
+PREFETCH_COMMANDS = ['!m', '!g', '!6']
+
+# A part of the result of a query executed by a WhoisQueryExecutor, as a tuple
+# of part of the response in bytes, and the new state of the session,
+# which is only set on the last part of the result.
+QueryResultChunk = Tuple[bytes, Optional[Dict[str, Any]]]
+
+
+class WhoisQueryExecutorFailure(Exception):
+    """
+    Raised when a query executor terminated while executing a query.
+    """
+    pass
 
 
 # Covered by integration tests
@@ -29,203 +68,744 @@ def start_whois_server():  # pragma: no cover
     setproctitle('irrd-whois-server-listener')
     address = (get_setting('server.whois.interface'), get_setting('server.whois.port'))
     logger.info(f'Starting whois server on TCP {address}')
-    server = WhoisTCPServer(
-        server_address=address,
-    )
-
-    # When this process receives SIGTERM, shut down the server cleanly.
-    def sigterm_handler(signum, frame):
-        nonlocal server
 
-        def shutdown(server):
-            logging.info('Whois server shutting down')
-            server.shutdown()
-            server.server_close()
-        # Shutdown must be called from a thread to prevent blocking.
-        threading.Thread(target=shutdown, args=(server,)).start()
-    signal.signal(signal.SIGTERM, sigterm_handler)
+    WhoisQueryMetrics().reset()
+    # The executors are started before the event loop is created,
+    # so that they do not inherit it.
+    executor_pool = WhoisQueryExecutorPool(int(get_setting('server.whois.executor_processes')))
+    executor_pool.start()
+
+    loop = asyncio.get_event_loop()
+    whois_server = WhoisServer(executor_pool)
+    query_metrics = WhoisQueryMetrics()
+
+    def flush_metrics():
+        whois_server.flush_metrics(query_metrics)
+        loop.call_later(METRICS_FLUSH_INTERVAL, flush_metrics)
+    loop.call_later(METRICS_FLUSH_INTERVAL, flush_metrics)
+    family = socket.AF_INET6 if IP(address[0]).version() == 6 else socket.AF_INET
+    server = loop.run_until_complete(asyncio.start_server(
+        whois_server.handle_connection, host=address[0], port=address[1],
+        family=family, reuse_address=True,
+    ))
+    executor_pool.attach_event_loop(loop)
+
+    def sigterm_handler():
+        logging.info('Whois server shutting down')
+        loop.stop()
+    loop.add_signal_handler(signal.SIGTERM, sigterm_handler)
+
+    def sighup_handler():
+        get_configuration().reload()
+        executor_pool.sighup_executors()
+    loop.add_signal_handler(signal.SIGHUP, sighup_handler)
+
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        executor_pool.shutdown()
+
+
+class WhoisServer:
+    """
+    Front-end of the whois server, which handles all client connections
+    in a single event loop.
+
+    Each connection is read from and written to asynchronously, so that idle
+    connections, like persistent !! sessions, are cheap. Queries are executed
+    by a WhoisQueryExecutorPool. Connections and queries are limited by
+    WhoisAdmissionControl: at most server.whois.max_connections clients
+    are served at the same time, further connections wait in a bounded
+    backlog until another connection is closed, and connections beyond
+    the backlog or the limit per client are rejected.
+    """
+    def __init__(self, executor_pool: 'WhoisQueryExecutorPool') -> None:
+        self.executor_pool = executor_pool
+        self.admission_control = WhoisAdmissionControl()
 
-    def sighup_handler(signum, frame):
-        nonlocal server
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Handle an individual whois client connection.
+        When this method returns, the connection is closed.
+        """
+        client_address = writer.get_extra_info('peername')
+        client_str = client_address[0] + ':' + str(client_address[1])
+        try:
+            reject_reason = await self.admission_control.admit(client_address[0])
+            if reject_reason:
+                logger.info(f'{client_str}: rejected connection: {reject_reason}')
+                writer.write(b'%% Too many connections\n')
+                await writer.drain()
+                return
+            try:
+                await self._handle_queries(reader, writer, client_address[0], client_str)
+            finally:
+                self.admission_control.release(client_address[0])
+        except Exception as e:
+            logger.error(f'Failed to handle whois connection from {client_str}, traceback follows: {e}',
+                         exc_info=e)
+        finally:
+            writer.close()
 
-        def sighup(server):
-            get_configuration().reload()
-            server.sighup_workers()
-        # sighup must be called from a thread to prevent blocking.
-        threading.Thread(target=sighup, args=(server,)).start()
-    signal.signal(signal.SIGHUP, sighup_handler)
+    async def _handle_queries(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                              client_ip: str, client_str: str) -> None:
+        """
+        Read and answer queries from a client, until the connection
+        should be closed.
+        """
+        if not is_client_permitted(client_ip, 'server.whois.access_list', default_deny=False):
+            writer.write(b'%% Access denied')
+            await writer.drain()
+            return
 
-    server.serve_forever()
+        session_state: Optional[Dict[str, Any]] = None
+        pending_data = b''
+        while True:
+            timeout = session_state['timeout'] if session_state else WHOIS_DEFAULT_TIMEOUT
+            try:
+                queries, pending_data = await self._read_queries(reader, pending_data, timeout)
+            except asyncio.TimeoutError:
+                logger.debug(f'{client_str}: closed connection after timeout')
+                return
+            if not queries:
+                return
 
+            close_requested = False
+            for index, query in enumerate(queries):
+                if query.upper() == '!Q':
+                    queries = queries[:index]
+                    close_requested = True
+                    break
+
+            if queries:
+                delay = self.admission_control.query_delay(client_ip, len(queries))
+                if delay:
+                    logger.debug(f'{client_str}: delaying queries by {delay:.3f}s for rate limit')
+                    await asyncio.sleep(delay)
+                session_state = await self._execute_queries(writer, client_ip, client_str, session_state, queries)
+                if session_state is None:
+                    return
+            if close_requested:
+                logger.debug(f'{client_str}: closed connection per request')
+                return
+            if not session_state or not session_state['multiple_command_mode']:
+                logger.debug(f'{client_str}: auto-closed connection')
+                return
 
-class WhoisTCPServer(socketserver.TCPServer):  # pragma: no cover
-    """
-    Server for whois queries.
+    def flush_metrics(self, query_metrics: WhoisQueryMetrics) -> None:
+        """
+        Record the state of admission control and the executor pool
+        in query_metrics, and write them to redis.
+        """
+        self.admission_control.prune()
+        admission_control = self.admission_control
+        metrics = {
+            'connections_active': admission_control.active_connections,
+            'connections_waiting': admission_control.waiting_connections,
+            'rate_limited_batches': admission_control.rate_limited_batches,
+            'rate_limit_delay': admission_control.rate_limit_delay,
+            'executor_tasks_pending': self.executor_pool.pending_tasks(),
+            'executors_busy': self.executor_pool.busy_executors(),
+        }
+        for reason, count in admission_control.rejected_connections.items():
+            metrics[f'connections_rejected:{reason}'] = count
+        query_metrics.record_server_metrics(metrics)
+        query_metrics.flush(force=True)
+
+    async def _read_queries(self, reader: asyncio.StreamReader, pending_data: bytes,
+                            timeout: float) -> Tuple[List[str], bytes]:
+        """
+        Read queries from a client. Returns all complete queries that the client
+        has sent so far, at most MAX_QUERIES_PER_BATCH, waiting for at least one
+        query, and any remaining data. Returns no queries on EOF, or if the
+        client sent a line over CLIENT_READ_SIZE.
+        Raises asyncio.TimeoutError if no query is received within timeout.
+        """
+        while True:
+            # Any further queries remain in pending_data for the next batch
+            lines = pending_data.split(b'\n', MAX_QUERIES_PER_BATCH)
+            pending_data = lines.pop()
+            queries = [line.decode('utf-8', errors='backslashreplace').strip() for line in lines]
+            queries = [query for query in queries if query]
+            if queries:
+                return queries, pending_data
+            if len(pending_data) > CLIENT_READ_SIZE:
+                return [], b''
+
+            data = await asyncio.wait_for(reader.read(CLIENT_READ_SIZE), timeout)
+            if not data:
+                # The last query may not end with a newline
+                last_query = pending_data.decode('utf-8', errors='backslashreplace').strip()
+                return [last_query] if last_query else [], b''
+            pending_data += data
+
+    async def _execute_queries(self, writer: asyncio.StreamWriter, client_ip: str, client_str: str,
+                               session_state: Optional[Dict[str, Any]],
+                               queries: List[str]) -> Optional[Dict[str, Any]]:
+        """
+        Execute a batch of queries and write the responses to the client.
+        Returns the new session state, or None if writing to the client failed,
+        or executing the queries failed, after writing an error to the client.
+        """
+        logger.debug(f'{client_str}: processing queries: {queries}')
+        start_time = time.perf_counter()
+        response_size = 0
 
-    Starts a number of worker processes that handle the client connections.
-    Whenever a client is connected, the connection is pushed onto a queue,
-    from which a worker picks it up. The workers are responsible for the
-    connection from then on.
-    """
-    allow_reuse_address = True
-    request_queue_size = 50
+        async def write_response(response_chunk: bytes) -> None:
+            nonlocal response_size
+            writer.write(response_chunk)
+            await writer.drain()
+            response_size += len(response_chunk)
 
-    def __init__(self, server_address, bind_and_activate=True):  # noqa: N803
-        self.address_family = socket.AF_INET6 if IP(server_address[0]).version() == 6 else socket.AF_INET
-        super().__init__(server_address, None, bind_and_activate)
+        try:
+            session_state = await self.executor_pool.execute(
+                client_ip, client_str, session_state, queries, write_response)
+        except OSError:
+            return None
+        except WhoisQueryExecutorFailure as wqef:
+            logger.error(f'{client_str}: failed to execute queries, closing connection: {wqef}')
+            mode = WhoisQueryResponseMode.IRRD if queries[0].startswith('!') else WhoisQueryResponseMode.RIPE
+            response = WhoisQueryResponse(WhoisQueryResponseType.ERROR, mode,
+                                          'Query could not be executed, please try again later.')
+            try:
+                await write_response(response.generate_response().encode('utf-8'))
+            except OSError:
+                pass
+            return None
 
-        self.connection_queue = mp.Queue()
-        self.workers = []
-        for i in range(int(get_setting('server.whois.max_connections'))):
-            worker = WhoisWorker(self.connection_queue)
-            worker.start()
-            self.workers.append(worker)
+        elapsed = time.perf_counter() - start_time
+        if len(queries) == 1:
+            logger.info(f'{client_str}: sent answer to query, elapsed {elapsed:.9f}s, '
+                        f'{response_size} bytes: {queries[0]}')
+        else:
+            logger.info(f'{client_str}: sent answers to {len(queries)} pipelined queries, elapsed '
+                        f'{elapsed:.9f}s, {response_size} bytes: {queries[0]} ... {queries[-1]}')
+        return session_state
 
-    def process_request(self, request, client_address):
-        """Push the client connection onto the queue for further handling."""
-        self.connection_queue.put((request, client_address))
 
-    def handle_error(self, request, client_address):
-        logger.error(f'Error while handling request from {client_address}', exc_info=True)
+class WhoisQueryExecutorPool:
+    """
+    A bounded pool of WhoisQueryExecutor processes.
+
+    Queries are put on a single task queue, from which any idle executor picks
+    them up. Results are sent in chunks on a result queue, read in a separate
+    thread, and handed to the event loop. An executor sends at most
+    RESPONSE_CHUNKS_IN_FLIGHT chunks that were not yet written to the client,
+    so that responses to slow clients do not pile up in memory.
+    Executors that terminate unexpectedly are replaced, and the query they
+    were executing fails. Queries fail as well if no executor picks them up
+    within server.whois.executor_timeout, in which case executors skip them
+    if they pick them up later, or if no result is received from the
+    executor within server.whois.executor_timeout after it picked them up.
+
+    Executors that request to be recycled, after executing too many queries
+    or using too much memory, are replaced gracefully: a replacement is
+    started first, and the old executor is only told to retire once the
+    replacement is ready to execute queries, so that the capacity of the
+    pool does not drop while executors are recycled.
+    """
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.task_queue: mp.Queue = mp.Queue()
+        self.result_queue: mp.Queue = mp.Queue()
+        self.executors: List[WhoisQueryExecutor] = []
+        self._task_ids = itertools.count()
+        self._pending: Dict[int, asyncio.Queue] = {}
+        # Pending tasks for which an executor has sent a result
+        self._started: Set[int] = set()
+        # Executors due for recycling, with the executor started to replace them
+        self._replacements: Dict[WhoisQueryExecutor, WhoisQueryExecutor] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self) -> None:
+        """
+        Start the executor processes.
+        """
+        for _ in range(self.size):
+            self._start_executor()
 
-    def sighup_workers(self):
-        for worker in self.workers:
-            os.kill(worker.pid, signal.SIGHUP)
+    def attach_event_loop(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Start handing results to the event loop, and monitoring the executors.
+        Must be called after start(), from the thread running the event loop.
+        """
+        self._loop = loop
+        threading.Thread(target=self._read_results, daemon=True).start()
+        loop.call_later(EXECUTOR_CHECK_INTERVAL, self._check_executors)
 
-    def shutdown(self):
+    async def execute(self, client_ip: str, client_str: str, session_state: Optional[Dict[str, Any]],
+                      queries: List[str], write_response: Callable[[bytes], Awaitable[None]]) -> Dict[str, Any]:
         """
-        Shut down the server, by killing all child processes,
-        and then deferring to built-in TCPServer shutdown.
+        Execute one or more queries from a session in one of the executors.
+        session_state is the state of the session, returned by the previous
+        execution, or None for the first queries in a session. write_response
+        is called for each chunk of the responses, as it is received from
+        the executor. Returns the new session state.
+        Raises WhoisQueryExecutorFailure if the executor terminated, if no
+        executor picked up the task within server.whois.executor_timeout,
+        or if the executor did not send the next chunk within
+        server.whois.executor_timeout.
+        """
+        task_id = next(self._task_ids)
+        # Bounded by RESPONSE_CHUNKS_IN_FLIGHT, as the executor waits
+        # for chunks to be written before sending more.
+        result_chunks: asyncio.Queue = asyncio.Queue()
+        self._pending[task_id] = result_chunks
+        timeout = int(get_setting('server.whois.executor_timeout')) or None
+        # Executors skip the task if they pick it up after this time,
+        # as the query has failed by then
+        queued_until = time.time() + timeout if timeout else None
+        self.task_queue.put((task_id, client_ip, client_str, session_state, queries, queued_until))
+        # The timeout for results only starts once an executor picked up the task
+        pickup_deadline = time.monotonic() + timeout if timeout else None
+        picked_up = not timeout
+        completed = False
+        try:
+            while True:
+                try:
+                    result_chunk = await asyncio.wait_for(
+                        result_chunks.get(), timeout if picked_up else EXECUTOR_PICKUP_CHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    if picked_up:
+                        raise WhoisQueryExecutorFailure(f'No result from query executor within {timeout} seconds')
+                    if self._executor_for_task(task_id):
+                        picked_up = True
+                    elif time.monotonic() > pickup_deadline:  # type: ignore
+                        raise WhoisQueryExecutorFailure(f'No query executor available within {timeout} seconds')
+                    continue
+                picked_up = True
+                if isinstance(result_chunk, Exception):
+                    raise result_chunk
+                response_chunk, new_session_state = result_chunk
+                if response_chunk:
+                    await write_response(response_chunk)
+                if new_session_state is not None:
+                    completed = True
+                    return new_session_state
+                self._acknowledge_chunk(task_id)
+        finally:
+            self._pending.pop(task_id, None)
+            self._started.discard(task_id)
+            if not completed:
+                self._cancel_task(task_id)
+
+    def pending_tasks(self) -> int:
+        """The number of tasks that are waiting for, or being executed by, an executor."""
+        return len(self._pending)
+
+    def busy_executors(self) -> int:
+        """The number of executors that are executing a task."""
+        return len([executor for executor in self.executors if executor.current_task_id.value != -1])
+
+    def sighup_executors(self) -> None:
+        for executor in self.executors:
+            os.kill(executor.pid, signal.SIGHUP)  # type: ignore
+
+    def shutdown(self) -> None:
         """
-        for worker in self.workers:
+        Shut down the pool, by terminating all executor processes.
+        """
+        for executor in self.executors:
             try:
-                worker.terminate()
-                worker.join()
+                executor.terminate()
+                executor.join()
             except Exception:  # pragma: no cover
                 pass
-        return super().shutdown()
+        self.result_queue.put(None)
+
+    def _start_executor(self) -> 'WhoisQueryExecutor':
+        executor = WhoisQueryExecutor(self.task_queue, self.result_queue)
+        executor.start()
+        self.executors.append(executor)
+        return executor
+
+    def _read_results(self) -> None:
+        """
+        Read results from the executors, and resolve the futures
+        of the queries. Runs in a separate thread.
+        """
+        while True:
+            result = self.result_queue.get()
+            if result is None:
+                return
+            self._loop.call_soon_threadsafe(self._resolve, *result)  # type: ignore
+
+    def _resolve(self, task_id: int, result_chunk: QueryResultChunk) -> None:
+        result_chunks = self._pending.get(task_id)
+        if result_chunks:
+            self._started.add(task_id)
+            result_chunks.put_nowait(result_chunk)
+        else:
+            # The query failed or the client disconnected: no more
+            # results are needed for this task.
+            self._cancel_task(task_id)
+
+    def _executor_for_task(self, task_id: int) -> Optional['WhoisQueryExecutor']:
+        for executor in self.executors:
+            if executor.current_task_id.value == task_id:
+                return executor
+        return None
+
+    def _acknowledge_chunk(self, task_id: int) -> None:
+        """
+        Tell the executor of a task that a chunk of its response was
+        written to the client, so that it can send the next one.
+        """
+        executor = self._executor_for_task(task_id)
+        if executor:
+            executor.chunks_written.value += 1
+            executor.chunk_written.set()
+
+    def _cancel_task(self, task_id: int) -> None:
+        """
+        Tell the executor of a task to stop executing it.
+        """
+        executor = self._executor_for_task(task_id)
+        if executor:
+            executor.task_cancelled.value = 1
+            executor.chunk_written.set()
+
+    def _check_executors(self) -> None:
+        """
+        Replace any executors that have terminated, and fail the
+        query they were executing, if any.
+        Start replacements for executors due for recycling, and
+        retire those executors once their replacement is ready.
+        """
+        for executor in list(self.executors):
+            if executor.is_alive():
+                self._recycle_executor(executor)
+                continue
+            self.executors.remove(executor)
+            task_id = executor.current_task_id.value
+            if executor.retire.value and task_id == -1:
+                logger.info(f'Whois query executor {executor.pid} was recycled')
+                executor.join()
+                continue
 
+            logger.error(f'Whois query executor {executor.pid} terminated unexpectedly '
+                         f'with exit code {executor.exitcode}, starting new executor')
+            self._fail_lost_tasks(executor, task_id)
+            # A replacement that was already started for this executor takes its place
+            if self._replacements.pop(executor, None) or executor.retire.value:
+                continue
+            new_executor = self._start_executor()
+            for recycled_executor, replacement in self._replacements.items():
+                if replacement == executor:
+                    self._replacements[recycled_executor] = new_executor
+        self._loop.call_later(EXECUTOR_CHECK_INTERVAL, self._check_executors)  # type: ignore
 
-class WhoisWorker(mp.Process, socketserver.StreamRequestHandler):
+    def _fail_lost_tasks(self, executor: 'WhoisQueryExecutor', task_id: int) -> None:
+        """
+        Fail the tasks that may have been lost by an executor that terminated
+        unexpectedly. This is the task it was executing, if recorded.
+        If not, the executor may have terminated after retrieving a task from
+        the task queue, but before recording it, so all pending tasks that
+        are not executed by another executor, and for which no results were
+        received, fail. Any of those that are still queued are cancelled
+        when their results are received.
+        """
+        if task_id != -1:
+            lost_task_ids = [task_id]
+        else:
+            executing_task_ids = {other.current_task_id.value for other in self.executors}
+            lost_task_ids = [
+                pending_task_id for pending_task_id in self._pending
+                if pending_task_id not in executing_task_ids and pending_task_id not in self._started
+            ]
+        for lost_task_id in lost_task_ids:
+            result_chunks = self._pending.get(lost_task_id)
+            if result_chunks:
+                result_chunks.put_nowait(WhoisQueryExecutorFailure(f'Query executor {executor.pid} terminated'))
+
+    def _recycle_executor(self, executor: 'WhoisQueryExecutor') -> None:
+        """
+        Start a replacement for an executor that requested to be recycled,
+        and retire it once the replacement is ready.
+        """
+        if not executor.recycle_requested.value or executor.retire.value:
+            return
+        replacement = self._replacements.get(executor)
+        if not replacement:
+            logger.info(f'Whois query executor {executor.pid} is due for recycling, starting replacement')
+            self._replacements[executor] = self._start_executor()
+        elif replacement.ready.value:
+            del self._replacements[executor]
+            executor.retire.value = 1
+
+
+class WhoisQueryExecutor(mp.Process):
     """
-    A whois worker is a process that handles whois client connections,
-    which are retrieved from a queue. After handling a connection,
-    the process waits for the next connection from the queue.s
+    A query executor is a process that executes whois queries, which are
+    retrieved from a queue. Each executor has its own database connection
+    and preloader. As any executor may execute the next query of a session,
+    the state of the session is passed along with each query, and
+    the new state is returned with the result.
+
+    Responses are sent in chunks of at least RESPONSE_CHUNK_SIZE, while
+    they are generated, so that large responses are not held in memory.
+    At most RESPONSE_CHUNKS_IN_FLIGHT chunks are sent ahead of the chunks
+    written to the client, after which the executor waits for the pool.
+    Memory that was used for a large response is not always returned to
+    the OS, so an executor requests to be recycled by the pool after
+    server.whois.executor_max_queries queries, or when its memory use
+    exceeds server.whois.executor_max_memory. It keeps executing
+    queries until the pool tells it to retire.
+    Responses to cacheable queries are retrieved from, or stored in,
+    the WhoisQueryCache shared by all executors. The latency and response
+    size of each query are recorded in WhoisQueryMetrics, and queries
+    slower than server.whois.slow_query_threshold are logged, along with
+    the SQL queries they executed.
     """
-    def __init__(self, connection_queue, *args, **kwargs):
-        self.connection_queue = connection_queue
-        # Note that StreamRequestHandler.__init__ is not called - the
-        # input for that is not available, as it's retrieved from the queue.
+    def __init__(self, task_queue, result_queue, *args, **kwargs):
+        self.task_queue = task_queue
+        self.result_queue = result_queue
+        # The ID of the task currently executed, or -1 if idle
+        self.current_task_id = mp.RawValue('q', -1)
+        # The number of chunks of the current task written to the client,
+        # and an event set by the pool when this number changes
+        self.chunks_written = mp.RawValue('q', 0)
+        self.chunk_written = mp.Event()
+        # Set by the pool when the current task should be abandoned
+        self.task_cancelled = mp.RawValue('b', 0)
+        # Set by the executor when it is ready to execute queries
+        self.ready = mp.RawValue('b', 0)
+        # Set by the executor when it should be replaced
+        self.recycle_requested = mp.RawValue('b', 0)
+        # Set by the pool when this executor should exit,
+        # after its replacement is ready
+        self.retire = mp.RawValue('b', 0)
+        self.queries_executed = 0
         super().__init__(*args, **kwargs)
 
     def run(self, keep_running=True) -> None:
         """
-        Whois worker run loop.
+        Query executor run loop.
         This method does not return, except if it failed to initialise a preloader,
-        or if keep_running is set, after the first request is handled. The latter
-        is used in the tests.
+        when it is retired after being recycled, or if keep_running is not set,
+        after the first query is handled. The latter is used in the tests.
         """
-        # Disable the special sigterm_handler defined in start_whois_server()
-        # (signal handlers are inherited)
+        # Disable the signal handlers of the whois server (signal handlers are inherited)
         signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
+        def sighup_handler(signum, frame) -> None:
+            get_configuration().reload()  # type: ignore
+        signal.signal(signal.SIGHUP, sighup_handler)
+        setproctitle('irrd-whois-executor')
+
         try:
             self.preloader = Preloader()
             self.database_handler = DatabaseHandler(readonly=True)
+            self.query_cache = WhoisQueryCache(self.preloader)
+            self.query_metrics = WhoisQueryMetrics()
         except Exception as e:
-            logger.error(f'Whois worker failed to initialise preloader or database,'
+            logger.error(f'Whois query executor failed to initialise preloader or database, '
                          f'unable to start, traceback follows: {e}', exc_info=e)
             return
+        self.ready.value = 1
 
         while True:
+            if self.retire.value:
+                logger.info(f'Whois query executor {self.pid} retiring after recycling')
+                self.query_metrics.flush(force=True)
+                self.database_handler.close()
+                return
             try:
-                setproctitle('irrd-whois-worker')
-                self.request, self.client_address = self.connection_queue.get()
-                self.setup()
-                self.handle_connection()
-                self.finish()
-                self.close_request()
-            except Exception as e:
-                try:
-                    self.close_request()
-                except Exception:  # pragma: no cover
-                    pass
-                logger.error(f'Failed to handle whois connection, traceback follows: {e}',
-                             exc_info=e)
+                get_timeout = EXECUTOR_RETIRE_CHECK_INTERVAL if self.recycle_requested.value else METRICS_FLUSH_INTERVAL
+                task = self.task_queue.get(timeout=get_timeout)
+            except queue.Empty:
+                self.query_metrics.flush(force=True)
+                continue
+            task_id, client_ip, client_str, session_state, queries, queued_until = task
+            if queued_until and time.time() > queued_until:
+                logger.info(f'{client_str}: skipped queries, as they were not picked up within '
+                            f'the executor timeout: {queries[0]}')
+                continue
+            self.chunks_written.value = 0
+            self.task_cancelled.value = 0
+            self.current_task_id.value = task_id
+            result_chunks = self.execute_queries(client_ip, client_str, session_state, queries)
+            for chunks_sent, result_chunk in enumerate(result_chunks):
+                if not self._wait_for_chunks_written(chunks_sent):
+                    logger.info(f'{client_str}: abandoned queries, response was not written to client')
+                    result_chunks.close()
+                    break
+                self.result_queue.put((task_id, result_chunk))
+            self.current_task_id.value = -1
+            self.query_metrics.flush()
+            self.queries_executed += len(queries)
+            self._check_recycle()
             if not keep_running:
                 break
 
-    def close_request(self):
-        # Close the connection in the same way normally done by TCPServer
-        try:
-            # explicitly shutdown.  socket.close() merely releases
-            # the socket and waits for GC to perform the actual close.
-            self.request.shutdown(socket.SHUT_WR)
-        except OSError:  # pragma: no cover
-            pass  # some platforms may raise ENOTCONN here
-        self.request.close()
-
-    def handle_connection(self):
+    def _wait_for_chunks_written(self, chunks_sent: int) -> bool:
         """
-        Handle an individual whois client connection.
-        When this method returns, the connection is closed.
+        Wait until less than RESPONSE_CHUNKS_IN_FLIGHT of the chunks_sent
+        chunks of the current task have not been written to the client.
+        Returns False if the task was cancelled, or the chunks were not
+        written within server.whois.executor_timeout.
         """
-        client_ip = self.client_address[0]
-        self.client_str = client_ip + ':' + str(self.client_address[1])
-        setproctitle(f'irrd-whois-worker-{self.client_str}')
-
-        if not self.is_client_permitted(client_ip):
-            self.wfile.write(b'%% Access denied')
+        timeout = int(get_setting('server.whois.executor_timeout'))
+        deadline = time.monotonic() + timeout
+        while chunks_sent - self.chunks_written.value >= RESPONSE_CHUNKS_IN_FLIGHT:
+            if self.task_cancelled.value or (timeout and time.monotonic() > deadline):
+                return False
+            self.chunk_written.wait(EXECUTOR_RETIRE_CHECK_INTERVAL)
+            self.chunk_written.clear()
+        return not self.task_cancelled.value
+
+    def _check_recycle(self) -> None:
+        """
+        Request to be recycled if this executor has executed
+        server.whois.executor_max_queries queries, or uses more than
+        server.whois.executor_max_memory megabytes of memory.
+        """
+        if self.recycle_requested.value:
             return
+        max_queries = int(get_setting('server.whois.executor_max_queries'))
+        max_memory = int(get_setting('server.whois.executor_max_memory'))
+        reason = None
+        if max_queries and self.queries_executed >= max_queries:
+            reason = f'executed {self.queries_executed} queries'
+        elif max_memory:
+            current_memory = memory_usage()
+            if current_memory > max_memory * 1024 * 1024:
+                reason = f'uses {current_memory // (1024 * 1024)} MB of memory'
+        if reason:
+            logger.info(f'Whois query executor {self.pid} {reason}, requesting recycling')
+            self.recycle_requested.value = 1
+
+    def execute_queries(self, client_ip: str, client_str: str, session_state: Optional[Dict[str, Any]],
+                        queries: List[str]) -> Generator[QueryResultChunk, None, None]:
+        """
+        Execute one or more queries, in the session with session_state.
+        Execution stops after any query that leaves the session outside
+        of multiple command mode, as the connection will then be closed.
+        Generates the responses in chunks, the last of which
+        includes the new session state.
+
+        Consecutive queries with the same command in PREFETCH_COMMANDS
+        are looked up together: first in the query cache, after which
+        the queries that are not cached are prefetched by the parser.
+        """
+        query_parser = WhoisQueryParser(client_ip, client_str, self.preloader, self.database_handler,
+                                        stream_results=True)
+        if session_state:
+            query_parser.restore_session_state(session_state)
+        slow_query_threshold = float(get_setting('server.whois.slow_query_threshold'))
+        response_buffer = b''
+        cache_lookups: Dict[str, Tuple[Optional[str], Optional[bytes]]] = {}
+        for index, query in enumerate(queries):
+            start_time = time.perf_counter()
+            response_size = 0
+            if slow_query_threshold:
+                self.database_handler.query_log = []
+            command = query[:2]
+            if command in PREFETCH_COMMANDS and (index == 0 or not queries[index - 1].startswith(command)):
+                consecutive_queries = list(itertools.takewhile(lambda q: q.startswith(command), queries[index:]))
+                if len(consecutive_queries) > 1:
+                    cache_lookups = self._lookup_cached_responses(query_parser, client_str, consecutive_queries)
+                    self._prefetch(query_parser, command, [
+                        q[2:] for q in consecutive_queries if cache_lookups.get(q, (None, None))[1] is None
+                    ])
+
+            cache_lookup = cache_lookups.pop(query, None)
+            for response_chunk in self._execute_query(query_parser, client_str, query, cache_lookup):
+                response_size += len(response_chunk)
+                response_buffer += response_chunk
+                if len(response_buffer) >= RESPONSE_CHUNK_SIZE:
+                    yield response_buffer, None
+                    response_buffer = b''
+            self._record_query(client_str, query, time.perf_counter() - start_time, response_size,
+                               slow_query_threshold)
+            if not query_parser.multiple_command_mode:
+                break
+        yield response_buffer, query_parser.session_state()
 
-        self.query_parser = WhoisQueryParser(client_ip, self.client_str, self.preloader,
-                                             self.database_handler)
-
-        data = True
-        while data:
-            timer = threading.Timer(self.query_parser.timeout, self.close_request)
-            timer.start()
-            data = self.rfile.readline()
-            timer.cancel()
-
-            query = data.decode('utf-8', errors='backslashreplace').strip()
-            if not query:
-                continue
-
-            logger.debug(f'{self.client_str}: processing query: {query}')
-
-            if not self.handle_query(query):
-                return
+    def _lookup_cached_responses(self, query_parser: WhoisQueryParser, client_str: str,
+                                 queries: List[str]) -> Dict[str, Tuple[Optional[str], Optional[bytes]]]:
+        """
+        Look up the cached responses for queries, with a single request
+        to the query cache. Returns a dict with the cache key and the cached
+        response, if any, of each query. Returns an empty dict on failure,
+        in which case the queries are looked up again when executed.
+        """
+        try:
+            cache_keys = {query: self.query_cache.cache_key(query, query_parser) for query in queries}
+            cacheable_keys = [cache_key for cache_key in cache_keys.values() if cache_key]
+            if not cacheable_keys:
+                return {}
+            cached_responses = dict(zip(cacheable_keys, self.query_cache.get_many(cacheable_keys)))
+            return {
+                query: (cache_key, cached_responses.get(cache_key) if cache_key else None)
+                for query, cache_key in cache_keys.items()
+            }
+        except Exception as e:
+            logger.error(f'{client_str}: failed to look up cached responses, traceback follows: {e}', exc_info=e)
+            return {}
 
-    def handle_query(self, query: str) -> bool:
+    def _prefetch(self, query_parser: WhoisQueryParser, command: str, parameters: List[str]) -> None:
         """
-        Handle an individual query.
-        Returns False when the connection should be closed,
-        True when more queries should be read.
+        Prefetch the results of queries with command, one of PREFETCH_COMMANDS,
+        and parameters, if there are multiple.
         """
-        start_time = time.perf_counter()
-        if query.upper() == '!Q':
-            logger.debug(f'{self.client_str}: closed connection per request')
-            return False
+        if len(parameters) < 2:
+            return
+        if command == '!m':
+            query_parser.prefetch_exact_keys(parameters)
+        else:
+            query_parser.prefetch_routes_for_origins(parameters, ip_version=4 if command == '!g' else 6)
 
-        response = self.query_parser.handle_query(query)
-        response_bytes = response.generate_response().encode('utf-8')
+    def _execute_query(self, query_parser: WhoisQueryParser, client_str: str, query: str,
+                       cache_lookup: Optional[Tuple[Optional[str], Optional[bytes]]]=None) -> Iterator[bytes]:
+        """
+        Execute a single query with query_parser, generating the response in chunks.
+        cache_lookup is the cache key and cached response of the query,
+        if these were already looked up.
+        """
         try:
-            self.wfile.write(response_bytes)
-        except OSError:
-            return False
-
-        elapsed = time.perf_counter() - start_time
-        logger.info(f'{self.client_str}: sent answer to query, elapsed {elapsed:.9f}s, '
-                    f'{len(response_bytes)} bytes: {query}')
+            if cache_lookup is None:
+                cache_key = self.query_cache.cache_key(query, query_parser)
+                cached_response = self.query_cache.get(cache_key) if cache_key else None
+            else:
+                cache_key, cached_response = cache_lookup
+            if cached_response is not None:
+                yield cached_response
+                return
 
-        if not self.query_parser.multiple_command_mode:
-            logger.debug(f'{self.client_str}: auto-closed connection')
-            return False
-        return True
+            response = query_parser.handle_query(query)
+            if response.response_type == WhoisQueryResponseType.ERROR:
+                cache_key = None
+            cacheable_chunks: List[bytes] = []
+            cacheable_size = 0
+            for response_chunk in response.generate_response_chunks():
+                response_chunk_bytes = response_chunk.encode('utf-8')
+                yield response_chunk_bytes
+                if cache_key:
+                    cacheable_chunks.append(response_chunk_bytes)
+                    cacheable_size += len(response_chunk_bytes)
+                    if cacheable_size > QUERY_CACHE_MAX_RESPONSE_SIZE:
+                        cache_key = None
+                        cacheable_chunks = []
+            if cache_key:
+                self.query_cache.set(cache_key, b''.join(cacheable_chunks))
+        except Exception as e:
+            logger.error(f'Failed to execute whois query "{query}" for {client_str}, traceback follows: {e}',
+                         exc_info=e)
+            yield b'% An internal error occurred while processing this query.\n\n'
 
-    def is_client_permitted(self, ip: str) -> bool:
+    def _record_query(self, client_str: str, query: str, elapsed: float, response_size: int,
+                      slow_query_threshold: float) -> None:
         """
-        Check whether a client is permitted.
+        Record the metrics of an executed query, and log it
+        if it exceeded the slow query threshold.
         """
-        return is_client_permitted(ip, 'server.whois.access_list', default_deny=False)
+        slow = bool(slow_query_threshold) and elapsed >= slow_query_threshold
+        if slow:
+            query_log = self.database_handler.query_log or []
+            executed_queries = '\n'.join(repr(executed_query) for executed_query in query_log)
+            logger.warning(f'{client_str}: slow query, elapsed {elapsed:.9f}s, {response_size} bytes: {query}\n'
+                           f'SQL queries executed:\n{executed_queries or "none"}')
+        self.database_handler.query_log = None
+        self.query_metrics.record(query, elapsed, response_size, slow)
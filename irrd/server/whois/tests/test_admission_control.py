@@ -0,0 +1,118 @@
+import asyncio
+from unittest.mock import Mock
+
+import pytest
+
+from ..admission_control import WhoisAdmissionControl, REJECT_BACKLOG_FULL, REJECT_CLIENT_LIMIT
+
+
+@pytest.fixture()
+def event_loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+
+class TestWhoisAdmissionControl:
+    def test_connection_limits(self, config_override, event_loop):
+        config_override({
+            'server': {
+                'whois': {
+                    'max_connections': 2,
+                    'max_connection_backlog': 1,
+                    'max_connections_per_client': 2,
+                }
+            },
+        })
+        admission_control = WhoisAdmissionControl()
+        admit = admission_control.admit
+
+        assert event_loop.run_until_complete(admit('192.0.2.1')) is None
+        assert event_loop.run_until_complete(admit('192.0.2.2')) is None
+        assert admission_control.active_connections == 2
+
+        # All slots are in use, so the next connection waits in the backlog
+        waiting = event_loop.create_task(admit('192.0.2.1'))
+        event_loop.run_until_complete(asyncio.sleep(0))
+        assert not waiting.done()
+        assert admission_control.waiting_connections == 1
+
+        # Waiting connections count towards the limit per client
+        assert event_loop.run_until_complete(admit('192.0.2.1')) == REJECT_CLIENT_LIMIT
+        # The backlog is full
+        assert event_loop.run_until_complete(admit('192.0.2.3')) == REJECT_BACKLOG_FULL
+        assert admission_control.rejected_connections == {REJECT_CLIENT_LIMIT: 1, REJECT_BACKLOG_FULL: 1}
+
+        admission_control.release('192.0.2.1')
+        assert event_loop.run_until_complete(waiting) is None
+        assert admission_control.waiting_connections == 0
+        assert admission_control.active_connections == 2
+
+        admission_control.release('192.0.2.1')
+        admission_control.release('192.0.2.2')
+        assert admission_control.active_connections == 0
+        assert not admission_control._client_connections
+
+    def test_connection_limit_per_client_disabled(self, config_override, event_loop):
+        config_override({
+            'server': {
+                'whois': {
+                    'max_connections': 5,
+                    'max_connection_backlog': 0,
+                    'max_connections_per_client': 0,
+                }
+            },
+        })
+        admission_control = WhoisAdmissionControl()
+        for _ in range(5):
+            assert event_loop.run_until_complete(admission_control.admit('192.0.2.1')) is None
+        result = event_loop.run_until_complete(admission_control.admit('192.0.2.1'))
+        assert result == REJECT_BACKLOG_FULL
+
+    def test_cancelled_while_waiting(self, config_override, event_loop):
+        config_override({
+            'server': {'whois': {'max_connections': 1}},
+        })
+        admission_control = WhoisAdmissionControl()
+        assert event_loop.run_until_complete(admission_control.admit('192.0.2.1')) is None
+        waiting = event_loop.create_task(admission_control.admit('192.0.2.2'))
+        event_loop.run_until_complete(asyncio.sleep(0))
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            event_loop.run_until_complete(waiting)
+        assert admission_control.waiting_connections == 0
+        assert admission_control._client_connections == {'192.0.2.1': 1}
+
+    def test_query_rate_limit(self, config_override, event_loop, monkeypatch):
+        config_override({
+            'server': {'whois': {'max_query_rate_per_client': 10}},
+        })
+        mock_time = Mock(return_value=100)
+        monkeypatch.setattr('irrd.server.whois.admission_control.time.monotonic', mock_time)
+        admission_control = WhoisAdmissionControl()
+
+        # Bursts of up to one second of queries are not delayed
+        assert admission_control.query_delay('192.0.2.1', 10) == 0
+        assert admission_control.query_delay('192.0.2.1', 5) == 0.5
+        assert admission_control.query_delay('192.0.2.2', 1) == 0
+
+        # The bucket refills at the rate limit, but never over one second of queries
+        mock_time.return_value = 101.5
+        assert admission_control.query_delay('192.0.2.1', 10) == 0
+        assert admission_control.query_delay('192.0.2.1', 20) == 2
+        assert admission_control.rate_limited_batches == 2
+        assert admission_control.rate_limit_delay == 2.5
+
+        # Clients whose bucket is full again are pruned
+        mock_time.return_value = 102
+        admission_control.prune()
+        assert list(admission_control._query_buckets.keys()) == ['192.0.2.1']
+
+        config_override({
+            'server': {'whois': {'max_query_rate_per_client': 0}},
+        })
+        assert admission_control.query_delay('192.0.2.1', 1000) == 0
+        admission_control.prune()
+        assert not admission_control._query_buckets
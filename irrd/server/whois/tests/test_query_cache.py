@@ -0,0 +1,90 @@
+from unittest.mock import Mock
+
+import pytest
+
+from irrd.storage.change_serials import SourceChangeSerials
+from irrd.storage.preload import Preloader
+from ..query_cache import WhoisQueryCache, REDIS_QUERY_CACHE_KEY_PREFIX
+
+
+@pytest.fixture()
+def prepare_cache(monkeypatch, config_override):
+    config_override({
+        'sources': {'TEST1': {}, 'TEST2': {}},
+        'server': {'whois': {'query_cache_ttl': 60}},
+    })
+    monkeypatch.setattr('irrd.storage.change_serials.REDIS_SOURCE_CHANGE_SERIALS_KEY',
+                        b'TEST-irrd-source-change-serials')
+    mock_preloader = Mock(spec=Preloader)
+    mock_preloader.generation = Mock(return_value=1)
+    mock_query_parser = Mock(sources=['TEST1', 'TEST2'], rpki_invalid_filter_enabled=True,
+                             out_scope_filter_enabled=True)
+    mock_query_parser._query_cost_limit = Mock(return_value=0)
+    cache = WhoisQueryCache(mock_preloader)
+    yield cache, mock_preloader, mock_query_parser
+    cache._redis_conn.delete(b'TEST-irrd-source-change-serials')
+
+
+class TestWhoisQueryCache:
+    def test_cache_key(self, prepare_cache, config_override):
+        cache, mock_preloader, mock_query_parser = prepare_cache
+        key = cache.cache_key('!gAS65537', mock_query_parser)
+        assert key.startswith(REDIS_QUERY_CACHE_KEY_PREFIX)
+        assert cache.cache_key(' !gAS65537\r\n', mock_query_parser) == key
+        assert cache.cache_key('!gAS65538', mock_query_parser) != key
+        assert cache.cache_key('-x  192.0.2.0/24', mock_query_parser) == \
+            cache.cache_key('-x 192.0.2.0/24', mock_query_parser)
+        assert cache.cache_key('-K -r -T route -i mnt-by MNT-TEST', mock_query_parser)
+        assert cache.cache_key('AS65537', mock_query_parser)
+
+        # Session state and changed data affect the key
+        mock_query_parser.sources = ['TEST2', 'TEST1']
+        assert cache.cache_key('!gAS65537', mock_query_parser) != key
+        mock_query_parser.sources = ['TEST1', 'TEST2']
+        mock_query_parser.rpki_invalid_filter_enabled = False
+        assert cache.cache_key('!gAS65537', mock_query_parser) != key
+        mock_query_parser.rpki_invalid_filter_enabled = True
+        assert cache.cache_key('!gAS65537', mock_query_parser) == key
+        mock_query_parser._query_cost_limit = Mock(return_value=100)
+        assert cache.cache_key('!gAS65537', mock_query_parser) != key
+        mock_query_parser._query_cost_limit = Mock(return_value=0)
+        assert cache.cache_key('!gAS65537', mock_query_parser) == key
+        SourceChangeSerials().increase(['TEST2'])
+        assert cache.cache_key('!gAS65537', mock_query_parser) != key
+        key = cache.cache_key('!gAS65537', mock_query_parser)
+        mock_preloader.generation = Mock(return_value=2)
+        assert cache.cache_key('!gAS65537', mock_query_parser) != key
+
+        # Queries that change the session state
+        for query in ['!!', '!sTEST1', '!t10', '!v', '!j-*', '!fno-rpki-filter', '!',
+                      '-k', '-s TEST1 -x 192.0.2.0/24', '-a AS65537', '-V agent AS65537', '-g TEST1:3:1-LAST']:
+            assert cache.cache_key(query, mock_query_parser) is None, query
+
+        # No preload snapshot yet, or cache disabled
+        mock_preloader.generation = Mock(return_value=None)
+        assert cache.cache_key('!gAS65537', mock_query_parser) is None
+        mock_preloader.generation = Mock(return_value=2)
+        config_override({
+            'sources': {'TEST1': {}, 'TEST2': {}},
+            'server': {'whois': {'query_cache_ttl': 0}},
+        })
+        assert cache.cache_key('!gAS65537', mock_query_parser) is None
+
+    def test_get_set(self, prepare_cache):
+        cache, mock_preloader, mock_query_parser = prepare_cache
+        key = REDIS_QUERY_CACHE_KEY_PREFIX + 'TEST-key'
+        cache._redis_conn.delete(key)
+        assert cache.get(key) is None
+        cache.set(key, b'response')
+        assert cache.get(key) == b'response'
+        assert 0 < cache._redis_conn.ttl(key) <= 60
+        cache._redis_conn.delete(key)
+
+    def test_get_many(self, prepare_cache):
+        cache, mock_preloader, mock_query_parser = prepare_cache
+        keys = [REDIS_QUERY_CACHE_KEY_PREFIX + 'TEST-key1', REDIS_QUERY_CACHE_KEY_PREFIX + 'TEST-key2']
+        cache._redis_conn.delete(*keys)
+        cache.set(keys[1], b'response')
+        assert cache.get_many(keys) == [None, b'response']
+        assert cache.get_many([]) == []
+        cache._redis_conn.delete(*keys)
@@ -0,0 +1,81 @@
+from unittest.mock import Mock
+
+import pytest
+import redis
+
+from irrd.conf import get_setting
+from ..query_metrics import WhoisQueryMetrics, query_command_type
+
+
+def test_query_command_type():
+    assert query_command_type('!gAS65537') == '!g'
+    assert query_command_type(' !6AS65537') == '!6'
+    assert query_command_type('!!') == '!!'
+    assert query_command_type('!e') == 'other'
+    assert query_command_type('!') == 'other'
+    assert query_command_type('-i mnt-by MNT-TEST') == '-i'
+    assert query_command_type('-s TEST1 -T route -M 192.0.2.0/24') == '-M'
+    assert query_command_type('-k') == '-k'
+    assert query_command_type('-K -r AS65537') == 'text'
+    assert query_command_type('-s -x') == 'other'
+    assert query_command_type('-e') == 'other'
+
+
+class TestWhoisQueryMetrics:
+    def test_record_and_flush(self, config_override, monkeypatch):
+        config_override({'redis_url': 'redis://invalid-host.example.com'})  # Not actually used
+        redis_key = b'TEST-irrd-whois-query-metrics'
+        monkeypatch.setattr('irrd.server.whois.query_metrics.REDIS_WHOIS_QUERY_METRICS_KEY', redis_key)
+        monkeypatch.setattr('irrd.server.whois.query_metrics.time.monotonic', Mock(return_value=100))
+        redis_conn = redis.Redis.from_url(get_setting('redis_url'))
+        redis_conn.delete(redis_key)
+
+        mock_statement_cache = Mock(hits=10, misses=5)
+        monkeypatch.setattr('irrd.server.whois.query_metrics.statement_cache', mock_statement_cache)
+
+        query_metrics = WhoisQueryMetrics()
+        mock_statement_cache.hits = 13
+        mock_statement_cache.misses = 6
+        query_metrics.record('!gAS65537', 0.002, 50)
+        query_metrics.record('!gAS65538', 20, 5000, slow=True)
+        query_metrics.record('-i mnt-by MNT-TEST', 0.5, 1000)
+
+        # Metrics are only written after METRICS_FLUSH_INTERVAL, unless forced
+        query_metrics.flush()
+        assert not redis_conn.exists(redis_key)
+        query_metrics.flush(force=True)
+
+        metrics = {key.decode('utf-8'): float(value) for key, value in redis_conn.hgetall(redis_key).items()}
+        assert metrics == {
+            'latency_bucket:!g:0.0025': 1,
+            'latency_bucket:!g:+Inf': 1,
+            'latency_sum:!g': 20.002,
+            'size_bucket:!g:100': 1,
+            'size_bucket:!g:10000': 1,
+            'size_sum:!g': 5050,
+            'slow_queries:!g': 1,
+            'latency_bucket:-i:0.5': 1,
+            'latency_sum:-i': 0.5,
+            'size_bucket:-i:1000': 1,
+            'size_sum:-i': 1000,
+            'statement_cache_hits': 3,
+            'statement_cache_misses': 1,
+        }
+
+        query_metrics.record('!gAS65537', 0.002, 50)
+        mock_statement_cache.hits = 15
+        monkeypatch.setattr('irrd.server.whois.query_metrics.time.monotonic', Mock(return_value=110))
+        query_metrics.flush()
+        assert float(redis_conn.hget(redis_key, 'latency_sum:!g')) == pytest.approx(20.004)
+        assert int(redis_conn.hget(redis_key, 'statement_cache_hits')) == 5
+        assert int(redis_conn.hget(redis_key, 'statement_cache_misses')) == 1
+
+        query_metrics.record_server_metrics({'connections_active': 5, 'connections_waiting': 2})
+        query_metrics.flush(force=True)
+        query_metrics.record_server_metrics({'connections_active': 3})
+        query_metrics.flush(force=True)
+        assert int(redis_conn.hget(redis_key, 'connections_active')) == 3
+        assert int(redis_conn.hget(redis_key, 'connections_waiting')) == 2
+
+        query_metrics.reset()
+        assert not redis_conn.exists(redis_key)
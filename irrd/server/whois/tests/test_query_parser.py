@@ -11,9 +11,10 @@ from irrd.mirroring.nrtm_generator import NRTMGeneratorException
 from irrd.rpki.status import RPKIStatus
 from irrd.scopefilter.status import ScopeFilterStatus
 from irrd.storage.preload import Preloader
+from irrd.storage.set_expansion_cache import SetExpansionCache
 from irrd.utils.test_utils import flatten_mock_calls
 from ..query_parser import WhoisQueryParser
-from ..query_response import WhoisQueryResponseType, WhoisQueryResponseMode
+from ..query_response import WhoisQueryResponseType, WhoisQueryResponseMode, WhoisQueryResultStream
 
 # Note that these mock objects are not entirely valid RPSL objects,
 # as they are meant to test all the scenarios in the query parser.
@@ -66,6 +67,9 @@ def prepare_parser(monkeypatch, config_override):
     mock_database_query = Mock()
     monkeypatch.setattr('irrd.server.whois.query_parser.RPSLDatabaseQuery', lambda columns=None, ordered_by_sources=True: mock_database_query)
     mock_preloader = Mock(spec=Preloader)
+    mock_preloader.set_store_available = Mock(return_value=False)
+    mock_preloader.prefix_index_available = Mock(return_value=False)
+    mock_preloader.set_expansion_cache = SetExpansionCache()
 
     parser = WhoisQueryParser('127.0.0.1', '127.0.0.1:99999', mock_preloader, mock_database_handler)
     parser.out_scope_filter_enabled = False
@@ -154,6 +158,25 @@ class TestWhoisQueryParserRIPE:
         assert response.mode == WhoisQueryResponseMode.RIPE
         assert not response.result
 
+    def test_route_search_stream_results(self, prepare_parser):
+        mock_dq, mock_dh, mock_preloader, parser = prepare_parser
+        mock_dh.execute_query_stream = mock_dh.execute_query
+        parser.stream_results = True
+
+        response = parser.handle_query('-x 192.0.2.0/25')
+        assert response.response_type == WhoisQueryResponseType.SUCCESS
+        assert isinstance(response.result, WhoisQueryResultStream)
+        assert ''.join(response.result) == MOCK_ROUTE_COMBINED
+
+        mock_dh.execute_query_stream = lambda query: iter([])
+        response = parser.handle_query('-x 192.0.2.0/32')
+        assert response.response_type == WhoisQueryResponseType.KEY_NOT_FOUND
+        assert not response.result
+
+        # Key fields only output is not streamed, as it is deduplicated
+        response = parser.handle_query('-K -x 192.0.2.0/25')
+        assert response.result == MOCK_ROUTE_COMBINED_KEY_FIELDS
+
     def test_route_search_less_specific_one_level(self, prepare_parser):
         mock_dq, mock_dh, mock_preloader, parser = prepare_parser
 
@@ -163,9 +186,65 @@ class TestWhoisQueryParserRIPE:
         assert response.result == MOCK_ROUTE_COMBINED
         assert flatten_mock_calls(mock_dq) == [
             ['object_classes', (['route', 'route6'],), {}],
-            ['ip_less_specific_one_level', (IP('192.0.2.0/25'),), {}]
+            ['ip_less_specific_one_level', (IP('192.0.2.0/25'),), {'use_parent_links': False}]
         ]
 
+    def test_route_search_less_specific_one_level_parent_links(self, prepare_parser, config_override):
+        mock_dq, mock_dh, mock_preloader, parser = prepare_parser
+
+        response = parser.handle_query('-s TEST1 -l 192.0.2.0/25')
+        assert response.response_type == WhoisQueryResponseType.SUCCESS
+        assert response.result == MOCK_ROUTE_COMBINED
+        assert flatten_mock_calls(mock_dq) == [
+            ['sources', (['TEST1'],), {}],
+            ['object_classes', (['route', 'route6'],), {}],
+            ['ip_less_specific_one_level', (IP('192.0.2.0/25'),), {'use_parent_links': True}],
+        ]
+        mock_dq.reset_mock()
+
+        # Parent links do not take the RPKI or scope filter status into account,
+        # but can be used if the filters have no effect on the source
+        parser.out_scope_filter_enabled = True
+        parser.handle_query('-s TEST1 -l 192.0.2.0/25')
+        assert flatten_mock_calls(mock_dq) == [
+            ['sources', (['TEST1'],), {}],
+            ['scopefilter_status', ([ScopeFilterStatus.in_scope],), {}],
+            ['object_classes', (['route', 'route6'],), {}],
+            ['ip_less_specific_one_level', (IP('192.0.2.0/25'),), {'use_parent_links': True}],
+        ]
+        mock_dq.reset_mock()
+
+        config_override({
+            'rpki': {'roa_source': None},
+            'scopefilter': {'asns': ['23456']},
+            'sources': {'TEST1': {}, 'TEST2': {'scopefilter_excluded': True}},
+            'sources_default': [],
+        })
+        parser.handle_query('-s TEST1 -l 192.0.2.0/25')
+        assert flatten_mock_calls(mock_dq)[-1] == [
+            'ip_less_specific_one_level', (IP('192.0.2.0/25'),), {'use_parent_links': False}]
+        parser.handle_query('-s TEST2 -l 192.0.2.0/25')
+        assert flatten_mock_calls(mock_dq)[-1] == [
+            'ip_less_specific_one_level', (IP('192.0.2.0/25'),), {'use_parent_links': True}]
+
+        parser.rpki_invalid_filter_enabled = True
+        parser.handle_query('-s TEST2 -l 192.0.2.0/25')
+        assert flatten_mock_calls(mock_dq)[-1] == [
+            'ip_less_specific_one_level', (IP('192.0.2.0/25'),), {'use_parent_links': False}]
+
+    def test_route_search_less_specific_one_level_parent_links_default_settings(self, prepare_parser):
+        mock_dq, mock_dh, mock_preloader, _ = prepare_parser
+        # A new parser has the scope filter enabled, but it is not configured
+        parser = WhoisQueryParser('127.0.0.1', '127.0.0.1:99999', mock_preloader, mock_dh)
+        assert parser.out_scope_filter_enabled
+
+        parser.handle_query('!sTEST1')
+        mock_dq.reset_mock()
+        response = parser.handle_query('!r192.0.2.0/25,l')
+        assert response.response_type == WhoisQueryResponseType.SUCCESS
+        assert flatten_mock_calls(mock_dq)[-1] == [
+            'ip_less_specific_one_level', (IP('192.0.2.0/25'),), {'use_parent_links': True}]
+
     def test_route_search_less_specific(self, prepare_parser):
         mock_dq, mock_dh, mock_preloader, parser = prepare_parser
 
@@ -221,6 +300,57 @@ class TestWhoisQueryParserRIPE:
         assert response.mode == WhoisQueryResponseMode.RIPE
         assert response.result.startswith('Inverse attribute search not supported for invalid-attr')
 
+    def test_query_cost_limit(self, prepare_parser, config_override):
+        mock_dq, mock_dh, mock_preloader, parser = prepare_parser
+        config_override({
+            'rpki': {'roa_source': None},
+            'sources': {'TEST1': {}, 'TEST2': {}},
+            'sources_default': [],
+            'server': {'whois': {'max_query_cost': 10}},
+        })
+        mock_dh.estimate_row_count = Mock(return_value=11)
+
+        response = parser.handle_query('-i mnt-by MNT-TEST')
+        assert response.response_type == WhoisQueryResponseType.ERROR
+        assert response.result.startswith('Query rejected, as the estimated number of results (11) '
+                                          'exceeds the limit of 10 for this client.')
+        response = parser.handle_query('-M 192.0.2.0/25')
+        assert response.response_type == WhoisQueryResponseType.ERROR
+        assert mock_dh.estimate_row_count.call_count == 2
+
+        # Queries with a bounded number of results are not estimated
+        response = parser.handle_query('-x 192.0.2.0/25')
+        assert response.response_type == WhoisQueryResponseType.SUCCESS
+        assert mock_dh.estimate_row_count.call_count == 2
+
+        mock_dh.estimate_row_count = Mock(return_value=10)
+        response = parser.handle_query('-i mnt-by MNT-TEST')
+        assert response.response_type == WhoisQueryResponseType.SUCCESS
+        assert response.result == MOCK_ROUTE_COMBINED
+
+    def test_query_cost_limit_per_access_list(self, prepare_parser, config_override):
+        mock_dq, mock_dh, mock_preloader, parser = prepare_parser
+        config_override({
+            'rpki': {'roa_source': None},
+            'sources': {'TEST1': {}, 'TEST2': {}},
+            'sources_default': [],
+            'server': {'whois': {
+                'max_query_cost': 10,
+                'max_query_cost_per_access_list': {'other': 100, 'local': 0, 'also-local': 1},
+            }},
+            'access_lists': {
+                'other': ['192.0.2.0/24'],
+                'local': ['127.0.0.0/8'],
+                'also-local': ['127.0.0.1'],
+            },
+        })
+        mock_dh.estimate_row_count = Mock(return_value=1000)
+
+        # The first access list that includes the client applies, 0 meaning no limit
+        response = parser.handle_query('-i mnt-by MNT-TEST')
+        assert response.response_type == WhoisQueryResponseType.SUCCESS
+        assert not mock_dh.estimate_row_count.called
+
     def test_sources_list(self, prepare_parser):
         mock_dq, mock_dh, mock_preloader, parser = prepare_parser
         mock_dh.reset_mock()
@@ -231,6 +361,25 @@ class TestWhoisQueryParserRIPE:
         assert not response.result
         assert parser.sources == ['TEST1']
 
+    def test_session_state(self, prepare_parser):
+        mock_dq, mock_dh, mock_preloader, parser = prepare_parser
+
+        parser.handle_query('-k')
+        parser.handle_query('-s test1')
+        parser.handle_query('-V user-agent')
+        state = parser.session_state()
+        assert state['sources'] == ['TEST1']
+        assert state['user_agent'] == 'user-agent'
+        assert state['multiple_command_mode']
+
+        new_parser = WhoisQueryParser('127.0.0.1', '127.0.0.1:99999', mock_preloader, mock_dh)
+        assert not new_parser.multiple_command_mode
+        new_parser.restore_session_state(state)
+        assert new_parser.sources == ['TEST1']
+        assert new_parser.user_agent == 'user-agent'
+        assert new_parser.multiple_command_mode
+        assert new_parser.session_state() == state
+
     def test_sources_all(self, prepare_parser):
         mock_dq, mock_dh, mock_preloader, parser = prepare_parser
         mock_dh.reset_mock()
@@ -541,8 +690,30 @@ class TestWhoisQueryParserIRRD:
         assert response.mode == WhoisQueryResponseMode.IRRD
         assert response.result == 'Invalid AS number ASFOOBAR: number part is not numeric'
 
+        response = parser.handle_query('!gAS65547,X')
+        assert response.response_type == WhoisQueryResponseType.ERROR
+        assert response.mode == WhoisQueryResponseMode.IRRD
+        assert response.result == 'Invalid aggregation flag: X'
+
         assert not mock_dq.mock_calls
 
+    def test_routes_for_origin_aggregated(self, prepare_parser):
+        mock_dq, mock_dh, mock_preloader, parser = prepare_parser
+
+        mock_preloader.aggregated_routes_for_origins = Mock(return_value=['192.0.2.0/24'])
+        response = parser.handle_query('!gAS65547,a')
+        assert response.response_type == WhoisQueryResponseType.SUCCESS
+        assert response.result == '192.0.2.0/24'
+
+        mock_preloader.aggregated_routes_for_origins = Mock(return_value=['2001:db8::/32^32-33'])
+        response = parser.handle_query('!6AS65547,R')
+        assert response.response_type == WhoisQueryResponseType.SUCCESS
+        assert response.result == '2001:db8::/32^32-33'
+
+        assert flatten_mock_calls(mock_preloader.aggregated_routes_for_origins) == [
+            ['', (['AS65547'], ['TEST1', 'TEST2']), {'ip_version': 6, 'ranges': True}],
+        ]
+
     def test_handle_irrd_routes_for_as_set(self, prepare_parser, monkeypatch):
         mock_dq, mock_dh, mock_preloader, parser = prepare_parser
 
@@ -593,6 +764,14 @@ class TestWhoisQueryParserIRRD:
         ]
         mock_preloader.routes_for_origins.reset_mock()
 
+        mock_preloader.aggregated_routes_for_origins = Mock(return_value=['192.0.2.0/24'])
+        response = parser.handle_query('!a4AS-FOO,A')
+        assert response.response_type == WhoisQueryResponseType.SUCCESS
+        assert response.result == '192.0.2.0/24'
+        assert flatten_mock_calls(mock_preloader.aggregated_routes_for_origins) == [
+            ['', ({'AS65547', 'AS65548'}, parser.sources), {'ip_version': 4, 'ranges': False}],
+        ]
+
         assert not mock_dq.mock_calls
 
     def test_as_set_members(self, prepare_parser):
@@ -783,6 +962,145 @@ class TestWhoisQueryParserIRRD:
             ['lookup_attrs_in', (['member-of'], ['RRS-TEST']), {}],
         ]
 
+    def test_set_members_preloaded(self, prepare_parser):
+        mock_dq, mock_dh, mock_preloader, parser = prepare_parser
+        mock_dh.execute_query = Mock()
+        preloaded_sets = {
+            'AS-FIRSTLEVEL': {
+                'TEST1': ['as-set', ['AS65547', 'AS-SECONDLEVEL', 'AS-2nd-UNKNOWN', 'RS-IGNORED'], []],
+            },
+            'AS-SECONDLEVEL': {
+                'TEST1': ['as-set', ['AS-THIRDLEVEL', 'AS65544'], []],
+                'TEST2': ['as-set', ['AS-IGNOREME'], []],
+            },
+            'AS-THIRDLEVEL': {
+                # Refers back to the first as-set to test infinite recursion issues
+                'TEST2': ['as-set', ['AS65545', 'AS-FIRSTLEVEL'], [
+                    ['TEST1', 'AS65546', True, True],
+                    ['TEST1', 'AS65548', False, True],
+                    ['TEST2', 'AS65549', True, False],
+                ]],
+            },
+            'RS-IGNORED': {
+                'TEST1': ['route-set', ['192.0.2.0/24'], []],
+            },
+        }
+        mock_preloader.set_store_available = Mock(return_value=True)
+        mock_preloader.sets = lambda set_name: preloaded_sets.get(set_name.upper(), {})
+
+        response = parser.handle_query('!iAS-FIRSTLEVEL')
+        assert response.response_type == WhoisQueryResponseType.SUCCESS
+        assert response.result == 'AS-2nd-UNKNOWN AS-SECONDLEVEL AS65547 RS-IGNORED'
+
+        response = parser.handle_query('!iAS-FIRSTLEVEL,1')
+        assert response.response_type == WhoisQueryResponseType.SUCCESS
+        assert response.result == 'AS65544 AS65545 AS65546 AS65547 AS65548 AS65549'
+
+        parser.rpki_invalid_filter_enabled = True
+        parser.out_scope_filter_enabled = True
+        response = parser.handle_query('!iAS-FIRSTLEVEL,1')
+        assert response.result == 'AS65544 AS65545 AS65546 AS65547'
+
+        # Source priority changes which object is used for AS-SECONDLEVEL
+        parser.rpki_invalid_filter_enabled = False
+        parser.out_scope_filter_enabled = False
+        parser.handle_query('!sTEST2,TEST1')
+        response = parser.handle_query('!iAS-FIRSTLEVEL,1')
+        assert response.result == 'AS65547'
+
+        # Members by reference from sources that are not queried are excluded
+        parser.handle_query('!sTEST2')
+        response = parser.handle_query('!iAS-THIRDLEVEL,1')
+        assert response.result == 'AS65545 AS65549'
+
+        response = parser.handle_query('!iAS-NOTEXIST')
+        assert response.response_type == WhoisQueryResponseType.KEY_NOT_FOUND
+        assert not response.result
+        assert not mock_dh.execute_query.called
+
+    def test_set_members_query_cost_limit(self, prepare_parser, config_override):
+        mock_dq, mock_dh, mock_preloader, parser = prepare_parser
+        config_override({
+            'rpki': {'roa_source': None},
+            'sources': {'TEST1': {}, 'TEST2': {}},
+            'sources_default': [],
+            'server': {'whois': {'max_query_cost': 2}},
+        })
+        preloaded_sets = {
+            'AS-FIRSTLEVEL': {'TEST1': ['as-set', ['AS65547', 'AS-SECONDLEVEL'], []]},
+            'AS-SECONDLEVEL': {'TEST1': ['as-set', ['AS65544', 'AS65545'], []]},
+        }
+        mock_preloader.set_store_available = Mock(return_value=True)
+        mock_preloader.sets = lambda set_name: preloaded_sets.get(set_name.upper(), {})
+        mock_preloader.routes_for_origins = Mock(return_value={'192.0.2.0/25'})
+        mock_preloader.route_count_for_origins = Mock(return_value=1)
+        cache = mock_preloader.set_expansion_cache
+        cache.snapshot_attached(1, None)
+
+        response = parser.handle_query('!iAS-FIRSTLEVEL')
+        assert response.response_type == WhoisQueryResponseType.SUCCESS
+        assert response.result == 'AS-SECONDLEVEL AS65547'
+
+        # Recursive expansions are rejected on their estimated size, before resolving
+        response = parser.handle_query('!iAS-FIRSTLEVEL,1')
+        assert response.response_type == WhoisQueryResponseType.ERROR
+        assert response.result.startswith('Query rejected, as the estimated number of results (3) exceeds the limit of 2')
+        assert not len(cache)
+
+        # The routes of AS members are estimated from the preloaded route counts
+        response = parser.handle_query('!aAS-FIRSTLEVEL')
+        assert response.response_type == WhoisQueryResponseType.SUCCESS
+        assert response.result == '192.0.2.0/25'
+        mock_preloader.route_count_for_origins = Mock(return_value=2)
+        response = parser.handle_query('!a4AS-FIRSTLEVEL')
+        assert response.response_type == WhoisQueryResponseType.ERROR
+        assert response.result.startswith('Query rejected, as the estimated number of results (4) exceeds the limit of 2')
+        assert mock_preloader.route_count_for_origins.call_args[0][2] == 4
+        assert len(mock_preloader.routes_for_origins.mock_calls) == 1
+
+        # The limit also applies to results from the set expansion cache
+        cache.put(('!i', 'AS-FIRSTLEVEL', False, ('TEST1', 'TEST2'), None, False, False),
+                  'AS65544 AS65545 AS65547', set(), 1)
+        response = parser.handle_query('!iAS-FIRSTLEVEL,1')
+        assert response.response_type == WhoisQueryResponseType.ERROR
+        assert response.result.startswith('Query rejected, as the number of results (3) exceeds the limit of 2')
+
+    def test_set_expansion_cache(self, prepare_parser):
+        mock_dq, mock_dh, mock_preloader, parser = prepare_parser
+        preloaded_sets = {
+            'AS-FIRSTLEVEL': {'TEST1': ['as-set', ['AS65547', 'AS-SECONDLEVEL'], []]},
+            'AS-SECONDLEVEL': {'TEST1': ['as-set', ['AS65548'], []]},
+            'RS-TEST': {'TEST1': ['route-set', ['192.0.2.0/24', 'AS65549'], []]},
+        }
+        mock_sets = Mock(side_effect=lambda set_name: preloaded_sets.get(set_name.upper(), {}))
+        mock_preloader.set_store_available = Mock(return_value=True)
+        mock_preloader.sets = mock_sets
+        mock_preloader.routes_for_origins = Mock(return_value={'198.51.100.0/24'})
+        cache = mock_preloader.set_expansion_cache
+        cache.snapshot_attached(1, None)
+
+        assert parser.handle_query('!iAS-FIRSTLEVEL,1').result == 'AS65547 AS65548'
+        assert parser.handle_query('!ias-firstlevel,1').result == 'AS65547 AS65548'
+        assert parser.handle_query('!a4AS-FIRSTLEVEL').result == '198.51.100.0/24'
+        assert parser.handle_query('!a4AS-FIRSTLEVEL').result == '198.51.100.0/24'
+        assert parser.handle_query('!iRS-TEST,1').result == '192.0.2.0/24 198.51.100.0/24'
+        assert parser.handle_query('!iRS-TEST,1').result == '192.0.2.0/24 198.51.100.0/24'
+        assert len(mock_sets.mock_calls) == 5
+        assert len(mock_preloader.routes_for_origins.mock_calls) == 2
+        assert len(cache) == 3
+
+        # A different source selection is cached separately
+        parser.handle_query('!sTEST1')
+        assert parser.handle_query('!iAS-FIRSTLEVEL,1').result == 'AS65547 AS65548'
+        assert len(mock_sets.mock_calls) == 7
+        assert len(cache) == 4
+
+        # Only entries depending on a changed set or origin are invalidated
+        cache.snapshot_attached(2, ['set:AS-SECONDLEVEL'])
+        assert len(cache) == 1
+        cache.snapshot_attached(3, ['origin:AS65549'])
+        assert len(cache) == 0
+
     def test_route_set_compatibility_ipv4_only_route_set_members(self, prepare_parser, config_override):
         mock_dq, mock_dh, mock_preloader, parser = prepare_parser
 
@@ -1001,6 +1319,56 @@ class TestWhoisQueryParserIRRD:
         assert response.mode == WhoisQueryResponseMode.IRRD
         assert response.result == 'Invalid argument for object lookup: foo'
 
+    def test_exact_key_prefetched(self, prepare_parser):
+        mock_dq, mock_dh, mock_preloader, parser = prepare_parser
+
+        parser.prefetch_exact_keys(['route,192.0.2.0/25,AS65547', 'route,192.0.2.128/25,AS65545 ', 'foo'])
+        assert flatten_mock_calls(mock_dq)[0] == ['object_classes', (['route'],), {}]
+        assert flatten_mock_calls(mock_dq)[1][0] == 'rpsl_pks'
+        assert sorted(flatten_mock_calls(mock_dq)[1][1][0]) == ['192.0.2.0/25,AS65547', '192.0.2.128/25,AS65545']
+        mock_dq.reset_mock()
+        mock_dh.execute_query = lambda query: []
+
+        response = parser.handle_query('!mroute,192.0.2.0/25,AS65547')
+        assert response.response_type == WhoisQueryResponseType.SUCCESS
+        assert response.result == MOCK_ROUTE1.strip()
+        response = parser.handle_query('!mroute,192.0.2.128/25,as65545')
+        assert response.response_type == WhoisQueryResponseType.SUCCESS
+        assert response.result == MOCK_ROUTE3.strip()
+        assert not mock_dq.mock_calls
+
+        # Prefetched objects are only used once, other keys are queried as usual
+        response = parser.handle_query('!mroute,192.0.2.0/25,AS65547')
+        assert response.response_type == WhoisQueryResponseType.KEY_NOT_FOUND
+        response = parser.handle_query('!mroute,192.0.2.0/25,AS65544')
+        assert response.response_type == WhoisQueryResponseType.KEY_NOT_FOUND
+        assert flatten_mock_calls(mock_dq)[-1] == ['first_only', (), {}]
+
+    def test_routes_for_origin_prefetched(self, prepare_parser):
+        mock_dq, mock_dh, mock_preloader, parser = prepare_parser
+        mock_preloader.routes_per_origin = Mock(return_value={
+            'AS65547': {'192.0.2.0/25'},
+            'AS65548': set(),
+        })
+
+        parser.prefetch_routes_for_origins(['AS65547', 'as65548', 'AS65549,a', 'INVALID'], ip_version=4)
+        mock_preloader.routes_per_origin.assert_called_once_with(
+            {'AS65547', 'AS65548'}, ['TEST1', 'TEST2'], ip_version=4)
+
+        response = parser.handle_query('!gAS65547')
+        assert response.response_type == WhoisQueryResponseType.SUCCESS
+        assert response.result == '192.0.2.0/25'
+        response = parser.handle_query('!gAS65548')
+        assert response.response_type == WhoisQueryResponseType.KEY_NOT_FOUND
+        assert not mock_preloader.routes_for_origins.called
+
+        # Prefetched routes are only used once, and only for the same IP version
+        mock_preloader.routes_for_origins = Mock(return_value={'2001:db8::/32'})
+        parser.prefetch_routes_for_origins(['AS65547', 'AS65548'], ip_version=4)
+        response = parser.handle_query('!6AS65547')
+        assert response.result == '2001:db8::/32'
+        mock_preloader.routes_for_origins.assert_called_once_with(['AS65547'], ['TEST1', 'TEST2'], ip_version=6)
+
     def test_user_agent(self, prepare_parser):
         mock_dq, mock_dh, mock_preloader, parser = prepare_parser
         mock_dh.reset_mock()
@@ -1055,6 +1423,42 @@ class TestWhoisQueryParserIRRD:
         assert response.mode == WhoisQueryResponseMode.IRRD
         assert not response.result
 
+    def test_route_search_origins_preloaded(self, prepare_parser, config_override):
+        mock_dq, mock_dh, mock_preloader, parser = prepare_parser
+        mock_dh.reset_mock()
+        parser.out_scope_filter_enabled = True
+        mock_preloader.prefix_index_available = Mock(return_value=True)
+        mock_preloader.origins_for_prefix = Mock(return_value=['AS65544', 'AS65547'])
+
+        response = parser.handle_query('!r192.0.2.0/25,o')
+        assert response.response_type == WhoisQueryResponseType.SUCCESS
+        assert response.mode == WhoisQueryResponseMode.IRRD
+        assert response.result == 'AS65544 AS65547'
+        assert flatten_mock_calls(mock_preloader.origins_for_prefix) == [
+            ['', (4, '192.0.2.0', 25, ['TEST1', 'TEST2']), {}],
+        ]
+        assert not mock_dq.mock_calls
+
+        mock_preloader.origins_for_prefix = Mock(return_value=[])
+        response = parser.handle_query('!r2001:db8::/32,o')
+        assert response.response_type == WhoisQueryResponseType.KEY_NOT_FOUND
+        assert not response.result
+        assert flatten_mock_calls(mock_preloader.origins_for_prefix) == [
+            ['', (6, '2001:db8::', 32, ['TEST1', 'TEST2']), {}],
+        ]
+        assert not mock_dq.mock_calls
+
+        # The preload store only contains routes that pass the scope filter
+        mock_preloader.origins_for_prefix.reset_mock()
+        parser.out_scope_filter_enabled = False
+        response = parser.handle_query('!r192.0.2.0/25,o')
+        assert response.result == 'AS65547 AS65544 AS65545'
+        assert flatten_mock_calls(mock_dq) == [
+            ['object_classes', (['route', 'route6'],), {}],
+            ['ip_exact', (IP('192.0.2.0/25'),), {}]
+        ]
+        assert not mock_preloader.origins_for_prefix.mock_calls
+
     def test_route_search_exact_rpki_aware(self, prepare_parser, config_override):
         mock_dq, mock_dh, mock_preloader, _ = prepare_parser
         config_override({
@@ -1128,7 +1532,7 @@ class TestWhoisQueryParserIRRD:
         assert response.result == MOCK_ROUTE_COMBINED
         assert flatten_mock_calls(mock_dq) == [
             ['object_classes', (['route', 'route6'],), {}],
-            ['ip_less_specific_one_level', (IP('192.0.2.0/25'),), {}]
+            ['ip_less_specific_one_level', (IP('192.0.2.0/25'),), {'use_parent_links': False}]
         ]
 
     def test_route_search_less_specific(self, prepare_parser):
@@ -2,7 +2,8 @@ from _pytest.python_api import raises
 
 from irrd.conf import PASSWORD_HASH_DUMMY_VALUE
 from irrd.utils.rpsl_samples import SAMPLE_MNTNER
-from ..query_response import WhoisQueryResponse, WhoisQueryResponseMode, WhoisQueryResponseType
+from ..query_response import (WhoisQueryResponse, WhoisQueryResponseMode, WhoisQueryResponseType,
+                              WhoisQueryResultStream)
 
 
 class TestWhoisQueryResponse:
@@ -69,3 +70,46 @@ class TestWhoisQueryResponse:
         assert 'CRYPT-PW ' + PASSWORD_HASH_DUMMY_VALUE in response
         assert 'CRYPT-PW LEuuhsBJNFV0Q' not in response
         assert 'MD5-pw $1$fgW84Y9r$kKEn9MUq8PChNKpQhO6BM.' not in response
+
+    def test_response_chunks(self, monkeypatch):
+        def stream():
+            return WhoisQueryResultStream(iter(['object1\n', 'object2\n\n', SAMPLE_MNTNER]))
+
+        response = WhoisQueryResponse(mode=WhoisQueryResponseMode.RIPE,
+                                      response_type=WhoisQueryResponseType.SUCCESS,
+                                      result=stream())
+        chunks = list(response.generate_response_chunks())
+        assert len(chunks) == 4
+        assert chunks[:2] == ['object1\n', 'object2\n\n']
+        assert 'CRYPT-PW ' + PASSWORD_HASH_DUMMY_VALUE in chunks[2]
+        assert 'CRYPT-PW LEuuhsBJNFV0Q' not in chunks[2]
+        assert chunks[3] == '\n\n\n'
+
+        # Read back from the spool in small chunks, to ensure it is actually
+        # written to a file.
+        monkeypatch.setattr('irrd.server.whois.query_response.RESPONSE_SPOOL_MAX_MEMORY', 5)
+        monkeypatch.setattr('irrd.server.whois.query_response.RESPONSE_SPOOL_READ_SIZE', 8)
+        response = WhoisQueryResponse(mode=WhoisQueryResponseMode.IRRD,
+                                      response_type=WhoisQueryResponseType.SUCCESS,
+                                      result=stream())
+        chunks = list(response.generate_response_chunks())
+        expected = WhoisQueryResponse(mode=WhoisQueryResponseMode.IRRD,
+                                      response_type=WhoisQueryResponseType.SUCCESS,
+                                      result=stream()).generate_response()
+        assert ''.join(chunks) == expected
+        assert chunks[0] == expected.split('\n')[0] + '\n'
+        assert chunks[1] == 'object1\n'
+        assert chunks[-1] == '\nC\n'
+
+        for mode in WhoisQueryResponseMode:
+            empty_stream = WhoisQueryResultStream(iter([]))
+            assert not empty_stream
+            response = WhoisQueryResponse(mode=mode, response_type=WhoisQueryResponseType.SUCCESS,
+                                          result=empty_stream)
+            assert ''.join(response.generate_response_chunks()) == WhoisQueryResponse(
+                mode=mode, response_type=WhoisQueryResponseType.SUCCESS, result='').generate_response()
+
+        response = WhoisQueryResponse(mode=WhoisQueryResponseMode.IRRD,
+                                      response_type=WhoisQueryResponseType.SUCCESS,
+                                      result='test')
+        assert list(response.generate_response_chunks()) == ['A5\ntest\nC\n']
@@ -1,173 +1,830 @@
-import socket
+import asyncio
+import threading
 import time
-from io import BytesIO
+import uuid
 from queue import Queue
-from unittest.mock import Mock
+from unittest.mock import Mock, ANY, call
 
 import pytest
 
+from irrd.storage.change_serials import SourceChangeSerials
+from irrd.storage.database_handler import ExecutedQuery
 from irrd.storage.preload import Preloader
-from ..server import WhoisWorker
+from ..query_cache import WhoisQueryCache
+from ..server import WhoisServer, WhoisQueryExecutor, WhoisQueryExecutorPool, WhoisQueryExecutorFailure
 
 
-class MockSocket:
-    def __init__(self):
-        # rfile (for read) and wfile (for write) are from the perspective
-        # of the WhoisWorker, opposite of the test's perspective
-        self.rfile = BytesIO()
-        self.wfile = BytesIO()
-        self.shutdown_called = False
-        self.close_called = False
+class MockExecutorPool:
+    def __init__(self, results):
+        self.results = results
+        self.queries = []
 
-    def makefile(self, mode, bufsize):
-        return self.wfile if 'w' in mode else self.rfile
+    async def execute(self, client_ip, client_str, session_state, queries, write_response):
+        self.queries.append((client_ip, client_str, session_state, queries))
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        response, new_session_state = result
+        for response_chunk in response:
+            await write_response(response_chunk)
+        return new_session_state
 
-    def sendall(self, bytes):
-        self.wfile.write(bytes)
 
-    def shutdown(self, flags):
-        self.shutdown_called = True
+class MockWriter:
+    def __init__(self):
+        self.written = b''
+        self.closed = False
 
-    def close(self):
-        self.close_called = True
+    def get_extra_info(self, name):
+        assert name == 'peername'
+        return '192.0.2.1', 99999
 
+    def write(self, data):
+        self.written += data
 
-@pytest.fixture()
-def create_worker(config_override, monkeypatch):
-    mock_preloader = Mock(spec=Preloader)
-    monkeypatch.setattr('irrd.server.whois.server.Preloader', lambda: mock_preloader)
+    async def drain(self):
+        pass
 
-    config_override({
-        'redis_url': 'redis://invalid-host.example.com',  # Not actually used
-    })
-    queue = Queue()
-    worker = WhoisWorker(queue)
-    request = MockSocket()
-    queue.put((request, ('192.0.2.1', 99999)))
-    yield worker, request
-
-
-class TestWhoisWorker:
-    def test_whois_request_worker_no_access_list(self, create_worker):
-        worker, request = create_worker
-        # Empty query in first line should be ignored.
-        request.rfile.write(b' \n!v\r\n')
-        request.rfile.seek(0)
-        worker.run(keep_running=False)
-
-        assert worker.client_str == '192.0.2.1:99999'
-        request.wfile.seek(0)
-        assert b'IRRd -- version' in request.wfile.read()
-        assert request.shutdown_called
-        assert request.close_called
-
-    def test_whois_request_worker_exception(self, create_worker, monkeypatch, caplog):
-        monkeypatch.setattr('irrd.server.whois.server.WhoisQueryParser',
-                            Mock(side_effect=OSError('expected')))
+    def close(self):
+        self.closed = True
 
-        worker, request = create_worker
-        request.rfile.write(b'!v\r\n')
-        request.rfile.seek(0)
-        worker.run(keep_running=False)
 
-        request.wfile.seek(0)
-        assert not request.wfile.read()
-        assert request.shutdown_called
-        assert request.close_called
-        assert 'Failed to handle whois connection' in caplog.text
+def session_state(multiple_command_mode=False, timeout=30):
+    return {'multiple_command_mode': multiple_command_mode, 'timeout': timeout}
 
-    def test_whois_request_worker_preload_failed(self, create_worker, monkeypatch, caplog):
-        monkeypatch.setattr('irrd.server.whois.server.Preloader',
-                            Mock(side_effect=OSError('expected')))
 
-        worker, request = create_worker
-        request.rfile.write(b'!v\r\n')
-        request.rfile.seek(0)
-        worker.run(keep_running=False)
-
-        request.wfile.seek(0)
-        assert not request.wfile.read()
-        assert 'worker failed to initialise preloader' in caplog.text
-
-    def test_whois_request_worker_timeout(self, create_worker):
-        worker, request = create_worker
-
-        request.rfile = Mock()
-        readline_call_count = 0
-
-        # This mock implementation simulates user behaviour that
-        # should trigger a timeout.
-        # First, !! is sent to prevent the connection from closing right away.
-        # Then, !t1 is used to set a very short timeout.
-        # Third, readline() blocks for 2s, simulating a user not sending
-        # any query to IRRd, triggering the shutdown call by the timeout.
-        def mock_readline():
-            nonlocal readline_call_count
-            readline_call_count += 1
-            if readline_call_count == 1:
-                return b'!!\n'
-            if readline_call_count == 2:
-                return b'!t1\n'
-            if readline_call_count == 3:
-                time.sleep(2)
-                return b''
-        request.rfile.readline = mock_readline
-
-        request.rfile.seek(0)
-        worker.run(keep_running=False)
-
-        request.wfile.seek(0)
-        assert request.shutdown_called
-
-    def test_whois_request_worker_write_error(self, create_worker, caplog):
-        worker, request = create_worker
-        request.rfile.write(b'!!\n!v\n')
-        request.rfile.seek(0)
-        # Write errors are usually due to the connection being
-        # dropped, and should cause the connection to be closed
-        # from our end.
-        request.sendall = Mock(side_effect=socket.error('expected'))
-        worker.run(keep_running=False)
-
-    def test_whois_request_worker_access_list_permitted(self, config_override, create_worker):
+@pytest.fixture()
+def run_connection(config_override):
+    config_override({
+        'server': {'whois': {'max_connections': 2}},
+    })
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    def run(pool, client_input, eof=True):
+        reader = asyncio.StreamReader(loop=loop)
+        reader.feed_data(client_input)
+        if eof:
+            reader.feed_eof()
+        writer = MockWriter()
+        whois_server = WhoisServer(pool)
+        loop.run_until_complete(whois_server.handle_connection(reader, writer))
+        assert writer.closed
+        return writer.written
+
+    yield run
+    loop.close()
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+
+class TestWhoisServer:
+    def test_single_query(self, run_connection):
+        pool = MockExecutorPool([([b'resp', b'onse'], session_state())])
+        # Empty query in first line should be ignored. The executor only
+        # executes the first query, as the session is not in multiple command mode.
+        assert run_connection(pool, b' \n!v\r\n!v\r\n') == b'response'
+        assert pool.queries == [('192.0.2.1', '192.0.2.1:99999', None, ['!v', '!v'])]
+
+    def test_query_without_newline(self, run_connection):
+        pool = MockExecutorPool([([b'response'], session_state())])
+        assert run_connection(pool, b'!v') == b'response'
+        assert pool.queries == [('192.0.2.1', '192.0.2.1:99999', None, ['!v'])]
+
+    def test_multiple_command_mode(self, run_connection):
+        # Pipelined queries are executed in one batch, up to !q
+        pool = MockExecutorPool([
+            ([b'response1', b'response2'], session_state(multiple_command_mode=True)),
+        ])
+        assert run_connection(pool, b'!!\n!v\n!v\n!q\n!v\n') == b'response1response2'
+        assert [query[2:] for query in pool.queries] == [
+            (None, ['!!', '!v', '!v']),
+        ]
+
+        # Connection closed by the client
+        pool = MockExecutorPool([
+            ([b'response1'], session_state(multiple_command_mode=True)),
+        ])
+        assert run_connection(pool, b'!!\n!v\n') == b'response1'
+
+    def test_batch_size(self, run_connection, monkeypatch):
+        monkeypatch.setattr('irrd.server.whois.server.MAX_QUERIES_PER_BATCH', 2)
+        pool = MockExecutorPool([
+            ([b'response1'], session_state(multiple_command_mode=True)),
+            ([b'response2'], session_state(multiple_command_mode=True)),
+        ])
+        assert run_connection(pool, b'!!\n!v\n!v\n') == b'response1response2'
+        assert [query[2:] for query in pool.queries] == [
+            (None, ['!!', '!v']),
+            (session_state(multiple_command_mode=True), ['!v']),
+        ]
+
+    def test_query_too_long(self, run_connection, monkeypatch):
+        monkeypatch.setattr('irrd.server.whois.server.CLIENT_READ_SIZE', 10)
+        pool = MockExecutorPool([])
+        assert run_connection(pool, b'!' + b'a' * 20, eof=False) == b''
+        assert not pool.queries
+
+    def test_timeout(self, run_connection):
+        pool = MockExecutorPool([
+            ([], session_state(multiple_command_mode=True, timeout=0.1)),
+        ])
+        # The client does not close the connection, but the timeout does
+        assert run_connection(pool, b'!!\n!t1\n', eof=False) == b''
+        assert len(pool.queries) == 1
+
+    def test_executor_failure(self, run_connection, caplog):
+        pool = MockExecutorPool([WhoisQueryExecutorFailure('expected')])
+        assert run_connection(pool, b'!v\n') == b'F Query could not be executed, please try again later.\n'
+        assert '192.0.2.1:99999: failed to execute queries, closing connection: expected' in caplog.text
+
+        pool = MockExecutorPool([WhoisQueryExecutorFailure('expected')])
+        assert run_connection(pool, b'-V\n') == b'%% ERROR: Query could not be executed, please try again later.\n\n\n'
+
+    def test_access_list_permitted(self, config_override, run_connection):
         config_override({
-            'redis_url': 'redis://invalid-host.example.com',  # Not actually used
             'server': {
                 'whois': {
                     'access_list': 'test-access-list',
+                    'max_connections': 2,
                 },
             },
             'access_lists': {
                 'test-access-list': ['192.0.2.0/25'],
             },
         })
+        pool = MockExecutorPool([([b'response'], session_state())])
+        assert run_connection(pool, b'!v\n') == b'response'
 
-        worker, request = create_worker
-        request.rfile.write(b'!q\n')
-        request.rfile.seek(0)
-        worker.run(keep_running=False)
-
-        request.wfile.seek(0)
-        assert not request.wfile.read()
-
-    def test_whois_request_worker_access_list_denied(self, config_override, create_worker):
+    def test_access_list_denied(self, config_override, run_connection):
         config_override({
-            'redis_url': 'redis://invalid-host.example.com',  # Not actually used
             'server': {
                 'whois': {
                     'access_list': 'test-access-list',
+                    'max_connections': 2,
                 },
             },
             'access_lists': {
                 'test-access-list': ['192.0.2.128/25'],
             },
         })
+        pool = MockExecutorPool([])
+        assert run_connection(pool, b'!v\n') == b'%% Access denied'
+        assert not pool.queries
+
+    def test_too_many_connections(self, run_connection, monkeypatch):
+        pool = MockExecutorPool([])
+        mock_admit = Mock(return_value='client_limit')
+
+        async def admit(client_ip):
+            return mock_admit(client_ip)
+        monkeypatch.setattr('irrd.server.whois.server.WhoisAdmissionControl.admit', lambda self, client_ip: admit(client_ip))
+        assert run_connection(pool, b'!v\n') == b'%% Too many connections\n'
+        assert not pool.queries
+        mock_admit.assert_called_once_with('192.0.2.1')
+
+    def test_connection_released(self, run_connection, monkeypatch):
+        mock_release = Mock()
+        monkeypatch.setattr('irrd.server.whois.server.WhoisAdmissionControl.release', mock_release)
+        pool = MockExecutorPool([WhoisQueryExecutorFailure('expected')])
+        run_connection(pool, b'!v\n')
+        assert mock_release.call_count == 1
+
+    def test_query_rate_limit(self, run_connection, monkeypatch):
+        mock_query_delay = Mock(return_value=0.01)
+        monkeypatch.setattr('irrd.server.whois.server.WhoisAdmissionControl.query_delay', mock_query_delay)
+        pool = MockExecutorPool([([b'response'], session_state())])
+        assert run_connection(pool, b'!v\n!v\n') == b'response'
+        mock_query_delay.assert_called_once_with('192.0.2.1', 2)
+
+    def test_flush_metrics(self, config_override):
+        config_override({
+            'server': {'whois': {'max_connections': 2}},
+        })
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        pool = Mock()
+        pool.pending_tasks = lambda: 3
+        pool.busy_executors = lambda: 2
+        whois_server = WhoisServer(pool)
+        loop.run_until_complete(whois_server.admission_control.admit('192.0.2.1'))
+        whois_server.admission_control.rejected_connections['backlog_full'] = 4
+
+        mock_query_metrics = Mock()
+        whois_server.flush_metrics(mock_query_metrics)
+        mock_query_metrics.record_server_metrics.assert_called_once_with({
+            'connections_active': 1,
+            'connections_waiting': 0,
+            'rate_limited_batches': 0,
+            'rate_limit_delay': 0,
+            'executor_tasks_pending': 3,
+            'executors_busy': 2,
+            'connections_rejected:backlog_full': 4,
+        })
+        mock_query_metrics.flush.assert_called_once_with(force=True)
+        loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
 
-        worker, request = create_worker
-        request.rfile.write(b'!v\n')
-        request.rfile.seek(0)
-        worker.run(keep_running=False)
 
-        assert worker.client_str == '192.0.2.1:99999'
-        request.wfile.seek(0)
-        assert request.wfile.read() == b'%% Access denied'
+@pytest.fixture()
+def create_executor(config_override, monkeypatch):
+    mock_preloader = Mock(spec=Preloader)
+    # No preload snapshot, which disables the query cache
+    mock_preloader.generation = Mock(return_value=None)
+    monkeypatch.setattr('irrd.server.whois.server.Preloader', lambda: mock_preloader)
+    monkeypatch.setattr('irrd.server.whois.server.DatabaseHandler', lambda readonly: Mock())
+
+    config_override({
+        'redis_url': 'redis://invalid-host.example.com',  # Not actually used
+    })
+    task_queue = Queue()
+    result_queue = Queue()
+    executor = WhoisQueryExecutor(task_queue, result_queue)
+    executor.mock_preloader = mock_preloader
+    yield executor, task_queue, result_queue
+
+
+def read_result(result_queue):
+    """Read all chunks of a result, returning the task ID, response and session state."""
+    response = b''
+    while True:
+        task_id, (response_chunk, session_state) = result_queue.get_nowait()
+        response += response_chunk
+        if session_state is not None:
+            return task_id, response, session_state
+
+
+class TestWhoisQueryExecutor:
+    def test_execute_queries_with_session_state(self, create_executor):
+        executor, task_queue, result_queue = create_executor
+        task_queue.put((1, '192.0.2.1', '192.0.2.1:99999', None, ['!!'], None))
+        executor.run(keep_running=False)
+        task_id, response, state = read_result(result_queue)
+        assert task_id == 1
+        assert response == b''
+        assert state['multiple_command_mode']
+        assert executor.current_task_id.value == -1
+
+        task_queue.put((2, '192.0.2.1', '192.0.2.1:99999', state, ['!t10'], None))
+        executor.run(keep_running=False)
+        task_id, response, state = read_result(result_queue)
+        assert task_id == 2
+        assert response == b'C\n'
+        assert state['multiple_command_mode']
+        assert state['timeout'] == 10
+
+        task_queue.put((3, '192.0.2.1', '192.0.2.1:99999', state, ['!v'], None))
+        executor.run(keep_running=False)
+        task_id, response, state = read_result(result_queue)
+        assert task_id == 3
+        assert b'IRRd -- version' in response
+        assert state['timeout'] == 10
+        assert result_queue.empty()
+
+    def test_execute_pipelined_queries(self, create_executor, monkeypatch):
+        executor, task_queue, result_queue = create_executor
+        mock_prefetch = Mock()
+        monkeypatch.setattr('irrd.server.whois.server.WhoisQueryParser.prefetch_exact_keys', mock_prefetch)
+        mock_dh = Mock()
+        mock_dh.execute_query_stream = lambda query: iter([])
+        monkeypatch.setattr('irrd.server.whois.server.DatabaseHandler', lambda readonly: mock_dh)
+
+        queries = ['!!', '!t10', '!maut-num,AS65537', '!maut-num,AS65538', '!v', '!mroute,192.0.2.0/24']
+        task_queue.put((1, '192.0.2.1', '192.0.2.1:99999', None, queries, None))
+        executor.run(keep_running=False)
+        task_id, response, state = read_result(result_queue)
+        assert response.startswith(b'C\nD\nD\nA')
+        assert response.endswith(b'\nC\nD\n')
+        assert state['timeout'] == 10
+        # Consecutive !m queries are looked up together
+        mock_prefetch.assert_called_once_with(['aut-num,AS65537', 'aut-num,AS65538'])
+
+        # As are consecutive !g and !6 queries
+        mock_prefetch_routes = Mock()
+        monkeypatch.setattr('irrd.server.whois.server.WhoisQueryParser.prefetch_routes_for_origins',
+                            mock_prefetch_routes)
+        queries = ['!!', '!gAS65537', '!gAS65538', '!6AS65537', '!6AS65538', '!gAS65539']
+        task_queue.put((1, '192.0.2.1', '192.0.2.1:99999', None, queries, None))
+        executor.run(keep_running=False)
+        read_result(result_queue)
+        assert mock_prefetch_routes.mock_calls == [
+            call(['AS65537', 'AS65538'], ip_version=4),
+            call(['AS65537', 'AS65538'], ip_version=6),
+        ]
+
+        # Queries after leaving multiple command mode are not executed
+        task_queue.put((2, '192.0.2.1', '192.0.2.1:99999', None, ['!v', '!v'], None))
+        executor.run(keep_running=False)
+        task_id, response, state = read_result(result_queue)
+        assert response.count(b'IRRd -- version') == 1
+        assert not state['multiple_command_mode']
+
+    def test_execute_query_in_chunks(self, create_executor, monkeypatch):
+        executor, task_queue, result_queue = create_executor
+        monkeypatch.setattr('irrd.server.whois.server.RESPONSE_CHUNK_SIZE', 10)
+        mock_response = Mock()
+        mock_response.generate_response_chunks = lambda: iter(['A20\n', 'route: 192.0.2.0/24\n', 'C\n'])
+        mock_parser = Mock()
+        mock_parser.handle_query = lambda query: mock_response
+        mock_parser.session_state = lambda: {'timeout': 30}
+        monkeypatch.setattr('irrd.server.whois.server.WhoisQueryParser', lambda *args, **kwargs: mock_parser)
+
+        task_queue.put((1, '192.0.2.1', '192.0.2.1:99999', None, ['!mroute,192.0.2.0/24'], None))
+        executor.run(keep_running=False)
+        assert result_queue.get_nowait() == (1, (b'A20\nroute: 192.0.2.0/24\n', None))
+        assert result_queue.get_nowait() == (1, (b'C\n', {'timeout': 30}))
+        assert result_queue.empty()
+
+    def test_execute_query_waits_for_chunks_written(self, create_executor, monkeypatch, caplog):
+        executor, task_queue, result_queue = create_executor
+        monkeypatch.setattr('irrd.server.whois.server.RESPONSE_CHUNK_SIZE', 1)
+        monkeypatch.setattr('irrd.server.whois.server.RESPONSE_CHUNKS_IN_FLIGHT', 2)
+        mock_response = Mock()
+        mock_response.generate_response_chunks = lambda: iter(['A', 'B', 'C', 'D'])
+        mock_parser = Mock()
+        mock_parser.handle_query = lambda query: mock_response
+        mock_parser.session_state = lambda: {'timeout': 30}
+        monkeypatch.setattr('irrd.server.whois.server.WhoisQueryParser', lambda *args, **kwargs: mock_parser)
+
+        # The first two chunks are written, after which the task is cancelled
+        def write_chunks():
+            while executor.current_task_id.value != 1:
+                pass
+            executor.chunks_written.value = 2
+            executor.chunk_written.set()
+            while result_queue.qsize() < 4:
+                pass
+            executor.task_cancelled.value = 1
+            executor.chunk_written.set()
+        writer_thread = threading.Thread(target=write_chunks)
+        writer_thread.start()
+
+        task_queue.put((1, '192.0.2.1', '192.0.2.1:99999', None, ['!mroute,192.0.2.0/24'], None))
+        executor.run(keep_running=False)
+        writer_thread.join()
+        assert [result_queue.get_nowait() for _ in range(4)] == [
+            (1, (b'A', None)), (1, (b'B', None)), (1, (b'C', None)), (1, (b'D', None)),
+        ]
+        assert result_queue.empty()
+        assert executor.current_task_id.value == -1
+        assert 'abandoned queries' in caplog.text
+
+    def test_execute_query_cached(self, create_executor, config_override, monkeypatch):
+        config_override({
+            'redis_url': 'redis://invalid-host.example.com',  # Not actually used
+            'sources': {'TEST1': {}},
+            'server': {'whois': {'query_cache_ttl': 60}},
+        })
+        monkeypatch.setattr('irrd.storage.change_serials.REDIS_SOURCE_CHANGE_SERIALS_KEY',
+                            b'TEST-irrd-source-change-serials')
+        monkeypatch.setattr('irrd.server.whois.query_cache.REDIS_QUERY_CACHE_KEY_PREFIX',
+                            f'TEST-irrd-whois-query-cache-{uuid.uuid4()}-')
+        executor, task_queue, result_queue = create_executor
+        executor.mock_preloader.generation = Mock(return_value=1)
+        executor.mock_preloader.routes_for_origins = Mock(return_value=['192.0.2.0/24'])
+        executor.mock_preloader.set_store_available = Mock(return_value=False)
+
+        def run_query(query, session_state=None):
+            task_queue.put((1, '192.0.2.1', '192.0.2.1:99999', session_state, [query], None))
+            executor.run(keep_running=False)
+            return read_result(result_queue)[1:]
+
+        assert run_query('!gAS65537') == (b'A13\n192.0.2.0/24\nC\n', ANY)
+        executor.mock_preloader.routes_for_origins = Mock(return_value=['192.0.2.0/25'])
+        # Cached response
+        response, state = run_query('!gAS65537')
+        assert response == b'A13\n192.0.2.0/24\nC\n'
+        assert not executor.mock_preloader.routes_for_origins.called
+
+        # A new preload generation invalidates the cache
+        executor.mock_preloader.generation = Mock(return_value=2)
+        assert run_query('!gAS65537')[0] == b'A13\n192.0.2.0/25\nC\n'
+        executor.mock_preloader.routes_for_origins.reset_mock()
+
+        # As do changes to the selected sources
+        SourceChangeSerials().increase(['TEST1'])
+        run_query('!gAS65537')
+        assert executor.mock_preloader.routes_for_origins.called
+        executor.mock_preloader.routes_for_origins.reset_mock()
+
+        # Queries that change the session state are not cached, nor are errors
+        mock_cache_set = Mock()
+        monkeypatch.setattr(WhoisQueryCache, 'set', mock_cache_set)
+        assert run_query('!!')[1]['multiple_command_mode']
+        assert run_query('-k')[1]['multiple_command_mode']
+        assert run_query('!gINVALID')[0].startswith(b'F ')
+        assert not mock_cache_set.called
+
+        # Pipelined queries with cached responses are not prefetched
+        executor.mock_preloader.routes_per_origin = Mock(return_value={
+            'AS65538': {'192.0.2.128/25'},
+            'AS65539': set(),
+        })
+        queries = ['!!', '!gAS65537', '!gAS65538', '!gAS65539']
+        task_queue.put((1, '192.0.2.1', '192.0.2.1:99999', None, queries, None))
+        executor.run(keep_running=False)
+        response = read_result(result_queue)[1]
+        assert response == b'A13\n192.0.2.0/25\nC\nA15\n192.0.2.128/25\nC\nD\n'
+        executor.mock_preloader.routes_per_origin.assert_called_once_with(
+            {'AS65538', 'AS65539'}, ['TEST1', 'RPKI'], ip_version=4)
+
+    def test_execute_query_cached_query_cost_limit(self, create_executor, config_override, monkeypatch):
+        config_override({
+            'redis_url': 'redis://invalid-host.example.com',  # Not actually used
+            'sources': {'TEST1': {}},
+            'access_lists': {'limited': ['192.0.2.2']},
+            'server': {'whois': {
+                'query_cache_ttl': 60,
+                'max_query_cost_per_access_list': {'limited': 1},
+            }},
+        })
+        monkeypatch.setattr('irrd.storage.change_serials.REDIS_SOURCE_CHANGE_SERIALS_KEY',
+                            b'TEST-irrd-source-change-serials')
+        monkeypatch.setattr('irrd.server.whois.query_cache.REDIS_QUERY_CACHE_KEY_PREFIX',
+                            f'TEST-irrd-whois-query-cache-{uuid.uuid4()}-')
+        monkeypatch.setattr('irrd.server.whois.server.WhoisQueryParser._recursive_set_resolve',
+                            lambda self, members: {'AS65537', 'AS65538'})
+        executor, task_queue, result_queue = create_executor
+        executor.mock_preloader.generation = Mock(return_value=1)
+        executor.mock_preloader.routes_for_origins = Mock(return_value=['192.0.2.0/24', '198.51.100.0/24'])
+        executor.mock_preloader.set_store_available = Mock(return_value=False)
+
+        def run_query(client_ip):
+            task_queue.put((1, client_ip, f'{client_ip}:99999', None, ['!aAS-TEST'], None))
+            executor.run(keep_running=False)
+            return read_result(result_queue)[1]
+
+        # The response to a client without a limit is cached,
+        # but not served to a client that exceeds its limit.
+        assert run_query('192.0.2.1') == b'A29\n192.0.2.0/24 198.51.100.0/24\nC\n'
+        assert run_query('192.0.2.1') == b'A29\n192.0.2.0/24 198.51.100.0/24\nC\n'
+        assert executor.mock_preloader.routes_for_origins.call_count == 1
+        assert b'exceeds the limit of 1' in run_query('192.0.2.2')
+
+    def test_slow_query_log_and_metrics(self, create_executor, config_override, monkeypatch, caplog):
+        config_override({
+            'redis_url': 'redis://invalid-host.example.com',  # Not actually used
+            'server': {'whois': {'slow_query_threshold': 5}},
+        })
+        executor, task_queue, result_queue = create_executor
+        mock_response = Mock()
+        mock_response.generate_response_chunks = lambda: iter(['A5\n', 'route\n', 'C\n'])
+        mock_parser = Mock()
+        mock_parser.session_state = lambda: {'timeout': 30, 'multiple_command_mode': True}
+
+        def mock_handle_query(query):
+            executor.database_handler.query_log.append(ExecutedQuery('SQL QUERY'))
+            return mock_response
+        mock_parser.handle_query = mock_handle_query
+        monkeypatch.setattr('irrd.server.whois.server.WhoisQueryParser', lambda *args, **kwargs: mock_parser)
+        monkeypatch.setattr('irrd.server.whois.server.time.perf_counter', Mock(side_effect=[0, 1, 1, 11]))
+
+        task_queue.put((1, '192.0.2.1', '192.0.2.1:99999', None, ['!gAS65537', '-i mnt-by MNT-TEST'], None))
+        executor.run(keep_running=False)
+        assert read_result(result_queue)[1] == b'A5\nroute\nC\n' * 2
+        assert executor.database_handler.query_log is None
+
+        assert 'slow query, elapsed 10.000000000s, 11 bytes: -i mnt-by MNT-TEST' in caplog.text
+        assert "'SQL QUERY'\nROWS: 0" in caplog.text
+        assert 'slow query, elapsed 1.000000000s' not in caplog.text
+        assert executor.query_metrics._pending['latency_sum:!g'] == 1
+        assert executor.query_metrics._pending['latency_bucket:!g:1'] == 1
+        assert executor.query_metrics._pending['size_sum:!g'] == 11
+        assert executor.query_metrics._pending['slow_queries:-i'] == 1
+        assert 'slow_queries:!g' not in executor.query_metrics._pending
+
+    def test_execute_query_exception(self, create_executor, monkeypatch, caplog):
+        executor, task_queue, result_queue = create_executor
+        mock_parser = Mock()
+        mock_parser.handle_query = Mock(side_effect=OSError('expected'))
+        mock_parser.session_state = lambda: {'timeout': 30}
+        monkeypatch.setattr('irrd.server.whois.server.WhoisQueryParser', lambda *args, **kwargs: mock_parser)
+
+        task_queue.put((1, '192.0.2.1', '192.0.2.1:99999', None, ['!v'], None))
+        executor.run(keep_running=False)
+        task_id, response, state = read_result(result_queue)
+        assert response == b'% An internal error occurred while processing this query.\n\n'
+        assert state == {'timeout': 30}
+        assert 'Failed to execute whois query "!v"' in caplog.text
+
+    def test_recycle_after_max_queries(self, create_executor, config_override, caplog):
+        executor, task_queue, result_queue = create_executor
+        config_override({
+            'redis_url': 'redis://invalid-host.example.com',
+            'server': {'whois': {'executor_max_queries': 3}},
+        })
+        task_queue.put((1, '192.0.2.1', '192.0.2.1:99999', None, ['!!', '!v'], None))
+        executor.run(keep_running=False)
+        assert executor.ready.value
+        assert not executor.recycle_requested.value
+
+        task_queue.put((2, '192.0.2.1', '192.0.2.1:99999', None, ['!v'], None))
+        executor.run(keep_running=False)
+        assert executor.recycle_requested.value
+        assert 'executed 3 queries, requesting recycling' in caplog.text
+
+        # The executor keeps executing queries until it is retired
+        task_queue.put((3, '192.0.2.1', '192.0.2.1:99999', None, ['!v'], None))
+        executor.run(keep_running=False)
+        assert read_result(result_queue)[0] == 1
+        assert read_result(result_queue)[0] == 2
+        assert read_result(result_queue)[0] == 3
+
+        executor.retire.value = 1
+        task_queue.put((4, '192.0.2.1', '192.0.2.1:99999', None, ['!v'], None))
+        executor.run()
+        assert result_queue.empty()
+        assert executor.database_handler.close.call_count == 1
+        assert 'retiring after recycling' in caplog.text
+
+    def test_recycle_after_max_memory(self, create_executor, config_override, monkeypatch, caplog):
+        executor, task_queue, result_queue = create_executor
+        config_override({
+            'redis_url': 'redis://invalid-host.example.com',
+            'server': {'whois': {'executor_max_memory': 100}},
+        })
+        monkeypatch.setattr('irrd.server.whois.server.memory_usage', lambda: 100 * 1024 * 1024)
+        task_queue.put((1, '192.0.2.1', '192.0.2.1:99999', None, ['!v'], None))
+        executor.run(keep_running=False)
+        assert not executor.recycle_requested.value
+
+        monkeypatch.setattr('irrd.server.whois.server.memory_usage', lambda: 150 * 1024 * 1024)
+        task_queue.put((2, '192.0.2.1', '192.0.2.1:99999', None, ['!v'], None))
+        executor.run(keep_running=False)
+        assert executor.recycle_requested.value
+        assert 'uses 150 MB of memory, requesting recycling' in caplog.text
+
+    def test_skip_expired_task(self, create_executor, caplog):
+        executor, task_queue, result_queue = create_executor
+        # Tasks picked up after the executor timeout are skipped, as the query already failed
+        task_queue.put((1, '192.0.2.1', '192.0.2.1:99999', None, ['!v'], time.time() - 1))
+        task_queue.put((2, '192.0.2.1', '192.0.2.1:99999', None, ['!v'], time.time() + 60))
+        executor.run(keep_running=False)
+        assert read_result(result_queue)[0] == 2
+        assert result_queue.empty()
+        assert 'skipped queries, as they were not picked up within the executor timeout: !v' in caplog.text
+
+    def test_preload_failed(self, create_executor, monkeypatch, caplog):
+        monkeypatch.setattr('irrd.server.whois.server.Preloader',
+                            Mock(side_effect=OSError('expected')))
+
+        executor, task_queue, result_queue = create_executor
+        task_queue.put((1, '192.0.2.1', '192.0.2.1:99999', None, ['!v'], None))
+        executor.run(keep_running=False)
+        assert result_queue.empty()
+        assert 'executor failed to initialise preloader' in caplog.text
+
+
+class TestWhoisQueryExecutorPool:
+    def test_execute_and_replace_executors(self, monkeypatch, caplog):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        pool = WhoisQueryExecutorPool(2)
+        pool.task_queue = Queue()
+        pool._loop = loop
+
+        started_executors = []
+
+        def mock_start_executor():
+            executor = Mock()
+            executor.is_alive = lambda: True
+            executor.current_task_id.value = -1
+            executor.chunks_written.value = 0
+            executor.task_cancelled.value = 0
+            executor.ready.value = 0
+            executor.recycle_requested.value = 0
+            executor.retire.value = 0
+            pool.executors.append(executor)
+            started_executors.append(executor)
+            return executor
+        monkeypatch.setattr(pool, '_start_executor', mock_start_executor)
+        pool.start()
+        assert len(pool.executors) == 2
+
+        written_chunks = []
+
+        async def write_response(response_chunk):
+            written_chunks.append(response_chunk)
+
+        # Chunks of the result from an executor are written,
+        # until the final chunk with the session state.
+        query = loop.create_task(pool.execute('192.0.2.1', '192.0.2.1:99999', None, ['!v'], write_response))
+        loop.run_until_complete(asyncio.sleep(0))
+        task_id, client_ip, client_str, state, queries, queued_until = pool.task_queue.get_nowait()
+        assert (client_ip, client_str, state, queries) == ('192.0.2.1', '192.0.2.1:99999', None, ['!v'])
+        pool._resolve(task_id, (b'resp', None))
+        pool._resolve(task_id, (b'onse', {'timeout': 30}))
+        assert loop.run_until_complete(query) == {'timeout': 30}
+        assert written_chunks == [b'resp', b'onse']
+        assert not pool._pending
+        # Results for queries that are no longer pending are ignored
+        pool._resolve(task_id, (b'response', {}))
+
+        # An executor terminating while executing a query fails that query,
+        # and the executor is replaced
+        query = loop.create_task(pool.execute('192.0.2.1', '192.0.2.1:99999', None, ['!v'], write_response))
+        loop.run_until_complete(asyncio.sleep(0))
+        task_id = pool.task_queue.get_nowait()[0]
+        dead_executor = pool.executors[0]
+        dead_executor.is_alive = lambda: False
+        dead_executor.current_task_id.value = task_id
+        pool._check_executors()
+        with pytest.raises(WhoisQueryExecutorFailure):
+            loop.run_until_complete(query)
+        assert dead_executor not in pool.executors
+        assert len(pool.executors) == 2
+        assert len(started_executors) == 3
+        assert pool.pending_tasks() == 0
+        pool.executors[0].current_task_id.value = 10
+        assert pool.busy_executors() == 1
+        assert 'terminated unexpectedly' in caplog.text
+        loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    def test_recycle_executors(self, monkeypatch, caplog):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        pool = WhoisQueryExecutorPool(2)
+        pool._loop = loop
+
+        started_executors = []
+
+        def mock_start_executor():
+            executor = Mock()
+            executor.is_alive = lambda: True
+            executor.current_task_id.value = -1
+            executor.chunks_written.value = 0
+            executor.task_cancelled.value = 0
+            executor.ready.value = 0
+            executor.recycle_requested.value = 0
+            executor.retire.value = 0
+            pool.executors.append(executor)
+            started_executors.append(executor)
+            return executor
+        monkeypatch.setattr(pool, '_start_executor', mock_start_executor)
+        pool.start()
+        recycled_executor, other_executor = pool.executors
+
+        # A replacement is started, but the recycled executor
+        # is only retired once the replacement is ready.
+        recycled_executor.recycle_requested.value = 1
+        pool._check_executors()
+        assert len(pool.executors) == 3
+        replacement = pool.executors[2]
+        assert not recycled_executor.retire.value
+        pool._check_executors()
+        assert len(started_executors) == 3
+        assert not recycled_executor.retire.value
+
+        replacement.ready.value = 1
+        pool._check_executors()
+        assert recycled_executor.retire.value
+        assert not pool._replacements
+
+        recycled_executor.is_alive = lambda: False
+        pool._check_executors()
+        assert pool.executors == [other_executor, replacement]
+        assert recycled_executor.join.call_count == 1
+        assert len(started_executors) == 3
+        assert 'was recycled' in caplog.text
+        assert 'terminated unexpectedly' not in caplog.text
+
+        # If an executor due for recycling terminates before its replacement
+        # is ready, the replacement takes its place.
+        other_executor.recycle_requested.value = 1
+        pool._check_executors()
+        assert len(started_executors) == 4
+        other_executor.is_alive = lambda: False
+        pool._check_executors()
+        assert pool.executors == [replacement, started_executors[3]]
+        assert not pool._replacements
+        assert len(started_executors) == 4
+        assert 'terminated unexpectedly' in caplog.text
+
+        # If a replacement terminates before it is ready,
+        # a new replacement is started.
+        replacement.recycle_requested.value = 1
+        pool._check_executors()
+        failed_replacement = started_executors[4]
+        failed_replacement.is_alive = lambda: False
+        pool._check_executors()
+        assert pool._replacements == {replacement: started_executors[5]}
+        assert len(pool.executors) == 3
+        loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    def test_flow_control_timeout_and_lost_tasks(self, config_override, monkeypatch, caplog):
+        config_override({
+            'server': {'whois': {'executor_timeout': 1}},
+        })
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        pool = WhoisQueryExecutorPool(2)
+        pool.task_queue = Queue()
+        pool._loop = loop
+
+        def mock_start_executor():
+            executor = Mock()
+            executor.is_alive = lambda: True
+            executor.current_task_id.value = -1
+            executor.chunks_written.value = 0
+            executor.task_cancelled.value = 0
+            executor.ready.value = 0
+            executor.recycle_requested.value = 0
+            executor.retire.value = 0
+            pool.executors.append(executor)
+            return executor
+        monkeypatch.setattr(pool, '_start_executor', mock_start_executor)
+        pool.start()
+        busy_executor, idle_executor = pool.executors
+
+        written_chunks = []
+
+        async def write_response(response_chunk):
+            written_chunks.append(response_chunk)
+
+        # Chunks written to the client are acknowledged to the executor
+        query = loop.create_task(pool.execute('192.0.2.1', '192.0.2.1:99999', None, ['!v'], write_response))
+        loop.run_until_complete(asyncio.sleep(0))
+        task_id = pool.task_queue.get_nowait()[0]
+        busy_executor.current_task_id.value = task_id
+        pool._resolve(task_id, (b'resp', None))
+        loop.run_until_complete(asyncio.sleep(0))
+        assert written_chunks == [b'resp']
+        assert busy_executor.chunks_written.value == 1
+        assert busy_executor.chunk_written.set.call_count == 1
+
+        # If no further result is received in time, the query fails,
+        # and the executor is told to abandon it.
+        with pytest.raises(WhoisQueryExecutorFailure):
+            loop.run_until_complete(query)
+        assert busy_executor.task_cancelled.value == 1
+        assert not pool._pending
+        # Results of abandoned tasks cancel them again
+        busy_executor.task_cancelled.value = 0
+        pool._resolve(task_id, (b'onse', None))
+        assert busy_executor.task_cancelled.value == 1
+        busy_executor.current_task_id.value = -1
+
+        # An executor terminating without a recorded task fails the pending
+        # tasks that are not executed by another executor, and for which no
+        # results were received.
+        started_query = loop.create_task(pool.execute('192.0.2.1', '192.0.2.1:99999', None, ['!v'], write_response))
+        executing_query = loop.create_task(pool.execute('192.0.2.1', '192.0.2.1:99999', None, ['!v'], write_response))
+        lost_query = loop.create_task(pool.execute('192.0.2.1', '192.0.2.1:99999', None, ['!v'], write_response))
+        loop.run_until_complete(asyncio.sleep(0))
+        started_task_id, executing_task_id, lost_task_id = [pool.task_queue.get_nowait()[0] for _ in range(3)]
+        pool._resolve(started_task_id, (b'resp', None))
+        busy_executor.current_task_id.value = executing_task_id
+        idle_executor.is_alive = lambda: False
+        pool._check_executors()
+        with pytest.raises(WhoisQueryExecutorFailure):
+            loop.run_until_complete(lost_query)
+        pool._resolve(started_task_id, (b'onse', {'timeout': 30}))
+        pool._resolve(executing_task_id, (b'response', {'timeout': 30}))
+        assert loop.run_until_complete(started_query) == {'timeout': 30}
+        assert loop.run_until_complete(executing_query) == {'timeout': 30}
+        assert not pool._pending
+        assert not pool._started
+        assert 'terminated unexpectedly' in caplog.text
+        loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    def test_executor_timeout_starts_on_pickup(self, config_override, monkeypatch):
+        config_override({
+            'server': {'whois': {'executor_timeout': 1}},
+        })
+        monkeypatch.setattr('irrd.server.whois.server.EXECUTOR_PICKUP_CHECK_INTERVAL', 0.01)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        pool = WhoisQueryExecutorPool(1)
+        pool.task_queue = Queue()
+        pool._loop = loop
+        executor = Mock()
+        executor.current_task_id.value = -1
+        pool.executors.append(executor)
+
+        async def write_response(response_chunk):
+            pass
+
+        # A task that is not picked up by an executor fails, and is skipped
+        # by the executor if picked up later
+        query = loop.create_task(pool.execute('192.0.2.1', '192.0.2.1:99999', None, ['!v'], write_response))
+        with pytest.raises(WhoisQueryExecutorFailure) as wqef:
+            loop.run_until_complete(query)
+        assert 'No query executor available within 1 seconds' in str(wqef.value)
+        queued_until = pool.task_queue.get_nowait()[5]
+        assert time.time() - 1 < queued_until <= time.time()
+        assert not pool._pending
+
+        # Once picked up, the executor has the full timeout to send results
+        query = loop.create_task(pool.execute('192.0.2.1', '192.0.2.1:99999', None, ['!v'], write_response))
+        loop.run_until_complete(asyncio.sleep(0))
+        task_id = pool.task_queue.get_nowait()[0]
+
+        def pick_up():
+            executor.current_task_id.value = task_id
+        loop.call_later(0.8, pick_up)
+        loop.call_later(1.5, lambda: pool._resolve(task_id, (b'response', {'timeout': 30})))
+        assert loop.run_until_complete(query) == {'timeout': 30}
+        loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
@@ -6,6 +6,11 @@ from irrd.conf import get_setting
 
 engine = None
 
+# The number of connections kept in the pool of each process, and the number
+# of further connections that can be opened when all of them are in use.
+DATABASE_POOL_SIZE = 2
+DATABASE_POOL_MAX_OVERFLOW = 10
+
 
 def get_engine():
     global engine
@@ -13,7 +18,8 @@ def get_engine():
         return engine
     engine = sa.create_engine(
         get_setting('database_url'),
-        pool_size=2,
+        pool_size=DATABASE_POOL_SIZE,
+        max_overflow=DATABASE_POOL_MAX_OVERFLOW,
         json_deserializer=ujson.loads,
     )
 
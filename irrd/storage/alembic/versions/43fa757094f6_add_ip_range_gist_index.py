@@ -0,0 +1,32 @@
+"""Add GiST index on the IP range of RPSL objects
+
+Revision ID: 43fa757094f6
+Revises: a7766c144d61
+Create Date: 2026-10-18 10:12:41.226108
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '43fa757094f6'
+down_revision = 'a7766c144d61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("""
+        DO $$ BEGIN
+            CREATE TYPE inetrange AS RANGE (subtype = inet);
+        EXCEPTION WHEN duplicate_object THEN NULL;
+        END $$
+    """)
+    op.create_index('ix_rpsl_objects_ip_range_gist', 'rpsl_objects', [sa.text("inetrange(ip_first, ip_last, '[]')")],
+                    unique=False, postgresql_using='gist', postgresql_where=sa.text('ip_version IS NOT NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_rpsl_objects_ip_range_gist', table_name='rpsl_objects')
+    op.execute('DROP TYPE IF EXISTS inetrange')
@@ -0,0 +1,46 @@
+"""Add parent links to RPSL objects
+
+Revision ID: e6a9305e07e8
+Revises: 43fa757094f6
+Create Date: 2026-10-18 14:37:09.517203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'e6a9305e07e8'
+down_revision = '43fa757094f6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('rpsl_objects', sa.Column('parent_ip_first', postgresql.INET(), nullable=True))
+    op.add_column('rpsl_objects', sa.Column('parent_ip_last', postgresql.INET(), nullable=True))
+    op.create_index('ix_rpsl_objects_parent_ip_first_parent_ip_last', 'rpsl_objects',
+                    ['parent_ip_first', 'parent_ip_last'], unique=False)
+
+    # Set the parent links of all existing objects. This uses the GiST index
+    # on the IP range, and may take some time on large databases.
+    op.execute("""
+        UPDATE rpsl_objects SET (parent_ip_first, parent_ip_last) = (
+            SELECT parent.ip_first, parent.ip_last FROM rpsl_objects AS parent
+            WHERE parent.object_class = rpsl_objects.object_class
+                AND parent.source = rpsl_objects.source
+                AND parent.ip_version = rpsl_objects.ip_version
+                AND inetrange(parent.ip_first, parent.ip_last, '[]')
+                    @> inetrange(rpsl_objects.ip_first, rpsl_objects.ip_last, '[]')
+                AND NOT (parent.ip_first = rpsl_objects.ip_first AND parent.ip_last = rpsl_objects.ip_last)
+            ORDER BY parent.ip_size ASC, parent.ip_first ASC
+            LIMIT 1
+        )
+        WHERE rpsl_objects.ip_version IS NOT NULL
+    """)
+
+
+def downgrade():
+    op.drop_index('ix_rpsl_objects_parent_ip_first_parent_ip_last', table_name='rpsl_objects')
+    op.drop_column('rpsl_objects', 'parent_ip_last')
+    op.drop_column('rpsl_objects', 'parent_ip_first')
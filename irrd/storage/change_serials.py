@@ -0,0 +1,41 @@
+from typing import Iterable, List
+
+import redis
+
+from irrd.conf import get_setting
+
+REDIS_SOURCE_CHANGE_SERIALS_KEY = b'irrd-source-change-serials'
+
+
+class SourceChangeSerials:
+    """
+    Per-source change serials, which are increased after every committed
+    change to the objects of a source. Unlike journal serials, these include
+    changes that are not journaled, like imports of sources without
+    keep_journal, and changes in RPKI and scope filter status.
+
+    This allows other processes, like the whois query cache, to detect
+    whether any data of a source has changed, with a single redis lookup.
+    """
+    def __init__(self):
+        self._redis_conn = redis.Redis.from_url(get_setting('redis_url'))
+
+    def increase(self, sources: Iterable[str]) -> None:
+        """
+        Increase the serials of the given sources.
+        Should be called after changes to the DB have been committed.
+        """
+        pipeline = self._redis_conn.pipeline(transaction=False)
+        for source in sources:
+            pipeline.hincrby(REDIS_SOURCE_CHANGE_SERIALS_KEY, source, 1)
+        pipeline.execute()
+
+    def current(self, sources: List[str]) -> List[int]:
+        """
+        Return the current serials of the given sources, in the same order.
+        Sources that have never been changed have serial 0.
+        """
+        if not sources:
+            return []
+        serials = self._redis_conn.hmget(REDIS_SOURCE_CHANGE_SERIALS_KEY, sources)
+        return [int(serial) if serial else 0 for serial in serials]
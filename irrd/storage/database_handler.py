@@ -1,12 +1,18 @@
+import enum
 import logging
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from datetime import datetime, timezone
 from functools import lru_cache
 from io import StringIO
 from typing import List, Set, Dict, Any, Tuple, Iterator, Union, Optional
 
 import sqlalchemy as sa
+import ujson
 from sqlalchemy.dialects import postgresql as pg
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.base import Executable
+from sqlalchemy.sql.compiler import Compiled
+from sqlalchemy.sql.expression import ClauseElement
 
 from irrd.conf import get_setting
 from irrd.rpki.status import RPKIStatus
@@ -15,14 +21,116 @@ from irrd.rpsl.rpsl_objects import OBJECT_CLASS_MAPPING
 from irrd.scopefilter.status import ScopeFilterStatus
 from irrd.vendor import postgres_copy
 from . import get_engine
+from .change_serials import SourceChangeSerials
 from .models import RPSLDatabaseObject, RPSLDatabaseJournal, DatabaseOperation, RPSLDatabaseStatus, \
     ROADatabaseObject, JournalEntryOrigin
-from .preload import Preloader
+from .preload import Preloader, PreloadRouteChange, PreloadSetChange, SET_STORE_RELEVANT_OBJECT_CLASSES
 from .queries import (BaseRPSLObjectDatabaseQuery, DatabaseStatusQuery,
                       RPSLDatabaseObjectStatisticsQuery, ROADatabaseObjectQuery)
 
 logger = logging.getLogger(__name__)
 MAX_RECORDS_BUFFER_BEFORE_INSERT = 15000
+# Temporary table into which bulk loads with a staging table are copied
+RPSL_BULK_LOAD_STAGING_TABLE = 'rpsl_objects_bulk_load'
+MAX_PRELOAD_CHANGES_BEFORE_FULL_RELOAD = 10000
+# The immediate less specific object of an RPSL object, i.e. the smallest object
+# of the same object class and source that strictly contains its IP range.
+# Used to set parent_ip_first/parent_ip_last, correlated to rpsl_objects.
+RPSL_PARENT_LINK_SUBQUERY = """
+    SELECT parent.ip_first, parent.ip_last FROM rpsl_objects AS parent
+    WHERE parent.object_class = rpsl_objects.object_class
+        AND parent.source = rpsl_objects.source
+        AND parent.ip_version = rpsl_objects.ip_version
+        AND inetrange(parent.ip_first, parent.ip_last, '[]')
+            @> inetrange(rpsl_objects.ip_first, rpsl_objects.ip_last, '[]')
+        AND NOT (parent.ip_first = rpsl_objects.ip_first AND parent.ip_last = rpsl_objects.ip_last)
+    ORDER BY parent.ip_size ASC, parent.ip_first ASC
+    LIMIT 1
+"""
+# Maximum number of compiled statements kept in the statement cache of each process
+STATEMENT_CACHE_MAX_SIZE = 1000
+
+
+class StatementCache:
+    """
+    Cache of SQLAlchemy compiled statements for RPSL object queries, by the
+    shape of the query, so that statements are only built and compiled to
+    SQL once for each shape, rather than for every query. This only saves
+    the work in IRRd: the statements are not prepared in PostgreSQL, which
+    still parses and plans every query. Each process has its own cache,
+    shared by all DatabaseHandler instances. When full, the least recently
+    used statement is evicted. The number of hits and misses are kept
+    for metrics.
+    """
+    def __init__(self, max_size: int=STATEMENT_CACHE_MAX_SIZE) -> None:
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._compiled: 'OrderedDict[Tuple, Compiled]' = OrderedDict()
+
+    def compiled_statement(self, query: BaseRPSLObjectDatabaseQuery, dialect) -> Compiled:
+        """
+        Return the compiled statement for query, to be executed with the
+        parameters from query.statement_params().
+        """
+        cache_key = query.statement_cache_key()
+        compiled = self._compiled.get(cache_key)
+        if compiled is not None:
+            self.hits += 1
+            self._compiled.move_to_end(cache_key)
+            return compiled
+
+        self.misses += 1
+        compiled = query.finalise_statement().compile(dialect=dialect)
+        if len(self._compiled) >= self.max_size:
+            self._compiled.popitem(last=False)
+        self._compiled[cache_key] = compiled
+        return compiled
+
+
+statement_cache = StatementCache()
+
+
+class Explain(Executable, ClauseElement):
+    """
+    EXPLAIN for a statement, which returns the query plan
+    of the statement in JSON, without executing it.
+    """
+    def __init__(self, statement) -> None:
+        self.statement = statement
+
+
+@compiles(Explain, 'postgresql')
+def _compile_explain(element, compiler, **kwargs):
+    return 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.statement, **kwargs)
+
+
+def _copy_text_value(value: Any) -> str:
+    """Encode a column value for the text format of COPY."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, enum.Enum):
+        value = value.name
+    elif isinstance(value, dict):
+        value = ujson.dumps(value, escape_forward_slashes=False)
+    elif isinstance(value, datetime):
+        value = value.isoformat()
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class ExecutedQuery:
+    """
+    A query executed by a DatabaseHandler with the query log enabled,
+    along with the number of rows retrieved so far.
+    """
+    def __init__(self, query) -> None:
+        self.query = query
+        self.row_count = 0
+
+    def __repr__(self):
+        return f'{repr(self.query)}\nROWS: {self.row_count}'
 
 
 class DatabaseHandler:
@@ -40,8 +148,33 @@ class DatabaseHandler:
     # with all database column names and their values, and then the origin of the change
     # and the serial of the change at the NRTM source, if any.
     _rpsl_upsert_buffer: List[Tuple[dict, JournalEntryOrigin, Optional[int]]]
+    # The RPSL copy buffer has the same structure, for objects of a source
+    # being bulk loaded with COPY, see start_rpsl_bulk_load().
+    _rpsl_copy_buffer: List[Tuple[dict, JournalEntryOrigin, Optional[int]]]
+    # The source being bulk loaded, if any, whether it is loaded through
+    # a staging table, and in case it is not, all keys of objects copied so far.
+    _rpsl_bulk_load_source: Optional[str]
+    _rpsl_bulk_load_staging: bool
+    _rpsl_bulk_load_pk_source_seen: Set[str]
+    # IP ranges of RPSL objects that were written or deleted in the current
+    # transaction, for which parent links must be updated on commit. Keys are
+    # tuples of object class, source, IP version, first and last address,
+    # values are whether any object with the range was deleted.
+    _rpsl_parent_link_changes: Dict[Tuple[str, str, int, str, str], bool]
+    # Sources for which the parent links of all objects are rebuilt on commit.
+    _rpsl_parent_link_sources: Set[str]
     # The ROA insert buffer is a list of dicts with columm names and their values.
     _roa_insert_buffer: List[Dict[str, Union[str, int]]]
+    # Changes to route(6) objects, to be applied to the preload store after commit.
+    # None indicates that a full reload of the preload store is required.
+    _preload_route_changes: Optional[List[PreloadRouteChange]]
+    # Changes to objects that may affect sets in the preload store.
+    _preload_set_changes: List[PreloadSetChange]
+    # Sources of which objects were changed, to increase their change serials after commit.
+    _sources_modified: Set[str]
+    # If set to a list, each query executed through execute_query() or
+    # execute_query_stream() is appended to it, e.g. for slow query logging.
+    query_log: Optional[List[ExecutedQuery]] = None
 
     def __init__(self, readonly=False):
         """
@@ -58,6 +191,7 @@ class DatabaseHandler:
         else:
             self._start_transaction()
             self.preloader = Preloader(enable_queries=False)
+            self.change_serials = SourceChangeSerials()
 
     def refresh_connection(self) -> None:
         """
@@ -85,8 +219,17 @@ class DatabaseHandler:
         self._transaction = self._connection.begin()
         self._rpsl_pk_source_seen: Set[str] = set()
         self._rpsl_upsert_buffer = []
+        self._rpsl_copy_buffer = []
+        self._rpsl_bulk_load_source = None
+        self._rpsl_bulk_load_staging = False
+        self._rpsl_bulk_load_pk_source_seen = set()
+        self._rpsl_parent_link_changes = {}
+        self._rpsl_parent_link_sources = set()
         self._roa_insert_buffer = []
         self._object_classes_modified: Set[str] = set()
+        self._sources_modified = set()
+        self._preload_route_changes = []
+        self._preload_set_changes = []
         self._rpsl_guaranteed_no_existing = True
         self.status_tracker = DatabaseStatusTracker(self, journaling_enabled=self.journaling_enabled)
 
@@ -103,22 +246,55 @@ class DatabaseHandler:
         Commit any pending changes to the database and start a fresh transaction.
         """
         self._flush_rpsl_object_writing_buffer()
+        self._finish_rpsl_bulk_load()
+        self._update_rpsl_parent_links()
+        self._rebuild_rpsl_parent_links()
         self._flush_roa_writing_buffer()
         self.status_tracker.finalise_transaction()
         try:
             self._transaction.commit()
-            if self._object_classes_modified:
-                self.preloader.signal_reload(self._object_classes_modified)
-            self._start_transaction()
         except Exception as exc:  # pragma: no cover
             self._transaction.rollback()
             logger.error('Exception occurred while committing changes, rolling back', exc_info=exc)
             raise
+        self._signal_committed_changes()
+        self._start_transaction()
+
+    def _signal_committed_changes(self) -> None:
+        """
+        Signal the changes of the transaction that was just committed
+        to the change serials and the preload store.
+        As the changes are already committed, failures, e.g. because redis
+        is unavailable, are logged, and a full reload of the preload store
+        is requested instead of applying the changes.
+        """
+        try:
+            if self._sources_modified:
+                self.change_serials.increase(self._sources_modified)
+            if self._object_classes_modified:
+                preload_sequence = None
+                if self._preload_route_changes or self._preload_set_changes:
+                    preload_sequence = self.preloader.claim_change_sequence()
+                self.preloader.signal_reload(self._object_classes_modified, self._preload_route_changes,
+                                             self._preload_set_changes, preload_sequence)
+        except Exception as exc:
+            logger.error('Exception occurred while signalling committed changes, '
+                         'requesting full preload reload', exc_info=exc)
+            try:
+                self.preloader.signal_reload(self._object_classes_modified)
+            except Exception as reload_exc:
+                logger.error(f'Failed to request full preload reload, the preload store will be '
+                             f'updated on the next periodic full reload: {reload_exc}')
 
     def rollback(self, start_transaction=True) -> None:
         """Roll back the current transaction, discarding all submitted changes."""
         self._rpsl_upsert_buffer = []
+        self._rpsl_copy_buffer = []
+        self._rpsl_bulk_load_source = None
+        self._rpsl_bulk_load_staging = False
         self._rpsl_pk_source_seen = set()
+        self._rpsl_parent_link_changes = {}
+        self._rpsl_parent_link_sources = set()
         self.status_tracker.reset()
         self._transaction.rollback()
         if start_transaction:
@@ -135,12 +311,70 @@ class DatabaseHandler:
         # To be able to query objects that were just created, flush the buffer.
         if not self.readonly and flush_rpsl_buffer:
             self._flush_rpsl_object_writing_buffer()
-        statement = query.finalise_statement()
-        result = self._connection.execute(statement)
-        for row in result.fetchall():
+        executed_query = self._log_query(query)
+        result = self._execute_query_statement(self._connection, query)
+        rows = result.fetchall()
+        if executed_query:
+            executed_query.row_count = len(rows)
+        for row in rows:
             yield dict(row)
         result.close()
 
+    def estimate_row_count(self, query: BaseRPSLObjectDatabaseQuery) -> int:
+        """
+        Estimate the number of rows an RPSL object query returns, from the
+        query plan of PostgreSQL, without executing it. The estimate is based
+        on the table statistics, and can be far off, but it is cheap.
+        """
+        plan = self._connection.execute(Explain(query.finalise_statement())).scalar()
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def execute_query_stream(self, query: BaseRPSLObjectDatabaseQuery) -> Iterator[Dict[str, Any]]:
+        """
+        Execute an RPSLDatabaseQuery, retrieving the results from a server-side
+        cursor in batches, rather than fetching all rows at once.
+
+        Server-side cursors can not be used in autocommit mode, so in a readonly
+        handler, a transaction is started until the results are consumed.
+        The results must be fully consumed, or the iterator closed,
+        before another query is executed.
+        """
+        transaction = None
+        if self.readonly:
+            self._connection.execution_options(isolation_level='READ COMMITTED')
+            transaction = self._connection.begin()
+        else:
+            self._flush_rpsl_object_writing_buffer()
+        try:
+            executed_query = self._log_query(query)
+            result = self._execute_query_statement(self._connection.execution_options(stream_results=True), query)
+            for row in result:
+                if executed_query:
+                    executed_query.row_count += 1
+                yield dict(row)
+            result.close()
+        finally:
+            if transaction:
+                transaction.rollback()
+                self._connection.execution_options(isolation_level='AUTOCOMMIT')
+
+    def _execute_query_statement(self, connection: sa.engine.Connection, query) -> sa.engine.ResultProxy:
+        """
+        Execute the statement of a query on connection. For RPSL object queries,
+        a compiled statement from the statement cache is used.
+        """
+        if isinstance(query, BaseRPSLObjectDatabaseQuery):
+            compiled = statement_cache.compiled_statement(query, connection.dialect)
+            return connection.execute(compiled, query.statement_params())
+        return connection.execute(query.finalise_statement())
+
+    def _log_query(self, query) -> Optional[ExecutedQuery]:
+        if self.query_log is None:
+            return None
+        executed_query = ExecutedQuery(query)
+        self.query_log.append(executed_query)
+        return executed_query
+
     def execute_statement(self, statement):
         """Execute a raw SQLAlchemy statement, without flushing the upsert buffer."""
         return self._connection.execute(statement)
@@ -184,7 +418,8 @@ class DatabaseHandler:
         # will conflict.
         source = rpsl_object.parsed_data['source']
         rpsl_pk_source = rpsl_object.pk() + '-' + source
-        if rpsl_pk_source in self._rpsl_pk_source_seen:
+        bulk_load = self._rpsl_bulk_load_applies(source, rpsl_pk_source)
+        if not bulk_load and rpsl_pk_source in self._rpsl_pk_source_seen:
             self._flush_rpsl_object_writing_buffer()
 
         update_time = datetime.now(timezone.utc)
@@ -206,13 +441,72 @@ class DatabaseHandler:
             'updated': update_time,
         }
 
-        self._rpsl_upsert_buffer.append((object_dict, origin, source_serial))
+        if bulk_load:
+            self._rpsl_copy_buffer.append((object_dict, origin, source_serial))
+            if not self._rpsl_bulk_load_staging:
+                self._rpsl_bulk_load_pk_source_seen.add(rpsl_pk_source)
+        else:
+            self._rpsl_upsert_buffer.append((object_dict, origin, source_serial))
+            self._rpsl_pk_source_seen.add(rpsl_pk_source)
 
-        self._rpsl_pk_source_seen.add(rpsl_pk_source)
         self._object_classes_modified.add(rpsl_object.rpsl_object_class)
+        self._sources_modified.add(source)
+        self._record_rpsl_parent_link_change(rpsl_object.rpsl_object_class, source, rpsl_object.ip_version(),
+                                             ip_first, ip_last, deleted=False)
+        if rpsl_object.rpsl_object_class in ['route', 'route6']:
+            visible = all([
+                rpsl_object.rpki_status in [RPKIStatus.not_found, RPKIStatus.valid],
+                rpsl_object.scopefilter_status == ScopeFilterStatus.in_scope,
+            ])
+            self._record_preload_route_change(rpsl_object.ip_version(), source, rpsl_object.asn_first,
+                                              ip_first, rpsl_object.prefix_length, visible)
+        if rpsl_object.rpsl_object_class in SET_STORE_RELEVANT_OBJECT_CLASSES:
+            member_of = rpsl_object.parsed_data.get('member-of', [])
+            self._record_preload_set_change(source, rpsl_object.rpsl_object_class, rpsl_object.pk(), member_of)
 
         if len(self._rpsl_upsert_buffer) > MAX_RECORDS_BUFFER_BEFORE_INSERT:
             self._flush_rpsl_object_writing_buffer()
+        if len(self._rpsl_copy_buffer) > MAX_RECORDS_BUFFER_BEFORE_INSERT:
+            self._flush_rpsl_copy_buffer()
+
+    def start_rpsl_bulk_load(self, source: str, staging_table: bool=False) -> None:
+        """
+        Start a bulk load of RPSL objects for a source, intended for full
+        imports after delete_all_rpsl_objects_with_journal(). Until the end of
+        the transaction, objects of this source passed to upsert_rpsl_object()
+        are written with COPY, which is much faster than INSERT for large
+        numbers of objects.
+
+        If staging_table is set, objects are copied into a temporary table,
+        which is not WAL-logged, and moved into the RPSL object table with
+        a single statement on commit. Until then, they are not visible to
+        queries. Otherwise, objects are copied directly into the RPSL object
+        table, and only objects that occur more than once in the load
+        are written with INSERT .. ON CONFLICT DO UPDATE.
+        """
+        self._flush_rpsl_object_writing_buffer()
+        self._finish_rpsl_bulk_load()
+        self._rpsl_bulk_load_source = source
+        self._rpsl_bulk_load_staging = staging_table
+        self._rpsl_bulk_load_pk_source_seen = set()
+        self._rpsl_parent_link_sources.add(source)
+        if staging_table:
+            self._connection.execute(
+                f'CREATE TEMPORARY TABLE {RPSL_BULK_LOAD_STAGING_TABLE} '
+                f'(LIKE {RPSLDatabaseObject.__tablename__} INCLUDING DEFAULTS, bulk_load_seq BIGSERIAL) '
+                f'ON COMMIT DROP'
+            )
+        logger.info(f'Starting bulk load of RPSL objects for {source}, staging table: {staging_table}')
+
+    def _rpsl_bulk_load_applies(self, source: str, rpsl_pk_source: str) -> bool:
+        """
+        Determine whether an object should be written through the bulk load.
+        Without a staging table, objects already copied must be upserted,
+        as COPY can not update existing rows.
+        """
+        if source != self._rpsl_bulk_load_source:
+            return False
+        return self._rpsl_bulk_load_staging or rpsl_pk_source not in self._rpsl_bulk_load_pk_source_seen
 
     def insert_roa_object(self, ip_version: int, prefix_str: str, asn: int, max_length: int, trust_anchor: str) -> None:
         """
@@ -276,8 +570,13 @@ class DatabaseHandler:
                 origin=JournalEntryOrigin.rpki_status,
                 source_serial=None,
             )
+        for rpsl_obj in rpsl_objs_now_valid + rpsl_objs_now_invalid + rpsl_objs_now_not_found:
+            self._sources_modified.add(rpsl_obj['source'])
         if rpsl_objs_now_valid or rpsl_objs_now_invalid or rpsl_objs_now_not_found:
             self._object_classes_modified.add('route')
+            # The visibility of routes also depends on their scope filter status,
+            # which is not known here, so this requires a full preload reload.
+            self._preload_route_changes = None
 
     def update_scopefilter_status(self, rpsl_objs_now_in_scope: List[Dict[str, str]]=[],
                                   rpsl_objs_now_out_scope_as: List[Dict[str, str]]=[],
@@ -329,6 +628,13 @@ class DatabaseHandler:
                 )
                 self._object_classes_modified.add(rpsl_obj['object_class'])
 
+        for rpsl_obj in rpsl_objs_now_in_scope + rpsl_objs_now_out_scope_as + rpsl_objs_now_out_scope_prefix:
+            self._sources_modified.add(rpsl_obj['source'])
+        if rpsl_objs_now_in_scope or rpsl_objs_now_out_scope_as or rpsl_objs_now_out_scope_prefix:
+            # The visibility of routes also depends on their RPKI status,
+            # which is not known here, so this requires a full preload reload.
+            self._preload_route_changes = None
+
     def delete_rpsl_object(self, origin: JournalEntryOrigin, rpsl_object: Optional[RPSLObject]=None,
                            source: Optional[str]=None, rpsl_pk: Optional[str]=None,
                            source_serial: Optional[int]=None) -> None:
@@ -346,7 +652,9 @@ class DatabaseHandler:
             rpsl_pk = rpsl_object.pk()
         stmt = table.delete(
             sa.and_(table.c.rpsl_pk == rpsl_pk, table.c.source == source),
-        ).returning(table.c.pk, table.c.rpsl_pk, table.c.source, table.c.object_class, table.c.object_text)
+        ).returning(table.c.pk, table.c.rpsl_pk, table.c.source, table.c.object_class, table.c.object_text,
+                    table.c.ip_version, table.c.ip_first, table.c.ip_last, table.c.prefix_length,
+                    table.c.asn_first)
         results = self._connection.execute(stmt)
 
         if results.rowcount == 0:
@@ -373,10 +681,72 @@ class DatabaseHandler:
             source_serial=source_serial,
         )
         self._object_classes_modified.add(result['object_class'])
+        self._sources_modified.add(result['source'])
+        self._record_rpsl_parent_link_change(result['object_class'], result['source'], result['ip_version'],
+                                             result['ip_first'], result['ip_last'], deleted=True)
+        if result['object_class'] in ['route', 'route6']:
+            self._record_preload_route_change(result['ip_version'], result['source'], result['asn_first'],
+                                              result['ip_first'], result['prefix_length'], visible=False)
+        if result['object_class'] in SET_STORE_RELEVANT_OBJECT_CLASSES:
+            self._record_preload_set_change(result['source'], result['object_class'], result['rpsl_pk'],
+                                            member_of=[])
+
+    def _record_rpsl_parent_link_change(self, object_class: str, source: str, ip_version: Optional[int],
+                                        ip_first: Optional[str], ip_last: Optional[str], deleted: bool) -> None:
+        """
+        Record a write or deletion of an object with an IP range, so that
+        the parent links of the objects it may affect are updated on commit.
+        Repeated changes to the same range are recorded once.
+        Sources being bulk loaded are skipped, as all their parent links
+        are rebuilt on commit.
+        """
+        if None in [ip_version, ip_first, ip_last] or source in self._rpsl_parent_link_sources:
+            return
+        key = (object_class, source, ip_version, ip_first, ip_last)
+        self._rpsl_parent_link_changes[key] = self._rpsl_parent_link_changes.get(key, False) or deleted  # type: ignore
+
+    def _record_preload_route_change(self, ip_version: Optional[int], source: str, asn_first: Optional[int],
+                                     ip_first: Optional[str], prefix_length: Optional[int], visible: bool) -> None:
+        """
+        Record a change to a route(6) object, so that it can be applied
+        to the preload store after commit, without a full reload.
+        If the number of changes is very large, a full reload is
+        scheduled instead.
+        """
+        if self._preload_route_changes is None or None in [ip_version, asn_first, ip_first, prefix_length]:
+            return
+        if len(self._preload_route_changes) >= MAX_PRELOAD_CHANGES_BEFORE_FULL_RELOAD:
+            self._preload_route_changes = None
+            return
+        prefix = f'{ip_first}/{prefix_length}'
+        self._preload_route_changes.append((ip_version, source, f'AS{asn_first}', prefix, visible))  # type: ignore
+
+    def _record_preload_set_change(self, source: str, object_class: str, rpsl_pk: str, member_of: List[str]) -> None:
+        """
+        Record a change to an object that may affect the sets in the
+        preload store, so that the preload store manager can determine
+        which sets need to be reloaded.
+        If the number of changes is very large, a full reload is
+        scheduled instead.
+        """
+        if self._preload_route_changes is None:
+            return
+        if len(self._preload_set_changes) >= MAX_PRELOAD_CHANGES_BEFORE_FULL_RELOAD:
+            self._preload_route_changes = None
+            return
+        self._preload_set_changes.append((source, object_class, rpsl_pk, member_of))
 
     def _flush_rpsl_object_writing_buffer(self) -> None:
         """
-        Flush the current object writing buffer to the database.
+        Flush the current object writing buffers to the database.
+        """
+        # Objects in the upsert buffer may update objects in the copy buffer
+        self._flush_rpsl_copy_buffer()
+        self._flush_rpsl_upsert_buffer()
+
+    def _flush_rpsl_upsert_buffer(self) -> None:
+        """
+        Flush the current upsert buffer to the database.
 
         This happens in one large INSERT .. ON CONFLICT DO UPDATE ..
         statement, which is more performant than individual
@@ -407,7 +777,107 @@ class DatabaseHandler:
             logger.error(f'Exception occurred while executing statement: {stmt}, rolling back', exc_info=exc)
             raise
 
-        for obj, origin, source_serial in self._rpsl_upsert_buffer:
+        self._record_rpsl_operations(self._rpsl_upsert_buffer)
+        self._rpsl_pk_source_seen = set()
+        self._rpsl_upsert_buffer = []
+
+    def _flush_rpsl_copy_buffer(self) -> None:
+        """
+        Flush the current copy buffer of a bulk load to the database, with
+        a single COPY into the RPSL object table or the staging table.
+        """
+        if not self._rpsl_copy_buffer:
+            return
+
+        columns = list(self._rpsl_copy_buffer[0][0].keys())
+        rows = StringIO()
+        for obj, _, _ in self._rpsl_copy_buffer:
+            rows.write('\t'.join([_copy_text_value(obj[column]) for column in columns]) + '\n')
+        rows.seek(0)
+
+        destination = sa.table(RPSL_BULK_LOAD_STAGING_TABLE) if self._rpsl_bulk_load_staging else RPSLDatabaseObject
+        postgres_copy.copy_from(rows, destination, self._connection, columns=columns)
+        self._record_rpsl_operations(self._rpsl_copy_buffer)
+        self._rpsl_copy_buffer = []
+
+    def _finish_rpsl_bulk_load(self) -> None:
+        """
+        Move the objects of a bulk load with a staging table into the RPSL
+        object table. If an object occurs more than once, the last one wins.
+        """
+        if not self._rpsl_bulk_load_staging:
+            return
+        self._flush_rpsl_copy_buffer()
+        columns = [
+            c.name for c in RPSLDatabaseObject.__table__.columns
+            if c.name not in ['pk', 'created']
+        ]
+        columns_str = ', '.join(columns)
+        columns_to_update = ', '.join([
+            f'{column} = EXCLUDED.{column}'
+            for column in columns if column not in ['rpsl_pk', 'source']
+        ])
+        self._connection.execute(
+            f'INSERT INTO {RPSLDatabaseObject.__tablename__} ({columns_str}) '
+            f'SELECT DISTINCT ON (rpsl_pk, source) {columns_str} FROM {RPSL_BULK_LOAD_STAGING_TABLE} '
+            f'ORDER BY rpsl_pk, source, bulk_load_seq DESC '
+            f'ON CONFLICT (rpsl_pk, source) DO UPDATE SET {columns_to_update}'
+        )
+        self._connection.execute(f'DROP TABLE {RPSL_BULK_LOAD_STAGING_TABLE}')
+        self._rpsl_bulk_load_staging = False
+
+    def _update_rpsl_parent_links(self) -> None:
+        """
+        Update the parent links of objects affected by the changes recorded
+        in this transaction, with a single UPDATE on commit, rather than on
+        every flush of the object writing buffer. A new or updated object with range R may become
+        the parent of objects within R, whose parent is currently a range
+        containing R, or who have no parent. When the last object with
+        range R is deleted, objects whose parent is R need a new parent.
+        Both cases also update the parent link of any objects with range R.
+        """
+        if not self._rpsl_parent_link_changes:
+            return
+        object_classes, sources, ip_versions, ip_firsts, ip_lasts = zip(*self._rpsl_parent_link_changes.keys())
+        deleted = self._rpsl_parent_link_changes.values()
+        stmt = sa.text(f"""
+            UPDATE rpsl_objects SET (parent_ip_first, parent_ip_last) = ({RPSL_PARENT_LINK_SUBQUERY})
+            FROM unnest(:object_classes, :sources, :ip_versions, CAST(:ip_firsts AS inet[]),
+                        CAST(:ip_lasts AS inet[]), :deleted)
+                AS changed(object_class, source, ip_version, ip_first, ip_last, deleted)
+            WHERE rpsl_objects.object_class = changed.object_class
+                AND rpsl_objects.source = changed.source
+                AND rpsl_objects.ip_version = changed.ip_version
+                AND inetrange(rpsl_objects.ip_first, rpsl_objects.ip_last, '[]')
+                    <@ inetrange(changed.ip_first, changed.ip_last, '[]')
+                AND (rpsl_objects.parent_ip_first IS NULL OR (
+                    inetrange(rpsl_objects.parent_ip_first, rpsl_objects.parent_ip_last, '[]')
+                        @> inetrange(changed.ip_first, changed.ip_last, '[]')
+                    AND (changed.deleted OR NOT (rpsl_objects.parent_ip_first = changed.ip_first
+                                                 AND rpsl_objects.parent_ip_last = changed.ip_last))
+                ))
+        """)
+        self._connection.execute(stmt, object_classes=list(object_classes), sources=list(sources),
+                                 ip_versions=list(ip_versions), ip_firsts=list(ip_firsts),
+                                 ip_lasts=list(ip_lasts), deleted=list(deleted))
+        self._rpsl_parent_link_changes = {}
+
+    def _rebuild_rpsl_parent_links(self) -> None:
+        """
+        Rebuild the parent links of all objects of sources that were bulk loaded.
+        """
+        for source in sorted(self._rpsl_parent_link_sources):
+            stmt = sa.text(f"""
+                UPDATE rpsl_objects SET (parent_ip_first, parent_ip_last) = ({RPSL_PARENT_LINK_SUBQUERY})
+                WHERE rpsl_objects.source = :source AND rpsl_objects.ip_version IS NOT NULL
+            """)
+            self._connection.execute(stmt, source=source)
+            logger.info(f'Rebuilt parent links of RPSL objects for {source}')
+        self._rpsl_parent_link_sources = set()
+
+    def _record_rpsl_operations(self, buffer: List[Tuple[dict, JournalEntryOrigin, Optional[int]]]) -> None:
+        """Record the operations for written objects with the status tracker."""
+        for obj, origin, source_serial in buffer:
             # RPKI invalid objects never generated a journal entry,
             # as mirrors should not see them. This does not affect
             # RPKI excluded sources, because they are always not_found.
@@ -426,9 +896,6 @@ class DatabaseHandler:
                     source_serial=source_serial,
                 )
 
-        self._rpsl_pk_source_seen = set()
-        self._rpsl_upsert_buffer = []
-
     def _flush_roa_writing_buffer(self):
         """
         Flush the current ROA buffer to the database.
@@ -458,6 +925,7 @@ class DatabaseHandler:
         Note that no journal records are kept of this change itself.
         """
         self._flush_rpsl_object_writing_buffer()
+        self.status_tracker.flush_journal()
         table = RPSLDatabaseObject.__table__
         stmt = table.delete(table.c.source == source)
         self._connection.execute(stmt)
@@ -469,6 +937,8 @@ class DatabaseHandler:
         self._connection.execute(stmt)
         # All objects are presumed to have been changed.
         self._object_classes_modified.update(OBJECT_CLASS_MAPPING.keys())
+        self._sources_modified.add(source)
+        self._preload_route_changes = None
 
     def delete_all_roa_objects(self):
         """
@@ -540,6 +1010,7 @@ class DatabaseStatusTracker:
     reflect the range of serials known for a particular source.
     """
     journaling_enabled: bool
+    _journal_buffer: List[Dict[str, Any]]
     _new_serials_per_source: Dict[str, Set[int]]
     _sources_seen: Set[str]
     _newest_mirror_serials: Dict[str, int]
@@ -593,34 +1064,62 @@ class DatabaseStatusTracker:
         and the database.SOURCE.keep_journal is set.
         The source will always be added to _sources_seen.
 
-        Note that this method locks the journal table for writing to ensure a
-        gapless set of NRTM serials.
+        Journal entries are buffered, and written by flush_journal(),
+        which is called when the buffer is full and when finalising.
         """
         self._sources_seen.add(source)
         if self.journaling_enabled and get_setting(f'sources.{source}.keep_journal'):
-            serial_nrtm: Union[int, sa.sql.expression.Select]
-            journal_tablename = RPSLDatabaseJournal.__tablename__
-
+            entry = {
+                'rpsl_pk': rpsl_pk,
+                'source': source,
+                'operation': operation,
+                'object_class': object_class,
+                'object_text': object_text,
+                'origin': origin,
+            }
             if self._is_serial_synchronised(source):
-                serial_nrtm = source_serial
-            else:
-                self.database_handler.execute_statement(f'LOCK TABLE {journal_tablename} IN EXCLUSIVE MODE')
-                serial_nrtm = sa.select([sa.text('COALESCE(MAX(serial_nrtm), 0) + 1')])
-                serial_nrtm = serial_nrtm.where(RPSLDatabaseJournal.__table__.c.source == source)
-                serial_nrtm = serial_nrtm.as_scalar()
-            stmt = RPSLDatabaseJournal.__table__.insert().values(
-                rpsl_pk=rpsl_pk,
-                source=source,
-                operation=operation,
-                object_class=object_class,
-                object_text=object_text,
-                serial_nrtm=serial_nrtm,
-                origin=origin,
-            ).returning(self.c_journal.serial_nrtm)
+                entry['serial_nrtm'] = source_serial
+            self._journal_buffer.append(entry)
+            if len(self._journal_buffer) > MAX_RECORDS_BUFFER_BEFORE_INSERT:
+                self.flush_journal()
+
+    def flush_journal(self) -> None:
+        """
+        Write all buffered journal entries to the database in one statement.
 
-            insert_result = self.database_handler.execute_statement(stmt)
-            inserted_serial = insert_result.fetchone()['serial_nrtm']
-            self._new_serials_per_source[source].add(inserted_serial)
+        Entries for sources without synchronised serials are assigned
+        a contiguous range of serials per source, following the newest
+        serial in the journal, in the order in which they were recorded.
+        Note that this method locks the journal table for writing to ensure a
+        gapless set of NRTM serials.
+        """
+        if not self._journal_buffer:
+            return
+        unassigned_sources = {
+            entry['source'] for entry in self._journal_buffer
+            if 'serial_nrtm' not in entry
+        }
+        if unassigned_sources:
+            journal_tablename = RPSLDatabaseJournal.__tablename__
+            self.database_handler.execute_statement(f'LOCK TABLE {journal_tablename} IN EXCLUSIVE MODE')
+            newest_serials_q = sa.select([
+                self.c_journal.source,
+                sa.func.max(self.c_journal.serial_nrtm),
+            ]).where(self.c_journal.source.in_(unassigned_sources)).group_by(self.c_journal.source)
+            result = self.database_handler.execute_statement(newest_serials_q)
+            newest_serials = {source: serial for source, serial in result}
+
+            for entry in self._journal_buffer:
+                if 'serial_nrtm' not in entry:
+                    serial_nrtm = newest_serials.get(entry['source'], 0) + 1
+                    newest_serials[entry['source']] = serial_nrtm
+                    entry['serial_nrtm'] = serial_nrtm
+
+        stmt = RPSLDatabaseJournal.__table__.insert().values(self._journal_buffer)
+        self.database_handler.execute_statement(stmt)
+        for entry in self._journal_buffer:
+            self._new_serials_per_source[entry['source']].add(entry['serial_nrtm'])
+        self._journal_buffer = []
 
     def finalise_transaction(self):
         """
@@ -630,6 +1129,7 @@ class DatabaseStatusTracker:
           serial stats in the status object.
         - Update the latest source errors.
         """
+        self.flush_journal()
         for source in self._sources_seen:
             stmt = pg.insert(RPSLDatabaseStatus).values(
                 source=source,
@@ -712,6 +1212,7 @@ class DatabaseStatusTracker:
         return is_serial_synchronised(self.database_handler, source)
 
     def reset(self):
+        self._journal_buffer = []
         self._new_serials_per_source = defaultdict(set)
         self._sources_seen = set()
         self._newest_mirror_serials = dict()
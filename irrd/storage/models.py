@@ -33,6 +33,19 @@ class JournalEntryOrigin(enum.Enum):
 
 Base = declarative_base()
 
+# Range type over INET, used to index the IP range of RPSL objects with GiST,
+# so that less and more specific searches can use a single containment
+# condition. Ranges of IPv4 and IPv6 addresses never overlap, as INET values
+# are ordered by IP version first. No subtype_diff function is set, as
+# PostgreSQL can not return the difference between IPv6 addresses.
+sa.event.listen(Base.metadata, 'before_create', sa.DDL("""
+    DO $$ BEGIN
+        CREATE TYPE inetrange AS RANGE (subtype = inet);
+    EXCEPTION WHEN duplicate_object THEN NULL;
+    END $$
+"""))
+sa.event.listen(Base.metadata, 'after_drop', sa.DDL('DROP TYPE IF EXISTS inetrange'))
+
 
 class RPSLDatabaseObject(Base):  # type: ignore
     """
@@ -59,6 +72,10 @@ class RPSLDatabaseObject(Base):  # type: ignore
     ip_size = sa.Column(sa.DECIMAL(scale=0))
     # Only filled for route/route6
     prefix_length = sa.Column(sa.Integer, nullable=True)
+    # IP range of the immediate less specific object of the same object class
+    # and source, if any. Maintained by the DatabaseHandler.
+    parent_ip_first = sa.Column(pg.INET, nullable=True)
+    parent_ip_last = sa.Column(pg.INET, nullable=True)
 
     asn_first = sa.Column(sa.BigInteger, index=True)
     asn_last = sa.Column(sa.BigInteger, index=True)
@@ -76,6 +93,9 @@ class RPSLDatabaseObject(Base):  # type: ignore
             sa.Index('ix_rpsl_objects_ip_first_ip_last', 'ip_first', 'ip_last', ),
             sa.Index('ix_rpsl_objects_ip_last_ip_first', 'ip_last', 'ip_first'),
             sa.Index('ix_rpsl_objects_asn_first_asn_last', 'asn_first', 'asn_last'),
+            sa.Index('ix_rpsl_objects_parent_ip_first_parent_ip_last', 'parent_ip_first', 'parent_ip_last'),
+            sa.Index('ix_rpsl_objects_ip_range_gist', sa.text("inetrange(ip_first, ip_last, '[]')"),
+                     postgresql_using='gist', postgresql_where=sa.text('ip_version IS NOT NULL')),
         ]
         for name in lookup_field_names():
             index_name = 'ix_rpsl_objects_parsed_data_' + name.replace('-', '_')
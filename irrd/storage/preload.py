@@ -1,28 +1,99 @@
 import logging
-import random
+import os
 import signal
+import socket
 import threading
 import time
 from collections import defaultdict
-from typing import Optional, List, Set, Dict, Union
+from typing import Optional, List, Set, Dict, Union, Tuple, Iterable, Any
 
 import redis
+import ujson
 from setproctitle import setproctitle
 
 from irrd.conf import get_setting
 from irrd.rpki.status import RPKIStatus
 from irrd.scopefilter.status import ScopeFilterStatus
+from irrd.utils.prefix_aggregation import aggregate_prefix_ranges, aggregate_prefixes
 from irrd.utils.process_support import ExceptionLoggingProcess
+from .preload_snapshot import OverlaySnapshot, PreloadSnapshot, write_snapshot
 from .queries import RPSLDatabaseQuery
+from .set_expansion_cache import SetExpansionCache, origin_dependency, set_dependency
 
-SENTINEL_HASH_CREATED = b'SENTINEL_HASH_CREATED'
+# Each store is written under a new versioned key for every full reload, e.g.
+# irrd-preload-origin-route4-42, and then switched to atomically by updating
+# the pointer hash, which maps store keys to their current versioned keys.
 REDIS_ORIGIN_ROUTE4_STORE_KEY = b'irrd-preload-origin-route4'
 REDIS_ORIGIN_ROUTE6_STORE_KEY = b'irrd-preload-origin-route6'
+REDIS_SET_STORE_KEY = b'irrd-preload-sets'
+REDIS_STORE_POINTER_KEY = b'irrd-preload-store-pointers'
+REDIS_STORE_VERSION_KEY = b'irrd-preload-store-version'
+# Maximum number of hash entries read or written in a single redis command,
+# so that large stores do not block redis for other clients.
+REDIS_CHUNK_SIZE = 1000
 REDIS_PRELOAD_RELOAD_CHANNEL = 'irrd-preload-reload-channel'
 REDIS_PRELOAD_COMPLETE_CHANNEL = 'irrd-preload-complete-channel'
-REDIS_ORIGIN_LIST_SEPARATOR = ','
+REDIS_PRELOAD_CHANGES_KEY = b'irrd-preload-changes'
+# Sequence number of changes, claimed by each transaction before it commits,
+# so that changes can be applied in commit order.
+REDIS_PRELOAD_SEQUENCE_KEY = b'irrd-preload-sequence'
+REDIS_PRELOAD_RELOAD_MESSAGE = b'reload'
+REDIS_PRELOAD_UPDATE_MESSAGE = b'update'
+REDIS_PRELOAD_GENERATION_KEY = b'irrd-preload-generation'
+# Metrics on updates of the store and on the current snapshot, and the
+# number of origins and prefixes in the store per source and IP version.
+REDIS_PRELOAD_METRICS_KEY = b'irrd-preload-metrics'
+REDIS_PRELOAD_STORE_SIZE_KEY = b'irrd-preload-store-size'
+PRELOAD_SNAPSHOT_FILENAME = 'irrd-preload.snapshot'
+# Incremental updates are written to a delta snapshot, containing the entries
+# changed since the base snapshot. Once the delta has more entries than
+# PRELOAD_DELTA_MAX_ENTRIES, a new base snapshot is written instead.
+PRELOAD_DELTA_SNAPSHOT_FILENAME = 'irrd-preload-delta.snapshot'
+PRELOAD_DELTA_MAX_ENTRIES = 50000
+SNAPSHOT_ORIGIN_ROUTE4_TABLE = 'origin-route4'
+SNAPSHOT_ORIGIN_ROUTE6_TABLE = 'origin-route6'
+SNAPSHOT_SET_TABLE = 'sets'
+# Index of the origins per prefix, derived from the origin-route tables.
+# Keys are packed prefixes, values are space separated source/origin keys.
+SNAPSHOT_PREFIX_ORIGINS_TABLES = {4: 'prefix-origins4', 6: 'prefix-origins6'}
+# Sets and origins changed since the previous snapshot, only present for incremental updates
+SNAPSHOT_CHANGES_TABLE = 'changes'
+# Generation of the base snapshot to which a delta snapshot applies
+SNAPSHOT_DELTA_BASE_TABLE = 'base'
 REDIS_KEY_ORIGIN_SOURCE_SEPARATOR = '_'
-MAX_MEMORY_LIFETIME = 60
+# Even with incremental updates, a full reload is done periodically,
+# as a safety net in case any changes were missed.
+FULL_RELOAD_INTERVAL = 3600
+
+# A change to a single route in the preload store, as a tuple of
+# IP version, source, origin, prefix, and whether the route
+# should now be visible in the store.
+PreloadRouteChange = Tuple[int, str, str, str, bool]
+
+# Changes to these object classes may affect the set store,
+# which contains all as-sets and route-sets, including members
+# added through mbrs-by-ref.
+SET_STORE_RELEVANT_OBJECT_CLASSES = {'as-set', 'route-set', 'aut-num', 'route', 'route6'}
+SET_MEMBER_OF_QUERY_CHUNK_SIZE = 1000
+
+# A change to an object that may affect the set store, as a tuple
+# of source, object class, RPSL primary key, and the set names in the
+# member-of attribute of the object, if it still exists.
+PreloadSetChange = Tuple[str, str, str, List[str]]
+
+# A preloaded as-set or route-set, as a list of the object class,
+# the members and mp-members, and the members added through mbrs-by-ref.
+# The latter are lists of the source and the member, e.g. a prefix for a
+# route-set, and whether the referring object passes the RPKI filter and
+# the scope filter.
+PreloadedSet = List[Any]
+
+# Prefixes for each origin are stored in a packed binary format, both
+# in redis and in memory: each entry is the network address in
+# network byte order, followed by a single byte for the prefix length.
+PACKED_PREFIX_SIZE = {4: 5, 6: 17}
+PACKED_PREFIX_FAMILY = {4: socket.AF_INET, 6: socket.AF_INET6}
+ADDRESS_LENGTH = {4: 32, 6: 128}
 
 logger = logging.getLogger(__name__)
 
@@ -34,7 +105,51 @@ large data sets, this can improve performance.
 """
 
 
+def preload_snapshot_path() -> str:
+    """
+    Path of the snapshot of the preload store, shared between processes.
+    """
+    return os.path.join(get_setting('piddir'), PRELOAD_SNAPSHOT_FILENAME)
+
+
+def preload_delta_snapshot_path() -> str:
+    """
+    Path of the delta snapshot, with the changes since the snapshot
+    at preload_snapshot_path().
+    """
+    return os.path.join(get_setting('piddir'), PRELOAD_DELTA_SNAPSHOT_FILENAME)
+
+
+def pack_prefix(ip_version: int, address: str, prefix_length: int) -> bytes:
+    """
+    Pack a single prefix, e.g. 4, '192.0.2.0', 24, into the
+    binary format used in the preload store.
+    """
+    return socket.inet_pton(PACKED_PREFIX_FAMILY[ip_version], address) + bytes([prefix_length])
+
+
+def split_packed_prefixes(ip_version: int, packed: bytes) -> Iterable[bytes]:
+    """
+    Split a packed list of prefixes into individual packed prefixes.
+    """
+    entry_size = PACKED_PREFIX_SIZE[ip_version]
+    return (packed[offset:offset + entry_size] for offset in range(0, len(packed), entry_size))
+
+
+def unpack_prefix(ip_version: int, packed_prefix: bytes) -> str:
+    """
+    Unpack a single packed prefix into a string, e.g. '192.0.2.0/24'.
+    """
+    address = socket.inet_ntop(PACKED_PREFIX_FAMILY[ip_version], packed_prefix[:-1])
+    return f'{address}/{packed_prefix[-1]}'
+
+
 class PersistentPubSubWorkerThread(redis.client.PubSubWorkerThread):  # type: ignore
+    """
+    Thread that calls callback for each message on the preload complete
+    channel. After each (re)subscription, callback is also called without
+    a message, as any messages sent before the subscription are missed.
+    """
     def __init__(self, callback, *args, **kwargs):
         self.callback = callback
         self.should_resubscribe = True
@@ -47,6 +162,7 @@ class PersistentPubSubWorkerThread(redis.client.PubSubWorkerThread):  # type: ig
                 if self.should_resubscribe:
                     self.pubsub.subscribe(**{REDIS_PRELOAD_COMPLETE_CHANNEL: self.callback})
                     self.should_resubscribe = False
+                    self.callback()
                 self.pubsub.get_message(ignore_subscribe_messages=True, timeout=self.sleep_time)
             except redis.ConnectionError as rce:  # pragma: no cover
                 logger.error(f'Failed redis pubsub connection, '
@@ -69,18 +185,25 @@ class Preloader:
     needs to be updated. This interface can be used from any thread
     or process.
     """
-    _memory_loaded = False
+    _snapshot: Optional[OverlaySnapshot] = None
 
     def __init__(self, enable_queries=True):
         """
         Initialise the preloader.
         If this instance is only used for signalling that the store needs to be
         updated, set enable_queries=False.
-        Otherwise, this method starts a background thread that keeps an in-memory store,
-        which is automatically updated.
+        Otherwise, this method attaches the current snapshot of the store, if any,
+        and starts a background thread that attaches each new snapshot.
         """
         self._redis_conn = redis.Redis.from_url(get_setting('redis_url'))
+        self.set_expansion_cache = SetExpansionCache()
+        # Notified whenever a new snapshot is attached
+        self._snapshot_attached = threading.Condition()
         if enable_queries:
+            try:
+                self._load_routes_into_memory()
+            except (OSError, ValueError) as exc:  # pragma: no cover
+                logger.error(f'Failed to attach existing preload snapshot, waiting for new snapshot: {exc}')
             self._pubsub = self._redis_conn.pubsub()
             self._pubsub_thread = PersistentPubSubWorkerThread(
                 callback=self._load_routes_into_memory,
@@ -90,7 +213,22 @@ class Preloader:
             )
             self._pubsub_thread.start()
 
-    def signal_reload(self, object_classes_changed: Optional[Set[str]]=None) -> None:
+    def claim_change_sequence(self) -> int:
+        """
+        Claim a sequence number for changes that were just committed.
+        This should be called directly after the commit: if two transactions
+        change the same object, the second can only write it after the first
+        committed, and therefore nearly always claims a higher sequence number.
+        It is not claimed before the commit, as a redis failure must not
+        abort the transaction. Any remaining misordering is corrected
+        by the periodic full reload.
+        """
+        return self._redis_conn.incr(REDIS_PRELOAD_SEQUENCE_KEY)
+
+    def signal_reload(self, object_classes_changed: Optional[Set[str]]=None,
+                      route_changes: Optional[List[PreloadRouteChange]]=None,
+                      set_changes: Optional[List[PreloadSetChange]]=None,
+                      sequence: Optional[int]=None) -> None:
         """
         Perform a (re)load.
         Should be called after changes to the DB have been committed.
@@ -100,10 +238,33 @@ class Preloader:
 
         If object_classes_changed is provided, a reload is only performed
         if those classes are relevant to the data in the preload store.
+        If route_changes is provided, only those changes, along with
+        any set_changes, are applied to the store, rather than a full reload.
+        The sequence should be claimed with claim_change_sequence() directly
+        after the changes were committed, as writers signal their changes
+        independently, and therefore not necessarily in commit order.
+
+        The time of the oldest commit not yet picked up by the preload
+        store manager is recorded, to determine the staleness of the store.
         """
-        relevant_object_classes = {'route', 'route6'}
-        if object_classes_changed is None or object_classes_changed.intersection(relevant_object_classes):
-            self._redis_conn.publish(REDIS_PRELOAD_RELOAD_CHANNEL, 'reload')
+        relevant_object_classes = SET_STORE_RELEVANT_OBJECT_CLASSES
+        if object_classes_changed is not None and not object_classes_changed.intersection(relevant_object_classes):
+            return
+        if route_changes is not None and not route_changes and not set_changes:
+            return
+
+        if route_changes is not None and sequence is None:
+            sequence = self.claim_change_sequence()
+
+        pipeline = self._redis_conn.pipeline(transaction=True)
+        pipeline.hsetnx(REDIS_PRELOAD_METRICS_KEY, 'pending_commit_timestamp', time.time())
+        if route_changes is None:
+            pipeline.publish(REDIS_PRELOAD_RELOAD_CHANNEL, REDIS_PRELOAD_RELOAD_MESSAGE)
+        else:
+            changes = {'sequence': sequence, 'routes': route_changes, 'sets': set_changes or []}
+            pipeline.rpush(REDIS_PRELOAD_CHANGES_KEY, ujson.dumps(changes))
+            pipeline.publish(REDIS_PRELOAD_RELOAD_CHANNEL, REDIS_PRELOAD_UPDATE_MESSAGE)
+        pipeline.execute()
 
     def routes_for_origins(self, origins: Union[List[str], Set[str]], sources: List[str],
                            ip_version: Optional[int] = None) -> Set[str]:
@@ -118,50 +279,278 @@ class Preloader:
         AS065537 or as65537.
         This call will block until the preload store is loaded.
         """
-        while not self._memory_loaded:
-            time.sleep(1)  # pragma: no cover
+        prefix_sets: Set[str] = set()
+        for table_ip_version, packed_prefixes in self._packed_routes_for_origins(origins, sources, ip_version).items():
+            prefix_sets.update(unpack_prefix(table_ip_version, packed_prefix) for packed_prefix in packed_prefixes)
+        return prefix_sets
+
+    def aggregated_routes_for_origins(self, origins: Union[List[str], Set[str]], sources: List[str],
+                                      ip_version: Optional[int] = None, ranges: bool = False) -> List[str]:
+        """
+        Retrieve the prefixes originating from the provided origins, like
+        routes_for_origins(), but aggregated into the smallest list of prefixes
+        covering the same address space, sorted by address.
+
+        If ranges is set, the prefixes are instead aggregated into prefix
+        ranges that match exactly the same prefixes, in RPSL range operator
+        notation, e.g. 192.0.2.0/24^24-25.
+        This call will block until the preload store is loaded.
+        """
+        results = []
+        for table_ip_version, packed_prefixes in self._packed_routes_for_origins(origins, sources, ip_version).items():
+            address_length = ADDRESS_LENGTH[table_ip_version]
+
+            def format_prefix(network: int, length: int) -> str:
+                packed_address = network.to_bytes(address_length // 8, 'big')
+                return unpack_prefix(table_ip_version, packed_address + bytes([length]))
+
+            prefixes = (
+                (int.from_bytes(packed_prefix[:-1], 'big'), packed_prefix[-1])
+                for packed_prefix in packed_prefixes
+            )
+            if not ranges:
+                results += [format_prefix(network, length) for network, length in aggregate_prefixes(prefixes, address_length)]
+                continue
+
+            for network, length, min_length, max_length in aggregate_prefix_ranges(prefixes, address_length):
+                if min_length == max_length == length:
+                    results.append(format_prefix(network, length))
+                elif min_length == max_length:
+                    results.append(f'{format_prefix(network, length)}^{min_length}')
+                else:
+                    results.append(f'{format_prefix(network, length)}^{min_length}-{max_length}')
+        return results
+
+    def routes_per_origin(self, origins: Union[List[str], Set[str]], sources: List[str],
+                          ip_version: Optional[int] = None) -> Dict[str, Set[str]]:
+        """
+        Retrieve the prefixes originating from each of the provided origins,
+        from the given sources, as a dict keyed by origin. The result for each
+        origin is the same as routes_for_origins() for only that origin, but
+        all origins are looked up in the same snapshot.
+        This call will block until the preload store is loaded.
+        """
+        snapshot = self._wait_for_snapshot()
+        prefixes_per_origin: Dict[str, Set[str]] = {}
+        for origin in origins:
+            prefixes: Set[str] = set()
+            for table_ip_version, packed_entries in self._packed_entries_for_origins(
+                    [origin], sources, ip_version, snapshot).items():
+                for packed in packed_entries:
+                    prefixes.update(
+                        unpack_prefix(table_ip_version, packed_prefix)
+                        for packed_prefix in split_packed_prefixes(table_ip_version, packed)
+                    )
+            prefixes_per_origin[origin] = prefixes
+        return prefixes_per_origin
+
+    def route_count_for_origins(self, origins: Union[List[str], Set[str]], sources: List[str],
+                                ip_version: Optional[int] = None) -> int:
+        """
+        Count the prefixes originating from the provided origins, from the
+        given sources, without unpacking them. Prefixes originated from
+        multiple origins or sources are counted for each, so this is an upper
+        bound of the number of prefixes returned by routes_for_origins().
+        This call will block until the preload store is loaded.
+        """
+        return sum(
+            len(packed) // PACKED_PREFIX_SIZE[table_ip_version]
+            for table_ip_version, packed_entries in self._packed_entries_for_origins(origins, sources, ip_version).items()
+            for packed in packed_entries
+        )
+
+    def _packed_routes_for_origins(self, origins: Union[List[str], Set[str]], sources: List[str],
+                                   ip_version: Optional[int] = None) -> Dict[int, Set[bytes]]:
+        """
+        Retrieve the packed prefixes originating from the provided origins,
+        per IP version.
+        """
+        packed_prefixes_per_ip_version: Dict[int, Set[bytes]] = {}
+        for table_ip_version, packed_entries in self._packed_entries_for_origins(origins, sources, ip_version).items():
+            packed_prefixes: Set[bytes] = set()
+            for packed in packed_entries:
+                packed_prefixes.update(split_packed_prefixes(table_ip_version, packed))
+            packed_prefixes_per_ip_version[table_ip_version] = packed_prefixes
+        return packed_prefixes_per_ip_version
+
+    def _packed_entries_for_origins(self, origins: Union[List[str], Set[str]], sources: List[str],
+                                    ip_version: Optional[int] = None,
+                                    snapshot: Optional[OverlaySnapshot] = None) -> Dict[int, List[bytes]]:
+        """
+        Retrieve the entries of the origin-route tables for the provided
+        origins and sources, each the packed prefixes of one source and
+        origin, per IP version, from snapshot or the current snapshot.
+        """
+        # Keep a reference, as the snapshot may be replaced while this query runs
+        if snapshot is None:
+            snapshot = self._wait_for_snapshot()
         if ip_version and ip_version not in [4, 6]:
             raise ValueError(f'Invalid IP version: {ip_version}')
         if not origins or not sources:
-            return set()
+            return {}
 
-        prefix_sets: Set[str] = set()
-        for source in sources:
-            for origin in origins:
-                if (not ip_version or ip_version == 4) and source in self._origin_route4_store and origin in self._origin_route4_store[source]:
-                    prefix_sets.update(self._origin_route4_store[source][origin].split(REDIS_ORIGIN_LIST_SEPARATOR))
-                if (not ip_version or ip_version == 6) and source in self._origin_route6_store and origin in self._origin_route6_store[source]:
-                    prefix_sets.update(self._origin_route6_store[source][origin].split(REDIS_ORIGIN_LIST_SEPARATOR))
+        tables = []
+        if not ip_version or ip_version == 4:
+            tables.append((4, SNAPSHOT_ORIGIN_ROUTE4_TABLE))
+        if not ip_version or ip_version == 6:
+            tables.append((6, SNAPSHOT_ORIGIN_ROUTE6_TABLE))
 
-        return prefix_sets
+        packed_entries_per_ip_version: Dict[int, List[bytes]] = {}
+        for table_ip_version, table_name in tables:
+            packed_entries = []
+            for source in sources:
+                for origin in origins:
+                    key = (source + REDIS_KEY_ORIGIN_SOURCE_SEPARATOR + origin).encode('ascii')
+                    packed = snapshot.get(table_name, key)
+                    if packed:
+                        packed_entries.append(packed)
+            packed_entries_per_ip_version[table_ip_version] = packed_entries
+        return packed_entries_per_ip_version
 
-    def _load_routes_into_memory(self, redis_message):
+    def origins_for_prefix(self, ip_version: int, address: str, prefix_length: int,
+                           sources: List[str], less_specific: bool = False) -> List[str]:
         """
-        Update the in-memory store. This is called whenever a
-        message is sent to REDIS_PRELOAD_COMPLETE_CHANNEL.
+        Retrieve the origins of all routes for a prefix, e.g. 4, '192.0.2.0', 24,
+        from the given sources. If less_specific is set, the origins of
+        routes for all less specific prefixes are included as well.
+
+        Returns a list of origins, ordered by prefix from least specific
+        to most specific, and then by AS number. An origin is included
+        once for each source that has a route for it.
+        This call will block until the preload store is loaded.
         """
-        while not self._redis_conn.exists(REDIS_ORIGIN_ROUTE4_STORE_KEY):
-            time.sleep(1)  # pragma: no cover
+        snapshot = self._wait_for_snapshot()
+        address_length = ADDRESS_LENGTH[ip_version]
+        network = int.from_bytes(socket.inet_pton(PACKED_PREFIX_FAMILY[ip_version], address), 'big')
+        sources_set = set(sources)
 
-        # Create a bit of randomness in when workers will update
-        time.sleep(random.random())
+        origins = []
+        lengths = range(prefix_length + 1) if less_specific else [prefix_length]
+        for length in lengths:
+            host_bits = address_length - length
+            masked_network = (network >> host_bits) << host_bits
+            packed_prefix = masked_network.to_bytes(address_length // 8, 'big') + bytes([length])
+            keys = snapshot.get(SNAPSHOT_PREFIX_ORIGINS_TABLES[ip_version], packed_prefix)
+            if not keys:
+                continue
+            origins_for_length = []
+            for key in keys.decode('utf-8').split(' '):
+                source, origin = key.rsplit(REDIS_KEY_ORIGIN_SOURCE_SEPARATOR, 1)
+                if source in sources_set:
+                    origins_for_length.append(origin)
+            origins += sorted(origins_for_length, key=lambda origin: int(origin[2:]))
+        return origins
 
-        self._origin_route4_store = dict()
-        self._origin_route6_store = dict()
+    def prefix_index_available(self) -> bool:
+        """
+        Determine whether the prefix to origins index is loaded, i.e.
+        whether origins_for_prefix() can be used. Does not block.
+        """
+        snapshot = self._snapshot
+        return snapshot is not None and snapshot.has_table(SNAPSHOT_PREFIX_ORIGINS_TABLES[4])
 
-        def _load(redis_key, target):
-            for key, routes in self._redis_conn.hgetall(redis_key).items():
-                if key == SENTINEL_HASH_CREATED:
-                    continue
-                source, origin = key.decode('ascii').split(REDIS_KEY_ORIGIN_SOURCE_SEPARATOR)
-                if source not in target:
-                    target[source] = dict()
-                target[source][origin] = routes.decode('ascii')
+    def set_store_available(self) -> bool:
+        """
+        Determine whether the set store is loaded, i.e. whether
+        sets() can be used. Does not block.
+        """
+        return self._snapshot is not None
+
+    def sets(self, set_name: str) -> Dict[str, PreloadedSet]:
+        """
+        Retrieve all as-sets and route-sets named set_name,
+        as a dict with sources as keys and PreloadedSet lists as values.
+        Set names are case insensitive.
+        This call will block until the preload store is loaded.
+        """
+        snapshot = self._wait_for_snapshot()
+        serialised_sets = snapshot.get(SNAPSHOT_SET_TABLE, set_name.upper().encode('utf-8'))
+        if not serialised_sets:
+            return {}
+        return ujson.loads(serialised_sets)
+
+    def generation(self) -> Optional[int]:
+        """
+        The generation of the currently attached snapshot, or None if no
+        snapshot is attached yet. Every update of the store increases
+        the generation.
+        """
+        snapshot = self._snapshot
+        return snapshot.generation if snapshot else None
+
+    def _wait_for_snapshot(self) -> OverlaySnapshot:
+        """
+        Return the current snapshot, blocking until the
+        first snapshot has been attached.
+        """
+        with self._snapshot_attached:
+            self._snapshot_attached.wait_for(lambda: self._snapshot is not None)
+            return self._snapshot  # type: ignore
+
+    def _load_routes_into_memory(self, redis_message=None):
+        """
+        Attach the latest snapshot of the store. This is called whenever a
+        message is sent to REDIS_PRELOAD_COMPLETE_CHANNEL, which contains
+        the generation of the new snapshot, and without a message after
+        subscribing to the channel.
+
+        The snapshot is memory mapped, and therefore shared with all
+        other processes. The previous snapshot is not closed, as queries
+        may still be using it - it is released once no longer referenced.
+        If there is a delta snapshot for the current base snapshot, only
+        the delta is attached. If the delta and base snapshot do not match,
+        because a new base snapshot is being published, only the base
+        snapshot is attached, until the next message.
+        Cached set expansions affected by the changes in the snapshot
+        are invalidated. Any queries waiting for the first snapshot
+        are woken up immediately.
+        """
+        # Generations are not compared by order, as they restart
+        # if the redis data is lost.
+        current_generation = self.generation()
+        if redis_message:
+            if int(redis_message['data']) == current_generation:
+                return
+        elif not os.path.exists(preload_snapshot_path()):
+            return
+
+        try:
+            delta: Optional[PreloadSnapshot] = PreloadSnapshot(preload_delta_snapshot_path())
+        except FileNotFoundError:
+            delta = None
+        base = self._snapshot.base if self._snapshot else None
+        if delta is None or base is None or self._delta_base_generation(delta) != base.generation:
+            new_base = PreloadSnapshot(preload_snapshot_path())
+            if base is None or new_base.generation != base.generation:
+                base = new_base
+            else:
+                new_base.close()
+            if delta is not None and self._delta_base_generation(delta) != base.generation:
+                delta.close()
+                delta = None
+
+        snapshot = OverlaySnapshot(base, delta)
+        if snapshot.generation == current_generation:
+            if delta is not None:
+                delta.close()
+            return
+        newest_snapshot = delta if delta is not None else base
+        changed_dependencies = None
+        if newest_snapshot.has_table(SNAPSHOT_CHANGES_TABLE):
+            changed_dependencies = [key.decode('utf-8') for key in newest_snapshot.keys(SNAPSHOT_CHANGES_TABLE)]
 
-        _load(REDIS_ORIGIN_ROUTE4_STORE_KEY, self._origin_route4_store)
-        _load(REDIS_ORIGIN_ROUTE6_STORE_KEY, self._origin_route6_store)
+        with self._snapshot_attached:
+            self._snapshot = snapshot
+            self.set_expansion_cache.snapshot_attached(snapshot.generation, changed_dependencies)
+            self._snapshot_attached.notify_all()
+        logger.debug(f'Attached preload snapshot generation {snapshot.generation}')
 
-        self._memory_loaded = True
+    def _delta_base_generation(self, delta: PreloadSnapshot) -> Optional[int]:
+        """
+        The generation of the base snapshot to which a delta snapshot applies.
+        """
+        base_generation = delta.get(SNAPSHOT_DELTA_BASE_TABLE, b'generation')
+        return int(base_generation) if base_generation else None
 
 
 class PreloadStoreManager(ExceptionLoggingProcess):
@@ -174,13 +563,36 @@ class PreloadStoreManager(ExceptionLoggingProcess):
         super().__init__(*args, **kwargs)
         self._target = self.main
         self._redis_conn = redis.Redis.from_url(get_setting('redis_url'))
+        # Names of the sets to which objects add a member through mbrs-by-ref,
+        # keyed by source and primary key of the object, used to determine
+        # which sets are affected by changes.
+        self._set_referring_objects: Dict[Tuple[str, str], Set[str]] = dict()
+        # Time of the oldest commit included in the update in progress, if any
+        self._claimed_commit_timestamp: Optional[float] = None
+        self._coalesced_reloads = 0
+        # Set from the main loop, and cleared by the updater thread that claims it
+        self._full_reload_required = threading.Event()
+        # Highest sequence number of changes included in the store
+        self._applied_sequence = 0
+        # Tables of the current snapshot, patched by incremental updates,
+        # or None if these need to be read from redis
+        self._snapshot_tables: Optional[Dict[str, Dict[bytes, bytes]]] = None
+        # Entries changed since the base snapshot was written, for the delta
+        # snapshot, with empty values for removed entries
+        self._delta_tables: Dict[str, Dict[bytes, bytes]] = {}
+        # Generation of the current base snapshot, if any
+        self._base_generation: Optional[int] = None
+        # Number of origins and prefixes per IP version and source
+        self._store_size: Dict[str, int] = defaultdict(int)
 
     def main(self):
         """
         Main function for the preload manager.
 
         Monitors a Redis pubsub channel, and triggers a reload when
-        a message is received.
+        a message is received. Depending on the message, this is
+        either a full reload, or an incremental update. Full reloads
+        are also done every FULL_RELOAD_INTERVAL seconds.
         """
         setproctitle('irrd-preload-store-manager')
         try:
@@ -196,18 +608,23 @@ class PreloadStoreManager(ExceptionLoggingProcess):
 
         self._reload_lock = threading.Lock()
         self._threads = []
+        self._full_reload_required.set()
+        self._last_full_reload = time.monotonic()
         self.terminate = False  # Used to exit main() in tests
 
         while not self.terminate:
             self.perform_reload()
             try:
                 self._pubsub.subscribe(REDIS_PRELOAD_RELOAD_CHANNEL)
-                for item in self._pubsub.listen():
-                    if item['type'] == 'message':
-                        logger.debug('Reload requested through redis channel')
+                while not self.terminate:
+                    item = self._pubsub.get_message(ignore_subscribe_messages=True, timeout=5)
+                    if item and item['type'] == 'message':
+                        full_reload = item['data'] != REDIS_PRELOAD_UPDATE_MESSAGE
+                        logger.debug(f'Reload requested through redis channel, full reload: {full_reload}')
+                        self.perform_reload(full_reload=full_reload)
+                    if time.monotonic() - self._last_full_reload > FULL_RELOAD_INTERVAL:
+                        logger.debug('Performing periodic full reload')
                         self.perform_reload()
-                        if self.terminate:
-                            return
             except redis.ConnectionError as rce:  # pragma: no cover
                 logger.error(f'Failed redis pubsub connection, attempting reconnect and reload in 5s: {rce}')
                 time.sleep(5)
@@ -217,13 +634,23 @@ class PreloadStoreManager(ExceptionLoggingProcess):
         Clear the existing data. This is done on startup, to ensure no
         queries are being answered with outdated data.
         """
+        self._snapshot_tables = None
+        self._base_generation = None
         try:
-            self._redis_conn.delete(REDIS_ORIGIN_ROUTE4_STORE_KEY, REDIS_ORIGIN_ROUTE6_STORE_KEY)
+            self._redis_conn.delete(REDIS_STORE_POINTER_KEY, REDIS_PRELOAD_METRICS_KEY, REDIS_PRELOAD_STORE_SIZE_KEY)
+            for store_key in [REDIS_ORIGIN_ROUTE4_STORE_KEY, REDIS_ORIGIN_ROUTE6_STORE_KEY, REDIS_SET_STORE_KEY]:
+                for versioned_key in self._redis_conn.scan_iter(match=store_key + b'-*', count=REDIS_CHUNK_SIZE):
+                    self._delete_hash(versioned_key)
         except redis.ConnectionError as rce:  # pragma: no cover
             logger.error(f'Failed to empty preload store due to redis connection error, '
                          f'queries may have outdated results until full reload is completed (max 30s): {rce}')
+        for path in [preload_delta_snapshot_path(), preload_snapshot_path()]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
 
-    def perform_reload(self) -> None:
+    def perform_reload(self, full_reload=True) -> None:
         """
         Perform a (re)load.
         Should be called after changes to the DB have been committed.
@@ -235,36 +662,44 @@ class PreloadStoreManager(ExceptionLoggingProcess):
         If a current thread is running, and a next thread is already
         running as well (waiting for a lock) no action is taken. The
         change that prompted this reload call will already be processed
-        by the thread that is currently waiting.
+        by the thread that is currently waiting. This is counted as
+        a coalesced reload in the preload metrics.
+
+        If full_reload is False, the thread will only apply the pending
+        changes, unless a full reload was also requested before
+        the thread started its update.
         """
+        if full_reload:
+            self._full_reload_required.set()
+            self._last_full_reload = time.monotonic()
         self._remove_dead_threads()
         if len(self._threads) > 1:
             # Another thread is already scheduled to follow the current one
+            self._coalesced_reloads += 1
             return
         thread = PreloadUpdater(self, self._reload_lock)
         thread.start()
         self._threads.append(thread)
 
-    def update_route_store(self, new_origin_route4_store, new_origin_route6_store) -> bool:
+    def update_store(self, new_origin_route4_store, new_origin_route6_store,
+                     new_set_store, new_set_referring_objects) -> bool:
         """
-        Store the new route information in redis. Returns True on success, False on failure.
+        Store the new route and set information in redis.
+        Returns True on success, False on failure.
         """
         try:
-            pipeline = self._redis_conn.pipeline(transaction=True)
-            pipeline.delete(REDIS_ORIGIN_ROUTE4_STORE_KEY, REDIS_ORIGIN_ROUTE6_STORE_KEY)
-            # The redis store can't store sets, only strings
-            origin_route4_str_dict = {k: REDIS_ORIGIN_LIST_SEPARATOR.join(v) for k, v in new_origin_route4_store.items()}
-            origin_route6_str_dict = {k: REDIS_ORIGIN_LIST_SEPARATOR.join(v) for k, v in new_origin_route6_store.items()}
-            # Redis can't handle empty dicts, but the dict needs to be present
-            # in order not to block queries.
-            origin_route4_str_dict[SENTINEL_HASH_CREATED] = '1'
-            origin_route6_str_dict[SENTINEL_HASH_CREATED] = '1'
-            # hmset causes a deprecation warning, but is required for Redis 3 compatibility
-            pipeline.hmset(REDIS_ORIGIN_ROUTE4_STORE_KEY, origin_route4_str_dict)
-            pipeline.hmset(REDIS_ORIGIN_ROUTE6_STORE_KEY, origin_route6_str_dict)
-            pipeline.execute()
-
-            self._redis_conn.publish(REDIS_PRELOAD_COMPLETE_CHANNEL, 'complete')
+            # The redis store can't store sets, only strings, so the packed prefixes are concatenated
+            origin_route4_store = {k.encode('utf-8'): b''.join(sorted(v)) for k, v in new_origin_route4_store.items()}
+            origin_route6_store = {k.encode('utf-8'): b''.join(sorted(v)) for k, v in new_origin_route6_store.items()}
+            self._replace_stores({
+                REDIS_ORIGIN_ROUTE4_STORE_KEY: origin_route4_store,
+                REDIS_ORIGIN_ROUTE6_STORE_KEY: origin_route6_store,
+                REDIS_SET_STORE_KEY: new_set_store,
+            })
+            self._set_referring_objects = new_set_referring_objects
+            self._set_snapshot_tables(self._build_snapshot_tables(origin_route4_store, origin_route6_store,
+                                                                  new_set_store))
+            self._publish_snapshot()
             return True
 
         except redis.ConnectionError as rce:  # pragma: no cover
@@ -274,6 +709,449 @@ class PreloadStoreManager(ExceptionLoggingProcess):
             self.perform_reload()
             return False
 
+    def claim_full_reload(self) -> bool:
+        """
+        Determine whether the next update should be a full reload, and if so,
+        reset the flag. Any pending route changes are discarded in that case,
+        as the full reload will include them. This must be called before the
+        full reload queries the database, so that no changes are missed.
+
+        Changes with a sequence number claimed before this point may be
+        committed after the full reload queried the database. If these are
+        signalled later, they trigger another full reload, as they can not
+        be applied in order anymore.
+        """
+        if not self._full_reload_required.is_set():
+            return False
+        self._full_reload_required.clear()
+        try:
+            pipeline = self._redis_conn.pipeline(transaction=True)
+            pipeline.delete(REDIS_PRELOAD_CHANGES_KEY)
+            pipeline.get(REDIS_PRELOAD_SEQUENCE_KEY)
+            pipeline.hget(REDIS_PRELOAD_METRICS_KEY, 'pending_commit_timestamp')
+            pipeline.hdel(REDIS_PRELOAD_METRICS_KEY, 'pending_commit_timestamp')
+            _, sequence, pending_commit_timestamp, _ = pipeline.execute()
+            self._applied_sequence = int(sequence or 0)
+            self._claim_commit_timestamp(pending_commit_timestamp)
+        except redis.ConnectionError as rce:  # pragma: no cover
+            logger.error(f'Failed to discard pending preload changes due to redis connection error, '
+                         f'these will be re-applied after the full reload: {rce}')
+        return True
+
+    def claim_pending_changes(self) -> Tuple[List[PreloadRouteChange], List[PreloadSetChange]]:
+        """
+        Retrieve and remove all pending changes, recorded by Preloader.signal_reload(),
+        in the order in which they were committed.
+        Returns a tuple of the route changes and the set changes.
+
+        If any change is older than changes already included in the store,
+        it may undo a newer change, so a full reload is scheduled instead,
+        and no changes are returned.
+        """
+        pipeline = self._redis_conn.pipeline(transaction=True)
+        pipeline.lrange(REDIS_PRELOAD_CHANGES_KEY, 0, -1)
+        pipeline.delete(REDIS_PRELOAD_CHANGES_KEY)
+        pipeline.hget(REDIS_PRELOAD_METRICS_KEY, 'pending_commit_timestamp')
+        pipeline.hdel(REDIS_PRELOAD_METRICS_KEY, 'pending_commit_timestamp')
+        serialised_changes, _, pending_commit_timestamp, _ = pipeline.execute()
+        self._claim_commit_timestamp(pending_commit_timestamp)
+
+        all_changes = sorted((ujson.loads(serialised_change) for serialised_change in serialised_changes),
+                             key=lambda changes: changes['sequence'])
+        if all_changes and all_changes[0]['sequence'] <= self._applied_sequence:
+            logger.info('Received preload store changes out of commit order, performing full reload instead')
+            self.perform_reload()
+            return [], []
+
+        route_changes: List[PreloadRouteChange] = []
+        set_changes: List[PreloadSetChange] = []
+        for changes in all_changes:
+            self._applied_sequence = changes['sequence']
+            route_changes += [tuple(change) for change in changes['routes']]  # type: ignore
+            set_changes += [tuple(change) for change in changes['sets']]  # type: ignore
+        return route_changes, set_changes
+
+    def changed_set_names(self, set_changes: List[PreloadSetChange]) -> Set[str]:
+        """
+        Determine the names of the sets in the set store that are affected by
+        a set of changes, and need to be reloaded. These are any changed
+        as-set or route-set, any set in the member-of attribute of a changed
+        object, and any set to which a changed object currently adds
+        a member through mbrs-by-ref.
+        """
+        set_names: Set[str] = set()
+        for source, object_class, rpsl_pk, member_of in set_changes:
+            if object_class in ['as-set', 'route-set']:
+                set_names.add(rpsl_pk.upper())
+            set_names.update(set_name.upper() for set_name in member_of)
+            set_names.update(self._set_referring_objects.get((source, rpsl_pk), set()))
+        return set_names
+
+    def apply_changes(self, route_changes: List[PreloadRouteChange],
+                      set_names: Optional[Set[str]]=None,
+                      new_sets: Optional[Dict[bytes, bytes]]=None,
+                      new_set_referring_objects: Optional[Dict[Tuple[str, str], Set[str]]]=None) -> bool:
+        """
+        Apply route changes to the route information in redis, and replace
+        the sets in set_names in the set store. new_sets contains the sets
+        that still exist, keyed by set name, and new_set_referring_objects
+        the objects that add members to them through mbrs-by-ref.
+        Returns True on success, False on failure.
+
+        Route changes are applied in order, i.e. a later change to the same
+        prefix/origin/source overrides an earlier change.
+        Only the changed keys are patched in the tables of the snapshot.
+        """
+        try:
+            redis_keys = {
+                4: self._current_store_key(REDIS_ORIGIN_ROUTE4_STORE_KEY),
+                6: self._current_store_key(REDIS_ORIGIN_ROUTE6_STORE_KEY),
+            }
+            set_store_key = self._current_store_key(REDIS_SET_STORE_KEY)
+            if None in redis_keys.values() or set_store_key is None:
+                # The store is missing in redis, e.g. because redis was restarted
+                logger.info('Preload store not found in redis, performing full reload instead of applying changes')
+                self.perform_reload()
+                return False
+            if self._snapshot_tables is None:
+                self._set_snapshot_tables(self._build_snapshot_tables(
+                    self._read_hash(redis_keys[4]),
+                    self._read_hash(redis_keys[6]),
+                    self._read_hash(set_store_key),
+                ))
+
+            changed_dependencies: Set[str] = set()
+            changes_per_ip_version: Dict[int, Dict[str, Dict[bytes, bool]]] = {
+                4: defaultdict(dict),
+                6: defaultdict(dict),
+            }
+            for ip_version, source, origin, prefix, visible in route_changes:
+                changed_dependencies.add(origin_dependency(origin))
+                key = source + REDIS_KEY_ORIGIN_SOURCE_SEPARATOR + origin
+                address, length = prefix.split('/')
+                changes_per_ip_version[ip_version][key][pack_prefix(ip_version, address, int(length))] = visible
+
+            for ip_version, changes in changes_per_ip_version.items():
+                if not changes:
+                    continue
+                redis_key: bytes = redis_keys[ip_version]  # type: ignore
+                keys = list(changes.keys())
+                current_values = []
+                for chunk_start in range(0, len(keys), REDIS_CHUNK_SIZE):
+                    current_values += self._redis_conn.hmget(redis_key, keys[chunk_start:chunk_start + REDIS_CHUNK_SIZE])
+
+                new_values = dict()
+                removed_keys = []
+                for key, current_value in zip(keys, current_values):
+                    prefixes = set(split_packed_prefixes(ip_version, current_value)) if current_value else set()
+                    for packed_prefix, visible in changes[key].items():
+                        if visible:
+                            prefixes.add(packed_prefix)
+                        else:
+                            prefixes.discard(packed_prefix)
+                    if prefixes:
+                        new_values[key] = b''.join(sorted(prefixes))
+                    else:
+                        removed_keys.append(key)
+
+                self._write_hash(redis_key, new_values)
+                for chunk_start in range(0, len(removed_keys), REDIS_CHUNK_SIZE):
+                    self._redis_conn.hdel(redis_key, *removed_keys[chunk_start:chunk_start + REDIS_CHUNK_SIZE])
+
+                for key, new_value in new_values.items():
+                    self._patch_origin_table(ip_version, key.encode('utf-8'), new_value)
+                for key in removed_keys:
+                    self._patch_origin_table(ip_version, key.encode('utf-8'), None)
+
+            if set_names:
+                self._apply_set_changes(set_store_key, set_names, new_sets or {}, new_set_referring_objects or {},
+                                        changed_dependencies)
+
+            self._publish_snapshot(changed_dependencies)
+            return True
+
+        except redis.ConnectionError as rce:  # pragma: no cover
+            logger.error(f'Failed to apply changes to preload store due to redis connection error, '
+                         f'attempting new full reload in 5s: {rce}')
+            time.sleep(5)
+            self.perform_reload()
+            return False
+
+    def _apply_set_changes(self, set_store_key: bytes, set_names: Set[str], new_sets: Dict[bytes, bytes],
+                           new_set_referring_objects: Dict[Tuple[str, str], Set[str]],
+                           changed_dependencies: Set[str]) -> None:
+        """
+        Replace the sets in set_names in the set store in redis, and in the
+        snapshot tables, with their new versions from new_sets. Sets not in
+        new_sets are removed. The referring objects of these sets are
+        replaced as well. Any set that changed is added to changed_dependencies.
+        """
+        set_table = self._snapshot_tables[SNAPSHOT_SET_TABLE]  # type: ignore
+        removed_keys = []
+        for set_name in set_names:
+            key = set_name.encode('utf-8')
+            new_value = new_sets.get(key)
+            if set_table.get(key) != new_value:
+                changed_dependencies.add(set_dependency(set_name))
+                self._set_snapshot_entry(SNAPSHOT_SET_TABLE, key, new_value)
+            if new_value is None:
+                removed_keys.append(key)
+
+        self._write_hash(set_store_key, new_sets)
+        for chunk_start in range(0, len(removed_keys), REDIS_CHUNK_SIZE):
+            self._redis_conn.hdel(set_store_key, *removed_keys[chunk_start:chunk_start + REDIS_CHUNK_SIZE])
+
+        for referring_object in list(self._set_referring_objects.keys()):
+            referred_set_names = self._set_referring_objects[referring_object] - set_names
+            if referred_set_names:
+                self._set_referring_objects[referring_object] = referred_set_names
+            else:
+                del self._set_referring_objects[referring_object]
+        for referring_object, referred_set_names in new_set_referring_objects.items():
+            self._set_referring_objects.setdefault(referring_object, set()).update(referred_set_names)
+
+    def _publish_snapshot(self, changed_dependencies: Optional[Set[str]]=None) -> None:
+        """
+        Write a new snapshot of the store from the current snapshot tables,
+        and notify all preloaders that it is available.
+        The snapshot is written once, and then shared by all processes
+        answering queries, rather than each of them retrieving the store.
+
+        For incremental updates, changed_dependencies are the sets and
+        origins that changed since the previous snapshot, which are included
+        in the snapshot to invalidate cached set expansions.
+
+        Snapshots are never modified in place, so that processes can use them
+        without locking. For incremental updates, only a delta snapshot is
+        written, with the entries changed since the base snapshot, so that
+        the cost depends on the number of changes, not the size of the store.
+        A new base snapshot is written for full reloads, and once the delta
+        has more than PRELOAD_DELTA_MAX_ENTRIES entries, after which the
+        delta is removed. The time taken is recorded in the metrics as
+        snapshot_duration_last.
+        """
+        generation = self._redis_conn.incr(REDIS_PRELOAD_GENERATION_KEY)
+        delta_entries = sum(len(table) for table in self._delta_tables.values())
+        write_base = any([
+            changed_dependencies is None,
+            self._base_generation is None,
+            delta_entries > PRELOAD_DELTA_MAX_ENTRIES,
+        ])
+        tables: Dict[str, Dict[bytes, bytes]] = dict(self._snapshot_tables or {}) if write_base else dict(self._delta_tables)
+        if changed_dependencies is not None:
+            tables[SNAPSHOT_CHANGES_TABLE] = {dependency.encode('utf-8'): b'' for dependency in changed_dependencies}
+
+        write_start_time = time.perf_counter()
+        if write_base:
+            write_snapshot(preload_snapshot_path(), generation, tables)
+            try:
+                os.unlink(preload_delta_snapshot_path())
+            except FileNotFoundError:
+                pass
+            self._base_generation = generation
+            self._delta_tables = {}
+            delta_entries = 0
+        else:
+            tables[SNAPSHOT_DELTA_BASE_TABLE] = {b'generation': str(self._base_generation).encode('ascii')}
+            write_snapshot(preload_delta_snapshot_path(), generation, tables)
+        snapshot_duration = time.perf_counter() - write_start_time
+        snapshot_type = 'base' if write_base else 'delta'
+        logger.debug(f'Wrote preload {snapshot_type} snapshot generation {generation} in {snapshot_duration:.3f}s')
+
+        store_size = {key: value for key, value in self._store_size.items() if value}
+        snapshot_timestamp = time.time()
+        metrics: Dict[str, Union[int, float]] = {
+            'generation': generation,
+            'snapshot_timestamp': snapshot_timestamp,
+            'snapshot_duration_last': snapshot_duration,
+            'snapshot_delta_entries': delta_entries,
+            'sets': len((self._snapshot_tables or {}).get(SNAPSHOT_SET_TABLE, {})),
+        }
+        if self._claimed_commit_timestamp is not None:
+            metrics['commit_delay_last'] = snapshot_timestamp - self._claimed_commit_timestamp
+            self._claimed_commit_timestamp = None
+
+        pipeline = self._redis_conn.pipeline(transaction=True)
+        pipeline.delete(REDIS_PRELOAD_STORE_SIZE_KEY)
+        if store_size:
+            pipeline.hmset(REDIS_PRELOAD_STORE_SIZE_KEY, store_size)
+        pipeline.hmset(REDIS_PRELOAD_METRICS_KEY, metrics)
+        pipeline.hdel(REDIS_PRELOAD_METRICS_KEY, 'claimed_commit_timestamp')
+        pipeline.publish(REDIS_PRELOAD_COMPLETE_CHANNEL, str(generation))
+        pipeline.execute()
+
+    def _build_snapshot_tables(self, origin_route4_store: Dict[bytes, bytes], origin_route6_store: Dict[bytes, bytes],
+                               set_store: Dict[bytes, bytes]) -> Dict[str, Dict[bytes, bytes]]:
+        """
+        Build the tables of a snapshot from the contents of the stores,
+        including the index of origins per prefix.
+        """
+        tables = {
+            SNAPSHOT_ORIGIN_ROUTE4_TABLE: origin_route4_store,
+            SNAPSHOT_ORIGIN_ROUTE6_TABLE: origin_route6_store,
+            SNAPSHOT_SET_TABLE: set_store,
+        }
+        for ip_version, table_name in [(4, SNAPSHOT_ORIGIN_ROUTE4_TABLE), (6, SNAPSHOT_ORIGIN_ROUTE6_TABLE)]:
+            tables[SNAPSHOT_PREFIX_ORIGINS_TABLES[ip_version]] = self._build_prefix_index(ip_version, tables[table_name])
+        return tables
+
+    def _set_snapshot_tables(self, tables: Dict[str, Dict[bytes, bytes]]) -> None:
+        """
+        Replace all tables of the snapshot, which requires
+        the next snapshot to be written as a new base snapshot.
+        """
+        self._snapshot_tables = tables
+        self._delta_tables = {}
+        self._base_generation = None
+        self._store_size = defaultdict(int)
+        for ip_version, table_name in [(4, SNAPSHOT_ORIGIN_ROUTE4_TABLE), (6, SNAPSHOT_ORIGIN_ROUTE6_TABLE)]:
+            for key, packed_prefixes in tables[table_name].items():
+                source = key.decode('utf-8').rsplit(REDIS_KEY_ORIGIN_SOURCE_SEPARATOR, 1)[0]
+                self._store_size[f'origins:{ip_version}:{source}'] += 1
+                self._store_size[f'prefixes:{ip_version}:{source}'] += len(packed_prefixes) // PACKED_PREFIX_SIZE[ip_version]
+
+    def _set_snapshot_entry(self, table_name: str, key: bytes, value: Optional[bytes]) -> None:
+        """
+        Set an entry in a table of the snapshot, or remove it if value
+        is None, and record the change for the delta snapshot.
+        """
+        table = self._snapshot_tables[table_name]  # type: ignore
+        if value:
+            table[key] = value
+        else:
+            table.pop(key, None)
+        self._delta_tables.setdefault(table_name, {})[key] = value or b''
+
+    def _patch_origin_table(self, ip_version: int, key: bytes, new_value: Optional[bytes]) -> None:
+        """
+        Set the packed prefixes of a source/origin key in the origin-route
+        table of the snapshot, or remove the key if new_value is None,
+        and update the index of origins per prefix for the changed prefixes,
+        and the store size.
+        """
+        tables: Dict[str, Dict[bytes, bytes]] = self._snapshot_tables  # type: ignore
+        origin_table_name = SNAPSHOT_ORIGIN_ROUTE4_TABLE if ip_version == 4 else SNAPSHOT_ORIGIN_ROUTE6_TABLE
+        prefix_index_name = SNAPSHOT_PREFIX_ORIGINS_TABLES[ip_version]
+        prefix_index = tables[prefix_index_name]
+        current_prefixes = set(split_packed_prefixes(ip_version, tables[origin_table_name].get(key, b'')))
+        new_prefixes = set(split_packed_prefixes(ip_version, new_value or b''))
+        self._set_snapshot_entry(origin_table_name, key, new_value)
+
+        source = key.decode('utf-8').rsplit(REDIS_KEY_ORIGIN_SOURCE_SEPARATOR, 1)[0]
+        self._store_size[f'origins:{ip_version}:{source}'] += int(bool(new_prefixes)) - int(bool(current_prefixes))
+        self._store_size[f'prefixes:{ip_version}:{source}'] += len(new_prefixes) - len(current_prefixes)
+
+        for packed_prefix in current_prefixes - new_prefixes:
+            prefix_keys = [k for k in prefix_index.get(packed_prefix, b'').split(b' ') if k and k != key]
+            self._set_snapshot_entry(prefix_index_name, packed_prefix, b' '.join(prefix_keys) or None)
+        for packed_prefix in new_prefixes - current_prefixes:
+            prefix_keys = [k for k in prefix_index.get(packed_prefix, b'').split(b' ') if k]
+            self._set_snapshot_entry(prefix_index_name, packed_prefix, b' '.join(sorted(prefix_keys + [key])))
+
+    def _build_prefix_index(self, ip_version: int, origin_routes: Dict[bytes, bytes]) -> Dict[bytes, bytes]:
+        """
+        Build the index of origins per prefix, from the contents of an
+        origin-route store, i.e. packed prefixes per source/origin key.
+        """
+        index: Dict[bytes, List[bytes]] = defaultdict(list)
+        for key, packed_prefixes in origin_routes.items():
+            for packed_prefix in split_packed_prefixes(ip_version, packed_prefixes):
+                index[packed_prefix].append(key)
+        return {packed_prefix: b' '.join(sorted(keys)) for packed_prefix, keys in index.items()}
+
+    def record_update(self, full_reload: bool, duration: float) -> None:
+        """
+        Record the metrics of a completed update of the store, which
+        took duration seconds, along with the number of coalesced reloads.
+        """
+        update_type = 'full' if full_reload else 'incremental'
+        try:
+            pipeline = self._redis_conn.pipeline(transaction=True)
+            pipeline.hincrby(REDIS_PRELOAD_METRICS_KEY, f'updates_{update_type}', 1)
+            pipeline.hincrbyfloat(REDIS_PRELOAD_METRICS_KEY, f'duration_total_{update_type}', duration)
+            pipeline.hmset(REDIS_PRELOAD_METRICS_KEY, {
+                f'duration_last_{update_type}': duration,
+                'coalesced_reloads': self._coalesced_reloads,
+            })
+            pipeline.execute()
+        except redis.ConnectionError as rce:  # pragma: no cover
+            logger.error(f'Failed to record preload store metrics due to redis connection error: {rce}')
+
+    def _claim_commit_timestamp(self, pending_commit_timestamp: Optional[bytes]) -> None:
+        """
+        Record that the commits since pending_commit_timestamp are included
+        in the update in progress. If a previous update did not complete,
+        the timestamp of its oldest commit is kept.
+        """
+        if pending_commit_timestamp is None:
+            return
+        timestamp = float(pending_commit_timestamp)
+        if self._claimed_commit_timestamp is None or timestamp < self._claimed_commit_timestamp:
+            self._claimed_commit_timestamp = timestamp
+        self._redis_conn.hset(REDIS_PRELOAD_METRICS_KEY, 'claimed_commit_timestamp', self._claimed_commit_timestamp)
+
+    def _current_store_key(self, store_key: bytes) -> Optional[bytes]:
+        """
+        Get the versioned redis key where the current version
+        of a store is kept, or None if the store does not exist.
+        """
+        return self._redis_conn.hget(REDIS_STORE_POINTER_KEY, store_key)
+
+    def _replace_stores(self, new_stores: Dict[bytes, Dict[Any, bytes]]) -> None:
+        """
+        Replace the contents of one or more stores, keyed by store key.
+        The new contents are written under new versioned keys, in chunks, and
+        then all stores are switched over in a single atomic update of the
+        pointer hash. The previous versions are deleted afterwards, also
+        in chunks. This ensures no reader sees a partially written store,
+        and redis is never blocked by writing or deleting large hashes.
+        """
+        version = self._redis_conn.incr(REDIS_STORE_VERSION_KEY)
+        new_keys = {}
+        for store_key, contents in new_stores.items():
+            versioned_key = store_key + b'-%d' % version
+            self._write_hash(versioned_key, contents)
+            new_keys[store_key] = versioned_key
+
+        previous_keys = self._redis_conn.hmget(REDIS_STORE_POINTER_KEY, list(new_keys.keys()))
+        # hmset causes a deprecation warning, but is required for Redis 3 compatibility
+        self._redis_conn.hmset(REDIS_STORE_POINTER_KEY, new_keys)
+        for previous_key in previous_keys:
+            if previous_key:
+                self._delete_hash(previous_key)
+
+    def _write_hash(self, redis_key: bytes, contents: Dict[Any, bytes]) -> None:
+        """
+        Write contents to a hash in redis, in chunks of REDIS_CHUNK_SIZE.
+        """
+        items = list(contents.items())
+        for chunk_start in range(0, len(items), REDIS_CHUNK_SIZE):
+            self._redis_conn.hmset(redis_key, dict(items[chunk_start:chunk_start + REDIS_CHUNK_SIZE]))
+
+    def _read_hash(self, redis_key: Optional[bytes]) -> Dict[bytes, bytes]:
+        """
+        Read the contents of a hash from redis, in chunks of about REDIS_CHUNK_SIZE.
+        Returns an empty dict if redis_key is None or does not exist.
+        """
+        if not redis_key:
+            return {}
+        return dict(self._redis_conn.hscan_iter(redis_key, count=REDIS_CHUNK_SIZE))
+
+    def _delete_hash(self, redis_key: bytes) -> None:
+        """
+        Delete a hash from redis, removing its fields in chunks first,
+        as deleting a large hash at once blocks redis.
+        """
+        fields: List[bytes] = []
+        for field, _ in self._redis_conn.hscan_iter(redis_key, count=REDIS_CHUNK_SIZE):
+            fields.append(field)
+            if len(fields) >= REDIS_CHUNK_SIZE:
+                self._redis_conn.hdel(redis_key, *fields)
+                fields = []
+        if fields:
+            self._redis_conn.hdel(redis_key, *fields)
+        self._redis_conn.delete(redis_key)
+
     def _remove_dead_threads(self) -> None:
         """
         Remove dead threads from self.threads(),
@@ -287,8 +1165,9 @@ class PreloadStoreManager(ExceptionLoggingProcess):
 class PreloadUpdater(threading.Thread):
     """
     PreloadUpdater is a thread that updates the preload store,
-    currently for prefixes per origin per address family.
-    It is started by PreloadStoreManager.
+    currently for prefixes per origin per address family, and
+    as-sets/route-sets. It is started by PreloadStoreManager, and either
+    performs a full reload from the database, or applies pending changes.
     """
     def __init__(self, preloader, reload_lock, *args, **kwargs):
         self.preloader = preloader
@@ -320,38 +1199,141 @@ class PreloadUpdater(threading.Thread):
         """
         Update the store.
 
-        After loading the data from the database, sets the two new stores
-        on the provided preloader object.
+        If no full reload is required, only applies pending changes
+        to the store. Otherwise, after loading the data from the database,
+        sets the new stores on the provided preloader object.
         The lock is then released to allow another thread to start, and
         the store_ready_event set to indicate that the store has been
         loaded at least once, and answers can be provided based on it.
+        The duration of each completed update is recorded in the metrics.
         """
+        start_time = time.perf_counter()
+        if not self.preloader.claim_full_reload():
+            if self._update_incremental(mock_database_handler):
+                self.preloader.record_update(False, time.perf_counter() - start_time)
+            return
+
         logger.debug(f'Starting preload store update from thread {self}')
 
-        new_origin_route4_store: Dict[str, set] = defaultdict(set)
-        new_origin_route6_store: Dict[str, set] = defaultdict(set)
+        new_origin_route4_store: Dict[str, Set[bytes]] = defaultdict(set)
+        new_origin_route6_store: Dict[str, Set[bytes]] = defaultdict(set)
 
-        if not mock_database_handler:  # pragma: no cover
-            from .database_handler import DatabaseHandler
-            dh = DatabaseHandler(readonly=True)
-        else:
-            dh = mock_database_handler
+        dh = self._database_handler(mock_database_handler)
 
         q = RPSLDatabaseQuery(column_names=['ip_version', 'ip_first', 'prefix_length', 'asn_first', 'source'], enable_ordering=False)
         q = q.object_classes(['route', 'route6']).rpki_status([RPKIStatus.not_found, RPKIStatus.valid])
         q = q.scopefilter_status([ScopeFilterStatus.in_scope])
 
         for result in dh.execute_query(q):
-            prefix = result['ip_first']
             key = result['source'] + REDIS_KEY_ORIGIN_SOURCE_SEPARATOR + 'AS' + str(result['asn_first'])
-            length = result['prefix_length']
+            packed_prefix = pack_prefix(result['ip_version'], result['ip_first'], result['prefix_length'])
 
             if result['ip_version'] == 4:
-                new_origin_route4_store[key].add(f'{prefix}/{length}')
+                new_origin_route4_store[key].add(packed_prefix)
             if result['ip_version'] == 6:
-                new_origin_route6_store[key].add(f'{prefix}/{length}')
+                new_origin_route6_store[key].add(packed_prefix)
 
+        new_set_store, new_set_referring_objects = self._load_set_store(dh)
         dh.close()
 
-        if self.preloader.update_route_store(new_origin_route4_store, new_origin_route6_store):
+        if self.preloader.update_store(new_origin_route4_store, new_origin_route6_store,
+                                       new_set_store, new_set_referring_objects):
+            self.preloader.record_update(True, time.perf_counter() - start_time)
             logger.info(f'Completed updating preload store from thread {self}')
+
+    def _update_incremental(self, mock_database_handler=None) -> bool:
+        """
+        Apply the pending changes to the store. Route changes are applied
+        directly, but if any change affects sets in the set store, those
+        sets are reloaded from the database.
+        Returns True if changes were applied, False otherwise.
+        """
+        route_changes, set_changes = self.preloader.claim_pending_changes()
+        if not route_changes and not set_changes:
+            return False
+        logger.debug(f'Starting incremental preload store update from thread {self}')
+
+        new_sets = None
+        new_set_referring_objects = None
+        set_names = self.preloader.changed_set_names(set_changes)
+        if set_names:
+            dh = self._database_handler(mock_database_handler)
+            new_sets, new_set_referring_objects = self._load_set_store(dh, set_names)
+            dh.close()
+
+        if not self.preloader.apply_changes(route_changes, set_names, new_sets, new_set_referring_objects):
+            return False
+        logger.debug(f'Completed incremental preload store update from thread {self}')
+        return True
+
+    def _load_set_store(self, dh, set_names: Optional[Set[str]]=None
+                        ) -> Tuple[Dict[bytes, bytes], Dict[Tuple[str, str], Set[str]]]:
+        """
+        Load all as-sets and route-sets from the database, or only those in set_names,
+        including members added through mbrs-by-ref. Returns a tuple of a dict with
+        the serialised PreloadedSets per source, keyed by set name, and a dict with
+        the names of the sets to which objects add a member through mbrs-by-ref,
+        keyed by (source, rpsl_pk) of the object.
+        """
+        sets: Dict[str, Dict[str, PreloadedSet]] = defaultdict(dict)
+        # Sets with mbrs-by-ref, by name, with the PreloadedSet and the mbrs-by-ref maintainers
+        sets_with_mbrs_by_ref: Dict[str, List[Tuple[PreloadedSet, Set[str]]]] = defaultdict(list)
+
+        columns = ['rpsl_pk', 'source', 'object_class', 'parsed_data']
+        set_name_chunks: List[Optional[List[str]]] = [None]
+        if set_names is not None:
+            sorted_set_names = sorted(set_names)
+            set_name_chunks = [
+                sorted_set_names[chunk_start:chunk_start + SET_MEMBER_OF_QUERY_CHUNK_SIZE]
+                for chunk_start in range(0, len(sorted_set_names), SET_MEMBER_OF_QUERY_CHUNK_SIZE)
+            ]
+        for set_name_chunk in set_name_chunks:
+            q = RPSLDatabaseQuery(column_names=columns, enable_ordering=False)
+            q = q.object_classes(['as-set', 'route-set'])
+            if set_name_chunk is not None:
+                q = q.rpsl_pks(set_name_chunk)
+            for result in dh.execute_query(q):
+                object_data = result['parsed_data']
+                members = object_data.get('members', []) + object_data.get('mp-members', [])
+                preloaded_set = [result['object_class'], members, []]
+                sets[result['rpsl_pk']][result['source']] = preloaded_set
+
+                mbrs_by_ref = object_data.get('mbrs-by-ref')
+                if mbrs_by_ref:
+                    mbrs_by_ref_upper = {m.strip().upper() for m in mbrs_by_ref}
+                    sets_with_mbrs_by_ref[result['rpsl_pk']].append((preloaded_set, mbrs_by_ref_upper))
+
+        referring_objects: Dict[Tuple[str, str], Set[str]] = defaultdict(set)
+        set_names_with_mbrs_by_ref = list(sets_with_mbrs_by_ref.keys())
+        columns = ['rpsl_pk', 'source', 'object_class', 'parsed_data', 'rpki_status', 'scopefilter_status']
+        for chunk_start in range(0, len(set_names_with_mbrs_by_ref), SET_MEMBER_OF_QUERY_CHUNK_SIZE):
+            chunk = set_names_with_mbrs_by_ref[chunk_start:chunk_start + SET_MEMBER_OF_QUERY_CHUNK_SIZE]
+            q = RPSLDatabaseQuery(column_names=columns, enable_ordering=False)
+            q = q.object_classes(['route', 'route6', 'aut-num']).lookup_attrs_in(['member-of'], chunk)
+
+            for result in dh.execute_query(q):
+                object_class = result['object_class']
+                object_data = result['parsed_data']
+                mntners = {m.upper() for m in object_data.get('mnt-by', [])}
+                rpki_acceptable = result['rpki_status'] in [RPKIStatus.not_found, RPKIStatus.valid]
+                scope_acceptable = result['scopefilter_status'] == ScopeFilterStatus.in_scope
+                member_entry = [result['source'], object_data[object_class], rpki_acceptable, scope_acceptable]
+
+                for set_name in object_data.get('member-of', []):
+                    for preloaded_set, mbrs_by_ref in sets_with_mbrs_by_ref.get(set_name.upper(), []):
+                        # Per RFC 2622 5.3, route-sets can only include routes and as-sets only aut-nums
+                        set_member_class = ['route', 'route6'] if preloaded_set[0] == 'route-set' else ['aut-num']
+                        if object_class not in set_member_class:
+                            continue
+                        if 'ANY' in mbrs_by_ref or mntners.intersection(mbrs_by_ref):
+                            preloaded_set[2].append(member_entry)
+                            referring_objects[(result['source'], result['rpsl_pk'])].add(set_name.upper())
+
+        serialised_sets = {name.encode('utf-8'): ujson.dumps(sets_per_source).encode('utf-8') for name, sets_per_source in sets.items()}
+        return serialised_sets, dict(referring_objects)
+
+    def _database_handler(self, mock_database_handler=None):
+        if not mock_database_handler:  # pragma: no cover
+            from .database_handler import DatabaseHandler
+            return DatabaseHandler(readonly=True)
+        return mock_database_handler
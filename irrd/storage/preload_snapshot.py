@@ -0,0 +1,187 @@
+import mmap
+import os
+import struct
+import tempfile
+from typing import Dict, Iterator, Optional, Tuple
+
+"""
+Preload snapshots are read-only files containing the preloaded data,
+which are built once by the preload store manager, and then memory
+mapped by all processes that answer queries. This means all processes
+share the same copy of the data in memory, and that a new version can
+be attached by a process without retrieving and decoding the full store.
+
+A snapshot contains a number of named tables, each mapping bytes keys
+to bytes values. The file layout is:
+- a header with a magic string, the generation number, and the number of tables
+- for each table, its name, the offset of its index and its number of entries
+- for each table, an index of fixed size entries, sorted by key, with the
+  offsets and lengths of the key and value, followed by the actual keys
+  and values.
+Lookups are a binary search over the index of a table.
+
+Snapshots are never modified after being written. A new snapshot is written
+to a temporary file and then atomically moved into place, so that processes
+still using the previous snapshot are not affected.
+
+To avoid rewriting a large snapshot for every small change, a delta snapshot
+can be written, which only contains the entries changed since a base
+snapshot. An OverlaySnapshot combines both: entries in the delta take
+precedence, and an empty value in the delta means the entry was removed.
+"""
+
+SNAPSHOT_MAGIC = b'IRRDPRE1'
+HEADER_FORMAT = '<8sQI'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+TABLE_HEADER_FORMAT = '<32sQI'
+TABLE_HEADER_SIZE = struct.calcsize(TABLE_HEADER_FORMAT)
+INDEX_ENTRY_FORMAT = '<QIQI'
+INDEX_ENTRY_SIZE = struct.calcsize(INDEX_ENTRY_FORMAT)
+
+
+def write_snapshot(path: str, generation: int, tables: Dict[str, Dict[bytes, bytes]]) -> None:
+    """
+    Write a new snapshot with the given generation number and tables to path.
+    Table names are limited to 32 bytes.
+    The new snapshot replaces any existing file at path atomically.
+    """
+    table_headers = []
+    table_contents = []
+    position = HEADER_SIZE + len(tables) * TABLE_HEADER_SIZE
+
+    for table_name, table in tables.items():
+        keys = sorted(table.keys())
+        index_offset = position
+        data_offset = index_offset + len(keys) * INDEX_ENTRY_SIZE
+        index = bytearray()
+        data = []
+        for key in keys:
+            value = table[key]
+            index += struct.pack(INDEX_ENTRY_FORMAT, data_offset, len(key), data_offset + len(key), len(value))
+            data.append(key)
+            data.append(value)
+            data_offset += len(key) + len(value)
+        table_headers.append(struct.pack(TABLE_HEADER_FORMAT, table_name.encode('ascii'), index_offset, len(keys)))
+        table_contents.append((index, data))
+        position = data_offset
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.irrd-snapshot-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(struct.pack(HEADER_FORMAT, SNAPSHOT_MAGIC, generation, len(tables)))
+            for table_header in table_headers:
+                f.write(table_header)
+            for index, data in table_contents:
+                f.write(index)
+                f.writelines(data)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+
+
+class PreloadSnapshot:
+    """
+    A read-only, memory mapped preload snapshot.
+
+    The snapshot remains usable until close() is called or the object is
+    garbage collected, even if the file is replaced by a newer snapshot.
+    Raises FileNotFoundError if there is no snapshot at path, or ValueError
+    if the file is not a valid snapshot.
+    """
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mmap) < HEADER_SIZE:
+            raise ValueError(f'Invalid preload snapshot in {path}: file is truncated')
+        magic, self.generation, table_count = struct.unpack_from(HEADER_FORMAT, self._mmap, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f'Invalid preload snapshot in {path}: unknown file format')
+
+        self._tables: Dict[str, Tuple[int, int]] = {}
+        for table_idx in range(table_count):
+            table_name, index_offset, entry_count = struct.unpack_from(
+                TABLE_HEADER_FORMAT, self._mmap, HEADER_SIZE + table_idx * TABLE_HEADER_SIZE)
+            self._tables[table_name.rstrip(b'\x00').decode('ascii')] = (index_offset, entry_count)
+
+    def get(self, table_name: str, key: bytes) -> Optional[bytes]:
+        """
+        Retrieve the value for key from a table, or None if the
+        key or table does not exist.
+        """
+        try:
+            index_offset, entry_count = self._tables[table_name]
+        except KeyError:
+            return None
+
+        low, high = 0, entry_count
+        while low < high:
+            middle = (low + high) // 2
+            key_offset, key_length, value_offset, value_length = struct.unpack_from(
+                INDEX_ENTRY_FORMAT, self._mmap, index_offset + middle * INDEX_ENTRY_SIZE)
+            middle_key = self._mmap[key_offset:key_offset + key_length]
+            if middle_key < key:
+                low = middle + 1
+            elif middle_key > key:
+                high = middle
+            else:
+                return self._mmap[value_offset:value_offset + value_length]
+        return None
+
+    def has_table(self, table_name: str) -> bool:
+        """
+        Determine whether a table exists in the snapshot, even if it is empty.
+        """
+        return table_name in self._tables
+
+    def keys(self, table_name: str) -> Iterator[bytes]:
+        """
+        Iterate over all keys in a table, in sorted order.
+        Yields nothing if the table does not exist.
+        """
+        index_offset, entry_count = self._tables.get(table_name, (0, 0))
+        for entry_idx in range(entry_count):
+            key_offset, key_length, _, _ = struct.unpack_from(
+                INDEX_ENTRY_FORMAT, self._mmap, index_offset + entry_idx * INDEX_ENTRY_SIZE)
+            yield self._mmap[key_offset:key_offset + key_length]
+
+    def table_size(self, table_name: str) -> int:
+        """
+        Return the number of entries in a table, or 0 if it does not exist.
+        """
+        return self._tables.get(table_name, (0, 0))[1]
+
+    def close(self) -> None:
+        self._mmap.close()
+
+
+class OverlaySnapshot:
+    """
+    A base snapshot, with an optional delta snapshot containing the entries
+    changed since the base was written. The generation is that of the delta,
+    if any. Lookups check the delta first, in which an empty value means
+    the entry was removed.
+    """
+    def __init__(self, base: PreloadSnapshot, delta: Optional[PreloadSnapshot]=None) -> None:
+        self.base = base
+        self.delta = delta
+        self.generation = delta.generation if delta else base.generation
+
+    def get(self, table_name: str, key: bytes) -> Optional[bytes]:
+        """
+        Retrieve the value for key from a table, or None if the key
+        or table does not exist, or the key was removed in the delta.
+        """
+        if self.delta is not None:
+            value = self.delta.get(table_name, key)
+            if value is not None:
+                return value or None
+        return self.base.get(table_name, key)
+
+    def has_table(self, table_name: str) -> bool:
+        """
+        Determine whether a table exists in the base snapshot.
+        """
+        return self.base.has_table(table_name)
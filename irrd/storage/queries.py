@@ -1,8 +1,9 @@
 import logging
-from typing import List, Optional
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
 
 import sqlalchemy as sa
 from IPy import IP
+from sqlalchemy.dialects import postgresql as pg
 from sqlalchemy.sql import Select, ColumnCollection
 
 from irrd.rpki.status import RPKIStatus
@@ -16,19 +17,44 @@ logger = logging.getLogger(__name__)
 
 
 class BaseRPSLObjectDatabaseQuery:
-    statement: Select
+    """
+    Base for RPSL object query builders.
+
+    The SQLAlchemy statement is only built when it is first used. Every filter
+    records its shape, e.g. that it filters on sources, and its values, as
+    named parameters. Queries with the same shape produce the same SQL, so
+    DatabaseHandler can reuse a compiled statement for any query with the same
+    statement_cache_key(), with the values from statement_params(), without
+    building or compiling the statement again.
+    """
     table: sa.Table
     columns: ColumnCollection
 
     def __init__(self, ordered_by_sources=True, enable_ordering=True):
         self._query_frozen = False
+        self._finalised = False
         self._sources_list = []
+        self._source_params: List[str] = []
         self._ordered_by_sources = ordered_by_sources
         self._enable_ordering = enable_ordering
+        self._shape: List[Hashable] = [self.__class__.__name__, ordered_by_sources, enable_ordering]
+        self._params: Dict[str, Any] = {}
+        self._statement_builders: List[Callable[[Select], Select]] = []
+        self._statement: Optional[Select] = None
+
+    @property
+    def statement(self) -> Select:
+        if self._statement is None:
+            statement = self._initial_statement()
+            for builder in self._statement_builders:
+                statement = builder(statement)
+            self._statement = statement
+        return self._statement
 
     def pk(self, pk: str):
         """Filter on an exact object PK (UUID)."""
-        return self._filter(self.columns.pk == pk)
+        pk_param = self._add_param(pk)
+        return self._filter('pk', lambda: self.columns.pk == self._bindparam(pk_param))
 
     def rpsl_pk(self, rpsl_pk: str):
         """Filter on an exact RPSL PK (e.g. 192.0.2.0/24,AS65537)."""
@@ -36,8 +62,8 @@ class BaseRPSLObjectDatabaseQuery:
 
     def rpsl_pks(self, rpsl_pks: List[str]):
         """Filter on an exact RPSL PK (e.g. 192.0.2.0/24,AS65537) - will match any PK in the list."""
-        rpsl_pks = [p.upper().strip() for p in rpsl_pks]
-        return self._filter(self.columns.rpsl_pk.in_(rpsl_pks))
+        rpsl_pks_param = self._add_param([p.upper().strip() for p in rpsl_pks])
+        return self._filter('rpsl_pks', lambda: self.columns.rpsl_pk.in_(self._bindparam(rpsl_pks_param)))
 
     def sources(self, sources: List[str]):
         """
@@ -48,8 +74,11 @@ class BaseRPSLObjectDatabaseQuery:
         """
         sources = [s.upper().strip() for s in sources]
         self._sources_list = sources
-        fltr = self.columns.source.in_(self._sources_list)
-        return self._filter(fltr)
+        # Individual parameters for each source are used for ordering
+        self._source_params = [self._add_param(source) for source in sources]
+        sources_param = self._add_param(sources)
+        return self._filter(('sources', len(sources)),
+                            lambda: self.columns.source.in_(self._bindparam(sources_param)))
 
     def object_classes(self, object_classes: List[str]):
         """
@@ -58,12 +87,13 @@ class BaseRPSLObjectDatabaseQuery:
         Classes list must be an iterable. Will match objects from any
         of the mentioned classes.
         """
-        fltr = self.columns.object_class.in_(object_classes)
-        return self._filter(fltr)
+        object_classes_param = self._add_param(list(object_classes))
+        return self._filter('object_classes',
+                            lambda: self.columns.object_class.in_(self._bindparam(object_classes_param)))
 
     def first_only(self):
         """Only return the first match."""
-        self.statement = self.statement.limit(1)
+        self._add_statement_builder('first_only', lambda statement: statement.limit(1))
         return self
 
     def finalise_statement(self) -> Select:
@@ -74,31 +104,82 @@ class BaseRPSLObjectDatabaseQuery:
         each other - particularly statements that determine the sort order of
         the query, which depends on sources_list() and prioritise_source().
         """
+        self._finalise()
+        return self.statement
+
+    def statement_cache_key(self) -> Tuple[Hashable, ...]:
+        """
+        Return the shape of this query, which is equal for any two queries
+        that produce the same SQL, apart from the values of statement_params().
+        This finalises the query, without building the statement.
+        """
+        self._finalise()
+        return tuple(self._shape)
+
+    def _finalise(self) -> None:
+        if self._finalised:
+            return
         self._query_frozen = True
+        self._finalised = True
 
         if self._enable_ordering:
-            order_by = []
-            if 'ip_first' in self.columns:
-                order_by.append(self.columns.ip_first.asc())
-            if 'asn_first' in self.columns:
-                order_by.append(self.columns.asn_first.asc())
-            if 'rpsl_pk' in self.columns:
-                order_by.append(self.columns.rpsl_pk.asc())
-
-            if self._ordered_by_sources and self._sources_list:
-                case_elements = []
-                for idx, source in enumerate(self._sources_list):
-                    case_elements.append((self.columns.source == source, idx + 1))
-
-                criterion = sa.case(case_elements, else_=100000)
-                order_by.insert(0, criterion)
-
-            self.statement = self.statement.order_by(*order_by)
-        return self.statement
+            source_params = self._source_params if self._ordered_by_sources else []
 
-    def _filter(self, fltr):
+            def order_by(statement: Select) -> Select:
+                order_by = []
+                if 'ip_first' in self.columns:
+                    order_by.append(self.columns.ip_first.asc())
+                if 'asn_first' in self.columns:
+                    order_by.append(self.columns.asn_first.asc())
+                if 'rpsl_pk' in self.columns:
+                    order_by.append(self.columns.rpsl_pk.asc())
+
+                if source_params:
+                    case_elements = []
+                    for idx, source_param in enumerate(source_params):
+                        case_elements.append((self.columns.source == self._bindparam(source_param), idx + 1))
+
+                    criterion = sa.case(case_elements, else_=100000)
+                    order_by.insert(0, criterion)
+                return statement.order_by(*order_by)
+
+            self._add_statement_builder(('order_by', len(source_params)), order_by)
+
+    def statement_params(self) -> Dict[str, Any]:
+        """Return the values of the parameters of the statement, by name."""
+        return self._params
+
+    def _initial_statement(self) -> Select:
+        raise NotImplementedError  # pragma: no cover
+
+    def _add_param(self, value: Any) -> str:
+        """
+        Add a parameter with a value to the query, returning its name.
+        Parameters are named by their position, so queries of the same
+        shape have the same parameters.
+        """
+        name = f'query_param_{len(self._params)}'
+        self._params[name] = value
+        return name
+
+    def _bindparam(self, name: str) -> sa.sql.expression.BindParameter:
+        value = self._params[name]
+        return sa.bindparam(name, value, expanding=isinstance(value, list))
+
+    def _filter(self, shape: Hashable, fltr: Callable[[], Any]):
+        """
+        Add a filter to the statement. fltr is called when the statement is
+        built, and should return the filter expression, using _bindparam()
+        for all values that are not part of the shape of the query.
+        """
         self._check_query_frozen()
-        self.statement = self.statement.where(fltr)
+        return self._add_statement_builder(shape, lambda statement: statement.where(fltr()))
+
+    def _add_statement_builder(self, shape: Hashable, builder: Callable[[Select], Select]):
+        self._shape.append(shape)
+        self._statement_builders.append(builder)
+        if self._statement is not None:
+            self._statement = builder(self._statement)
         return self
 
     def _check_query_frozen(self) -> None:
@@ -124,7 +205,11 @@ class RPSLDatabaseQuery(BaseRPSLObjectDatabaseQuery):
 
     def __init__(self, column_names=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        if column_names is None:
+        self._column_names = column_names
+        self._shape.append(tuple(column_names) if column_names is not None else None)
+
+    def _initial_statement(self) -> Select:
+        if self._column_names is None:
             columns = [
                 self.columns.pk,
                 self.columns.object_class,
@@ -135,9 +220,8 @@ class RPSLDatabaseQuery(BaseRPSLObjectDatabaseQuery):
                 self.columns.rpki_status,
             ]
         else:
-            columns = [self.columns.get(name) for name in column_names]
-        self.statement = sa.select(columns)
-        self._lookup_attr_counter = 0
+            columns = [self.columns.get(name) for name in self._column_names]
+        return sa.select(columns)
 
     def lookup_attr(self, attr_name: str, attr_value: str):
         """
@@ -159,19 +243,19 @@ class RPSLDatabaseQuery(BaseRPSLObjectDatabaseQuery):
                 raise ValueError(f'Invalid lookup attribute: {attr_name}')
         self._check_query_frozen()
 
-        value_filters = []
-        statement_params = {}
-        for attr_name in attr_names:
-            for attr_value in attr_values:
-                counter = self._lookup_attr_counter
-                self._lookup_attr_counter += 1
-                value_filters.append(sa.text(f'parsed_data->:lookup_attr_name{counter} ? :lookup_attr_value{counter}'))
-                statement_params[f'lookup_attr_name{counter}'] = attr_name
-                statement_params[f'lookup_attr_value{counter}'] = attr_value.upper()
-        fltr = sa.or_(*value_filters)
-        self.statement = self.statement.where(fltr).params(**statement_params)
+        param_pairs = [
+            (self._add_param(attr_name), self._add_param(attr_value.upper()))
+            for attr_name in attr_names
+            for attr_value in attr_values
+        ]
 
-        return self
+        def fltr():
+            return sa.or_(*[
+                sa.text(f'parsed_data->:{name_param} ? :{value_param}').bindparams(
+                    self._bindparam(name_param), self._bindparam(value_param))
+                for name_param, value_param in param_pairs
+            ])
+        return self._filter(('lookup_attrs_in', len(param_pairs)), fltr)
 
     def ip_exact(self, ip: IP):
         """
@@ -180,47 +264,71 @@ class RPSLDatabaseQuery(BaseRPSLObjectDatabaseQuery):
         The provided ip should be an IPy.IP class, and can be a prefix or
         an address.
         """
-        fltr = sa.and_(
-            self.columns.ip_first == str(ip.net()),
-            self.columns.ip_last == str(ip.broadcast()),
-            self.columns.ip_version == ip.version()
-        )
-        return self._filter(fltr)
+        first, last, version = self._add_ip_params(ip)
+        return self._filter('ip_exact', lambda: sa.and_(
+            self.columns.ip_first == self._bindparam(first),
+            self.columns.ip_last == self._bindparam(last),
+            self.columns.ip_version == self._bindparam(version),
+        ))
 
     def ip_less_specific(self, ip: IP):
         """Filter any less specifics or exact matches of a prefix."""
-        fltr = sa.and_(
-            self.columns.ip_first <= str(ip.net()),
-            self.columns.ip_last >= str(ip.broadcast()),
-            self.columns.ip_version == ip.version()
-        )
-        return self._filter(fltr)
+        first, last, version = self._add_ip_params(ip)
+        return self._filter('ip_less_specific', lambda: sa.and_(
+            self._ip_less_specific_filter(first, last),
+            self.columns.ip_version == self._bindparam(version),
+        ))
 
-    def ip_less_specific_one_level(self, ip: IP):
+    def ip_less_specific_one_level(self, ip: IP, use_parent_links: bool=False):
         """
         Filter one level less specific of a prefix.
 
+        If use_parent_links is set, objects in an object class and source in
+        which an object with exactly this prefix exists, are only matched if
+        that object links to them as its parent. This avoids searching all
+        less specific objects, but the parent links do not take any other
+        filters into account, like those on RPKI or scope filter status.
+        The result is only equal if the query is restricted to a single
+        source, and has no such filters.
+
         Due to implementation details around filtering, this must
         always be the last call on a query object, or unpredictable
         results may occur.
         """
         self._check_query_frozen()
-        # One level less specific could still have multiple objects.
-        # A subquery determines the smallest possible size less specific object,
-        # and this is then used to filter for any objects with that size.
-        fltr = sa.and_(
-            self.columns.ip_first <= str(ip.net()),
-            self.columns.ip_last >= str(ip.broadcast()),
-            self.columns.ip_version == ip.version(),
-            sa.not_(sa.and_(self.columns.ip_first == str(ip.net()), self.columns.ip_last == str(ip.broadcast()))),
-        )
-        self.statement = self.statement.where(fltr)
-
-        size_subquery = self.statement.with_only_columns([self.columns.ip_size])
-        size_subquery = size_subquery.order_by(self.columns.ip_size.asc())
-        size_subquery = size_subquery.limit(1)
-
-        self.statement = self.statement.where(self.columns.ip_size.in_(size_subquery))
+        first, last, version = self._add_ip_params(ip)
+
+        def builder(statement: Select) -> Select:
+            # One level less specific could still have multiple objects.
+            # A subquery determines the smallest possible size less specific object,
+            # and this is then used to filter for any objects with that size.
+            fltr = sa.and_(
+                self._ip_less_specific_filter(first, last),
+                self.columns.ip_version == self._bindparam(version),
+                sa.not_(sa.and_(self.columns.ip_first == self._bindparam(first),
+                                self.columns.ip_last == self._bindparam(last))),
+            )
+            size_subquery = statement.where(fltr).with_only_columns([self.columns.ip_size])
+            size_subquery = size_subquery.order_by(self.columns.ip_size.asc())
+            size_subquery = size_subquery.limit(1)
+            fltr = sa.and_(fltr, self.columns.ip_size.in_(size_subquery))
+            if not use_parent_links:
+                return statement.where(fltr)
+
+            exact = self.table.alias('exact_in_class')
+            exact_in_class = sa.exists().where(sa.and_(
+                exact.c.object_class == self.columns.object_class,
+                exact.c.source == self.columns.source,
+                exact.c.ip_first == self._bindparam(first),
+                exact.c.ip_last == self._bindparam(last),
+                exact.c.ip_version == self._bindparam(version),
+            ))
+            return statement.where(sa.or_(
+                self._ip_parent_filter(first, last, version),
+                sa.and_(sa.not_(exact_in_class), fltr),
+            ))
+
+        self._add_statement_builder(('ip_less_specific_one_level', use_parent_links), builder)
         self._query_frozen = True
         return self
 
@@ -230,30 +338,78 @@ class RPSLDatabaseQuery(BaseRPSLObjectDatabaseQuery):
         Note that this only finds full more specifics: objects for which their
         IP range is fully encompassed by the ip parameter.
         """
-        fltr = sa.and_(
-            self.columns.ip_first >= str(ip.net()),
-            self.columns.ip_first <= str(ip.broadcast()),
-            self.columns.ip_last <= str(ip.broadcast()),
-            self.columns.ip_last >= str(ip.net()),
-            self.columns.ip_version == ip.version(),
-            sa.not_(sa.and_(self.columns.ip_first == str(ip.net()), self.columns.ip_last == str(ip.broadcast()))),
-        )
-        return self._filter(fltr)
+        first, last, version = self._add_ip_params(ip)
+        return self._filter('ip_more_specific', lambda: sa.and_(
+            self._ip_more_specific_filter(first, last),
+            self.columns.ip_version == self._bindparam(version),
+            sa.not_(sa.and_(self.columns.ip_first == self._bindparam(first),
+                            self.columns.ip_last == self._bindparam(last))),
+        ))
+
+    def ip_parent_of(self, ip: IP):
+        """
+        Filter on the immediate less specific objects of the objects with exactly
+        this prefix or address range, within their object class and source,
+        using the parent links kept in the database.
+
+        This only matches objects in object classes and sources in which
+        an object with exactly this prefix or address range exists.
+        """
+        first, last, version = self._add_ip_params(ip)
+        return self._filter('ip_parent_of', lambda: self._ip_parent_filter(first, last, version))
+
+    def ip_children_of(self, ip: IP):
+        """
+        Filter on the objects whose immediate less specific object, within
+        their object class and source, has exactly this prefix or address range.
+        """
+        first, last, version = self._add_ip_params(ip)
+        return self._filter('ip_children_of', lambda: sa.and_(
+            self.columns.parent_ip_first == self._bindparam(first),
+            self.columns.parent_ip_last == self._bindparam(last),
+            self.columns.ip_version == self._bindparam(version),
+        ))
+
+    def _ip_parent_filter(self, first: str, last: str, version: str):
+        """
+        Filter on the objects that the objects with exactly the range of the
+        parameters first and last link to as their parent.
+        """
+        exact = self.table.alias('exact')
+        parents = sa.select([
+            exact.c.object_class,
+            exact.c.source,
+            exact.c.parent_ip_first,
+            exact.c.parent_ip_last,
+        ]).where(sa.and_(
+            exact.c.ip_first == self._bindparam(first),
+            exact.c.ip_last == self._bindparam(last),
+            exact.c.ip_version == self._bindparam(version),
+        ))
+        return sa.tuple_(
+            self.columns.object_class,
+            self.columns.source,
+            self.columns.ip_first,
+            self.columns.ip_last,
+        ).in_(parents)
 
     def asn(self, asn: int):
         """
         Filter for exact matches on an ASN.
         """
-        fltr = sa.and_(self.columns.asn_first == asn, self.columns.asn_last == asn)
-        return self._filter(fltr)
+        asn_param = self._add_param(asn)
+        return self._filter('asn', lambda: sa.and_(
+            self.columns.asn_first == self._bindparam(asn_param),
+            self.columns.asn_last == self._bindparam(asn_param),
+        ))
 
     def asns_first(self, asns: List[int]):
         """
         Filter for asn_first being in a list of ASNs.
         This is useful when also restricting object class to 'route' for instance.
         """
-        fltr = self.columns.asn_first.in_(asns)
-        return self._filter(fltr)
+        asns_param = self._add_param(list(asns))
+        return self._filter('asns_first', lambda: self.columns.asn_first.in_(self._bindparam(asns_param)))
 
     def asn_less_specific(self, asn: int):
         """
@@ -262,22 +418,26 @@ class RPSLDatabaseQuery(BaseRPSLObjectDatabaseQuery):
         This will match all objects that refer to this ASN, or a block
         encompassing it - including route, route6, aut-num and as-block.
         """
-        fltr = sa.and_(self.columns.asn_first <= asn, self.columns.asn_last >= asn)
-        return self._filter(fltr)
+        asn_param = self._add_param(asn)
+        return self._filter('asn_less_specific', lambda: sa.and_(
+            self.columns.asn_first <= self._bindparam(asn_param),
+            self.columns.asn_last >= self._bindparam(asn_param),
+        ))
 
     def rpki_status(self, status: List[RPKIStatus]):
         """
         Filter for RPSL objects with a specific RPKI validation status.
         """
-        fltr = self.columns.rpki_status.in_(status)
-        return self._filter(fltr)
+        status_param = self._add_param(list(status))
+        return self._filter('rpki_status', lambda: self.columns.rpki_status.in_(self._bindparam(status_param)))
 
     def scopefilter_status(self, status: List[ScopeFilterStatus]):
         """
         Filter for RPSL objects with a specific scope filter status.
         """
-        fltr = self.columns.scopefilter_status.in_(status)
-        return self._filter(fltr)
+        status_param = self._add_param(list(status))
+        return self._filter('scopefilter_status',
+                            lambda: self.columns.scopefilter_status.in_(self._bindparam(status_param)))
 
     def text_search(self, value: str):
         """
@@ -305,23 +465,43 @@ class RPSLDatabaseQuery(BaseRPSLObjectDatabaseQuery):
         except ValueError:
             pass
 
-        counter = self._lookup_attr_counter
-        self._lookup_attr_counter += 1
-        fltr = sa.or_(
-            self.columns.rpsl_pk == value.upper(),
+        rpsl_pk_param = self._add_param(value.upper())
+        text_param = self._add_param('%' + value + '%')
+        return self._filter('text_search', lambda: sa.or_(
+            self.columns.rpsl_pk == self._bindparam(rpsl_pk_param),
             sa.and_(
                 self.columns.object_class == 'person',
-                sa.text(f"parsed_data->>'person' ILIKE :lookup_attr_text_search{counter}")
+                sa.text(f"parsed_data->>'person' ILIKE :{text_param}").bindparams(self._bindparam(text_param))
             ),
             sa.and_(
                 self.columns.object_class == 'role',
-                sa.text(f"parsed_data->>'role' ILIKE :lookup_attr_text_search{counter}")
+                sa.text(f"parsed_data->>'role' ILIKE :{text_param}").bindparams(self._bindparam(text_param))
             ),
-        )
-        self.statement = self.statement.where(fltr).params(
-            **{f'lookup_attr_text_search{counter}': '%' + value + '%'}
-        )
-        return self
+        ))
+
+    def _add_ip_params(self, ip: IP) -> Tuple[str, str, str]:
+        """Add the parameters for a prefix filter: first and last address, and IP version."""
+        return self._add_param(str(ip.net())), self._add_param(str(ip.broadcast())), self._add_param(ip.version())
+
+    def _ip_less_specific_filter(self, first: str, last: str) -> sa.sql.expression.ColumnElement:
+        """Filter for objects whose IP range contains that of the parameters first and last."""
+        return self._ip_range().op('@>')(self._ip_range_param(first, last))
+
+    def _ip_more_specific_filter(self, first: str, last: str) -> sa.sql.expression.ColumnElement:
+        """Filter for objects whose IP range is contained in that of the parameters first and last."""
+        return self._ip_range().op('<@')(self._ip_range_param(first, last))
+
+    def _ip_range(self) -> sa.sql.expression.FunctionElement:
+        """
+        The IP range of objects, matching the expression of the GiST index
+        ix_rpsl_objects_ip_range_gist, so that containment filters can use it.
+        """
+        return sa.func.inetrange(self.columns.ip_first, self.columns.ip_last, sa.literal_column("'[]'"))
+
+    def _ip_range_param(self, first: str, last: str) -> sa.sql.expression.FunctionElement:
+        """The IP range from the parameters for first and last address."""
+        return sa.func.inetrange(sa.cast(self._bindparam(first), pg.INET), sa.cast(self._bindparam(last), pg.INET),
+                                 sa.literal_column("'[]'"))
 
     def __repr__(self):
         return f'RPSLDatabaseQuery: {self.statement}\nPARAMS: {self.statement.compile().params}'
@@ -335,9 +515,8 @@ class RPSLDatabaseJournalQuery(BaseRPSLObjectDatabaseQuery):
     table = RPSLDatabaseJournal.__table__
     columns = RPSLDatabaseJournal.__table__.c
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.statement = sa.select([
+    def _initial_statement(self) -> Select:
+        return sa.select([
             self.columns.pk,
             self.columns.rpsl_pk,
             self.columns.source,
@@ -352,11 +531,14 @@ class RPSLDatabaseJournalQuery(BaseRPSLObjectDatabaseQuery):
         """
         Filter for a serials within a specific range, inclusive.
         """
+        start_param = self._add_param(start)
         if end is not None:
-            fltr = sa.and_(self.columns.serial_nrtm >= start, self.columns.serial_nrtm <= end)
-        else:
-            fltr = self.columns.serial_nrtm >= start
-        return self._filter(fltr)
+            end_param = self._add_param(end)
+            return self._filter('serial_range', lambda: sa.and_(
+                self.columns.serial_nrtm >= self._bindparam(start_param),
+                self.columns.serial_nrtm <= self._bindparam(end_param),
+            ))
+        return self._filter('serial_start', lambda: self.columns.serial_nrtm >= self._bindparam(start_param))
 
     def __repr__(self):
         return f'RPSLDatabaseJournalQuery: {self.statement}\nPARAMS: {self.statement.compile().params}'
@@ -0,0 +1,109 @@
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, Hashable, Iterable, Optional, Set, Tuple
+
+"""
+The set expansion cache keeps fully resolved expansions of as-sets and
+route-sets, e.g. the result of a recursive !i or !a query, in memory
+of a single process. It is only used for expansions from the preload
+store, as the cache is invalidated when a new preload snapshot is attached.
+
+Each entry records the names of the sets and origins it depended on.
+An incremental update of the preload store records which sets and origins
+were changed, and only the entries depending on those are invalidated.
+Any other update, like a full reload, clears the entire cache.
+"""
+
+SET_EXPANSION_CACHE_MAX_ENTRIES = 1000
+
+
+def set_dependency(set_name: str) -> str:
+    """Dependency key for an as-set or route-set name."""
+    return 'set:' + set_name.upper()
+
+
+def origin_dependency(origin: str) -> str:
+    """Dependency key for the prefixes originated by an AS, e.g. AS65537."""
+    return 'origin:' + origin
+
+
+class SetExpansionCache:
+    """
+    Least recently used cache of set expansions, with invalidation
+    by dependencies. Thread safe, as new snapshots are attached from
+    a separate thread.
+    """
+    def __init__(self, max_entries: int=SET_EXPANSION_CACHE_MAX_ENTRIES) -> None:
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[Hashable, Tuple[Any, Set[str]]]' = OrderedDict()
+        self._dependents: Dict[str, Set[Hashable]] = defaultdict(set)
+        self._generation: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self) -> Optional[int]:
+        """
+        The generation of the preload snapshot to which the cache applies.
+        """
+        return self._generation
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Retrieve a cached expansion, or None if not cached.
+        """
+        with self._lock:
+            try:
+                value, _ = self._entries[key]
+            except KeyError:
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any, dependencies: Set[str], generation: Optional[int]) -> None:
+        """
+        Cache an expansion, which depends on the sets and origins in dependencies.
+        generation must be the generation of the cache when the expansion
+        was started, so that results resolved from an older snapshot
+        are not cached after a newer one was attached.
+        """
+        with self._lock:
+            if generation is None or generation != self._generation:
+                return
+            self._remove(key)
+            self._entries[key] = (value, set(dependencies))
+            for dependency in dependencies:
+                self._dependents[dependency].add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def snapshot_attached(self, generation: int, changed_dependencies: Optional[Iterable[str]]) -> None:
+        """
+        Invalidate the cache after a new snapshot was attached.
+        If the snapshot immediately follows the current generation, and
+        changed_dependencies is provided, only entries that depend on
+        those are invalidated. Otherwise, the cache is cleared.
+        """
+        with self._lock:
+            if changed_dependencies is not None and self._generation is not None \
+                    and generation == self._generation + 1:
+                for dependency in changed_dependencies:
+                    for key in list(self._dependents.get(dependency, [])):
+                        self._remove(key)
+            else:
+                self._entries.clear()
+                self._dependents.clear()
+            self._generation = generation
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, key: Hashable) -> None:
+        try:
+            _, dependencies = self._entries.pop(key)
+        except KeyError:
+            return
+        for dependency in dependencies:
+            dependents = self._dependents[dependency]
+            dependents.discard(key)
+            if not dependents:
+                del self._dependents[dependency]
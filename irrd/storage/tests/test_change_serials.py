@@ -0,0 +1,16 @@
+from ..change_serials import SourceChangeSerials
+
+
+class TestSourceChangeSerials:
+    def test_increase_current(self, monkeypatch):
+        monkeypatch.setattr('irrd.storage.change_serials.REDIS_SOURCE_CHANGE_SERIALS_KEY',
+                            b'TEST-irrd-source-change-serials')
+        change_serials = SourceChangeSerials()
+        change_serials._redis_conn.delete(b'TEST-irrd-source-change-serials')
+
+        assert change_serials.current(['TEST1', 'TEST2']) == [0, 0]
+        assert change_serials.current([]) == []
+        change_serials.increase({'TEST1'})
+        change_serials.increase(['TEST1', 'TEST2'])
+        assert change_serials.current(['TEST2', 'TEST1', 'TEST3']) == [1, 2, 0]
+        change_serials._redis_conn.delete(b'TEST-irrd-source-change-serials')
@@ -1,16 +1,19 @@
 import uuid
-from unittest.mock import Mock
+from unittest.mock import Mock, ANY
 
 import pytest
 from IPy import IP
 from pytest import raises
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.exc import ProgrammingError
 
 from irrd.rpki.status import RPKIStatus
 from irrd.scopefilter.status import ScopeFilterStatus
 from irrd.utils.test_utils import flatten_mock_calls
 from .. import get_engine
-from ..database_handler import DatabaseHandler
+from ..change_serials import SourceChangeSerials
+from ..database_handler import (DatabaseHandler, DatabaseStatusTracker, StatementCache, statement_cache,
+                                _copy_text_value)
 from ..models import RPSLDatabaseObject, DatabaseOperation, JournalEntryOrigin
 from ..preload import Preloader
 from ..queries import (RPSLDatabaseQuery, RPSLDatabaseJournalQuery, DatabaseStatusQuery,
@@ -45,6 +48,7 @@ def irrd_database(monkeypatch):
     RPSLDatabaseObject.metadata.create_all(engine)
 
     monkeypatch.setattr('irrd.storage.database_handler.Preloader', lambda enable_queries: Mock(spec=Preloader))
+    monkeypatch.setattr('irrd.storage.database_handler.SourceChangeSerials', lambda: Mock(spec=SourceChangeSerials))
 
     yield None
 
@@ -108,6 +112,8 @@ class TestDatabaseHandlerLive:
 
         self.dh = DatabaseHandler()
         self.dh.preloader.signal_reload = Mock(return_value=None)
+        self.dh.preloader.claim_change_sequence = Mock(side_effect=[1, 2])
+        self.dh.change_serials.increase = Mock(return_value=None)
         self.dh.upsert_rpsl_object(rpsl_object_route_v4, JournalEntryOrigin.auth_change)
         assert len(self.dh._rpsl_upsert_buffer) == 1
 
@@ -279,8 +285,23 @@ class TestDatabaseHandlerLive:
         self.dh.close()
 
         assert flatten_mock_calls(self.dh.preloader.signal_reload) == [
-            ['', ({'route'},), {}],
-            ['', ({'route'},), {}],
+            ['', ({'route'}, [
+                (4, 'TEST', 'AS65537', '192.0.2.0/24', True),
+                (4, 'TEST', 'AS65537', '192.0.2.0/24', True),
+                (6, 'TEST2', 'AS65537', '2001:db8::/32', True),
+                (6, 'TEST2', 'AS65537', '2001:db8::/32', True),
+            ], [
+                ('TEST', 'route', '192.0.2.0/24,AS65537', []),
+                ('TEST', 'route', '192.0.2.0/24,AS65537', []),
+                ('TEST2', 'route', '2001:db8::/64,AS65537', []),
+                ('TEST2', 'route', '2001:db8::/64,AS65537', []),
+            ], 1), {}],
+            ['', ({'route'}, [(6, 'TEST2', 'AS65537', '2001:db8::/32', False)],
+                  [('TEST2', 'route', '2001:db8::/64,AS65537', [])], 2), {}],
+        ]
+        assert flatten_mock_calls(self.dh.change_serials.increase) == [
+            ['', ({'TEST', 'TEST2'},), {}],
+            ['', ({'TEST2'},), {}],
         ]
 
     def test_disable_journaling(self, monkeypatch, irrd_database):
@@ -325,6 +346,57 @@ class TestDatabaseHandlerLive:
 
         self.dh.close()
 
+    @pytest.mark.parametrize('staging_table', [False, True])
+    def test_rpsl_bulk_load(self, monkeypatch, irrd_database, staging_table):
+        monkeypatch.setattr('irrd.storage.database_handler.MAX_RECORDS_BUFFER_BEFORE_INSERT', 1)
+
+        def rpsl_object(prefix, mnt_by):
+            return Mock(
+                pk=lambda: f'{prefix}/24,AS65537',
+                rpsl_object_class='route',
+                parsed_data={'mnt-by': [mnt_by], 'source': 'TEST'},
+                render_rpsl_text=lambda last_modified: f'route: {prefix}/24\n\tdescr: \\N\n',
+                ip_version=lambda: 4,
+                ip_first=IP(prefix),
+                ip_last=IP(prefix).make_net(24)[-1],
+                prefix_length=24,
+                asn_first=65537,
+                asn_last=65537,
+                rpki_status=RPKIStatus.invalid,
+                scopefilter_status=ScopeFilterStatus.in_scope,
+            )
+
+        self.dh = DatabaseHandler()
+        self.dh.preloader.signal_reload = Mock(return_value=None)
+        self.dh.change_serials.increase = Mock(return_value=None)
+        self.dh.delete_all_rpsl_objects_with_journal('TEST')
+        self.dh.disable_journaling()
+        self.dh.start_rpsl_bulk_load('TEST', staging_table=staging_table)
+        self.dh.upsert_rpsl_object(rpsl_object('192.0.2.0', 'MNT-OLD'), JournalEntryOrigin.mirror)
+        self.dh.upsert_rpsl_object(rpsl_object('198.51.100.0', 'MNT-TEST'), JournalEntryOrigin.mirror)
+        self.dh.upsert_rpsl_object(rpsl_object('203.0.113.0', 'MNT-TEST'), JournalEntryOrigin.mirror)
+        # A second version of an object that was already copied replaces it
+        self.dh.upsert_rpsl_object(rpsl_object('192.0.2.0', 'MNT-NEW'), JournalEntryOrigin.mirror)
+        assert not self.dh._rpsl_upsert_buffer if staging_table else self.dh._rpsl_upsert_buffer
+        self.dh.commit()
+
+        result = list(self.dh.execute_query(RPSLDatabaseQuery().sources(['TEST'])))
+        assert len(result) == 3
+        objects = {obj['rpsl_pk']: obj for obj in result}
+        obj = objects['192.0.2.0/24,AS65537']
+        assert obj['parsed_data'] == {'mnt-by': ['MNT-NEW'], 'source': 'TEST'}
+        assert obj['object_text'] == 'route: 192.0.2.0/24\n\tdescr: \\N\n'
+        assert obj['ip_last'] == '192.0.2.255'
+        assert obj['ip_size'] == 256
+        assert obj['rpki_status'] == RPKIStatus.invalid
+        assert not self._clean_result(self.dh.execute_query(RPSLDatabaseJournalQuery()))
+        assert len(list(self.dh.execute_query(DatabaseStatusQuery().sources(['TEST'])))) == 1
+
+        # The bulk load ends with the transaction
+        self.dh.upsert_rpsl_object(rpsl_object('192.0.2.0', 'MNT-NEWER'), JournalEntryOrigin.mirror)
+        assert len(self.dh._rpsl_upsert_buffer) == 1
+        self.dh.close()
+
     def test_roa_handling_and_query(self, irrd_database):
         self.dh = DatabaseHandler()
         self.dh.insert_roa_object(
@@ -504,6 +576,62 @@ class TestRPSLDatabaseQueryLive:
         self._assert_no_match(RPSLDatabaseQuery().rpki_status([RPKIStatus.valid]))
         self._assert_no_match(RPSLDatabaseQuery().scopefilter_status([ScopeFilterStatus.out_scope_as]))
 
+    def test_stream_results(self, irrd_database, database_handler_with_route):
+        self.dh = database_handler_with_route
+        query = RPSLDatabaseQuery().rpsl_pk('192.0.2.0/24,AS65537')
+        result = list(self.dh.execute_query_stream(query))
+        assert len(result) == 1
+        assert result[0]['rpki_status'] == RPKIStatus.invalid
+        assert not list(self.dh.execute_query_stream(RPSLDatabaseQuery().rpsl_pk('foo')))
+        self.dh.commit()
+
+        readonly_dh = DatabaseHandler(readonly=True)
+        result = list(readonly_dh.execute_query_stream(query))
+        assert len(result) == 1
+        # After streaming, the readonly handler is back in autocommit mode
+        assert readonly_dh._connection.connection.autocommit
+        assert len(list(readonly_dh.execute_query(query))) == 1
+
+        # The iterator can be closed before the results are consumed
+        stream = readonly_dh.execute_query_stream(query)
+        next(stream)
+        stream.close()
+        assert readonly_dh._connection.connection.autocommit
+        readonly_dh.close()
+
+    def test_query_log(self, irrd_database, database_handler_with_route):
+        self.dh = database_handler_with_route
+        query = RPSLDatabaseQuery().rpsl_pk('192.0.2.0/24,AS65537')
+        self.dh.query_log = []
+        list(self.dh.execute_query(query))
+        list(self.dh.execute_query_stream(RPSLDatabaseQuery().rpsl_pk('foo')))
+        assert [entry.query for entry in self.dh.query_log] == [query, ANY]
+        assert [entry.row_count for entry in self.dh.query_log] == [1, 0]
+        assert repr(self.dh.query_log[0]).startswith('RPSLDatabaseQuery: SELECT')
+        assert repr(self.dh.query_log[0]).endswith('\nROWS: 1')
+        self.dh.query_log = None
+
+    def test_estimate_row_count(self, irrd_database, database_handler_with_route):
+        self.dh = database_handler_with_route
+        query = RPSLDatabaseQuery().sources(['TEST']).lookup_attr('mnt-by', 'MNT-TEST')
+        self.dh.query_log = []
+        assert self.dh.estimate_row_count(query) >= 1
+        # The query itself is not executed
+        assert not self.dh.query_log
+        self.dh.query_log = None
+
+    def test_statement_cache(self, irrd_database, database_handler_with_route):
+        self.dh = database_handler_with_route
+        hits = statement_cache.hits
+        self._assert_match(RPSLDatabaseQuery().sources(['TEST']).rpsl_pk('192.0.2.0/24,AS65537'))
+        self._assert_no_match(RPSLDatabaseQuery().sources(['TEST']).rpsl_pk('192.0.2.0/25,AS65537'))
+        self._assert_no_match(RPSLDatabaseQuery().sources(['TEST2']).rpsl_pk('192.0.2.0/24,AS65537'))
+        self._assert_match(RPSLDatabaseQuery().rpsl_pks(['192.0.2.0/24,AS65537', '192.0.2.0/25,AS65537']))
+        self._assert_no_match(RPSLDatabaseQuery().rpsl_pks([]))
+        assert statement_cache.hits >= hits + 3
+        query = RPSLDatabaseQuery().sources(['TEST']).rpsl_pk('192.0.2.0/24,AS65537')
+        assert len(list(self.dh.execute_query_stream(query))) == 1
+
     def test_ordering_sources(self, irrd_database, database_handler_with_route):
         self.dh = database_handler_with_route
         rpsl_object_2 = Mock(
@@ -674,6 +802,82 @@ class TestRPSLDatabaseQueryLive:
         q = RPSLDatabaseQuery().sources(['TEST']).ip_less_specific_one_level(IP('192.0.2.0/27'))
         self._assert_match(q)
 
+    def test_parent_links(self, irrd_database, database_handler_with_route):
+        self.dh = database_handler_with_route
+
+        def route(prefix, source, rpki_status=RPKIStatus.not_found):
+            prefix = IP(prefix)
+            return Mock(
+                pk=lambda: f'{prefix},AS65537',
+                rpsl_object_class='route',
+                parsed_data={'mnt-by': ['MNT-TEST'], 'source': source},
+                render_rpsl_text=lambda last_modified: 'object-text',
+                ip_version=lambda: 4,
+                ip_first=prefix.net(),
+                ip_last=prefix.broadcast(),
+                prefix_length=prefix.prefixlen(),
+                asn_first=65537,
+                asn_last=65537,
+                rpki_status=rpki_status,
+                scopefilter_status=ScopeFilterStatus.in_scope,
+            )
+
+        def parent_links():
+            q = RPSLDatabaseQuery(column_names=['rpsl_pk', 'source', 'parent_ip_first', 'parent_ip_last'])
+            return {
+                (r['rpsl_pk'], r['source']): (r['parent_ip_first'], r['parent_ip_last'])
+                for r in self.dh.execute_query(q)
+            }
+
+        self.dh.upsert_rpsl_object(route('192.0.2.0/26', 'TEST'), JournalEntryOrigin.auth_change)
+        self.dh.upsert_rpsl_object(route('192.0.2.0/26', 'TEST2'), JournalEntryOrigin.auth_change)
+        self.dh.commit()
+        self.dh.upsert_rpsl_object(route('192.0.2.0/25', 'TEST'), JournalEntryOrigin.auth_change)
+        self.dh.commit()
+
+        assert parent_links() == {
+            ('192.0.2.0/24,AS65537', 'TEST'): (None, None),
+            ('192.0.2.0/25,AS65537', 'TEST'): ('192.0.2.0', '192.0.2.255'),
+            ('192.0.2.0/26,AS65537', 'TEST'): ('192.0.2.0', '192.0.2.127'),
+            ('192.0.2.0/26,AS65537', 'TEST2'): (None, None),
+        }
+
+        q = RPSLDatabaseQuery().ip_parent_of(IP('192.0.2.0/26'))
+        assert [r['rpsl_pk'] for r in self.dh.execute_query(q)] == ['192.0.2.0/25,AS65537']
+        q = RPSLDatabaseQuery().ip_children_of(IP('192.0.2.0/24'))
+        assert [r['rpsl_pk'] for r in self.dh.execute_query(q)] == ['192.0.2.0/25,AS65537']
+        self._assert_no_match(RPSLDatabaseQuery().ip_parent_of(IP('192.0.2.0/27')))
+        q = RPSLDatabaseQuery().sources(['TEST']).ip_less_specific_one_level(IP('192.0.2.0/26'), use_parent_links=True)
+        assert [r['rpsl_pk'] for r in self.dh.execute_query(q)] == ['192.0.2.0/25,AS65537']
+        # Without an object for the prefix, all less specifics are considered
+        q = RPSLDatabaseQuery().sources(['TEST']).ip_less_specific_one_level(IP('192.0.2.0/27'), use_parent_links=True)
+        assert [r['rpsl_pk'] for r in self.dh.execute_query(q)] == ['192.0.2.0/26,AS65537']
+        self._assert_no_match(
+            RPSLDatabaseQuery().sources(['TEST2']).ip_less_specific_one_level(IP('192.0.2.0/26'), use_parent_links=True))
+
+        # Parent links ignore the RPKI status, so they are not used with an RPKI filter
+        self.dh.upsert_rpsl_object(route('192.0.2.0/26', 'TEST', RPKIStatus.invalid), JournalEntryOrigin.auth_change)
+        self.dh.upsert_rpsl_object(route('192.0.2.0/27', 'TEST'), JournalEntryOrigin.auth_change)
+        self.dh.commit()
+        q = RPSLDatabaseQuery().sources(['TEST']).ip_less_specific_one_level(IP('192.0.2.0/27'), use_parent_links=True)
+        assert [r['rpsl_pk'] for r in self.dh.execute_query(q)] == ['192.0.2.0/26,AS65537']
+        q = RPSLDatabaseQuery().sources(['TEST']).rpki_status([RPKIStatus.not_found, RPKIStatus.valid])
+        q = q.ip_less_specific_one_level(IP('192.0.2.0/27'))
+        assert [r['rpsl_pk'] for r in self.dh.execute_query(q)] == ['192.0.2.0/25,AS65537']
+        self.dh.delete_rpsl_object(rpsl_pk='192.0.2.0/27,AS65537', source='TEST',
+                                   origin=JournalEntryOrigin.auth_change)
+
+        self.dh.delete_rpsl_object(rpsl_pk='192.0.2.0/25,AS65537', source='TEST',
+                                   origin=JournalEntryOrigin.auth_change)
+        self.dh.commit()
+        assert parent_links()[('192.0.2.0/26,AS65537', 'TEST')] == ('192.0.2.0', '192.0.2.255')
+
+        # A bulk load rebuilds all parent links of the source
+        self.dh.start_rpsl_bulk_load('TEST2')
+        self.dh.upsert_rpsl_object(route('192.0.2.0/25', 'TEST2'), JournalEntryOrigin.mirror)
+        self.dh.commit()
+        assert parent_links()[('192.0.2.0/26,AS65537', 'TEST2')] == ('192.0.2.0', '192.0.2.127')
+
     def test_modify_frozen_filter(self):
         with raises(ValueError) as ve:
             RPSLDatabaseQuery().ip_less_specific_one_level(IP('192.0.2.0/27')).sources(['TEST'])
@@ -692,3 +896,305 @@ class TestRPSLDatabaseQueryLive:
         __tracebackhide__ = True
         result = list(self.dh.execute_query(query))
         assert not len(result), f'Failed query: {query}: unexpected output: {result}'
+
+
+class TestStatementCache:
+    def test_query_shapes(self):
+        def query(sources, rpsl_pk, status):
+            return RPSLDatabaseQuery().sources(sources).rpsl_pk(rpsl_pk).rpki_status(status).first_only()
+
+        query1 = query(['TEST1', 'TEST2'], 'AS65537', [RPKIStatus.valid])
+        query2 = query(['TEST2', 'TEST1'], 'AS65538', [RPKIStatus.invalid, RPKIStatus.not_found])
+        assert query1.statement_cache_key() == query2.statement_cache_key()
+        assert query1.statement_cache_key() != query(['TEST1'], 'AS65537', []).statement_cache_key()
+        assert query1.statement_cache_key() != RPSLDatabaseQuery(ordered_by_sources=False).sources(
+            ['TEST1', 'TEST2']).rpsl_pk('AS65537').rpki_status([]).first_only().statement_cache_key()
+        assert query2.statement_params() == {
+            'query_param_0': 'TEST2',
+            'query_param_1': 'TEST1',
+            'query_param_2': ['TEST2', 'TEST1'],
+            'query_param_3': ['AS65538'],
+            'query_param_4': [RPKIStatus.invalid, RPKIStatus.not_found],
+        }
+
+        # The compiled statement of one query is valid for the other,
+        # including the parameters used for ordering by source.
+        dialect = postgresql.dialect()
+        compiled1 = query1.finalise_statement().compile(dialect=dialect)
+        compiled2 = query2.finalise_statement().compile(dialect=dialect)
+        assert compiled1.string == compiled2.string
+        assert compiled1.construct_params(query2.statement_params()) == compiled2.construct_params()
+
+        with raises(ValueError):
+            query1.sources(['TEST1'])
+
+    def test_statement_cache(self):
+        cache = StatementCache(max_size=2)
+        dialect = postgresql.dialect()
+        compiled = cache.compiled_statement(RPSLDatabaseQuery().rpsl_pk('AS65537'), dialect)
+        assert cache.compiled_statement(RPSLDatabaseQuery().rpsl_pk('AS65538'), dialect) is compiled
+        assert cache.compiled_statement(RPSLDatabaseQuery().pk('uuid'), dialect) is not compiled
+        assert (cache.hits, cache.misses) == (1, 2)
+
+        # When full, the least recently used statement is evicted
+        assert cache.compiled_statement(RPSLDatabaseQuery().rpsl_pk('AS65539'), dialect) is compiled
+        cache.compiled_statement(RPSLDatabaseQuery().asn(65537), dialect)
+        assert (cache.hits, cache.misses) == (2, 3)
+        assert cache.compiled_statement(RPSLDatabaseQuery().rpsl_pk('AS65537'), dialect) is compiled
+        assert (cache.hits, cache.misses) == (3, 3)
+        cache.compiled_statement(RPSLDatabaseQuery().pk('uuid'), dialect)
+        assert (cache.hits, cache.misses) == (3, 4)
+
+    def test_execute_query_with_cache(self, monkeypatch):
+        mock_engine = Mock()
+        mock_connection = mock_engine.connect()
+        mock_connection.dialect = postgresql.dialect()
+        mock_connection.execute = Mock(return_value=Mock(fetchall=lambda: [{'pk': 'uuid'}]))
+        monkeypatch.setattr('irrd.storage.database_handler.get_engine', lambda: mock_engine)
+        monkeypatch.setattr('irrd.storage.database_handler.statement_cache', StatementCache())
+
+        dh = DatabaseHandler(readonly=True)
+        assert list(dh.execute_query(RPSLDatabaseQuery().rpsl_pk('AS65537'))) == [{'pk': 'uuid'}]
+        assert list(dh.execute_query(RPSLDatabaseQuery().rpsl_pk('AS65538'))) == [{'pk': 'uuid'}]
+        compiled, params = mock_connection.execute.call_args[0]
+        assert 'WHERE rpsl_objects.rpsl_pk IN ([EXPANDING_query_param_0])' in compiled.string
+        assert params == {'query_param_0': ['AS65538']}
+
+        # Other queries are not cached
+        list(dh.execute_query(DatabaseStatusQuery()))
+        assert len(mock_connection.execute.call_args[0]) == 1
+
+    def test_estimate_row_count(self, monkeypatch):
+        mock_engine = Mock()
+        mock_connection = mock_engine.connect()
+        mock_connection.execute = Mock(return_value=Mock(scalar=lambda: [{'Plan': {'Plan Rows': 42}}]))
+        monkeypatch.setattr('irrd.storage.database_handler.get_engine', lambda: mock_engine)
+
+        dh = DatabaseHandler(readonly=True)
+        assert dh.estimate_row_count(RPSLDatabaseQuery().lookup_attr('mnt-by', 'MNT-TEST')) == 42
+        explain = mock_connection.execute.call_args[0][0]
+        compiled = str(explain.compile(dialect=postgresql.dialect()))
+        assert compiled.startswith('EXPLAIN (FORMAT JSON) SELECT')
+
+
+class TestRPSLBulkLoad:
+    def test_copy_text_value(self):
+        assert _copy_text_value(None) == '\\N'
+        assert _copy_text_value(42) == '42'
+        assert _copy_text_value(RPKIStatus.not_found) == 'not_found'
+        assert _copy_text_value({'descr': ['a/b', 'c\td']}) == '{"descr":["a/b","c\\\\td"]}'
+        assert _copy_text_value('a\tb\nc\rd\\N') == 'a\\tb\\nc\\rd\\\\N'
+
+    def test_start_rpsl_bulk_load(self, monkeypatch):
+        mock_engine = Mock()
+        mock_connection = mock_engine.connect()
+        monkeypatch.setattr('irrd.storage.database_handler.get_engine', lambda: mock_engine)
+        monkeypatch.setattr('irrd.storage.database_handler.Preloader', lambda enable_queries: Mock(spec=Preloader))
+        monkeypatch.setattr('irrd.storage.database_handler.SourceChangeSerials', lambda: Mock(spec=SourceChangeSerials))
+        mock_copy_from = Mock()
+        monkeypatch.setattr('irrd.storage.database_handler.postgres_copy.copy_from', mock_copy_from)
+
+        dh = DatabaseHandler()
+        dh.start_rpsl_bulk_load('TEST', staging_table=True)
+        assert mock_connection.execute.call_args[0][0].startswith(
+            'CREATE TEMPORARY TABLE rpsl_objects_bulk_load (LIKE rpsl_objects INCLUDING DEFAULTS')
+        rpsl_object = Mock(
+            pk=lambda: 'AS65537',
+            rpsl_object_class='aut-num',
+            parsed_data={'aut-num': 'AS65537', 'source': 'TEST'},
+            render_rpsl_text=lambda last_modified: 'aut-num: AS65537\n',
+            ip_version=lambda: None,
+            ip_first=None,
+            ip_last=None,
+            prefix_length=None,
+            asn_first=65537,
+            asn_last=65537,
+            rpki_status=RPKIStatus.not_found,
+            scopefilter_status=ScopeFilterStatus.in_scope,
+        )
+        for _ in range(2):
+            dh.upsert_rpsl_object(rpsl_object, JournalEntryOrigin.mirror)
+        assert not dh._rpsl_upsert_buffer
+        dh.status_tracker = Mock()
+        dh.commit()
+
+        rows, destination, connection = mock_copy_from.call_args[0]
+        rows = rows.read().splitlines()
+        assert len(rows) == 2
+        assert rows[0].startswith('AS65537\tTEST\taut-num\t{"aut-num":"AS65537","source":"TEST"}\t'
+                                  'aut-num: AS65537\\n\t\\N\t\\N\t\\N\t\\N\t\\N\t65537\t65537\tnot_found\tin_scope\t')
+        assert destination.name == 'rpsl_objects_bulk_load'
+        assert mock_copy_from.call_args[1]['columns'][:3] == ['rpsl_pk', 'source', 'object_class']
+        statements = [call[0][0] for call in mock_connection.execute.call_args_list if isinstance(call[0][0], str)]
+        assert statements[-2].startswith('INSERT INTO rpsl_objects (rpsl_pk, source, ')
+        assert 'SELECT DISTINCT ON (rpsl_pk, source)' in statements[-2]
+        assert statements[-1] == 'DROP TABLE rpsl_objects_bulk_load'
+        assert dh._rpsl_bulk_load_source is None
+
+        # Parent links are rebuilt for the entire source
+        rebuild_statement, rebuild_params = [
+            (call[0][0], call[1]) for call in mock_connection.execute.call_args_list
+            if 'parent_ip_first' in str(call[0][0])
+        ][-1]
+        assert 'WHERE rpsl_objects.source = :source' in str(rebuild_statement)
+        assert rebuild_params == {'source': 'TEST'}
+
+    def test_parent_link_changes(self, monkeypatch):
+        mock_engine = Mock()
+        mock_connection = mock_engine.connect()
+        monkeypatch.setattr('irrd.storage.database_handler.get_engine', lambda: mock_engine)
+        monkeypatch.setattr('irrd.storage.database_handler.Preloader', lambda enable_queries: Mock(spec=Preloader))
+        monkeypatch.setattr('irrd.storage.database_handler.SourceChangeSerials', lambda: Mock(spec=SourceChangeSerials))
+
+        dh = DatabaseHandler()
+        dh.status_tracker = Mock()
+        rpsl_object = Mock(
+            pk=lambda: '192.0.2.0/24,AS65537',
+            rpsl_object_class='route',
+            parsed_data={'route': '192.0.2.0/24', 'source': 'TEST'},
+            render_rpsl_text=lambda last_modified: 'route: 192.0.2.0/24\n',
+            ip_version=lambda: 4,
+            ip_first=IP('192.0.2.0'),
+            ip_last=IP('192.0.2.255'),
+            prefix_length=24,
+            asn_first=65537,
+            asn_last=65537,
+            rpki_status=RPKIStatus.not_found,
+            scopefilter_status=ScopeFilterStatus.in_scope,
+        )
+        def parent_link_updates():
+            return [
+                (call[0][0], call[1]) for call in mock_connection.execute.call_args_list
+                if 'FROM unnest(:object_classes, :sources, :ip_versions' in getattr(call[0][0], 'text', '')
+            ]
+
+        # Parent links are only updated on commit, once for each changed range
+        dh.upsert_rpsl_object(rpsl_object, JournalEntryOrigin.mirror)
+        dh._flush_rpsl_object_writing_buffer()
+        dh.upsert_rpsl_object(rpsl_object, JournalEntryOrigin.mirror)
+        dh._flush_rpsl_object_writing_buffer()
+        assert not parent_link_updates()
+        dh.commit()
+
+        [(statement, params)] = parent_link_updates()
+        assert params == {
+            'object_classes': ['route'],
+            'sources': ['TEST'],
+            'ip_versions': [4],
+            'ip_firsts': ['192.0.2.0'],
+            'ip_lasts': ['192.0.2.255'],
+            'deleted': [False],
+        }
+        assert not dh._rpsl_parent_link_changes
+
+        # Without changes, no parent links are updated
+        mock_connection.execute.reset_mock()
+        dh.commit()
+        assert not parent_link_updates()
+
+
+class TestCommit:
+    def test_signal_changes_after_commit(self, monkeypatch):
+        mock_engine = Mock()
+        mock_transaction = mock_engine.connect().begin()
+        monkeypatch.setattr('irrd.storage.database_handler.get_engine', lambda: mock_engine)
+        monkeypatch.setattr('irrd.storage.database_handler.Preloader', lambda enable_queries: Mock(spec=Preloader))
+        monkeypatch.setattr('irrd.storage.database_handler.SourceChangeSerials', lambda: Mock(spec=SourceChangeSerials))
+
+        dh = DatabaseHandler()
+        dh.status_tracker = Mock()
+        dh._object_classes_modified = {'route'}
+        dh._sources_modified = {'TEST'}
+        dh._preload_route_changes = [(4, 'TEST', 'AS65537', '192.0.2.0/24', True)]
+        # The sequence is claimed only once the transaction is committed
+        dh.preloader.claim_change_sequence = Mock(side_effect=lambda: mock_transaction.commit.called and 1)
+        dh.commit()
+        assert dh.preloader.signal_reload.call_args[0] == (
+            {'route'}, [(4, 'TEST', 'AS65537', '192.0.2.0/24', True)], [], 1)
+        assert dh.change_serials.increase.call_args[0] == ({'TEST'}, )
+
+        # A redis failure does not roll back the committed transaction,
+        # but requests a full reload instead
+        mock_transaction.reset_mock()
+        dh.preloader.signal_reload.reset_mock()
+        dh.status_tracker = Mock()
+        dh._object_classes_modified = {'route'}
+        dh._preload_route_changes = [(4, 'TEST', 'AS65537', '192.0.2.0/24', False)]
+        dh.preloader.claim_change_sequence = Mock(side_effect=ConnectionError())
+        dh.commit()
+        assert mock_transaction.commit.called
+        assert not mock_transaction.rollback.called
+        assert dh.preloader.signal_reload.call_args[0] == ({'route'}, )
+        assert not dh._preload_route_changes
+
+        # Failing to request the full reload is only logged
+        dh._object_classes_modified = {'route'}
+        dh.preloader.signal_reload = Mock(side_effect=ConnectionError())
+        dh.commit()
+
+
+class TestDatabaseStatusTracker:
+    def test_journal_batched_serials(self, config_override, monkeypatch):
+        config_override({
+            'sources': {
+                'TEST': {'keep_journal': True},
+                'TEST2': {'keep_journal': True, 'nrtm_host': 'localhost'},
+                'TEST3': {'keep_journal': True},
+                'TEST4': {},
+            }
+        })
+        monkeypatch.setattr('irrd.storage.database_handler.is_serial_synchronised',
+                            lambda database_handler, source: source == 'TEST2')
+        mock_dh = Mock()
+        mock_dh.execute_statement = Mock(side_effect=lambda statement: iter([('TEST', 41)]))
+        tracker = DatabaseStatusTracker(mock_dh)
+
+        for source, source_serial in [('TEST', None), ('TEST2', 42), ('TEST3', None),
+                                      ('TEST', None), ('TEST2', 43), ('TEST4', None)]:
+            tracker.record_operation(
+                operation=DatabaseOperation.add_or_update,
+                rpsl_pk='AS65537',
+                source=source,
+                object_class='aut-num',
+                object_text='aut-num: AS65537\n',
+                origin=JournalEntryOrigin.mirror,
+                source_serial=source_serial,
+            )
+        assert not mock_dh.execute_statement.call_count
+        tracker.flush_journal()
+
+        lock, newest_serials, insert = [call[0][0] for call in mock_dh.execute_statement.call_args_list]
+        assert lock == 'LOCK TABLE rpsl_database_journal IN EXCLUSIVE MODE'
+        assert 'GROUP BY rpsl_database_journal.source' in str(newest_serials)
+        params = insert.compile(dialect=postgresql.dialect()).params
+        inserted = [(params[f'source_m{idx}'], params[f'serial_nrtm_m{idx}']) for idx in range(5)]
+        assert inserted == [('TEST', 42), ('TEST2', 42), ('TEST3', 1), ('TEST', 43), ('TEST2', 43)]
+        assert tracker._new_serials_per_source == {'TEST': {42, 43}, 'TEST2': {42, 43}, 'TEST3': {1}}
+
+        # Synchronised serials require no lock
+        mock_dh.reset_mock()
+        tracker.record_operation(DatabaseOperation.delete, 'AS65537', 'TEST2', 'aut-num',
+                                 'aut-num: AS65537\n', JournalEntryOrigin.mirror, 44)
+        tracker.flush_journal()
+        tracker.flush_journal()
+        assert mock_dh.execute_statement.call_count == 1
+
+
+class TestIPRangeQueries:
+    def test_filters_match_gist_index(self):
+        dialect = postgresql.dialect()
+        index = [index for index in RPSLDatabaseObject.__table__.indexes
+                 if index.name == 'ix_rpsl_objects_ip_range_gist'][0]
+        index_expression = str(index.expressions[0])
+        assert index_expression == "inetrange(ip_first, ip_last, '[]')"
+
+        for query, operator in [
+            (RPSLDatabaseQuery().ip_less_specific(IP('192.0.2.0/25')), '@>'),
+            (RPSLDatabaseQuery().ip_less_specific_one_level(IP('192.0.2.0/25')), '@>'),
+            (RPSLDatabaseQuery().ip_less_specific_one_level(IP('192.0.2.0/25'), use_parent_links=True), '@>'),
+            (RPSLDatabaseQuery().ip_more_specific(IP('192.0.2.0/25')), '<@'),
+        ]:
+            compiled = str(query.finalise_statement().compile(dialect=dialect))
+            assert f"inetrange(rpsl_objects.ip_first, rpsl_objects.ip_last, '[]') {operator} " \
+                   "inetrange(CAST(%(query_param_0)s AS INET), CAST(%(query_param_1)s AS INET), '[]')" in compiled
+            assert 'rpsl_objects.ip_version = %(query_param_2)s' in compiled
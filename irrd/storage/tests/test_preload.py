@@ -1,22 +1,33 @@
+import os
 import threading
 import time
-from unittest.mock import Mock
+from unittest.mock import Mock, ANY
 
 import pytest
+import ujson
 
 from irrd.rpki.status import RPKIStatus
 from irrd.scopefilter.status import ScopeFilterStatus
 from irrd.utils.test_utils import flatten_mock_calls
 from ..database_handler import DatabaseHandler
 from ..preload import (Preloader, PreloadStoreManager, PreloadUpdater,
-                       REDIS_KEY_ORIGIN_SOURCE_SEPARATOR)
+                       REDIS_KEY_ORIGIN_SOURCE_SEPARATOR, pack_prefix, preload_delta_snapshot_path,
+                       preload_snapshot_path, SNAPSHOT_ORIGIN_ROUTE4_TABLE,
+                       split_packed_prefixes, unpack_prefix)
+from ..preload_snapshot import PreloadSnapshot
 from ..queries import RPSLDatabaseQuery
 
 # Use different stores in tests
-TEST_REDIS_ORIGIN_ROUTE4_STORE_KEY = 'TEST-irrd-preload-origin-route4'
-TEST_REDIS_ORIGIN_ROUTE6_STORE_KEY = 'TEST-irrd-preload-origin-route6'
+TEST_REDIS_ORIGIN_ROUTE4_STORE_KEY = b'TEST-irrd-preload-origin-route4'
+TEST_REDIS_ORIGIN_ROUTE6_STORE_KEY = b'TEST-irrd-preload-origin-route6'
 TEST_REDIS_PRELOAD_RELOAD_CHANNEL = 'TEST-irrd-preload-reload-channel'
 TEST_REDIS_PRELOAD_COMPLETE_CHANNEL = 'TEST-irrd-preload-complete-channel'
+TEST_REDIS_SET_STORE_KEY = b'TEST-irrd-preload-sets'
+TEST_REDIS_STORE_POINTER_KEY = b'TEST-irrd-preload-store-pointers'
+TEST_REDIS_PRELOAD_CHANGES_KEY = 'TEST-irrd-preload-changes'
+TEST_REDIS_PRELOAD_SEQUENCE_KEY = b'TEST-irrd-preload-sequence'
+TEST_REDIS_PRELOAD_METRICS_KEY = b'TEST-irrd-preload-metrics'
+TEST_REDIS_PRELOAD_STORE_SIZE_KEY = b'TEST-irrd-preload-store-size'
 
 
 @pytest.fixture()
@@ -27,11 +38,18 @@ def mock_preload_updater(monkeypatch, config_override):
 
 
 @pytest.fixture()
-def mock_redis_keys(monkeypatch, config_override):
+def mock_redis_keys(monkeypatch, config_override, tmpdir):
+    config_override({'piddir': str(tmpdir)})
     monkeypatch.setattr('irrd.storage.preload.REDIS_ORIGIN_ROUTE4_STORE_KEY', TEST_REDIS_ORIGIN_ROUTE4_STORE_KEY)
     monkeypatch.setattr('irrd.storage.preload.REDIS_ORIGIN_ROUTE6_STORE_KEY', TEST_REDIS_ORIGIN_ROUTE6_STORE_KEY)
     monkeypatch.setattr('irrd.storage.preload.REDIS_PRELOAD_RELOAD_CHANNEL', TEST_REDIS_PRELOAD_RELOAD_CHANNEL)
     monkeypatch.setattr('irrd.storage.preload.REDIS_PRELOAD_COMPLETE_CHANNEL', TEST_REDIS_PRELOAD_COMPLETE_CHANNEL)
+    monkeypatch.setattr('irrd.storage.preload.REDIS_SET_STORE_KEY', TEST_REDIS_SET_STORE_KEY)
+    monkeypatch.setattr('irrd.storage.preload.REDIS_STORE_POINTER_KEY', TEST_REDIS_STORE_POINTER_KEY)
+    monkeypatch.setattr('irrd.storage.preload.REDIS_PRELOAD_CHANGES_KEY', TEST_REDIS_PRELOAD_CHANGES_KEY)
+    monkeypatch.setattr('irrd.storage.preload.REDIS_PRELOAD_SEQUENCE_KEY', TEST_REDIS_PRELOAD_SEQUENCE_KEY)
+    monkeypatch.setattr('irrd.storage.preload.REDIS_PRELOAD_METRICS_KEY', TEST_REDIS_PRELOAD_METRICS_KEY)
+    monkeypatch.setattr('irrd.storage.preload.REDIS_PRELOAD_STORE_SIZE_KEY', TEST_REDIS_PRELOAD_STORE_SIZE_KEY)
 
 
 class TestPreloading:
@@ -67,6 +85,7 @@ class TestPreloading:
         assert mock_preload_updater.mock_calls[1][0] == '().is_alive'
         assert len(mock_preload_updater.mock_calls) == 2
         assert len(preload_manager._threads) == 2
+        assert preload_manager._coalesced_reloads == 1
         mock_preload_updater.reset_mock()
 
         # Assume all threads are dead
@@ -77,27 +96,30 @@ class TestPreloading:
         Preloader().signal_reload({'inetnum'})
         Preloader().signal_reload()
         Preloader().signal_reload()
+        time.sleep(1)
 
         # As all threads are considered dead, a new thread should be started
         assert mock_preload_updater.mock_calls[0][0] == ''
         assert mock_preload_updater.mock_calls[1][0] == '().start'
 
-        # Listen() on redis is blocking, unblock it after setting terminate
+        # The manager checks terminate after each message or timeout, wait for it to exit
         preload_manager.terminate = True
         Preloader().signal_reload()
+        preload_manager_thread.join()
 
     def test_routes_for_origins(self, mock_redis_keys):
         preloader = Preloader()
         preload_manager = PreloadStoreManager()
 
-        preload_manager.update_route_store(
+        preload_manager.update_store(
             {
-                f'TEST2{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65546': {'192.0.2.0/25'},
-                f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65547': {'192.0.2.128/25', '198.51.100.0/25'},
+                f'TEST2{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65546': {pack_prefix(4, '192.0.2.0', 25)},
+                f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65547': {pack_prefix(4, '192.0.2.128', 25), pack_prefix(4, '198.51.100.0', 25)},
             },
             {
-                f'TEST2{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65547': {'2001:db8::/32'},
+                f'TEST2{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65547': {pack_prefix(6, '2001:db8::', 32)},
             },
+            {}, set(),
         )
         sources = ['TEST1', 'TEST2']
         assert preloader.routes_for_origins([], sources) == set()
@@ -114,10 +136,364 @@ class TestPreloading:
         assert preloader.routes_for_origins(['AS65547', 'AS65546'], ['TEST1']) == {'192.0.2.128/25', '198.51.100.0/25'}
         assert preloader.routes_for_origins(['AS65547', 'AS65546'], ['TEST2']) == {'192.0.2.0/25', '2001:db8::/32'}
 
+        assert preloader.routes_per_origin(['AS65547', 'AS65546', 'AS65545'], sources, 4) == {
+            'AS65547': {'192.0.2.128/25', '198.51.100.0/25'},
+            'AS65546': {'192.0.2.0/25'},
+            'AS65545': set(),
+        }
+        assert preloader.routes_per_origin(['AS65547'], sources) == {
+            'AS65547': {'192.0.2.128/25', '198.51.100.0/25', '2001:db8::/32'},
+        }
+
+        assert preloader.route_count_for_origins(['AS65547', 'AS65546'], sources) == 4
+        assert preloader.route_count_for_origins(['AS65547', 'AS65546'], sources, 4) == 3
+        assert preloader.route_count_for_origins(['AS65545'], sources) == 0
+
         with pytest.raises(ValueError) as ve:
             preloader.routes_for_origins(['AS65547'], [], 2)
         assert 'Invalid IP version: 2' in str(ve.value)
 
+    def test_aggregated_routes_for_origins(self, mock_redis_keys):
+        preloader = Preloader(enable_queries=False)
+        preload_manager = PreloadStoreManager()
+
+        preload_manager.update_store(
+            {
+                f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65546': {pack_prefix(4, '192.0.2.0', 25), pack_prefix(4, '198.51.100.0', 24)},
+                f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65547': {pack_prefix(4, '192.0.2.128', 25), pack_prefix(4, '192.0.2.0', 24)},
+            },
+            {
+                f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65547': {pack_prefix(6, '2001:db8::', 33), pack_prefix(6, '2001:db8:8000::', 33)},
+            },
+            {}, set(),
+        )
+        preloader._load_routes_into_memory()
+        origins = ['AS65546', 'AS65547']
+        assert preloader.aggregated_routes_for_origins(origins, ['TEST1']) == [
+            '192.0.2.0/24', '198.51.100.0/24', '2001:db8::/32',
+        ]
+        assert preloader.aggregated_routes_for_origins(origins, ['TEST1'], 4, ranges=True) == [
+            '192.0.2.0/24^24-25', '198.51.100.0/24',
+        ]
+        assert preloader.aggregated_routes_for_origins(origins, ['TEST1'], 6, ranges=True) == [
+            '2001:db8::/32^33',
+        ]
+        assert preloader.aggregated_routes_for_origins(origins, ['TEST2']) == []
+
+    def test_origins_for_prefix(self, mock_redis_keys):
+        preloader = Preloader(enable_queries=False)
+        preload_manager = PreloadStoreManager()
+
+        preload_manager.update_store(
+            {
+                f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65547': {pack_prefix(4, '192.0.2.0', 24), pack_prefix(4, '192.0.2.0', 25)},
+                f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65546': {pack_prefix(4, '192.0.2.0', 25)},
+                f'TEST2{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65546': {pack_prefix(4, '192.0.2.0', 25)},
+                f'TEST2{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS8': {pack_prefix(4, '192.0.0.0', 16)},
+            },
+            {
+                f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65547': {pack_prefix(6, '2001:db8::', 32)},
+            },
+            {}, set(),
+        )
+        preloader._load_routes_into_memory()
+        assert preloader.prefix_index_available()
+        sources = ['TEST1', 'TEST2']
+        assert preloader.origins_for_prefix(4, '192.0.2.0', 25, sources) == ['AS65546', 'AS65546', 'AS65547']
+        assert preloader.origins_for_prefix(4, '192.0.2.0', 25, ['TEST1']) == ['AS65546', 'AS65547']
+        assert preloader.origins_for_prefix(4, '192.0.2.0', 24, sources) == ['AS65547']
+        assert preloader.origins_for_prefix(4, '192.0.2.128', 25, sources) == []
+        assert preloader.origins_for_prefix(4, '192.0.2.0', 25, sources, less_specific=True) == [
+            'AS8', 'AS65547', 'AS65546', 'AS65546', 'AS65547',
+        ]
+        assert preloader.origins_for_prefix(4, '192.0.2.128', 25, sources, less_specific=True) == ['AS8', 'AS65547']
+        assert preloader.origins_for_prefix(6, '2001:db8::', 32, sources) == ['AS65547']
+        assert preloader.origins_for_prefix(6, '2001:db8::', 48, sources) == []
+        assert preloader.origins_for_prefix(6, '2001:db8::', 48, sources, less_specific=True) == ['AS65547']
+
+        # The index follows incremental changes
+        assert preload_manager.apply_changes([(4, 'TEST1', 'AS65546', '192.0.2.0/25', False)])
+        preloader._load_routes_into_memory()
+        assert preloader.origins_for_prefix(4, '192.0.2.0', 25, sources) == ['AS65546', 'AS65547']
+
+    def test_wait_for_snapshot(self, mock_redis_keys):
+        preloader = Preloader(enable_queries=False)
+        preload_manager = PreloadStoreManager()
+        # No snapshot exists yet
+        preloader._load_routes_into_memory()
+        assert preloader.generation() is None
+
+        results = []
+        query_thread = threading.Thread(
+            target=lambda: results.append(preloader.routes_for_origins(['AS65546'], ['TEST1'])))
+        query_thread.start()
+        time.sleep(0.1)
+        assert not results
+
+        preload_manager.update_store({
+            f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65546': {pack_prefix(4, '192.0.2.0', 25)},
+        }, {}, {}, set())
+        generation = PreloadSnapshot(preload_snapshot_path()).generation
+        preloader._load_routes_into_memory({'data': str(generation).encode('ascii')})
+        query_thread.join(timeout=1)
+        assert results == [{'192.0.2.0/25'}]
+        assert preloader.generation() == generation
+
+        # The same generation is not attached again
+        snapshot = preloader._snapshot
+        preloader._load_routes_into_memory({'data': str(generation).encode('ascii')})
+        preloader._load_routes_into_memory()
+        assert preloader._snapshot is snapshot
+
+    def test_apply_route_changes(self, mock_redis_keys):
+        # Snapshots are attached explicitly, rather than by the pubsub thread
+        preloader = Preloader(enable_queries=False)
+        preload_manager = PreloadStoreManager()
+        preload_manager._full_reload_required.clear()
+
+        preload_manager.update_store(
+            {
+                f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65546': {pack_prefix(4, '192.0.2.0', 25)},
+                f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65547': {pack_prefix(4, '192.0.2.128', 25), pack_prefix(4, '198.51.100.0', 25)},
+            },
+            {}, {}, set(),
+        )
+        preloader._load_routes_into_memory()
+        first_sequence = preloader.claim_change_sequence()
+        stale_sequence = preloader.claim_change_sequence()
+        # Changes are applied in commit order, rather than the order in which they are signalled
+        preloader.signal_reload({'route'}, [
+            (4, 'TEST1', 'AS65547', '192.0.2.128/25', True),
+            (4, 'TEST1', 'AS65547', '198.51.100.0/25', False),
+        ])
+        preloader.signal_reload({'route'}, [
+            (4, 'TEST1', 'AS65546', '192.0.2.0/25', False),
+            (4, 'TEST1', 'AS65547', '192.0.2.128/25', False),
+            (6, 'TEST2', 'AS65547', '2001:db8::/32', True),
+        ], sequence=first_sequence)
+        # Not relevant to the store, should not be recorded
+        preloader.signal_reload({'inetnum'}, [(4, 'TEST1', 'AS65548', '203.0.113.0/24', True)])
+
+        route_changes, set_changes = preload_manager.claim_pending_changes()
+        assert not set_changes
+        read_hash = preload_manager._read_hash
+        preload_manager._read_hash = Mock(wraps=read_hash)
+        assert preload_manager.apply_changes(route_changes)
+        preloader._load_routes_into_memory()
+        # The tables of the snapshot are patched, rather than read from redis and rebuilt
+        assert not preload_manager._read_hash.mock_calls
+        assert preload_manager._snapshot_tables == preload_manager._build_snapshot_tables(
+            read_hash(preload_manager._current_store_key(TEST_REDIS_ORIGIN_ROUTE4_STORE_KEY)),
+            read_hash(preload_manager._current_store_key(TEST_REDIS_ORIGIN_ROUTE6_STORE_KEY)),
+            read_hash(preload_manager._current_store_key(TEST_REDIS_SET_STORE_KEY)),
+        )
+        assert preloader.origins_for_prefix(4, '192.0.2.128', 25, ['TEST1']) == ['AS65547']
+        assert preloader.origins_for_prefix(4, '192.0.2.0', 25, ['TEST1']) == []
+        sources = ['TEST1', 'TEST2']
+        assert preloader.routes_for_origins(['AS65546'], sources) == set()
+        assert preloader.routes_for_origins(['AS65547'], sources, 4) == {'192.0.2.128/25'}
+        assert preloader.routes_for_origins(['AS65547'], sources, 6) == {'2001:db8::/32'}
+        assert preloader.routes_for_origins(['AS65548'], sources) == set()
+
+        # Changes older than those already applied may undo newer changes
+        preload_manager.perform_reload = Mock()
+        preloader.signal_reload({'route'}, [(4, 'TEST1', 'AS65547', '192.0.2.128/25', False)],
+                                sequence=stale_sequence)
+        assert preload_manager.claim_pending_changes() == ([], [])
+        assert len(preload_manager.perform_reload.mock_calls) == 1
+
+        # Pending changes are discarded when a full reload is claimed
+        preloader.signal_reload({'route'}, [(4, 'TEST1', 'AS65548', '203.0.113.0/24', True)])
+        preload_manager._full_reload_required.set()
+        assert preload_manager.claim_full_reload()
+        assert not preload_manager.claim_full_reload()
+        assert preload_manager.claim_pending_changes() == ([], [])
+        assert preloader.routes_for_origins(['AS65548'], sources) == set()
+
+    def test_delta_snapshot(self, mock_redis_keys, monkeypatch):
+        preloader = Preloader(enable_queries=False)
+        preload_manager = PreloadStoreManager()
+        preload_manager._full_reload_required.clear()
+        preload_manager.update_store(
+            {
+                f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65546': {pack_prefix(4, '192.0.2.0', 25)},
+                f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65547': {pack_prefix(4, '198.51.100.0', 25)},
+            },
+            {}, {}, set(),
+        )
+        base_generation = PreloadSnapshot(preload_snapshot_path()).generation
+        preloader._load_routes_into_memory()
+        assert not os.path.exists(preload_delta_snapshot_path())
+
+        # Incremental updates only write the changed entries, on top of the same base
+        assert preload_manager.apply_changes([(4, 'TEST1', 'AS65546', '192.0.2.0/25', False)])
+        assert preload_manager.apply_changes([(4, 'TEST1', 'AS65548', '192.0.2.0/25', True)])
+        assert PreloadSnapshot(preload_snapshot_path()).generation == base_generation
+        delta = PreloadSnapshot(preload_delta_snapshot_path())
+        assert delta.generation == base_generation + 2
+        assert delta.get(SNAPSHOT_ORIGIN_ROUTE4_TABLE, f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65546'.encode('ascii')) == b''
+        assert delta.get(SNAPSHOT_ORIGIN_ROUTE4_TABLE, f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65547'.encode('ascii')) is None
+        base = preloader._snapshot.base
+        preloader._load_routes_into_memory()
+        assert preloader._snapshot.base is base
+        assert preloader.generation() == base_generation + 2
+        assert preloader.routes_for_origins(['AS65546'], ['TEST1']) == set()
+        assert preloader.routes_for_origins(['AS65547'], ['TEST1']) == {'198.51.100.0/25'}
+        assert preloader.routes_for_origins(['AS65548'], ['TEST1']) == {'192.0.2.0/25'}
+        assert preloader.origins_for_prefix(4, '192.0.2.0', 25, ['TEST1']) == ['AS65548']
+
+        # Once the delta grows too large, it is compacted into a new base snapshot
+        monkeypatch.setattr('irrd.storage.preload.PRELOAD_DELTA_MAX_ENTRIES', 2)
+        assert preload_manager.apply_changes([(4, 'TEST1', 'AS65547', '198.51.100.0/25', False)])
+        assert PreloadSnapshot(preload_snapshot_path()).generation == base_generation + 3
+        assert not os.path.exists(preload_delta_snapshot_path())
+        assert not preload_manager._delta_tables
+        preloader._load_routes_into_memory()
+        assert preloader._snapshot.delta is None
+        assert preloader.generation() == base_generation + 3
+        assert preloader.routes_for_origins(['AS65547'], ['TEST1']) == set()
+        assert preloader.routes_for_origins(['AS65548'], ['TEST1']) == {'192.0.2.0/25'}
+
+    def test_metrics(self, mock_redis_keys):
+        preloader = Preloader(enable_queries=False)
+        preload_manager = PreloadStoreManager()
+        preload_manager._full_reload_required.clear()
+        preload_manager._clear_existing_data()
+        redis_conn = preload_manager._redis_conn
+
+        preload_manager.update_store(
+            {
+                f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65546': {pack_prefix(4, '192.0.2.0', 25)},
+                f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65547': {pack_prefix(4, '192.0.2.128', 25), pack_prefix(4, '198.51.100.0', 25)},
+                f'TEST2{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65547': {pack_prefix(4, '192.0.2.128', 25)},
+            },
+            {
+                f'TEST2{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65547': {pack_prefix(6, '2001:db8::', 32)},
+            },
+            {b'AS-TEST': b'{}'}, set(),
+        )
+        assert redis_conn.hgetall(TEST_REDIS_PRELOAD_STORE_SIZE_KEY) == {
+            b'origins:4:TEST1': b'2',
+            b'prefixes:4:TEST1': b'3',
+            b'origins:4:TEST2': b'1',
+            b'prefixes:4:TEST2': b'1',
+            b'origins:6:TEST2': b'1',
+            b'prefixes:6:TEST2': b'1',
+        }
+        metrics = redis_conn.hgetall(TEST_REDIS_PRELOAD_METRICS_KEY)
+        assert int(metrics[b'generation']) == PreloadSnapshot(preload_snapshot_path()).generation
+        assert metrics[b'sets'] == b'1'
+        assert metrics[b'snapshot_delta_entries'] == b'0'
+        assert float(metrics[b'snapshot_duration_last']) >= 0
+        assert b'commit_delay_last' not in metrics
+
+        # The oldest commit not yet included in the store is tracked until the next snapshot
+        preloader.signal_reload({'route'}, [(4, 'TEST1', 'AS65546', '192.0.2.0/25', False)])
+        pending_commit_timestamp = float(redis_conn.hget(TEST_REDIS_PRELOAD_METRICS_KEY, 'pending_commit_timestamp'))
+        preloader.signal_reload({'route'}, [(4, 'TEST1', 'AS65547', '192.0.2.128/25', False)])
+        assert float(redis_conn.hget(TEST_REDIS_PRELOAD_METRICS_KEY, 'pending_commit_timestamp')) == pending_commit_timestamp
+
+        route_changes, _ = preload_manager.claim_pending_changes()
+        metrics = redis_conn.hgetall(TEST_REDIS_PRELOAD_METRICS_KEY)
+        assert b'pending_commit_timestamp' not in metrics
+        assert float(metrics[b'claimed_commit_timestamp']) == pending_commit_timestamp
+
+        assert preload_manager.apply_changes(route_changes)
+        preload_manager._coalesced_reloads = 2
+        preload_manager.record_update(False, 1.5)
+        preload_manager.record_update(False, 0.5)
+        metrics = redis_conn.hgetall(TEST_REDIS_PRELOAD_METRICS_KEY)
+        assert b'claimed_commit_timestamp' not in metrics
+        assert float(metrics[b'commit_delay_last']) >= 0
+        assert int(metrics[b'snapshot_delta_entries']) > 0
+        assert redis_conn.hget(TEST_REDIS_PRELOAD_STORE_SIZE_KEY, 'prefixes:4:TEST1') == b'1'
+        assert metrics[b'updates_incremental'] == b'2'
+        assert float(metrics[b'duration_total_incremental']) == 2
+        assert float(metrics[b'duration_last_incremental']) == 0.5
+        assert metrics[b'coalesced_reloads'] == b'2'
+
+        preload_manager._clear_existing_data()
+        assert not redis_conn.exists(TEST_REDIS_PRELOAD_METRICS_KEY)
+        assert not redis_conn.exists(TEST_REDIS_PRELOAD_STORE_SIZE_KEY)
+
+    def test_store_replacement(self, mock_redis_keys, monkeypatch):
+        monkeypatch.setattr('irrd.storage.preload.REDIS_CHUNK_SIZE', 2)
+        preload_manager = PreloadStoreManager()
+        redis_conn = preload_manager._redis_conn
+        redis_conn.hmset = Mock(wraps=redis_conn.hmset)
+
+        route4_store = {
+            f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS{asn}': {pack_prefix(4, '192.0.2.0', 24)}
+            for asn in range(65536, 65541)
+        }
+        preload_manager.update_store(route4_store, {}, {b'AS-TEST': b'{}'}, set())
+        first_key = redis_conn.hget(TEST_REDIS_STORE_POINTER_KEY, TEST_REDIS_ORIGIN_ROUTE4_STORE_KEY)
+        assert first_key.startswith(TEST_REDIS_ORIGIN_ROUTE4_STORE_KEY + b'-')
+        assert redis_conn.hlen(first_key) == 5
+        store_writes = [call[1] for call in redis_conn.hmset.mock_calls if call[1][0] != TEST_REDIS_STORE_POINTER_KEY]
+        assert max(len(contents) for key, contents in store_writes) == 2
+
+        preload_manager.update_store(route4_store, {}, {}, set())
+        second_key = redis_conn.hget(TEST_REDIS_STORE_POINTER_KEY, TEST_REDIS_ORIGIN_ROUTE4_STORE_KEY)
+        assert second_key != first_key
+        assert not redis_conn.exists(first_key)
+        assert preload_manager._read_hash(second_key) == {
+            key.encode('ascii'): pack_prefix(4, '192.0.2.0', 24) for key in route4_store.keys()
+        }
+
+        preload_manager._clear_existing_data()
+        assert not redis_conn.exists(second_key)
+        assert not redis_conn.exists(TEST_REDIS_STORE_POINTER_KEY)
+
+        # Changes can not be applied if the store is missing
+        preload_manager.perform_reload = Mock()
+        assert not preload_manager.apply_changes([(4, 'TEST1', 'AS65546', '192.0.2.0/25', True)])
+        assert len(preload_manager.perform_reload.mock_calls) == 1
+
+    def test_sets(self, mock_redis_keys):
+        preloader = Preloader(enable_queries=False)
+        preload_manager = PreloadStoreManager()
+        preload_manager._full_reload_required.clear()
+        assert not preloader.set_store_available()
+
+        preload_manager.update_store({}, {}, {
+            b'AS-TEST': b'{"TEST1":["as-set",["AS65547"],[["TEST1","AS65548",true,true]]]}',
+            b'AS-KEEP': b'{"TEST1":["as-set",[],[["TEST1","AS65548",true,true]]]}',
+        }, {('TEST1', 'AS65548'): {'AS-TEST', 'AS-KEEP'}})
+        preloader._load_routes_into_memory()
+        assert preloader.set_store_available()
+        assert preloader.sets('as-test') == {'TEST1': ['as-set', ['AS65547'], [['TEST1', 'AS65548', True, True]]]}
+        assert preloader.sets('AS-OTHER') == {}
+        cache = preloader.set_expansion_cache
+        cache.put('key-as-test', 'value', {'set:AS-TEST'}, cache.generation)
+        cache.put('key-origin', 'value', {'origin:AS65546'}, cache.generation)
+        cache.put('key-unrelated', 'value', {'set:AS-UNRELATED', 'origin:AS65547'}, cache.generation)
+
+        preloader.signal_reload({'route'}, [(4, 'TEST1', 'AS65546', '192.0.2.0/25', True)],
+                                [('TEST1', 'route', '192.0.2.0/25AS65546', [])])
+        route_changes, set_changes = preload_manager.claim_pending_changes()
+        assert route_changes == [(4, 'TEST1', 'AS65546', '192.0.2.0/25', True)]
+        assert set_changes == [('TEST1', 'route', '192.0.2.0/25AS65546', [])]
+        assert preload_manager.changed_set_names(set_changes) == set()
+        assert preload_manager.changed_set_names([('TEST1', 'route', '192.0.2.0/25AS65546', ['rs-test'])]) == {'RS-TEST'}
+        assert preload_manager.changed_set_names([('TEST1', 'as-set', 'AS-OTHER', [])]) == {'AS-OTHER'}
+        assert preload_manager.changed_set_names([('TEST1', 'aut-num', 'AS65548', [])]) == {'AS-TEST', 'AS-KEEP'}
+        assert preload_manager.changed_set_names([('TEST2', 'aut-num', 'AS65548', [])]) == set()
+
+        # Only the reloaded sets are replaced: AS-TEST was deleted, and AS-OTHER created
+        assert preload_manager.apply_changes(route_changes, {'AS-TEST', 'AS-OTHER'},
+                                             {b'AS-OTHER': b'{"TEST2":["as-set",[],[]]}'}, {})
+        preloader._load_routes_into_memory()
+        # Only cached set expansions depending on changed sets or origins are invalidated
+        assert cache.get('key-as-test') is None
+        assert cache.get('key-origin') is None
+        assert cache.get('key-unrelated') == 'value'
+        assert preloader.routes_for_origins(['AS65546'], ['TEST1']) == {'192.0.2.0/25'}
+        assert preloader.sets('AS-TEST') == {}
+        assert preloader.sets('AS-OTHER') == {'TEST2': ['as-set', [], []]}
+        assert preloader.sets('AS-KEEP') == {'TEST1': ['as-set', [], [['TEST1', 'AS65548', True, True]]]}
+        assert preload_manager.changed_set_names([('TEST1', 'aut-num', 'AS65548', [])]) == {'AS-KEEP'}
+
 
 class TestPreloadUpdater:
     def test_preload_updater(self, monkeypatch):
@@ -158,7 +534,63 @@ class TestPreloadUpdater:
                 'source': 'TEST2',
             },
         ]
-        mock_database_handler.execute_query = lambda query: mock_query_result
+        mock_set_query_result = [
+            {
+                'rpsl_pk': 'AS-TEST',
+                'source': 'TEST1',
+                'object_class': 'as-set',
+                'parsed_data': {'as-set': 'AS-TEST', 'members': ['AS65547'], 'mbrs-by-ref': ['MNT-TEST']},
+            },
+            {
+                'rpsl_pk': 'AS-TEST',
+                'source': 'TEST2',
+                'object_class': 'as-set',
+                'parsed_data': {'as-set': 'AS-TEST', 'members': ['AS65548']},
+            },
+            {
+                'rpsl_pk': 'RS-TEST',
+                'source': 'TEST1',
+                'object_class': 'route-set',
+                'parsed_data': {'route-set': 'RS-TEST', 'mp-members': ['2001:db8::/32'], 'mbrs-by-ref': ['ANY']},
+            },
+        ]
+        mock_member_of_query_result = [
+            {
+                'rpsl_pk': 'AS65549',
+                'source': 'TEST1',
+                'object_class': 'aut-num',
+                'parsed_data': {'aut-num': 'AS65549', 'member-of': ['as-test'], 'mnt-by': ['mnt-test']},
+                'rpki_status': RPKIStatus.not_found,
+                'scopefilter_status': ScopeFilterStatus.in_scope,
+            },
+            {
+                'rpsl_pk': 'AS65550',
+                'source': 'TEST1',
+                'object_class': 'aut-num',
+                'parsed_data': {'aut-num': 'AS65550', 'member-of': ['AS-TEST'], 'mnt-by': ['MNT-OTHER']},
+                'rpki_status': RPKIStatus.not_found,
+                'scopefilter_status': ScopeFilterStatus.in_scope,
+            },
+            {
+                # route-sets can not include aut-nums
+                'rpsl_pk': 'AS65551',
+                'source': 'TEST2',
+                'object_class': 'aut-num',
+                'parsed_data': {'aut-num': 'AS65551', 'member-of': ['RS-TEST'], 'mnt-by': ['MNT-TEST']},
+                'rpki_status': RPKIStatus.not_found,
+                'scopefilter_status': ScopeFilterStatus.in_scope,
+            },
+            {
+                'rpsl_pk': '192.0.2.0/24AS65547',
+                'source': 'TEST2',
+                'object_class': 'route',
+                'parsed_data': {'route': '192.0.2.0/24', 'member-of': ['RS-TEST'], 'mnt-by': ['MNT-OTHER']},
+                'rpki_status': RPKIStatus.invalid,
+                'scopefilter_status': ScopeFilterStatus.out_scope_as,
+            },
+        ]
+        mock_query_results = iter([mock_query_result, mock_set_query_result, mock_member_of_query_result])
+        mock_database_handler.execute_query = lambda query: next(mock_query_results)
         PreloadUpdater(mock_preload_obj, mock_reload_lock).run(mock_database_handler)
 
         assert flatten_mock_calls(mock_reload_lock) == [['acquire', (), {}], ['release', (), {}]]
@@ -166,22 +598,96 @@ class TestPreloadUpdater:
             ['object_classes', (['route', 'route6'],), {}],
             ['rpki_status', ([RPKIStatus.not_found, RPKIStatus.valid],), {}],
             ['scopefilter_status', ([ScopeFilterStatus.in_scope],), {}],
+            ['object_classes', (['as-set', 'route-set'],), {}],
+            ['object_classes', (['route', 'route6', 'aut-num'],), {}],
+            ['lookup_attrs_in', (['member-of'], ['AS-TEST', 'RS-TEST']), {}],
         ]
 
         assert flatten_mock_calls(mock_preload_obj) == [
+            ['claim_full_reload', (), {}],
             [
-                'update_route_store',
+                'update_store',
                 (
                     {
-                        f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65546': {'192.0.2.0/25'},
-                        f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65547': {'192.0.2.128/25', '198.51.100.0/25'},
+                        f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65546': {pack_prefix(4, '192.0.2.0', 25)},
+                        f'TEST1{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65547': {pack_prefix(4, '192.0.2.128', 25), pack_prefix(4, '198.51.100.0', 25)},
+                    },
+                    {
+                        f'TEST2{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65547': {pack_prefix(6, '2001:db8::', 32)}
                     },
                     {
-                        f'TEST2{REDIS_KEY_ORIGIN_SOURCE_SEPARATOR}AS65547': {'2001:db8::/32'}
+                        b'AS-TEST': ujson.dumps({
+                            'TEST1': ['as-set', ['AS65547'], [['TEST1', 'AS65549', True, True]]],
+                            'TEST2': ['as-set', ['AS65548'], []],
+                        }).encode('utf-8'),
+                        b'RS-TEST': ujson.dumps({
+                            'TEST1': ['route-set', ['2001:db8::/32'], [['TEST2', '192.0.2.0/24', False, False]]],
+                        }).encode('utf-8'),
                     },
+                    {('TEST1', 'AS65549'): {'AS-TEST'}, ('TEST2', '192.0.2.0/24AS65547'): {'RS-TEST'}},
                 ),
                 {}
-            ]
+            ],
+            ['record_update', (True, ANY), {}],
+        ]
+
+    def test_preload_updater_incremental(self, monkeypatch):
+        mock_database_handler = Mock(spec=DatabaseHandler)
+        mock_reload_lock = Mock()
+        mock_preload_obj = Mock()
+        mock_preload_obj.claim_full_reload = Mock(return_value=False)
+        route_changes = [(4, 'TEST1', 'AS65546', '192.0.2.0/25', True)]
+        set_changes = [('TEST1', 'route', '192.0.2.0/25AS65546', [])]
+        mock_preload_obj.claim_pending_changes = Mock(return_value=(route_changes, set_changes))
+        mock_preload_obj.changed_set_names = Mock(return_value=set())
+
+        PreloadUpdater(mock_preload_obj, mock_reload_lock).run(mock_database_handler)
+
+        assert flatten_mock_calls(mock_reload_lock) == [['acquire', (), {}], ['release', (), {}]]
+        assert flatten_mock_calls(mock_preload_obj) == [
+            ['claim_full_reload', (), {}],
+            ['claim_pending_changes', (), {}],
+            ['changed_set_names', (set_changes,), {}],
+            ['apply_changes', (route_changes, set(), None, None), {}],
+            ['record_update', (False, ANY), {}],
+        ]
+        assert not mock_database_handler.execute_query.mock_calls
+
+        # Only the sets affected by the changes are reloaded
+        mock_database_query = Mock(spec=RPSLDatabaseQuery)
+        monkeypatch.setattr('irrd.storage.preload.RPSLDatabaseQuery',
+                            lambda column_names, enable_ordering: mock_database_query)
+        mock_preload_obj.reset_mock()
+        mock_preload_obj.changed_set_names = Mock(return_value={'AS-TEST', 'AS-OTHER'})
+        mock_database_handler.execute_query = Mock(return_value=[{
+            'rpsl_pk': 'AS-TEST',
+            'source': 'TEST1',
+            'object_class': 'as-set',
+            'parsed_data': {'as-set': 'AS-TEST', 'members': ['AS65547']},
+        }])
+        PreloadUpdater(mock_preload_obj, mock_reload_lock).run(mock_database_handler)
+        assert flatten_mock_calls(mock_preload_obj) == [
+            ['claim_full_reload', (), {}],
+            ['claim_pending_changes', (), {}],
+            ['changed_set_names', (set_changes,), {}],
+            ['apply_changes', (route_changes, {'AS-TEST', 'AS-OTHER'}, {
+                b'AS-TEST': ujson.dumps({'TEST1': ['as-set', ['AS65547'], []]}).encode('utf-8'),
+            }, {}), {}],
+            ['record_update', (False, ANY), {}],
+        ]
+        assert flatten_mock_calls(mock_database_query) == [
+            ['object_classes', (['as-set', 'route-set'],), {}],
+            ['rpsl_pks', (['AS-OTHER', 'AS-TEST'],), {}],
+        ]
+        assert len(mock_database_handler.execute_query.mock_calls) == 1
+
+        # No pending changes
+        mock_preload_obj.reset_mock()
+        mock_preload_obj.claim_pending_changes = Mock(return_value=([], []))
+        PreloadUpdater(mock_preload_obj, mock_reload_lock).run(mock_database_handler)
+        assert flatten_mock_calls(mock_preload_obj) == [
+            ['claim_full_reload', (), {}],
+            ['claim_pending_changes', (), {}],
         ]
 
     def test_preload_updater_failure(self, caplog):
@@ -192,3 +698,15 @@ class TestPreloadUpdater:
 
         assert 'Updating preload store failed' in caplog.text
         assert flatten_mock_calls(mock_reload_lock) == [['acquire', (), {}], ['release', (), {}]]
+
+
+class TestPackedPrefixes:
+    def test_pack_unpack(self):
+        packed4 = pack_prefix(4, '192.0.2.0', 25) + pack_prefix(4, '198.51.100.0', 24)
+        assert packed4 == b'\xc0\x00\x02\x00\x19\xc6\x33\x64\x00\x18'
+        assert [unpack_prefix(4, p) for p in split_packed_prefixes(4, packed4)] == ['192.0.2.0/25', '198.51.100.0/24']
+
+        packed6 = pack_prefix(6, '2001:db8::', 32) + pack_prefix(6, '2001:db8::1', 128)
+        assert len(packed6) == 34
+        assert [unpack_prefix(6, p) for p in split_packed_prefixes(6, packed6)] == ['2001:db8::/32', '2001:db8::1/128']
+        assert list(split_packed_prefixes(6, b'')) == []
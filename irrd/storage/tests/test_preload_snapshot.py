@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+from ..preload_snapshot import OverlaySnapshot, PreloadSnapshot, write_snapshot
+
+
+class TestPreloadSnapshot:
+    def test_write_read_snapshot(self, tmpdir):
+        path = str(tmpdir) + '/snapshot'
+        table1 = {b'key-%d' % idx: b'value-%d' % idx for idx in range(1000)}
+        write_snapshot(path, 42, {
+            'table1': table1,
+            'table2': {b'a': b'', b'b': b'\x00\x01'},
+            'empty': {},
+        })
+
+        snapshot = PreloadSnapshot(path)
+        assert snapshot.generation == 42
+        for key, value in table1.items():
+            assert snapshot.get('table1', key) == value
+        assert snapshot.get('table1', b'key-1000') is None
+        assert snapshot.get('table1', b'a') is None
+        assert snapshot.get('table2', b'a') == b''
+        assert snapshot.get('table2', b'b') == b'\x00\x01'
+        assert snapshot.get('table2', b'c') is None
+        assert snapshot.get('empty', b'a') is None
+        assert snapshot.get('unknown', b'a') is None
+        assert snapshot.table_size('table1') == 1000
+        assert snapshot.table_size('table2') == 2
+        assert snapshot.table_size('empty') == 0
+        assert snapshot.table_size('unknown') == 0
+        assert list(snapshot.keys('table2')) == [b'a', b'b']
+        assert list(snapshot.keys('empty')) == []
+        assert list(snapshot.keys('unknown')) == []
+        assert snapshot.has_table('empty')
+        assert not snapshot.has_table('unknown')
+
+        # Replacing the snapshot must not affect the existing one
+        write_snapshot(path, 43, {'table1': {b'key-1': b'new-value'}})
+        assert snapshot.generation == 42
+        assert snapshot.get('table1', b'key-1') == b'value-1'
+        snapshot.close()
+
+        new_snapshot = PreloadSnapshot(path)
+        assert new_snapshot.generation == 43
+        assert new_snapshot.get('table1', b'key-1') == b'new-value'
+        assert new_snapshot.get('table1', b'key-2') is None
+        new_snapshot.close()
+
+        assert os.listdir(str(tmpdir)) == ['snapshot']
+
+    def test_overlay_snapshot(self, tmpdir):
+        write_snapshot(str(tmpdir) + '/base', 42, {
+            'table1': {b'a': b'base-a', b'b': b'base-b', b'c': b'base-c'},
+        })
+        write_snapshot(str(tmpdir) + '/delta', 44, {
+            'table1': {b'b': b'delta-b', b'c': b'', b'd': b'delta-d'},
+        })
+        base = PreloadSnapshot(str(tmpdir) + '/base')
+        delta = PreloadSnapshot(str(tmpdir) + '/delta')
+
+        snapshot = OverlaySnapshot(base, delta)
+        assert snapshot.generation == 44
+        assert snapshot.get('table1', b'a') == b'base-a'
+        assert snapshot.get('table1', b'b') == b'delta-b'
+        assert snapshot.get('table1', b'c') is None
+        assert snapshot.get('table1', b'd') == b'delta-d'
+        assert snapshot.get('table1', b'e') is None
+        assert snapshot.has_table('table1')
+        assert not snapshot.has_table('unknown')
+
+        snapshot = OverlaySnapshot(base)
+        assert snapshot.generation == 42
+        assert snapshot.get('table1', b'c') == b'base-c'
+        assert snapshot.get('table1', b'd') is None
+
+    def test_invalid_snapshot(self, tmpdir):
+        path = str(tmpdir) + '/snapshot'
+        with pytest.raises(FileNotFoundError):
+            PreloadSnapshot(path)
+
+        with open(path, 'wb') as f:
+            f.write(b'invalid')
+        with pytest.raises(ValueError) as ve:
+            PreloadSnapshot(path)
+        assert 'file is truncated' in str(ve.value)
+
+        with open(path, 'wb') as f:
+            f.write(b'invalid-snapshot-contents')
+        with pytest.raises(ValueError) as ve:
+            PreloadSnapshot(path)
+        assert 'unknown file format' in str(ve.value)
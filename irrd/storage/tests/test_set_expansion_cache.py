@@ -0,0 +1,55 @@
+from ..set_expansion_cache import SetExpansionCache, origin_dependency, set_dependency
+
+
+class TestSetExpansionCache:
+    def test_get_put(self):
+        cache = SetExpansionCache(max_entries=2)
+        cache.put('key1', 'value1', {'set:AS-TEST'}, None)
+        assert cache.get('key1') is None
+
+        cache.snapshot_attached(1, None)
+        assert cache.generation == 1
+        cache.put('key1', 'value1', {'set:AS-TEST'}, 1)
+        cache.put('key2', 'value2', {'set:AS-TEST', 'origin:AS65537'}, 1)
+        # Resolved from an older snapshot, must not be cached
+        cache.put('key3', 'value3', {'set:AS-OTHER'}, 0)
+        assert cache.get('key1') == 'value1'
+        assert cache.get('key2') == 'value2'
+        assert cache.get('key3') is None
+
+        # key2 is least recently used, and should be evicted
+        cache.get('key1')
+        cache.put('key3', 'value3', {'set:AS-OTHER'}, 1)
+        assert len(cache) == 2
+        assert cache.get('key2') is None
+        assert cache.get('key1') == 'value1'
+        assert cache.get('key3') == 'value3'
+
+    def test_invalidation(self):
+        cache = SetExpansionCache()
+        cache.snapshot_attached(1, None)
+        cache.put('key1', 'value1', {'set:AS-TEST'}, 1)
+        cache.put('key2', 'value2', {'set:AS-TEST', 'origin:AS65537'}, 1)
+        cache.put('key3', 'value3', {'set:AS-OTHER'}, 1)
+
+        cache.snapshot_attached(2, ['origin:AS65537', 'set:AS-UNKNOWN'])
+        assert cache.get('key1') == 'value1'
+        assert cache.get('key2') is None
+        assert cache.get('key3') == 'value3'
+
+        cache.snapshot_attached(3, ['set:AS-TEST'])
+        assert cache.get('key1') is None
+        assert cache.get('key3') == 'value3'
+
+        # Missed a generation, all entries are invalidated
+        cache.snapshot_attached(5, ['set:AS-TEST'])
+        assert len(cache) == 0
+        cache.put('key3', 'value3', {'set:AS-OTHER'}, 5)
+
+        # Full reload, all entries are invalidated
+        cache.snapshot_attached(6, None)
+        assert len(cache) == 0
+
+    def test_dependencies(self):
+        assert set_dependency('as-test') == 'set:AS-TEST'
+        assert origin_dependency('AS65537') == 'origin:AS65537'
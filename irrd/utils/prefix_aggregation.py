@@ -0,0 +1,96 @@
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set, Tuple
+
+"""
+Aggregation of prefix lists, e.g. for responses to !g or !a queries.
+
+Prefixes are handled as tuples of the network address as an integer and
+the prefix length, along with the address length, i.e. 32 for IPv4 or
+128 for IPv6, so that large lists can be aggregated without creating
+IP objects for each prefix.
+"""
+
+
+def aggregate_prefixes(prefixes: Iterable[Tuple[int, int]], address_length: int) -> List[Tuple[int, int]]:
+    """
+    Aggregate prefixes into the smallest list of prefixes that covers
+    exactly the same address space. More specifics of other prefixes are
+    removed, and adjacent prefixes are merged into their parent.
+    Returns a list of (network, length) tuples, sorted by address.
+    """
+    result: List[Tuple[int, int]] = []
+    for network, length in sorted(prefixes):
+        if result:
+            last_network, last_length = result[-1]
+            if last_length <= length and _parent(network, last_length, address_length) == last_network:
+                continue
+        result.append((network, length))
+
+        while len(result) >= 2:
+            (first_network, first_length), (second_network, second_length) = result[-2:]
+            if first_length != second_length or not first_length:
+                break
+            parent_network = _parent(first_network, first_length - 1, address_length)
+            if parent_network != first_network or second_network != first_network + _size(first_length, address_length):
+                break
+            result[-2:] = [(parent_network, first_length - 1)]
+    return result
+
+
+def aggregate_prefix_ranges(prefixes: Iterable[Tuple[int, int]],
+                            address_length: int) -> List[Tuple[int, int, int, int]]:
+    """
+    Aggregate prefixes into a short list of prefix ranges, that matches
+    exactly the same prefixes, e.g. 192.0.2.0/24 along with 192.0.2.0/25
+    and 192.0.2.128/25 are aggregated into 192.0.2.0/24^24-25.
+
+    Returns a list of (network, length, minimum length, maximum length)
+    tuples, sorted by address. The range includes every more specific
+    of network/length with a length between the minimum and maximum length.
+    """
+    networks_by_length: Dict[int, Set[int]] = defaultdict(set)
+    for network, length in prefixes:
+        networks_by_length[length].add(network)
+    covered_by_length: Dict[int, Set[int]] = defaultdict(set)
+
+    def all_present(network: int, length: int, more_specific_length: int) -> bool:
+        # Whether all more specifics of network/length with more_specific_length are present
+        present = networks_by_length.get(more_specific_length)
+        count = 1 << (more_specific_length - length)
+        if not present or count > len(present):
+            return False
+        step = _size(more_specific_length, address_length)
+        return all(network + idx * step in present for idx in range(count))
+
+    ranges = []
+    for length in sorted(networks_by_length.keys()):
+        for network in sorted(networks_by_length[length]):
+            if network in covered_by_length[length]:
+                continue
+
+            root_length = length
+            while root_length and all_present(_parent(network, root_length - 1, address_length),
+                                              root_length - 1, length):
+                root_length -= 1
+            root_network = _parent(network, root_length, address_length)
+
+            max_length = length
+            while max_length < address_length and all_present(root_network, root_length, max_length + 1):
+                max_length += 1
+
+            ranges.append((root_network, root_length, length, max_length))
+            for covered_length in range(length, max_length + 1):
+                step = _size(covered_length, address_length)
+                covered_by_length[covered_length].update(
+                    root_network + idx * step for idx in range(1 << (covered_length - root_length))
+                )
+    return sorted(ranges)
+
+
+def _parent(network: int, parent_length: int, address_length: int) -> int:
+    host_bits = address_length - parent_length
+    return (network >> host_bits) << host_bits
+
+
+def _size(length: int, address_length: int) -> int:
+    return 1 << (address_length - length)
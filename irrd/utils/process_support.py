@@ -1,6 +1,8 @@
 import logging
 import os
+import resource
 import signal
+import sys
 from multiprocessing import Process
 
 logger = logging.getLogger(__name__)
@@ -15,3 +17,17 @@ class ExceptionLoggingProcess(Process):  # pragma: no cover
             logger.critical(f'Essential IRRd subprocess encountered a fatal error, '
                             f'traceback follows, shutting down: {e}', exc_info=e)
             os.kill(os.getppid(), signal.SIGTERM)
+
+
+def memory_usage() -> int:
+    """
+    Return the resident set size of the current process, in bytes.
+    On platforms without /proc, this is the peak resident set size.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):  # pragma: no cover
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS, in kilobytes elsewhere
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
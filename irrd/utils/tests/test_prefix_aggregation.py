@@ -0,0 +1,72 @@
+import random
+
+from IPy import IP
+
+from ..prefix_aggregation import aggregate_prefixes, aggregate_prefix_ranges
+
+
+def prefixes(*prefixes_str):
+    return [(IP(p).int(), IP(p).prefixlen()) for p in prefixes_str]
+
+
+def test_aggregate_prefixes():
+    assert aggregate_prefixes([], 32) == []
+    assert aggregate_prefixes(prefixes(
+        '192.0.2.0/26', '192.0.2.64/26', '192.0.2.128/25', '192.0.2.128/27',
+        '198.51.100.0/24', '198.51.101.0/24', '203.0.113.1/32', '203.0.113.2/32',
+    ), 32) == prefixes('192.0.2.0/24', '198.51.100.0/23', '203.0.113.1/32', '203.0.113.2/32')
+    assert aggregate_prefixes(prefixes('0.0.0.0/1', '128.0.0.0/1', '192.0.2.0/24'), 32) == prefixes('0.0.0.0/0')
+    assert aggregate_prefixes(prefixes(
+        '2001:db8::/33', '2001:db8:8000::/33', '2001:db8:1::/48',
+    ), 128) == prefixes('2001:db8::/32')
+
+
+def test_aggregate_prefix_ranges():
+    assert aggregate_prefix_ranges([], 32) == []
+    ip = IP('192.0.2.0').int()
+    assert aggregate_prefix_ranges(prefixes(
+        '192.0.2.0/24', '192.0.2.0/25', '192.0.2.128/25',
+        '198.51.100.0/25', '198.51.100.128/25',
+        '203.0.113.0/24', '203.0.113.0/25',
+    ), 32) == [
+        (ip, 24, 24, 25),
+        (IP('198.51.100.0').int(), 24, 25, 25),
+        (IP('203.0.113.0').int(), 24, 24, 24),
+        (IP('203.0.113.0').int(), 25, 25, 25),
+    ]
+    assert aggregate_prefix_ranges(prefixes(
+        '2001:db8::/32', '2001:db8::/33', '2001:db8:8000::/33',
+    ), 128) == [(IP('2001:db8::').int(), 32, 32, 33)]
+
+
+def test_aggregate_prefix_ranges_exact():
+    # The ranges must always match exactly the original prefixes
+    random.seed(42)
+    for _ in range(20):
+        original = set()
+        for _ in range(200):
+            length = random.randint(20, 26)
+            network = (IP('192.0.0.0').int() + random.randint(0, 2 ** 12 - 1) * 2 ** 12) >> (32 - length) << (32 - length)
+            original.add((network, length))
+
+        expanded = set()
+        for network, length, min_length, max_length in aggregate_prefix_ranges(original, 32):
+            for more_specific_length in range(min_length, max_length + 1):
+                step = 2 ** (32 - more_specific_length)
+                for idx in range(2 ** (more_specific_length - length)):
+                    expanded.add((network + idx * step, more_specific_length))
+        assert expanded == original
+
+        # Aggregated prefixes must cover exactly the same address space
+        assert address_space(aggregate_prefixes(original, 32)) == address_space(original)
+
+
+def address_space(prefixes_int):
+    intervals = sorted((network, network + 2 ** (32 - length)) for network, length in prefixes_int)
+    merged = []
+    for start, end in intervals:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
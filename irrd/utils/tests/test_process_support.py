@@ -0,0 +1,7 @@
+from ..process_support import memory_usage
+
+
+def test_memory_usage():
+    usage = memory_usage()
+    # Any Python process uses more than a megabyte, and this test less than 10 GB
+    assert 1024 * 1024 < usage < 10 * 1024 * 1024 * 1024